@@ -0,0 +1,588 @@
+"""
+LLM usage accounting for AI calls.
+
+Every generate/refine request, background job and batch item runs under
+a UsageAccount. UsageCallbackHandler, attached to the agent run as a
+LangChain callback, records each LLM call's model, prompt and completion
+tokens (as reported by the provider, else estimated from the text), time
+to first token and latency, and each tool invocation with its duration.
+
+When the request finishes, its account is saved as one LLMUsageRecord
+for the chat session and user (the session's owner when the request is
+anonymous), priced from AI_MODEL_PRICES. GET /api/ai/usage/ aggregates
+the records. Requests that made no LLM call and were not served from the
+cache (validation errors, local refine edits) are not recorded.
+
+Accounts are context-local, like cancel tokens: views use @accounted,
+jobs and batch items usage_scope(). Streamed responses are saved when
+the stream ends; a stream closed before that counts as cancelled, with
+the calls that had finished by then.
+"""
+
+import contextlib
+import contextvars
+import functools
+import inspect
+import logging
+import re
+import threading
+import time
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db.models import Avg, Count, Max, Q, Sum
+from django.http import StreamingHttpResponse
+from langchain_core.callbacks import BaseCallbackHandler
+
+from chat_sessions.models import Session
+from modules.tokens import count_message_tokens, count_tokens
+
+from .cancellation import HTTP_499_CLIENT_CLOSED_REQUEST, GenerationCancelled
+from .concurrency import request_data
+from .models import LLMUsageRecord
+
+logger = logging.getLogger(__name__)
+
+OK = LLMUsageRecord.OK
+ERROR = LLMUsageRecord.ERROR
+CANCELLED = LLMUsageRecord.CANCELLED
+
+# Recent records listed by usage_summary()
+RECENT_RECORDS = 20
+
+COST_PRECISION = Decimal('0.00000001')
+
+_current_account = contextvars.ContextVar('ai_usage_account', default=None)
+
+
+def accounting_enabled():
+    return getattr(settings, 'AI_USAGE_ACCOUNTING', True)
+
+
+def _ms(seconds):
+    return round(seconds * 1000, 1)
+
+
+class UsageAccount:
+    """LLM calls and tool invocations made on behalf of one request or job."""
+
+    def __init__(self, kind, session_id=None, user_id=None, job_id=None):
+        self.kind = kind
+        self.session_id = str(session_id) if session_id else None
+        self.user_id = user_id
+        self.job_id = str(job_id) if job_id else None
+        self.started = time.monotonic()
+        self.first_token_at = None
+        self.calls = []
+        self.tool_calls = 0
+        self.tool_seconds = 0.0
+        self.cached = False
+        self.streamed = False
+        self.status = None
+        self.total_seconds = None
+        self._lock = threading.Lock()
+
+    def record_call(self, call):
+        with self._lock:
+            self.calls.append(call)
+
+    def record_first_token(self, at):
+        with self._lock:
+            if self.first_token_at is None:
+                self.first_token_at = at
+
+    def record_tool(self, seconds):
+        with self._lock:
+            self.tool_calls += 1
+            self.tool_seconds += seconds
+
+    def fail(self, status):
+        """Record an error or cancellation; the first one seen wins."""
+        with self._lock:
+            if self.status is None:
+                self.status = status
+
+    def close(self, status=OK):
+        """Stop the clock; returns False if the account was already closed."""
+        with self._lock:
+            if self.total_seconds is not None:
+                return False
+            self.total_seconds = time.monotonic() - self.started
+            if self.status is None:
+                self.status = status
+            return True
+
+    @property
+    def worth_recording(self):
+        return bool(self.calls) or self.cached
+
+    def totals(self):
+        with self._lock:
+            calls = list(self.calls)
+            return {
+                'model': calls[-1]['model'] if calls else '',
+                'calls': calls,
+                'llm_calls': len(calls),
+                'prompt_tokens': sum(call['prompt_tokens'] for call in calls),
+                'completion_tokens': sum(call['completion_tokens'] for call in calls),
+                'usage_estimated': any(call['estimated'] for call in calls),
+                'tool_calls': self.tool_calls,
+                'time_to_first_token_ms': (
+                    _ms(self.first_token_at - self.started) if self.first_token_at is not None else None
+                ),
+                'llm_ms': round(sum(call['latency_ms'] for call in calls), 1),
+                'tool_ms': _ms(self.tool_seconds),
+                'total_ms': _ms(self.total_seconds or 0),
+                'cached': self.cached,
+                'streamed': self.streamed,
+                'status': self.status or OK,
+                'cost': usage_cost(calls),
+            }
+
+
+def model_prices():
+    """AI_MODEL_PRICES: {model: [input, output]} in currency units per million tokens."""
+    return getattr(settings, 'AI_MODEL_PRICES', None) or {}
+
+
+def usage_cost(calls, prices=None):
+    """Cost of the given LLM calls, or None when none of their models has a price."""
+    prices = model_prices() if prices is None else prices
+    cost, priced = Decimal(0), False
+    for call in calls:
+        price = prices.get(call['model'])
+        if not price:
+            continue
+        input_price, output_price = (Decimal(str(value)) for value in price)
+        cost += (input_price * call['prompt_tokens'] + output_price * call['completion_tokens']) / 1_000_000
+        priced = True
+    return cost if priced else None
+
+
+def _invocation_model(serialized, invocation_params):
+    params = invocation_params or {}
+    return (
+        params.get('model_name') or params.get('model') or params.get('_type')
+        or (serialized or {}).get('name') or 'unknown'
+    )
+
+
+def _has_output(token, chunk):
+    message = getattr(chunk, 'message', None)
+    return bool(token or getattr(message, 'tool_call_chunks', None))
+
+
+class _PendingCall:
+    def __init__(self, model, messages):
+        self.model = model
+        self.messages = messages
+        self.started = time.monotonic()
+        self.first_token_at = None
+        self.text = []
+
+    def finish(self, message=None, text=None, status=OK):
+        usage = getattr(message, 'usage_metadata', None)
+        metadata = getattr(message, 'response_metadata', None) or {}
+        if usage:
+            prompt_tokens, completion_tokens = usage.get('input_tokens', 0), usage.get('output_tokens', 0)
+        else:
+            # The provider reported no usage, so estimate it from the text
+            text = text if text is not None else ''.join(self.text)
+            prompt_tokens, completion_tokens = count_message_tokens(self.messages), count_tokens(text)
+        return {
+            'model': metadata.get('model_name') or self.model,
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'estimated': not usage,
+            'time_to_first_token_ms': (
+                _ms(self.first_token_at - self.started) if self.first_token_at is not None else None
+            ),
+            'latency_ms': _ms(time.monotonic() - self.started),
+            'status': status,
+        }
+
+
+class UsageCallbackHandler(BaseCallbackHandler):
+    """Records the LLM calls and tool invocations of an agent run into an account."""
+
+    run_inline = True
+
+    def __init__(self, account):
+        self.account = account
+        self._calls = {}
+        self._tools = {}
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, invocation_params=None, **kwargs):
+        self._calls[run_id] = _PendingCall(
+            _invocation_model(serialized, invocation_params), messages[0] if messages else [],
+        )
+
+    def on_llm_new_token(self, token, *, chunk=None, run_id, **kwargs):
+        call = self._calls.get(run_id)
+        if call is None:
+            return
+        call.text.append(token)
+        if call.first_token_at is None and _has_output(token, chunk):
+            call.first_token_at = time.monotonic()
+            self.account.record_first_token(call.first_token_at)
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        call = self._calls.pop(run_id, None)
+        if call is None:
+            return
+        generation = response.generations[0][0] if response.generations and response.generations[0] else None
+        self.account.record_call(call.finish(
+            getattr(generation, 'message', None), getattr(generation, 'text', None),
+        ))
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        # Tokens streamed before the failure were still produced (and billed)
+        call = self._calls.pop(run_id, None)
+        if call is not None:
+            status = CANCELLED if isinstance(error, GenerationCancelled) else ERROR
+            self.account.record_call(call.finish(status=status))
+
+    def on_tool_start(self, serialized, input_str, *, run_id, **kwargs):
+        self._tools[run_id] = time.monotonic()
+
+    def on_tool_end(self, output, *, run_id, **kwargs):
+        started = self._tools.pop(run_id, None)
+        if started is not None:
+            self.account.record_tool(time.monotonic() - started)
+
+    def on_tool_error(self, error, *, run_id, **kwargs):
+        self.on_tool_end(None, run_id=run_id)
+
+    def on_chain_error(self, error, *, parent_run_id=None, **kwargs):
+        if parent_run_id is None:
+            self.account.fail(CANCELLED if isinstance(error, GenerationCancelled) else ERROR)
+
+
+def current_account():
+    return _current_account.get()
+
+
+def accounting_callbacks(account=None):
+    """Callback handlers that record an agent run into the current (or given) account."""
+    account = account or _current_account.get()
+    return [UsageCallbackHandler(account)] if account is not None else []
+
+
+def mark_cached():
+    """Note that the current request was answered without an LLM call of its own."""
+    account = _current_account.get()
+    if account is not None:
+        account.cached = True
+
+
+def _client_user_id(client):
+    """The user id in an admission client key such as "user:12" or "batch:user:12"."""
+    match = re.search(r'(?:^|:)user:(\d+)$', client or '')
+    return int(match.group(1)) if match else None
+
+
+def _request_user_id(request):
+    user = getattr(request, 'user', None)
+    return user.pk if user is not None and user.is_authenticated else None
+
+
+def _session_query(session_id):
+    return Session.objects.filter(pk=session_id).values_list('pk', 'user_id')
+
+
+def _record_fields(account, session):
+    session_id, owner_id = session or (None, None)
+    return {
+        'kind': account.kind,
+        'session_id': session_id,
+        'user_id': account.user_id or owner_id,
+        'job_id': account.job_id,
+        **account.totals(),
+    }
+
+
+def save_account(account):
+    """Persist a closed account as an LLMUsageRecord; never raises."""
+    if not account.worth_recording:
+        return None
+    try:
+        session = None
+        if account.session_id:
+            try:
+                session = _session_query(account.session_id).first()
+            except ValidationError:
+                pass
+        record = LLMUsageRecord.objects.create(**_record_fields(account, session))
+    except Exception:
+        accounting_stats.record(save_failures=1)
+        logger.exception("Could not save LLM usage for %s call", account.kind)
+        return None
+    accounting_stats.record(recorded=1)
+    return record
+
+
+async def asave_account(account):
+    """Async variant of save_account."""
+    if not account.worth_recording:
+        return None
+    try:
+        session = None
+        if account.session_id:
+            try:
+                session = await _session_query(account.session_id).afirst()
+            except ValidationError:
+                pass
+        record = await LLMUsageRecord.objects.acreate(**_record_fields(account, session))
+    except Exception:
+        accounting_stats.record(save_failures=1)
+        logger.exception("Could not save LLM usage for %s call", account.kind)
+        return None
+    accounting_stats.record(recorded=1)
+    return record
+
+
+class AccountingStats:
+    """Usage records saved by this process, and saves that failed."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.recorded = 0
+        self.save_failures = 0
+
+    def record(self, **counts):
+        with self._lock:
+            for name, count in counts.items():
+                setattr(self, name, getattr(self, name) + count)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'enabled': accounting_enabled(),
+                'recorded': self.recorded,
+                'save_failures': self.save_failures,
+            }
+
+
+accounting_stats = AccountingStats()
+
+
+def _error_status(error):
+    return CANCELLED if isinstance(error, GenerationCancelled) else ERROR
+
+
+@contextlib.contextmanager
+def usage_scope(kind, session_id=None, user_id=None, job_id=None, client=None):
+    """
+    Account for the AI calls made in the block and save the account when
+    it exits. `client` is an admission client key to take the user from.
+    """
+    if not accounting_enabled():
+        yield None
+        return
+    account = UsageAccount(
+        kind, session_id=session_id, user_id=user_id or _client_user_id(client), job_id=job_id,
+    )
+    context = _current_account.set(account)
+    status = OK
+    try:
+        yield account
+    except BaseException as error:
+        status = _error_status(error)
+        raise
+    finally:
+        _current_account.reset(context)
+        account.close(status)
+        save_account(account)
+
+
+def _response_status(response):
+    code = getattr(response, 'status_code', 200)
+    if code == HTTP_499_CLIENT_CLOSED_REQUEST:
+        return CANCELLED
+    return ERROR if code >= 400 else OK
+
+
+class _AccountedStream:
+    """Saves the account once a streaming response has been sent (or closed)."""
+
+    def __init__(self, frames, account):
+        self._frames = frames
+        self._account = account
+
+    def __iter__(self):
+        yield from self._frames
+        if self._account.close(OK):
+            save_account(self._account)
+
+    def close(self):
+        # Closed before the stream ended: the client went away
+        if self._account.close(CANCELLED):
+            save_account(self._account)
+        close = getattr(self._frames, 'close', None)
+        if close is not None:
+            close()
+
+
+class _AsyncAccountedStream:
+    def __init__(self, frames, account):
+        self._frames = frames
+        self._account = account
+
+    async def __aiter__(self):
+        completed = False
+        try:
+            async for frame in self._frames:
+                yield frame
+            completed = True
+        finally:
+            if self._account.close(OK if completed else CANCELLED):
+                await asave_account(self._account)
+
+    def close(self):
+        pass
+
+
+def _settle(response, account):
+    """Close the account now, or hand it to the stream for streaming responses."""
+    if isinstance(response, StreamingHttpResponse):
+        account.streamed = True
+        wrapper = _AsyncAccountedStream if response.is_async else _AccountedStream
+        response.streaming_content = wrapper(response.streaming_content, account)
+        return False
+    return account.close(_response_status(response))
+
+
+def accounted(kind):
+    """
+    Decorator for AI view handlers (sync or async) that accounts for the
+    LLM usage of the request as a `kind` call.
+    """
+    def decorator(view_method):
+        def start(request):
+            account = UsageAccount(
+                kind, session_id=request_data(request).get('session'), user_id=_request_user_id(request),
+            )
+            return account, _current_account.set(account)
+
+        if inspect.iscoroutinefunction(view_method):
+            @functools.wraps(view_method)
+            async def async_wrapper(view, request, *args, **kwargs):
+                if not accounting_enabled():
+                    return await view_method(view, request, *args, **kwargs)
+                account, context = start(request)
+                try:
+                    response = await view_method(view, request, *args, **kwargs)
+                except BaseException as error:
+                    account.close(_error_status(error))
+                    await asave_account(account)
+                    raise
+                finally:
+                    _current_account.reset(context)
+                if _settle(response, account):
+                    await asave_account(account)
+                return response
+            return async_wrapper
+
+        @functools.wraps(view_method)
+        def wrapper(view, request, *args, **kwargs):
+            if not accounting_enabled():
+                return view_method(view, request, *args, **kwargs)
+            account, context = start(request)
+            try:
+                response = view_method(view, request, *args, **kwargs)
+            except BaseException as error:
+                account.close(_error_status(error))
+                save_account(account)
+                raise
+            finally:
+                _current_account.reset(context)
+            if _settle(response, account):
+                save_account(account)
+            return response
+        return wrapper
+    return decorator
+
+
+def _rounded(value, digits=1):
+    return round(value, digits) if value is not None else None
+
+
+def _serialize_cost(cost):
+    return str(Decimal(cost).quantize(COST_PRECISION)) if cost is not None else None
+
+
+def serialize_usage_record(record):
+    return {
+        'id': record.pk,
+        'kind': record.kind,
+        'session': str(record.session_id) if record.session_id else None,
+        'user': record.user_id,
+        'job': str(record.job_id) if record.job_id else None,
+        'model': record.model,
+        'llm_calls': record.llm_calls,
+        'prompt_tokens': record.prompt_tokens,
+        'completion_tokens': record.completion_tokens,
+        'usage_estimated': record.usage_estimated,
+        'tool_calls': record.tool_calls,
+        'time_to_first_token_ms': record.time_to_first_token_ms,
+        'llm_ms': record.llm_ms,
+        'tool_ms': record.tool_ms,
+        'total_ms': record.total_ms,
+        'cached': record.cached,
+        'streamed': record.streamed,
+        'status': record.status,
+        'cost': _serialize_cost(record.cost),
+        'calls': record.calls,
+        'created_at': record.created_at.isoformat(),
+    }
+
+
+_AGGREGATES = {
+    'requests': Count('id'),
+    'llm_calls': Sum('llm_calls'),
+    'prompt_tokens': Sum('prompt_tokens'),
+    'completion_tokens': Sum('completion_tokens'),
+    'tool_calls': Sum('tool_calls'),
+    'cost': Sum('cost'),
+}
+
+
+def _group_totals(values):
+    return {
+        **values,
+        'llm_calls': values.get('llm_calls') or 0,
+        'prompt_tokens': values.get('prompt_tokens') or 0,
+        'completion_tokens': values.get('completion_tokens') or 0,
+        'tool_calls': values.get('tool_calls') or 0,
+        'cost': _serialize_cost(values.get('cost')),
+    }
+
+
+def usage_summary(records):
+    """Totals, per-model and per-kind breakdowns and the latest records of a queryset."""
+    totals = records.aggregate(
+        **_AGGREGATES,
+        cached=Count('id', filter=Q(cached=True)),
+        errors=Count('id', filter=Q(status=ERROR)),
+        cancelled=Count('id', filter=Q(status=CANCELLED)),
+        avg_total_ms=Avg('total_ms'),
+        max_total_ms=Max('total_ms'),
+        avg_time_to_first_token_ms=Avg('time_to_first_token_ms'),
+        avg_llm_ms=Avg('llm_ms'),
+    )
+    for name in ('avg_total_ms', 'max_total_ms', 'avg_time_to_first_token_ms', 'avg_llm_ms'):
+        totals[name] = _rounded(totals[name])
+    by_model = records.filter(llm_calls__gt=0).values('model').annotate(
+        **_AGGREGATES, avg_time_to_first_token_ms=Avg('time_to_first_token_ms'),
+    ).order_by('-requests')
+    by_kind = records.values('kind').annotate(**_AGGREGATES).order_by('-requests')
+    return {
+        'totals': _group_totals(totals),
+        'by_model': [
+            {**_group_totals(row), 'avg_time_to_first_token_ms': _rounded(row['avg_time_to_first_token_ms'])}
+            for row in by_model
+        ],
+        'by_kind': [_group_totals(row) for row in by_kind],
+        'recent': [serialize_usage_record(record) for record in records.order_by('-created_at')[:RECENT_RECORDS]],
+    }
@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class AiAgentConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'ai_agent'
+
+    def ready(self):
+        from . import signals  # noqa: F401
@@ -0,0 +1,187 @@
+"""
+Batch document generation.
+
+A batch is a list of prompts (or detail sets rendered into a shared
+prompt), each generated independently through generate_legal_document(),
+so every item gets the response cache, request coalescing and upstream
+resilience of a single request, and all items share the one agent
+executor and its connection pool.
+
+Items run on a thread pool of at most AI_BATCH_MAX_PARALLEL workers, and
+every item takes a slot from the admission controller in the bulk
+priority class, under a separate "batch:" client key, so a large batch
+yields to interactive requests instead of crowding them out. An item
+that cannot get a slot within ADMISSION_WAIT_FACTOR queue timeouts fails
+with a 429-style error rather than waiting forever.
+
+Batches of up to AI_BATCH_SYNC_LIMIT items are answered in the request;
+larger ones are queued as a "batch" AIJob (see ai_agent/jobs.py), so any
+worker process can run them and any web process can report on them.
+"""
+
+import contextvars
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from .accounting import usage_scope
+from .concurrency import AdmissionRejected, get_admission_controller
+from .priority import BULK
+from .reporting import start_report
+from .services import generate_legal_document, warm_agent_executor
+
+# Longest pause before retrying an item the admission queue turned away
+MAX_ADMISSION_BACKOFF = 5
+
+# An item gives up on admission after this many AI_QUEUE_TIMEOUTs
+ADMISSION_WAIT_FACTOR = 4
+
+
+class BatchValidationError(ValueError):
+    """The batch payload is malformed; the message is safe to show clients."""
+
+
+def build_batch_items(items, prompt=None):
+    """
+    Normalize the request's items into [{"id", "prompt"}, ...].
+
+    An item is a prompt string, {"prompt": "..."} or {"details": {...}}.
+    Details are appended to the item's prompt, or to the shared top-level
+    prompt, as a bullet list. Items may carry an "id" that is echoed back.
+    """
+    if not isinstance(items, list) or not items:
+        raise BatchValidationError('items must be a non-empty list.')
+    max_items = getattr(settings, 'AI_BATCH_MAX_ITEMS', 50)
+    if len(items) > max_items:
+        raise BatchValidationError(f'A batch may contain at most {max_items} items.')
+
+    normalized = []
+    for index, item in enumerate(items):
+        if isinstance(item, str):
+            item = {'prompt': item}
+        if not isinstance(item, dict):
+            raise BatchValidationError(f'Item {index} must be a string or an object.')
+        details = item.get('details') or {}
+        if not isinstance(details, dict):
+            raise BatchValidationError(f'Item {index}: details must be an object.')
+        item_prompt = item.get('prompt') or prompt
+        if not item_prompt:
+            raise BatchValidationError(f'Item {index} has no prompt and the batch has no shared prompt.')
+        if details:
+            lines = '\n'.join(f"- {key.replace('_', ' ')}: {value}" for key, value in details.items())
+            item_prompt = f"{item_prompt}\n\nUse these details:\n{lines}"
+        normalized.append({'id': item.get('id', index), 'prompt': item_prompt})
+    return normalized
+
+
+def _admitted(client, fn):
+    """
+    Run fn() holding an admission slot, waiting out 429s for a while.
+
+    Raises:
+        AdmissionRejected: if no slot was granted within
+            ADMISSION_WAIT_FACTOR * AI_QUEUE_TIMEOUT seconds
+    """
+    controller = get_admission_controller()
+    if controller is None:
+        return fn()
+    deadline = time.monotonic() + ADMISSION_WAIT_FACTOR * getattr(settings, 'AI_QUEUE_TIMEOUT', 30)
+    while True:
+        try:
+            slot = controller.acquire(client, BULK)
+            break
+        except AdmissionRejected as error:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise
+            time.sleep(min(error.retry_after, MAX_ADMISSION_BACKOFF, remaining))
+    try:
+        return fn()
+    finally:
+        slot.release()
+
+
+def _generate_item(index, item, client, use_cache):
+    call_report = start_report()
+    started = time.monotonic()
+
+    def generate():
+        with usage_scope('batch', client=client):
+            return generate_legal_document(item['prompt'], use_cache=use_cache)
+
+    try:
+        result = _admitted(client, generate)
+        outcome = {'status': 'ok', 'result': result}
+    except AdmissionRejected as error:
+        outcome = {
+            'status': 'error',
+            'error': f"{error.reason}, please retry later.",
+            'status_code': 429,
+            'retry_after': error.retry_after,
+        }
+    except Exception as e:
+        outcome = {'status': 'error', 'error': str(e)}
+    finally:
+        close_old_connections()
+    return {
+        'index': index,
+        'id': item['id'],
+        **outcome,
+        'elapsed_ms': round((time.monotonic() - started) * 1000, 1),
+        'report': call_report,
+    }
+
+
+def run_batch(items, client, use_cache=True, max_parallel=None, on_result=None):
+    """
+    Generate every item with bounded parallelism.
+
+    Args:
+        items (list): Output of build_batch_items()
+        client (str): Admission fairness key of the caller
+        use_cache (bool): Serve and store items through the response cache
+        max_parallel (int): Worker count, capped at AI_BATCH_MAX_PARALLEL
+        on_result (callable): Called with each item result as it finishes
+
+    Returns:
+        dict: {"results": [...] in item order, "summary": {...}}
+    """
+    # Resolve the shared executor once so workers never race to build it,
+    # and a missing API key fails the batch rather than every item
+    warm_agent_executor()
+
+    limit = getattr(settings, 'AI_BATCH_MAX_PARALLEL', 4)
+    workers = max(1, min(max_parallel or limit, limit, len(items)))
+    batch_client = f"batch:{client}"
+    results = [None] * len(items)
+    started = time.monotonic()
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='ai-batch') as pool:
+        futures = [
+            # Items inherit the caller's context, e.g. a job's cancel token
+            pool.submit(contextvars.copy_context().run, _generate_item, index, item, batch_client, use_cache)
+            for index, item in enumerate(items)
+        ]
+        for future in as_completed(futures):
+            result = future.result()
+            results[result['index']] = result
+            if on_result is not None:
+                on_result(result)
+
+    return {'results': results, 'summary': _summarize(results, time.monotonic() - started, workers)}
+
+
+def _summarize(results, elapsed, workers):
+    finished = [result for result in results if result is not None]
+    item_ms = sorted(result['elapsed_ms'] for result in finished)
+    return {
+        'items': len(results),
+        'succeeded': sum(1 for result in finished if result['status'] == 'ok'),
+        'failed': sum(1 for result in finished if result['status'] == 'error'),
+        'parallelism': workers,
+        'elapsed_ms': round(elapsed * 1000, 1),
+        'item_ms_p50': item_ms[len(item_ms) // 2] if item_ms else None,
+        'item_ms_max': item_ms[-1] if item_ms else None,
+    }
@@ -0,0 +1,368 @@
+"""
+Cancellation of in-flight AI calls.
+
+Every generate/refine call served by a view or a job worker runs under a
+CancelToken, registered by chat session and job id. A token is cancelled
+when:
+
+- the client disconnects from a streamed response (or, under ASGI, from
+  any async request),
+- a different generate request arrives for the same session
+  (superseded); an identical one (a retry or double-click) leaves the
+  running call alone, so it can share that call's result,
+- POST /api/ai/sessions/<id>/cancel/ or /api/ai/jobs/<id>/cancel/ is called.
+
+CancellationHandler, attached to the agent run as a LangChain callback,
+raises GenerationCancelled at the next LLM token, LLM call or tool call
+after cancellation. Because the LLM is streamed, that closes the
+underlying HTTP response mid-generation, so the provider stops producing
+(and billing) tokens, and the worker thread is freed.
+
+GenerationCancelled derives from BaseException, like
+asyncio.CancelledError, so tool error handling, retries, circuit breakers
+and the views' generic `except Exception` blocks let it through.
+"""
+
+import asyncio
+import contextlib
+import contextvars
+import functools
+import hashlib
+import inspect
+import json
+import threading
+from collections import defaultdict
+
+from django.http import JsonResponse, StreamingHttpResponse
+from langchain_core.callbacks import BaseCallbackHandler
+
+from .concurrency import request_data
+
+CLIENT_DISCONNECTED = 'client_disconnected'
+SUPERSEDED = 'superseded'
+CANCELLED = 'cancelled'
+CANCEL_REASONS = (CLIENT_DISCONNECTED, SUPERSEDED, CANCELLED)
+
+# Non-standard status (nginx's "client closed request") for cancelled calls
+HTTP_499_CLIENT_CLOSED_REQUEST = 499
+
+_current_token = contextvars.ContextVar('ai_cancel_token', default=None)
+
+# Body fields that decide what a generate/refine request computes
+_REQUEST_FIELDS = ('prompt', 'conversation_history', 'current_draft', 'user_request', 'mode')
+
+
+class GenerationCancelled(BaseException):
+    """Raised inside an agent run whose CancelToken was cancelled."""
+
+    def __init__(self, reason):
+        super().__init__(f"Generation cancelled ({reason})")
+        self.reason = reason
+
+
+def request_key(data):
+    """Digest of the fields of a request body that decide its result."""
+    payload = json.dumps({field: data.get(field) for field in _REQUEST_FIELDS}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class CancelToken:
+    def __init__(self, session_id=None, job_id=None, request_key=None):
+        self.session_id = str(session_id) if session_id else None
+        self.job_id = str(job_id) if job_id else None
+        self.request_key = request_key
+        self.reason = None
+        self.tokens_generated = 0
+        self.finished = False
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def cancel(self, reason=CANCELLED):
+        """Cancel the call; returns False if it had already finished or been cancelled."""
+        with self._lock:
+            if self.finished or self._event.is_set():
+                return False
+            self.reason = reason
+            self._event.set()
+        cancellation_stats.record_cancel(reason, self.tokens_generated)
+        return True
+
+    def finish(self):
+        with self._lock:
+            self.finished = True
+
+    def check(self):
+        if self._event.is_set():
+            raise GenerationCancelled(self.reason)
+
+
+class CancellationStats:
+    """Cancelled calls per reason and an estimate of the tokens they saved."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.cancelled = dict.fromkeys(CANCEL_REASONS, 0)
+        self.tokens_generated_before_cancel = 0
+        self.estimated_tokens_saved = 0
+        self.completed_runs = 0
+        self.completed_run_tokens = 0
+
+    def _average_run_tokens(self):
+        return self.completed_run_tokens / self.completed_runs if self.completed_runs else 0
+
+    def record_completion(self, tokens):
+        with self._lock:
+            self.completed_runs += 1
+            self.completed_run_tokens += tokens
+
+    def record_cancel(self, reason, tokens_generated):
+        with self._lock:
+            self.cancelled[reason] += 1
+            self.tokens_generated_before_cancel += tokens_generated
+            # A cancelled run would have produced about as much as an average completed one
+            self.estimated_tokens_saved += max(round(self._average_run_tokens()) - tokens_generated, 0)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'cancelled': sum(self.cancelled.values()),
+                'by_reason': dict(self.cancelled),
+                'tokens_generated_before_cancel': self.tokens_generated_before_cancel,
+                'estimated_tokens_saved': self.estimated_tokens_saved,
+                'avg_completed_run_tokens': round(self._average_run_tokens(), 1),
+            }
+
+
+cancellation_stats = CancellationStats()
+
+
+class CancellationRegistry:
+    """In-flight tokens of this process, by session and job."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._by_key = defaultdict(set)
+
+    @staticmethod
+    def _keys(token):
+        keys = []
+        if token.session_id:
+            keys.append(f"session:{token.session_id}")
+        if token.job_id:
+            keys.append(f"job:{token.job_id}")
+        return keys
+
+    def register(self, token, supersede=False):
+        """
+        Track token; with supersede, first cancel the calls for its session
+        that were made for a different request.
+        """
+        if supersede and token.session_id:
+            self._cancel(f"session:{token.session_id}", SUPERSEDED, keep=token.request_key)
+        with self._lock:
+            for key in self._keys(token):
+                self._by_key[key].add(token)
+
+    def unregister(self, token):
+        token.finish()
+        with self._lock:
+            for key in self._keys(token):
+                tokens = self._by_key.get(key)
+                if tokens is not None:
+                    tokens.discard(token)
+                    if not tokens:
+                        del self._by_key[key]
+
+    def _cancel(self, key, reason, keep=None):
+        with self._lock:
+            tokens = [
+                token for token in self._by_key.get(key, ())
+                if keep is None or token.request_key != keep
+            ]
+        return sum(1 for token in tokens if token.cancel(reason))
+
+    def cancel_session(self, session_id, reason=CANCELLED):
+        """Cancel every in-flight call for a session; returns how many were cancelled."""
+        return self._cancel(f"session:{session_id}", reason)
+
+    def cancel_job(self, job_id, reason=CANCELLED):
+        return self._cancel(f"job:{job_id}", reason)
+
+    def in_flight(self):
+        with self._lock:
+            return len({token for tokens in self._by_key.values() for token in tokens})
+
+
+cancellations = CancellationRegistry()
+
+
+class CancellationHandler(BaseCallbackHandler):
+    """Aborts the agent run at the next callback once its token is cancelled."""
+
+    raise_error = True
+    run_inline = True
+
+    def __init__(self, token):
+        self.token = token
+
+    def on_llm_start(self, serialized, prompts, **kwargs):
+        self.token.check()
+
+    def on_chat_model_start(self, serialized, messages, **kwargs):
+        self.token.check()
+
+    def on_llm_new_token(self, token, **kwargs):
+        self.token.tokens_generated += 1
+        self.token.check()
+
+    def on_tool_start(self, serialized, input_str, **kwargs):
+        self.token.check()
+
+    def on_agent_action(self, action, **kwargs):
+        self.token.check()
+
+    def on_chain_end(self, outputs, *, parent_run_id=None, **kwargs):
+        if parent_run_id is None and not self.token.cancelled:
+            cancellation_stats.record_completion(self.token.tokens_generated)
+
+
+def current_cancel_token():
+    return _current_token.get()
+
+
+@contextlib.contextmanager
+def cancel_scope(token):
+    """Register token and make it current for the AI calls made in the block."""
+    cancellations.register(token)
+    context = _current_token.set(token)
+    try:
+        yield token
+    finally:
+        _current_token.reset(context)
+        cancellations.unregister(token)
+
+
+def cancellation_callbacks(token=None):
+    """Callback handlers that make an agent run honour the current (or given) token."""
+    token = token or _current_token.get()
+    return [CancellationHandler(token)] if token is not None else []
+
+
+def cancelled_response(error):
+    return JsonResponse(
+        {'error': 'Generation cancelled.', 'reason': error.reason},
+        status=HTTP_499_CLIENT_CLOSED_REQUEST,
+        reason='Client Closed Request',
+    )
+
+
+class _CancellableStream:
+    """Cancels the call if a streamed response is closed before it finishes."""
+
+    def __init__(self, frames, token):
+        self._frames = frames
+        self._token = token
+
+    def __iter__(self):
+        yield from self._frames
+        cancellations.unregister(self._token)
+
+    def close(self):
+        # Django closes the response on disconnect too; unfinished means the client left
+        self._token.cancel(CLIENT_DISCONNECTED)
+        cancellations.unregister(self._token)
+        close = getattr(self._frames, 'close', None)
+        if close is not None:
+            close()
+
+
+class _AsyncCancellableStream:
+    def __init__(self, frames, token):
+        self._frames = frames
+        self._token = token
+
+    async def __aiter__(self):
+        completed = False
+        try:
+            async for frame in self._frames:
+                yield frame
+            completed = True
+        finally:
+            if not completed:
+                # Closed or cancelled mid-stream: the client went away
+                self._token.cancel(CLIENT_DISCONNECTED)
+                aclose = getattr(self._frames, 'aclose', None)
+                if aclose is not None:
+                    await aclose()
+            cancellations.unregister(self._token)
+
+    def close(self):
+        self._token.cancel(CLIENT_DISCONNECTED)
+        cancellations.unregister(self._token)
+
+
+def _hand_over(response, token):
+    """Unregister the token now, or when the stream ends for streaming responses."""
+    if isinstance(response, StreamingHttpResponse):
+        wrapper = _AsyncCancellableStream if response.is_async else _CancellableStream
+        response.streaming_content = wrapper(response.streaming_content, token)
+    else:
+        cancellations.unregister(token)
+    return response
+
+
+def cancellable(view_method=None, *, supersede=False):
+    """
+    Decorator for AI view handlers (sync or async) that runs them under a
+    CancelToken for the request's session. With supersede=True a new
+    request cancels calls still running for the same session, unless they
+    were made for an identical request.
+    """
+    if view_method is None:
+        return functools.partial(cancellable, supersede=supersede)
+
+    def start(request):
+        data = request_data(request)
+        token = CancelToken(session_id=data.get('session'), request_key=request_key(data))
+        cancellations.register(token, supersede=supersede)
+        return token, _current_token.set(token)
+
+    if inspect.iscoroutinefunction(view_method):
+        @functools.wraps(view_method)
+        async def async_wrapper(view, request, *args, **kwargs):
+            token, context = start(request)
+            try:
+                response = await view_method(view, request, *args, **kwargs)
+            except GenerationCancelled as error:
+                response = cancelled_response(error)
+            except asyncio.CancelledError:
+                # Under ASGI the view task is cancelled when the client disconnects
+                token.cancel(CLIENT_DISCONNECTED)
+                cancellations.unregister(token)
+                raise
+            except BaseException:
+                cancellations.unregister(token)
+                raise
+            finally:
+                _current_token.reset(context)
+            return _hand_over(response, token)
+        return async_wrapper
+
+    @functools.wraps(view_method)
+    def wrapper(view, request, *args, **kwargs):
+        token, context = start(request)
+        try:
+            response = view_method(view, request, *args, **kwargs)
+        except GenerationCancelled as error:
+            response = cancelled_response(error)
+        except BaseException:
+            cancellations.unregister(token)
+            raise
+        finally:
+            _current_token.reset(context)
+        return _hand_over(response, token)
+    return wrapper
@@ -0,0 +1,522 @@
+"""
+Admission control for AI endpoints.
+
+Only AI_MAX_CONCURRENT_CALLS requests run LLM work at once. Further
+requests wait in bounded queues, one per priority class (interactive,
+background, bulk), served by weighted round robin across classes and
+round-robin per client within a class, so neither a batch nor a single
+client can monopolize the model. When a queue (or a client's share of it)
+is full, or a request waits longer than AI_QUEUE_TIMEOUT, it is rejected
+immediately with 429 and a Retry-After estimate instead of tying up a
+worker that CRUD endpoints need.
+
+Both thread-based (DRF) and async views share one controller: sync waiters
+block on a threading.Event, async waiters await a future on their loop.
+"""
+
+import asyncio
+import functools
+import inspect
+import json
+import math
+import threading
+import time
+from collections import OrderedDict, deque
+
+from django.conf import settings
+from django.http import JsonResponse, StreamingHttpResponse
+from rest_framework import status
+
+from .priority import (
+    INTERACTIVE,
+    PRIORITY_CLASSES,
+    InvalidPriority,
+    WeightedPicker,
+    normalize_priority,
+    priority_weights,
+)
+
+# Number of recent queue waits kept for percentiles
+WAIT_SAMPLES = 1000
+
+
+class AdmissionRejected(Exception):
+    """Raised when a request cannot be admitted; carries a Retry-After hint."""
+
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class _Ticket:
+    """A queued request waiting for a slot."""
+
+    def __init__(self, client, priority, loop=None):
+        self.client = client
+        self.priority = priority
+        self.enqueued_at = time.monotonic()
+        self.granted = False
+        self.loop = loop
+        if loop is None:
+            self.event = threading.Event()
+        else:
+            self.future = loop.create_future()
+
+    def grant(self):
+        self.granted = True
+        if self.loop is None:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(self._resolve)
+
+    def _resolve(self):
+        if not self.future.done():
+            self.future.set_result(None)
+
+
+class Slot:
+    """An admitted request. release() is idempotent."""
+
+    def __init__(self, controller, priority):
+        self._controller = controller
+        self.priority = priority
+        self._started = time.monotonic()
+        self._lock = threading.Lock()
+        self._released = False
+
+    def release(self):
+        with self._lock:
+            if self._released:
+                return
+            self._released = True
+        self._controller._release(time.monotonic() - self._started, self.priority)
+
+
+def _percentile(samples, fraction):
+    if not samples:
+        return 0.0
+    samples = sorted(samples)
+    return round(samples[min(int(fraction * len(samples)), len(samples) - 1)] * 1000, 1)
+
+
+class AdmissionController:
+    """
+    Bounded LLM concurrency with fair, bounded wait queues per priority class.
+
+    Waiting classes are served by weighted round robin (see priority.py),
+    clients within a class round-robin. reserved_interactive slots are only
+    ever given to interactive requests, so a burst of batch work cannot
+    occupy every slot while a chat turn waits.
+    """
+
+    def __init__(self, max_concurrent=4, max_queue=16, max_queued_per_client=4, queue_timeout=30.0,
+                 weights=None, reserved_interactive=0, starvation_after=None):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.max_queued_per_client = max_queued_per_client
+        self.queue_timeout = queue_timeout
+        # Always leave other classes at least one slot
+        self.reserved_interactive = max(0, min(reserved_interactive, max_concurrent - 1))
+        self.starvation_after = starvation_after
+        self._picker = WeightedPicker(weights)
+        self._lock = threading.Lock()
+        # class -> client -> deque of tickets, clients in round-robin order
+        self._queues = {cls: OrderedDict() for cls in PRIORITY_CLASSES}
+        self._queued = dict.fromkeys(PRIORITY_CLASSES, 0)
+        self._in_flight = dict.fromkeys(PRIORITY_CLASSES, 0)
+        self._waits = deque(maxlen=WAIT_SAMPLES)
+        self._class_waits = {cls: deque(maxlen=WAIT_SAMPLES) for cls in PRIORITY_CLASSES}
+        self._service_time = None  # EWMA of seconds a slot is held
+        self.admitted = dict.fromkeys(PRIORITY_CLASSES, 0)
+        self.queued_total = 0
+        self.rejected_queue_full = 0
+        self.rejected_timeout = 0
+        self.starvation_promotions = 0
+        self.max_queue_depth_seen = 0
+        self.total_wait = 0.0
+
+    def _retry_after(self):
+        """Seconds until a new request would likely be admitted."""
+        if self._service_time is None:
+            return max(1, math.ceil(self.queue_timeout))
+        backlog = (sum(self._queued.values()) + 1) / max(self.max_concurrent, 1)
+        return max(1, math.ceil(self._service_time * backlog))
+
+    def _has_capacity(self, priority):
+        in_flight = sum(self._in_flight.values())
+        if in_flight >= self.max_concurrent:
+            return False
+        if priority == INTERACTIVE:
+            return True
+        return in_flight - self._in_flight[INTERACTIVE] < self.max_concurrent - self.reserved_interactive
+
+    def _eligible_classes(self):
+        """Classes with waiters that a free slot could be given to."""
+        return [cls for cls in PRIORITY_CLASSES if self._queued[cls] and self._has_capacity(cls)]
+
+    def _record_admission(self, priority, wait):
+        self.admitted[priority] += 1
+        self._waits.append(wait)
+        self._class_waits[priority].append(wait)
+
+    def _try_admit(self, client, priority, loop=None):
+        """Admit immediately (returns None) or enqueue and return a ticket."""
+        with self._lock:
+            if self._has_capacity(priority) and not self._eligible_classes():
+                self._in_flight[priority] += 1
+                self._record_admission(priority, 0.0)
+                return None
+            client_queue = self._queues[priority].get(client)
+            if self._queued[priority] >= self.max_queue or (
+                client_queue is not None and len(client_queue) >= self.max_queued_per_client
+            ):
+                self.rejected_queue_full += 1
+                raise AdmissionRejected('AI queue is full', self._retry_after())
+            ticket = _Ticket(client, priority, loop)
+            self._queues[priority].setdefault(client, deque()).append(ticket)
+            self._queued[priority] += 1
+            self.queued_total += 1
+            self.max_queue_depth_seen = max(self.max_queue_depth_seen, sum(self._queued.values()))
+            return ticket
+
+    def _admitted_after_wait(self, ticket):
+        wait = time.monotonic() - ticket.enqueued_at
+        with self._lock:
+            self.total_wait += wait
+            self._record_admission(ticket.priority, wait)
+        return Slot(self, ticket.priority)
+
+    def _abandon(self, ticket):
+        """
+        Take a waiting ticket out of the queue. Returns True if it had been
+        granted a slot in the meantime, which the caller then owns.
+        """
+        with self._lock:
+            if ticket.granted:
+                return True
+            queues = self._queues[ticket.priority]
+            client_queue = queues.get(ticket.client)
+            if client_queue is not None and ticket in client_queue:
+                client_queue.remove(ticket)
+                self._queued[ticket.priority] -= 1
+                if not client_queue:
+                    del queues[ticket.client]
+            return False
+
+    def _timed_out(self, ticket):
+        if self._abandon(ticket):
+            return self._admitted_after_wait(ticket)
+        with self._lock:
+            self.rejected_timeout += 1
+            retry_after = self._retry_after()
+        raise AdmissionRejected('Timed out waiting for an AI slot', retry_after)
+
+    def acquire(self, client, priority=INTERACTIVE):
+        """
+        Block until the request may call the LLM.
+
+        Raises:
+            AdmissionRejected: if the queue is full or the wait times out
+        """
+        ticket = self._try_admit(client, priority)
+        if ticket is None:
+            return Slot(self, priority)
+        if ticket.event.wait(self.queue_timeout):
+            return self._admitted_after_wait(ticket)
+        return self._timed_out(ticket)
+
+    async def aacquire(self, client, priority=INTERACTIVE):
+        """Async variant of acquire() that waits without holding a thread."""
+        ticket = self._try_admit(client, priority, asyncio.get_running_loop())
+        if ticket is None:
+            return Slot(self, priority)
+        try:
+            await asyncio.wait_for(asyncio.shield(ticket.future), self.queue_timeout)
+        except asyncio.TimeoutError:
+            return self._timed_out(ticket)
+        except asyncio.CancelledError:
+            # Client went away while queued; hand back a slot granted meanwhile
+            if self._abandon(ticket):
+                self._release(None, priority)
+            raise
+        return self._admitted_after_wait(ticket)
+
+    def _starving(self, classes):
+        """(class, client) of the oldest waiter past starvation_after, if any."""
+        if not self.starvation_after:
+            return None
+        now = time.monotonic()
+        oldest = None
+        for cls in classes:
+            for client, client_queue in self._queues[cls].items():
+                waited = now - client_queue[0].enqueued_at
+                if waited >= self.starvation_after and (oldest is None or waited > oldest[0]):
+                    oldest = (waited, cls, client)
+        return oldest[1:] if oldest else None
+
+    def _dispatch(self):
+        """Hand free slots to waiters: starving ones first, then by weight."""
+        while True:
+            eligible = self._eligible_classes()
+            if not eligible:
+                return
+            starving = self._starving(eligible)
+            if starving is not None:
+                cls, client = starving
+                self.starvation_promotions += 1
+                client_queue = self._queues[cls].pop(client)
+            else:
+                cls = self._picker.pick(eligible)
+                # Round-robin: serve the next client, then move it to the back
+                client, client_queue = self._queues[cls].popitem(last=False)
+            ticket = client_queue.popleft()
+            if client_queue:
+                self._queues[cls][client] = client_queue
+            self._queued[cls] -= 1
+            self._in_flight[cls] += 1
+            ticket.grant()
+
+    def _release(self, held_for, priority):
+        with self._lock:
+            # held_for is None for a slot handed back unused
+            if held_for is not None:
+                self._service_time = (
+                    held_for if self._service_time is None
+                    else 0.8 * self._service_time + 0.2 * held_for
+                )
+            self._in_flight[priority] -= 1
+            self._dispatch()
+
+    def stats(self):
+        with self._lock:
+            queued = sum(self._queued.values())
+            queued_admissions = self.queued_total - queued - self.rejected_timeout
+            return {
+                'max_concurrent': self.max_concurrent,
+                'max_queue': self.max_queue,
+                'reserved_interactive': self.reserved_interactive,
+                'in_flight': sum(self._in_flight.values()),
+                'queue_depth': queued,
+                'max_queue_depth_seen': self.max_queue_depth_seen,
+                'queued_clients': sum(len(queues) for queues in self._queues.values()),
+                'admitted': sum(self.admitted.values()),
+                'queued_total': self.queued_total,
+                'rejected_queue_full': self.rejected_queue_full,
+                'rejected_timeout': self.rejected_timeout,
+                'starvation_promotions': self.starvation_promotions,
+                'avg_queued_wait_ms': (
+                    round(self.total_wait / queued_admissions * 1000, 1) if queued_admissions > 0 else 0.0
+                ),
+                'wait_p50_ms': _percentile(self._waits, 0.5),
+                'wait_p95_ms': _percentile(self._waits, 0.95),
+                'avg_service_ms': (
+                    round(self._service_time * 1000, 1) if self._service_time is not None else None
+                ),
+                'classes': {
+                    cls: {
+                        'weight': self._picker.weights[cls],
+                        'in_flight': self._in_flight[cls],
+                        'queue_depth': self._queued[cls],
+                        'admitted': self.admitted[cls],
+                        'wait_p50_ms': _percentile(self._class_waits[cls], 0.5),
+                        'wait_p95_ms': _percentile(self._class_waits[cls], 0.95),
+                    }
+                    for cls in PRIORITY_CLASSES
+                },
+            }
+
+
+_admission_controller = None
+_admission_lock = threading.Lock()
+
+
+def get_admission_controller():
+    """Return the process-wide controller, or None if AI_MAX_CONCURRENT_CALLS is 0."""
+    global _admission_controller
+    max_concurrent = getattr(settings, 'AI_MAX_CONCURRENT_CALLS', 0)
+    if max_concurrent <= 0:
+        return None
+    with _admission_lock:
+        if _admission_controller is None:
+            _admission_controller = AdmissionController(
+                max_concurrent=max_concurrent,
+                max_queue=getattr(settings, 'AI_MAX_QUEUED_CALLS', 16),
+                max_queued_per_client=getattr(settings, 'AI_MAX_QUEUED_PER_CLIENT', 4),
+                queue_timeout=getattr(settings, 'AI_QUEUE_TIMEOUT', 30),
+                weights=priority_weights(),
+                reserved_interactive=getattr(settings, 'AI_INTERACTIVE_RESERVED_SLOTS', 1),
+                starvation_after=getattr(settings, 'AI_PRIORITY_STARVATION_AFTER', 10),
+            )
+        return _admission_controller
+
+
+def reset_admission_controller():
+    """Drop the controller so it is rebuilt from current settings."""
+    global _admission_controller
+    with _admission_lock:
+        _admission_controller = None
+
+
+def get_admission_stats():
+    controller = get_admission_controller()
+    return controller.stats() if controller is not None else {'enabled': False}
+
+
+def client_address(request):
+    """
+    The client's IP address: REMOTE_ADDR, or behind AI_TRUSTED_PROXY_COUNT
+    reverse proxies the X-Forwarded-For entry added by the outermost one.
+    Entries left of it are client-supplied and never trusted.
+    """
+    proxies = getattr(settings, 'AI_TRUSTED_PROXY_COUNT', 0)
+    if proxies > 0:
+        forwarded = [part.strip() for part in request.META.get('HTTP_X_FORWARDED_FOR', '').split(',')]
+        if len(forwarded) >= proxies and forwarded[-proxies]:
+            return forwarded[-proxies]
+    return request.META.get('REMOTE_ADDR', '')
+
+
+def client_key(request):
+    """Fairness key: the authenticated user, else the client address."""
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated:
+        return f"user:{user.pk}"
+    return f"ip:{client_address(request)}"
+
+
+def request_data(request):
+    """The parsed body of a DRF request, or the JSON body of a plain Django request."""
+    data = getattr(request, 'data', None)
+    if data is None:
+        try:
+            data = json.loads(request.body or b'{}')
+        except (ValueError, UnicodeDecodeError):
+            data = {}
+    return data if hasattr(data, 'get') else {}
+
+
+def request_priority(request):
+    """
+    Priority class asked for by the client: the X-AI-Priority header or a
+    "priority" field in the JSON body, defaulting to interactive.
+
+    Raises:
+        InvalidPriority: for an unknown class
+    """
+    value = request.headers.get('X-AI-Priority')
+    if value is None:
+        value = request_data(request).get('priority')
+    return normalize_priority(value, INTERACTIVE)
+
+
+def invalid_priority_response(error):
+    return JsonResponse({'error': str(error)}, status=status.HTTP_400_BAD_REQUEST)
+
+
+def busy_response(error):
+    response = JsonResponse(
+        {'error': f"{error.reason}, please retry later.", 'retry_after': error.retry_after},
+        status=status.HTTP_429_TOO_MANY_REQUESTS,
+    )
+    response['Retry-After'] = str(error.retry_after)
+    return response
+
+
+class _SlotStream:
+    """Holds the slot for as long as a streaming response is being sent."""
+
+    def __init__(self, frames, slot):
+        self._frames = frames
+        self._slot = slot
+
+    def __iter__(self):
+        try:
+            yield from self._frames
+        finally:
+            self._slot.release()
+
+    def close(self):
+        # Django closes the response even if it was never iterated
+        self._slot.release()
+        close = getattr(self._frames, 'close', None)
+        if close is not None:
+            close()
+
+
+class _AsyncSlotStream:
+    """Async counterpart of _SlotStream."""
+
+    def __init__(self, frames, slot):
+        self._frames = frames
+        self._slot = slot
+
+    async def __aiter__(self):
+        try:
+            async for frame in self._frames:
+                yield frame
+        finally:
+            self._slot.release()
+
+    def close(self):
+        self._slot.release()
+
+
+def _hold_until_done(response, slot):
+    """Release the slot now, or after the stream for streaming responses."""
+    if isinstance(response, StreamingHttpResponse):
+        wrapper = _AsyncSlotStream if response.is_async else _SlotStream
+        response.streaming_content = wrapper(response.streaming_content, slot)
+    else:
+        slot.release()
+    return response
+
+
+def admission_controlled(view_method):
+    """
+    Decorator for AI view handlers (sync or async) that runs them under the
+    admission controller in the request's priority class and answers 429
+    when the request is not admitted.
+    """
+    if inspect.iscoroutinefunction(view_method):
+        @functools.wraps(view_method)
+        async def async_wrapper(view, request, *args, **kwargs):
+            controller = get_admission_controller()
+            if controller is None:
+                return await view_method(view, request, *args, **kwargs)
+            try:
+                priority = request_priority(request)
+            except InvalidPriority as error:
+                return invalid_priority_response(error)
+            try:
+                slot = await controller.aacquire(client_key(request), priority)
+            except AdmissionRejected as error:
+                return busy_response(error)
+            try:
+                response = await view_method(view, request, *args, **kwargs)
+            except BaseException:
+                slot.release()
+                raise
+            return _hold_until_done(response, slot)
+        return async_wrapper
+
+    @functools.wraps(view_method)
+    def wrapper(view, request, *args, **kwargs):
+        controller = get_admission_controller()
+        if controller is None:
+            return view_method(view, request, *args, **kwargs)
+        try:
+            priority = request_priority(request)
+        except InvalidPriority as error:
+            return invalid_priority_response(error)
+        try:
+            slot = controller.acquire(client_key(request), priority)
+        except AdmissionRejected as error:
+            return busy_response(error)
+        try:
+            response = view_method(view, request, *args, **kwargs)
+        except BaseException:
+            slot.release()
+            raise
+        return _hold_until_done(response, slot)
+    return wrapper
@@ -0,0 +1,356 @@
+"""
+Server-side conversation history for AI calls.
+
+Instead of clients re-sending the whole conversation every turn, the AI
+endpoints can take a session id and read its messages from the database.
+The converted LangChain message list is cached in-process and kept up to
+date incrementally by the Message save/delete signals (see signals.py).
+
+Histories are then fitted to a token budget: the most recent turns are
+kept verbatim and older turns are folded into a rolling summary stored on
+the chat session.
+"""
+
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+
+from chat.models import Message
+from chat_sessions.models import Session
+from modules.tokens import count_message_tokens, count_tokens
+
+from .reporting import report
+
+
+class SessionNotFound(Exception):
+    """Raised when a session id does not match any chat session."""
+
+
+def to_langchain_message(role, content):
+    if role == 'user':
+        return HumanMessage(content=content)
+    if role == 'assistant':
+        return AIMessage(content=content)
+    return None
+
+
+class SessionHistoryCache:
+    """
+    Thread-safe LRU of converted message lists keyed by session id.
+
+    A per-session generation counter is bumped on every append or
+    invalidation, so a database load that raced with a concurrent save is
+    returned to its caller but not cached.
+    """
+
+    def __init__(self, max_sessions=256):
+        self.max_sessions = max_sessions
+        self._lock = threading.Lock()
+        self._sessions = OrderedDict()
+        self._generations = {}
+        self.hits = 0
+        self.misses = 0
+        self.appends = 0
+        self.invalidations = 0
+
+    def get(self, session_id):
+        """Return a copy of the cached history, or None on a miss."""
+        key = str(session_id)
+        with self._lock:
+            history = self._sessions.get(key)
+            if history is None:
+                self.misses += 1
+                return None
+            self._sessions.move_to_end(key)
+            self.hits += 1
+            return list(history)
+
+    def generation(self, session_id):
+        with self._lock:
+            return self._generations.get(str(session_id), 0)
+
+    def put(self, session_id, history, generation):
+        """Cache a freshly loaded history unless the session changed meanwhile."""
+        key = str(session_id)
+        with self._lock:
+            if self._generations.get(key, 0) != generation:
+                return
+            self._sessions[key] = list(history)
+            self._sessions.move_to_end(key)
+            while len(self._sessions) > self.max_sessions:
+                evicted, _ = self._sessions.popitem(last=False)
+                self._generations.pop(evicted, None)
+
+    def append(self, session_id, role, content):
+        """Extend a cached history with a newly saved message."""
+        key = str(session_id)
+        message = to_langchain_message(role, content)
+        with self._lock:
+            self._generations[key] = self._generations.get(key, 0) + 1
+            history = self._sessions.get(key)
+            if history is not None and message is not None:
+                history.append(message)
+                self.appends += 1
+
+    def invalidate(self, session_id):
+        key = str(session_id)
+        with self._lock:
+            self._generations[key] = self._generations.get(key, 0) + 1
+            if self._sessions.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'appends': self.appends,
+                'invalidations': self.invalidations,
+                'sessions': len(self._sessions),
+            }
+
+
+session_history = SessionHistoryCache()
+
+
+def _convert_rows(rows):
+    history = []
+    for role, content in rows:
+        message = to_langchain_message(role, content)
+        if message is not None:
+            history.append(message)
+    return history
+
+
+def _messages_for(session_id):
+    return Message.objects.filter(session_id=session_id).order_by('created_at').values_list('role', 'content')
+
+
+def load_session_history(session_id):
+    """
+    Return the session's messages as LangChain messages, oldest first.
+
+    Raises:
+        SessionNotFound: if the id is malformed or no such session exists
+    """
+    cached = session_history.get(session_id)
+    if cached is not None:
+        return cached
+
+    generation = session_history.generation(session_id)
+    try:
+        rows = list(_messages_for(session_id))
+        if not rows and not Session.objects.filter(pk=session_id).exists():
+            raise SessionNotFound(f"Session {session_id} not found")
+    except (ValidationError, ValueError):
+        raise SessionNotFound(f"Session {session_id} not found")
+
+    history = _convert_rows(rows)
+    session_history.put(session_id, history, generation)
+    return list(history)
+
+
+async def aload_session_history(session_id):
+    """Async variant of load_session_history using the async ORM API."""
+    cached = session_history.get(session_id)
+    if cached is not None:
+        return cached
+
+    generation = session_history.generation(session_id)
+    try:
+        rows = [row async for row in _messages_for(session_id)]
+        if not rows and not await Session.objects.filter(pk=session_id).aexists():
+            raise SessionNotFound(f"Session {session_id} not found")
+    except (ValidationError, ValueError):
+        raise SessionNotFound(f"Session {session_id} not found")
+
+    history = _convert_rows(rows)
+    session_history.put(session_id, history, generation)
+    return list(history)
+
+
+class HistoryWindowStats:
+    """Aggregate token savings of the history window across requests."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.trimmed_requests = 0
+        self.summaries = 0
+        self.summary_failures = 0
+        self.tokens_before = 0
+        self.tokens_after = 0
+        self.tokens_saved = 0
+
+    def record(self, window_report):
+        with self._lock:
+            self.requests += 1
+            self.tokens_before += window_report['tokens_before']
+            self.tokens_after += window_report['tokens_after']
+            self.tokens_saved += window_report['tokens_saved']
+            if window_report['tokens_saved'] > 0:
+                self.trimmed_requests += 1
+            if window_report['summary_updated']:
+                self.summaries += 1
+
+    def record_summary_failure(self):
+        with self._lock:
+            self.summary_failures += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'budget': getattr(settings, 'AI_HISTORY_TOKEN_BUDGET', 0),
+                'requests': self.requests,
+                'trimmed_requests': self.trimmed_requests,
+                'summaries': self.summaries,
+                'summary_failures': self.summary_failures,
+                'tokens_before': self.tokens_before,
+                'tokens_after': self.tokens_after,
+                'tokens_saved': self.tokens_saved,
+            }
+
+
+history_window_stats = HistoryWindowStats()
+
+
+def _suffix_start(messages, budget):
+    """Index where the longest suffix of messages fitting in budget begins."""
+    total = 0
+    start = len(messages)
+    while start > 0:
+        tokens = count_message_tokens([messages[start - 1]])
+        if total + tokens > budget:
+            break
+        total += tokens
+        start -= 1
+    # Always keep the latest message, even if it alone exceeds the budget
+    return min(start, max(len(messages) - 1, 0))
+
+
+def _plan_window(history, budget, summary, summarized, can_summarize):
+    """
+    Decide which messages stay verbatim.
+
+    Returns (start, summarize_until): messages from `start` on are kept
+    verbatim; if summarize_until is not None, history[summarized:summarize_until]
+    must first be folded into the summary (and start == summarize_until).
+    """
+    if summarized > len(history):
+        # The stored summary no longer matches the messages (e.g. deletions)
+        summarized = 0
+    recent = history[summarized:]
+    if count_message_tokens(recent) + count_tokens(summary) <= budget:
+        return summarized, None
+    if can_summarize:
+        # Summarize down to half the budget so the next few turns fit
+        # without another summarization call
+        cut = summarized + _suffix_start(recent, budget // 2)
+        return cut, cut if cut > summarized else None
+    return summarized + _suffix_start(recent, budget), None
+
+
+def _format_turns(messages):
+    lines = []
+    for message in messages:
+        speaker = 'User' if isinstance(message, HumanMessage) else 'Assistant'
+        lines.append(f"{speaker}: {message.content}")
+    return "\n".join(lines)
+
+
+def _windowed(history, start, summary, tokens_before, summary_updated):
+    messages = list(history[start:])
+    if summary:
+        messages.insert(0, SystemMessage(content=f"Summary of the earlier conversation:\n{summary}"))
+    tokens_after = count_message_tokens(messages)
+    window_report = {
+        'tokens_before': tokens_before,
+        'tokens_after': tokens_after,
+        'tokens_saved': max(tokens_before - tokens_after, 0),
+        'summarized_messages': start if summary else 0,
+        'summary_updated': summary_updated,
+    }
+    history_window_stats.record(window_report)
+    report(history_tokens_saved=window_report['tokens_saved'])
+    return messages, window_report
+
+
+def _stored_summary(session_id):
+    return Session.objects.filter(pk=session_id).values_list('history_summary', 'summary_message_count')
+
+
+def apply_history_window(history, session_id=None, summarize=None):
+    """
+    Fit a history into AI_HISTORY_TOKEN_BUDGET tokens.
+
+    With a session and a summarize(existing_summary, turns_text) callable,
+    older turns are folded into the session's stored summary; otherwise
+    they are simply dropped.
+
+    Returns:
+        tuple: (messages to send, report dict with tokens_saved etc.)
+    """
+    budget = getattr(settings, 'AI_HISTORY_TOKEN_BUDGET', 0)
+    if budget <= 0:
+        return history, None
+
+    tokens_before = count_message_tokens(history)
+    summary, summarized = '', 0
+    if session_id:
+        stored = _stored_summary(session_id).first()
+        if stored is not None:
+            summary, summarized = stored
+            if summarized > len(history):
+                summary, summarized = '', 0
+
+    can_summarize = bool(session_id) and summarize is not None
+    start, summarize_until = _plan_window(history, budget, summary, summarized, can_summarize)
+    summary_updated = False
+    if summarize_until is not None:
+        try:
+            summary = summarize(summary, _format_turns(history[summarized:summarize_until]))
+            Session.objects.filter(pk=session_id).update(
+                history_summary=summary, summary_message_count=summarize_until
+            )
+            summary_updated = True
+        except Exception:
+            # Summarization is an optimization; fall back to plain truncation
+            history_window_stats.record_summary_failure()
+            start = summarized + _suffix_start(history[summarized:], budget)
+    return _windowed(history, start, summary, tokens_before, summary_updated)
+
+
+async def aapply_history_window(history, session_id=None, asummarize=None):
+    """Async variant of apply_history_window using the async ORM."""
+    budget = getattr(settings, 'AI_HISTORY_TOKEN_BUDGET', 0)
+    if budget <= 0:
+        return history, None
+
+    tokens_before = count_message_tokens(history)
+    summary, summarized = '', 0
+    if session_id:
+        stored = await _stored_summary(session_id).afirst()
+        if stored is not None:
+            summary, summarized = stored
+            if summarized > len(history):
+                summary, summarized = '', 0
+
+    can_summarize = bool(session_id) and asummarize is not None
+    start, summarize_until = _plan_window(history, budget, summary, summarized, can_summarize)
+    summary_updated = False
+    if summarize_until is not None:
+        try:
+            summary = await asummarize(summary, _format_turns(history[summarized:summarize_until]))
+            await Session.objects.filter(pk=session_id).aupdate(
+                history_summary=summary, summary_message_count=summarize_until
+            )
+            summary_updated = True
+        except Exception:
+            history_window_stats.record_summary_failure()
+            start = summarized + _suffix_start(history[summarized:], budget)
+    return _windowed(history, start, summary, tokens_before, summary_updated)
@@ -0,0 +1,502 @@
+"""
+Database-backed background queue for AI requests.
+
+Clients submit a generate/refine/extract request or a large batch as an AIJob and poll (or
+subscribe over SSE) for its progress and result, so long agent runs with
+several Legal_Web_Search iterations never hold an HTTP request open past
+proxy timeouts. Jobs are run by `python manage.py run_ai_worker`; no
+broker is needed beyond the project database.
+
+Claiming is a conditional UPDATE, so any number of worker processes can
+share the table. A claimed job is leased for AI_JOB_VISIBILITY_TIMEOUT
+seconds and the worker keeps renewing the lease while the job runs; if a
+worker dies, the lease lapses and another worker picks the job up.
+Attempts that fail because the LLM was unavailable (timeouts, 5xx, an open
+circuit; see modules/resilience.py) are retried with exponential backoff up
+to AI_JOB_MAX_ATTEMPTS; any other error fails the job at once.
+Cancelling a running job flags it; the worker's heartbeat picks the flag
+up and cancels the job's CancelToken, stopping the LLM call.
+"""
+
+import asyncio
+import logging
+import os
+import socket
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, connection
+from django.db.models import Count, F, Min, Q
+from django.utils import timezone
+from langchain_core.callbacks import BaseCallbackHandler
+
+from modules.resilience import LLMUnavailable
+
+from .accounting import usage_scope
+from .batch import BatchValidationError, build_batch_items, run_batch
+from .cancellation import CancelToken, GenerationCancelled, cancel_scope, cancellations
+from .models import AIJob
+from .priority import BACKGROUND, INTERACTIVE, PRIORITY_CLASSES, WeightedPicker, normalize_priority
+from .refinement import REFINE_MODES
+from .services import (
+    extract_document_details_from_history,
+    generate_legal_document,
+    refine_legal_document,
+)
+from .streaming import format_sse
+
+logger = logging.getLogger(__name__)
+
+# Longest delay between retries of a failed job, in seconds
+MAX_RETRY_DELAY = 300
+# Seconds between progress writes while tokens stream in
+PROGRESS_WRITE_INTERVAL = 1.0
+# Seconds of silence before an SSE subscriber gets a keep-alive comment
+STREAM_KEEPALIVE = 15
+
+
+class JobValidationError(ValueError):
+    """The job request is malformed; the message is safe to show clients."""
+
+
+def validate_job(kind, payload):
+    """Check that payload carries what the job kind needs."""
+    if kind not in JOB_HANDLERS:
+        raise JobValidationError(f"kind must be one of: {', '.join(JOB_HANDLERS)}.")
+    if kind == 'generate' and not payload.get('prompt'):
+        raise JobValidationError('Prompt is required.')
+    if kind == 'refine':
+        if not payload.get('current_draft') or not payload.get('user_request'):
+            raise JobValidationError('Both current_draft and user_request are required.')
+        if payload.get('mode') and payload['mode'] not in REFINE_MODES:
+            raise JobValidationError(f"mode must be one of: {', '.join(REFINE_MODES)}.")
+    if kind == 'batch':
+        try:
+            build_batch_items(payload.get('items'), payload.get('prompt'))
+        except BatchValidationError as e:
+            raise JobValidationError(str(e))
+
+
+def enqueue(kind, payload, client='', priority=BACKGROUND):
+    """
+    Validate and queue a job; returns the AIJob.
+
+    Raises:
+        JobValidationError: for a malformed request or unknown priority
+    """
+    validate_job(kind, payload)
+    try:
+        priority = normalize_priority(priority, BACKGROUND)
+    except ValueError as e:
+        raise JobValidationError(str(e))
+    return AIJob.objects.create(
+        kind=kind,
+        payload=payload,
+        client=client,
+        priority=priority,
+        max_attempts=getattr(settings, 'AI_JOB_MAX_ATTEMPTS', 3),
+    )
+
+
+def serialize_job(job):
+    return {
+        'job_id': str(job.id),
+        'kind': job.kind,
+        'status': job.status,
+        'priority': job.priority,
+        'progress': job.progress,
+        'result': job.result,
+        'error': job.error or None,
+        'attempts': job.attempts,
+        'max_attempts': job.max_attempts,
+        'created_at': job.created_at.isoformat(),
+        'started_at': job.started_at.isoformat() if job.started_at else None,
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None,
+    }
+
+
+class JobProgressHandler(BaseCallbackHandler):
+    """Records agent progress (LLM calls, searches, tokens) on the job row."""
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.progress = {'stage': 'thinking', 'llm_calls': 0, 'searches': 0, 'tokens': 0}
+        self._last_write = 0.0
+
+    def _write(self, force=False):
+        now = time.monotonic()
+        if not force and now - self._last_write < PROGRESS_WRITE_INTERVAL:
+            return
+        self._last_write = now
+        AIJob.objects.filter(pk=self.job_id).update(progress=dict(self.progress), updated_at=timezone.now())
+
+    def update(self, **fields):
+        """Record progress reported by the job handler itself."""
+        self.progress.update(fields)
+        self._write(force=True)
+
+    def on_llm_start(self, serialized, prompts, **kwargs):
+        self.progress['llm_calls'] += 1
+        self.progress['stage'] = 'drafting' if self.progress['searches'] else 'thinking'
+        self._write(force=True)
+
+    def on_llm_new_token(self, token, **kwargs):
+        if token:
+            self.progress['tokens'] += 1
+            self._write()
+
+    def on_tool_start(self, serialized, input_str, **kwargs):
+        self.progress['searches'] += 1
+        self.progress['stage'] = 'searching'
+        self.progress['last_search'] = str(input_str)[:200]
+        self._write(force=True)
+
+
+def _run_generate(job, callbacks):
+    payload = job.payload
+    return {'result': generate_legal_document(
+        payload['prompt'],
+        payload.get('conversation_history'),
+        use_cache=payload.get('cache', True) not in (False, 'false', '0', 0),
+        session_id=payload.get('session'),
+        callbacks=callbacks,
+    )}
+
+
+def _run_refine(job, callbacks):
+    payload = job.payload
+    return {'result': refine_legal_document(
+        payload['current_draft'], payload['user_request'], payload.get('mode'), callbacks=callbacks,
+    )}
+
+
+def _run_extract_details(job, callbacks):
+    payload = job.payload
+    return {'details': extract_document_details_from_history(
+        payload.get('conversation_history', []), session_id=payload.get('session')
+    )}
+
+
+def _run_batch(job, callbacks):
+    payload = job.payload
+    items = build_batch_items(payload['items'], payload.get('prompt'))
+    progress = callbacks[0]
+    progress.update(stage='generating', completed=0, total=len(items))
+
+    def on_result(result):
+        progress.update(completed=progress.progress['completed'] + 1)
+
+    return run_batch(
+        items,
+        job.client,
+        use_cache=payload.get('cache', True) not in (False, 'false', '0', 0),
+        max_parallel=payload.get('max_parallel'),
+        on_result=on_result,
+    )
+
+
+JOB_HANDLERS = {
+    'generate': _run_generate,
+    'refine': _run_refine,
+    'extract_details': _run_extract_details,
+    'batch': _run_batch,
+}
+
+
+def _claimable(now):
+    return Q(status=AIJob.QUEUED, run_after__lte=now) | Q(status=AIJob.RUNNING, locked_until__lt=now)
+
+
+def _pick_class(runnable, now):
+    """Priority class to claim from next: a starving class, else by weight."""
+    oldest = dict(
+        runnable.values_list('priority').annotate(oldest=Min('created_at')).order_by()
+    )
+    if not oldest:
+        return None
+    starvation_after = getattr(settings, 'AI_PRIORITY_STARVATION_AFTER', 10)
+    if starvation_after:
+        starving = [cls for cls, created in oldest.items() if (now - created).total_seconds() >= starvation_after]
+        if starving:
+            return min(starving, key=oldest.get)
+    return _class_picker.pick(oldest)
+
+
+_class_picker = WeightedPicker()
+
+
+def claim_next(worker_id, classes=None):
+    """
+    Lease the next runnable job to worker_id, or return None.
+
+    Queued jobs and jobs whose lease expired are both runnable. Expired
+    jobs that used up their attempts are failed instead, and flagged ones
+    cancelled. classes limits the priority classes considered.
+    """
+    now = timezone.now()
+    AIJob.objects.filter(
+        Q(status=AIJob.QUEUED) | Q(status=AIJob.RUNNING, locked_until__lt=now), cancel_requested=True
+    ).update(status=AIJob.CANCELLED, finished_at=now, locked_until=None)
+    AIJob.objects.filter(
+        status=AIJob.RUNNING, locked_until__lt=now, attempts__gte=F('max_attempts')
+    ).update(
+        status=AIJob.FAILED, error='Worker lease expired on the final attempt.',
+        finished_at=now, locked_until=None,
+    )
+    visibility = timedelta(seconds=getattr(settings, 'AI_JOB_VISIBILITY_TIMEOUT', 300))
+    runnable = AIJob.objects.filter(_claimable(now))
+    if classes is not None:
+        runnable = runnable.filter(priority__in=classes)
+    priority = _pick_class(runnable, now)
+    if priority is None:
+        return None
+    candidates = runnable.filter(priority=priority).order_by('run_after', 'created_at')
+    for job_id in candidates.values_list('pk', flat=True)[:10]:
+        # Only one worker's conditional update can match; the others move on
+        claimed = AIJob.objects.filter(_claimable(now), pk=job_id).update(
+            status=AIJob.RUNNING,
+            locked_by=worker_id,
+            locked_until=now + visibility,
+            attempts=F('attempts') + 1,
+            started_at=now,
+            updated_at=now,
+        )
+        if claimed:
+            return AIJob.objects.get(pk=job_id)
+    return None
+
+
+def cancel_job(job):
+    """
+    Cancel a queued job at once, or flag a running one for its worker to
+    stop. Returns the refreshed job.
+    """
+    now = timezone.now()
+    AIJob.objects.filter(pk=job.pk, status=AIJob.QUEUED).update(
+        status=AIJob.CANCELLED, cancel_requested=True, finished_at=now, updated_at=now,
+    )
+    # Covers a job claimed between the two updates too
+    AIJob.objects.filter(pk=job.pk, status=AIJob.RUNNING).update(cancel_requested=True, updated_at=now)
+    job.refresh_from_db()
+    return job
+
+
+def extend_leases(job_ids, worker_id):
+    """Renew the visibility timeout of jobs this worker is still running."""
+    if not job_ids:
+        return 0
+    visibility = timedelta(seconds=getattr(settings, 'AI_JOB_VISIBILITY_TIMEOUT', 300))
+    return AIJob.objects.filter(
+        pk__in=job_ids, locked_by=worker_id, status=AIJob.RUNNING
+    ).update(locked_until=timezone.now() + visibility)
+
+
+def _retry_delay(job, error):
+    base = getattr(settings, 'AI_JOB_RETRY_BACKOFF', 5)
+    delay = min(base * 2 ** (job.attempts - 1), MAX_RETRY_DELAY)
+    return max(delay, getattr(error, 'retry_after', None) or 0)
+
+
+def _is_retryable(error):
+    # Only an upstream outage may clear up by itself; bad input never does
+    return isinstance(error, LLMUnavailable)
+
+
+def run_job(job, worker_id):
+    """Run a claimed job and record its outcome; a lost lease discards the outcome."""
+    owned = AIJob.objects.filter(pk=job.pk, locked_by=worker_id, status=AIJob.RUNNING)
+    progress = JobProgressHandler(job.pk)
+    try:
+        with cancel_scope(CancelToken(job_id=job.pk)), usage_scope(
+            job.kind, session_id=job.payload.get('session'), job_id=job.pk, client=job.client,
+        ):
+            result = JOB_HANDLERS[job.kind](job, [progress])
+    except GenerationCancelled as cancelled:
+        now = timezone.now()
+        logger.info("AI job %s cancelled", job.pk)
+        owned.update(
+            status=AIJob.CANCELLED, error=str(cancelled), finished_at=now, locked_until=None,
+            updated_at=now, progress={**progress.progress, 'stage': 'cancelled'},
+        )
+        return False
+    except Exception as error:
+        now = timezone.now()
+        if _is_retryable(error) and job.attempts < job.max_attempts:
+            delay = _retry_delay(job, error)
+            logger.warning("AI job %s attempt %s failed, retrying in %ss: %s", job.pk, job.attempts, delay, error)
+            owned.update(
+                status=AIJob.QUEUED, error=str(error), run_after=now + timedelta(seconds=delay),
+                locked_by='', locked_until=None, updated_at=now,
+            )
+        else:
+            logger.error("AI job %s failed: %s", job.pk, error)
+            owned.update(
+                status=AIJob.FAILED, error=str(error), finished_at=now,
+                locked_until=None, updated_at=now,
+            )
+        return False
+    now = timezone.now()
+    owned.update(
+        status=AIJob.SUCCEEDED, result=result, error='', finished_at=now,
+        locked_until=None, updated_at=now, progress={**progress.progress, 'stage': 'done'},
+    )
+    return True
+
+
+class JobWorker:
+    """
+    Runs AI jobs on `concurrency` threads, renewing their leases from a
+    heartbeat thread while they run. AI_INTERACTIVE_RESERVED_SLOTS threads
+    are kept for interactive jobs whenever background or bulk work would
+    otherwise occupy them all.
+    """
+
+    def __init__(self, concurrency=None, poll_interval=None, name=None):
+        self.concurrency = concurrency or getattr(settings, 'AI_JOB_WORKER_CONCURRENCY', 2)
+        self.poll_interval = poll_interval or getattr(settings, 'AI_JOB_POLL_INTERVAL', 1.0)
+        self.name = name or f"{socket.gethostname()}:{os.getpid()}"
+        self.reserved_interactive = max(
+            0, min(getattr(settings, 'AI_INTERACTIVE_RESERVED_SLOTS', 1), self.concurrency - 1)
+        )
+        self._running = {}  # job id -> (worker id, priority)
+        self._lock = threading.Lock()
+        self.processed = 0
+        self.failed = 0
+
+    def _worker_id(self, index):
+        return f"{self.name}:{index}"
+
+    def _claimable_classes(self):
+        """Classes this worker may start now, keeping reserved threads for interactive jobs."""
+        with self._lock:
+            others = sum(1 for _, priority in self._running.values() if priority != INTERACTIVE)
+        if others < self.concurrency - self.reserved_interactive:
+            return None
+        return [INTERACTIVE]
+
+    def _loop(self, index, stop, drain):
+        worker_id = self._worker_id(index)
+        try:
+            while not stop.is_set():
+                close_old_connections()
+                job = claim_next(worker_id, self._claimable_classes())
+                if job is None:
+                    if drain and not AIJob.objects.filter(_claimable(timezone.now())).exists():
+                        return
+                    stop.wait(self.poll_interval)
+                    continue
+                with self._lock:
+                    self._running[job.pk] = (worker_id, job.priority)
+                try:
+                    succeeded = run_job(job, worker_id)
+                finally:
+                    with self._lock:
+                        self._running.pop(job.pk, None)
+                with self._lock:
+                    self.processed += 1
+                    self.failed += not succeeded
+        finally:
+            connection.close()
+
+    def _heartbeat(self, stop):
+        # Cancellation requests are checked every poll, leases renewed every third of their timeout
+        renew_every = max(getattr(settings, 'AI_JOB_VISIBILITY_TIMEOUT', 300) / 3, 0.1)
+        renew_at = time.monotonic() + renew_every
+        try:
+            while not stop.wait(min(self.poll_interval, renew_every)):
+                with self._lock:
+                    running = {job_id: owner for job_id, (owner, _) in self._running.items()}
+                if not running:
+                    continue
+                flagged = AIJob.objects.filter(pk__in=list(running), cancel_requested=True)
+                for job_id in flagged.values_list('pk', flat=True):
+                    cancellations.cancel_job(job_id)
+                if time.monotonic() >= renew_at:
+                    renew_at = time.monotonic() + renew_every
+                    for worker_id in set(running.values()):
+                        extend_leases([job_id for job_id, owner in running.items() if owner == worker_id], worker_id)
+        finally:
+            connection.close()
+
+    def run(self, stop=None, drain=False):
+        """
+        Process jobs until stop is set, or with drain=True until the queue
+        has no runnable jobs left.
+        """
+        stop = stop or threading.Event()
+        heartbeat_stop = threading.Event()
+        heartbeat = threading.Thread(target=self._heartbeat, args=(heartbeat_stop,), daemon=True)
+        heartbeat.start()
+        threads = [
+            threading.Thread(target=self._loop, args=(index, stop, drain), name=f"ai-job-{index}", daemon=True)
+            for index in range(self.concurrency)
+        ]
+        for thread in threads:
+            thread.start()
+        try:
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(0.5)
+        finally:
+            stop.set()
+            heartbeat_stop.set()
+
+
+async def job_event_stream(job_id, poll_interval=0.5):
+    """
+    SSE frames following a job: `status` whenever its state or progress
+    changes, then `final` with the result, `error` if it failed or
+    `cancelled`. After AI_JOB_STREAM_MAX_SECONDS the stream ends with a
+    `timeout` frame carrying the job as it stands, so a subscriber to a
+    stuck job does not hold a connection forever.
+
+    Polls through the async ORM, so under ASGI a subscriber costs no thread.
+    """
+    last_seen = None
+    started = last_frame_at = time.monotonic()
+    max_seconds = getattr(settings, 'AI_JOB_STREAM_MAX_SECONDS', 600)
+    while True:
+        try:
+            job = await AIJob.objects.aget(pk=job_id)
+        except AIJob.DoesNotExist:
+            yield format_sse('error', {'error': 'Job not found.'})
+            return
+        data = serialize_job(job)
+        if job.status == AIJob.SUCCEEDED:
+            yield format_sse('final', data)
+            return
+        if job.status == AIJob.FAILED:
+            yield format_sse('error', data)
+            return
+        if job.status == AIJob.CANCELLED:
+            yield format_sse('cancelled', data)
+            return
+        if job.updated_at != last_seen:
+            last_seen = job.updated_at
+            last_frame_at = time.monotonic()
+            yield format_sse('status', data)
+        elif time.monotonic() - last_frame_at > STREAM_KEEPALIVE:
+            last_frame_at = time.monotonic()
+            yield ': keep-alive\n\n'
+        if time.monotonic() - started >= max_seconds:
+            yield format_sse('timeout', data)
+            return
+        await asyncio.sleep(poll_interval)
+
+
+def get_job_stats():
+    """Return job counts per status and class, and the age of the oldest runnable job."""
+    counts = dict(AIJob.objects.values_list('status').annotate(count=Count('pk')).order_by())
+    queued = dict(
+        AIJob.objects.filter(status=AIJob.QUEUED).values_list('priority').annotate(count=Count('pk')).order_by()
+    )
+    oldest = AIJob.objects.filter(status=AIJob.QUEUED, run_after__lte=timezone.now()).aggregate(
+        oldest=Min('created_at')
+    )['oldest']
+    return {
+        **{status: counts.get(status, 0) for status, _ in AIJob.STATUS_CHOICES},
+        'queued_by_priority': {cls: queued.get(cls, 0) for cls in PRIORITY_CLASSES},
+        'oldest_queued_age_s': round((timezone.now() - oldest).total_seconds(), 1) if oldest else None,
+    }
@@ -0,0 +1,49 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from modules.legal_index import open_index, update_index
+
+
+class Command(BaseCommand):
+    help = "Index the local legal corpus for Legal_Corpus_Search, re-reading only changed files."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'corpus', nargs='?', default=None,
+            help='Directory of .txt/.md statutes and regulations (default AI_LEGAL_CORPUS_DIR).',
+        )
+        parser.add_argument(
+            '--index', default=None,
+            help='Index directory (default AI_LEGAL_INDEX_PATH).',
+        )
+        parser.add_argument(
+            '--rebuild', action='store_true',
+            help='Re-index every file instead of only the changed ones.',
+        )
+
+    def handle(self, *args, **options):
+        corpus = options['corpus'] or getattr(settings, 'AI_LEGAL_CORPUS_DIR', '')
+        index_path = options['index'] or getattr(settings, 'AI_LEGAL_INDEX_PATH', '')
+        if not corpus:
+            raise CommandError("No corpus directory given and AI_LEGAL_CORPUS_DIR is not set.")
+        if not index_path:
+            raise CommandError("No --index given and AI_LEGAL_INDEX_PATH is not set.")
+
+        started = time.monotonic()
+        try:
+            summary = update_index(corpus, index_path, rebuild=options['rebuild'])
+        except FileNotFoundError as error:
+            raise CommandError(str(error))
+        stats = open_index(index_path).stats()
+
+        self.stdout.write(
+            f"{summary['added']} added, {summary['changed']} changed, {summary['removed']} removed, "
+            f"{summary['unchanged']} unchanged file(s); {summary['passages_indexed']} passage(s) indexed"
+            f"{' (full rebuild)' if summary['rebuilt'] else ''}."
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f"Index at {index_path}: {stats['files']} file(s), {stats['passages']} passage(s) "
+            f"in {stats['segments']} segment(s), built in {time.monotonic() - started:.1f}s."
+        ))
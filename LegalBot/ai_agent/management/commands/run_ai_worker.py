@@ -0,0 +1,46 @@
+import signal
+import threading
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from ai_agent.jobs import JobWorker
+
+
+class Command(BaseCommand):
+    help = "Run queued AI jobs (see /api/ai/jobs/) until interrupted."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--concurrency', type=int, default=None,
+            help='Jobs run at once (default AI_JOB_WORKER_CONCURRENCY).',
+        )
+        parser.add_argument(
+            '--poll-interval', type=float, default=None,
+            help='Seconds between queue polls when idle (default AI_JOB_POLL_INTERVAL).',
+        )
+        parser.add_argument(
+            '--drain', action='store_true',
+            help='Exit once no runnable jobs are left instead of waiting for more.',
+        )
+
+    def handle(self, *args, **options):
+        worker = JobWorker(concurrency=options['concurrency'], poll_interval=options['poll_interval'])
+        stop = threading.Event()
+
+        def shutdown(signum, frame):
+            # Finish the jobs in hand; unfinished ones are retried after their lease lapses
+            self.stdout.write("Stopping after the running jobs finish...")
+            stop.set()
+
+        signal.signal(signal.SIGINT, shutdown)
+        signal.signal(signal.SIGTERM, shutdown)
+
+        self.stdout.write(
+            f"AI worker {worker.name} running {worker.concurrency} job(s) at a time "
+            f"(visibility timeout {getattr(settings, 'AI_JOB_VISIBILITY_TIMEOUT', 300)}s)"
+        )
+        worker.run(stop, drain=options['drain'])
+        self.stdout.write(self.style.SUCCESS(
+            f"Processed {worker.processed} job(s), {worker.failed} did not succeed."
+        ))
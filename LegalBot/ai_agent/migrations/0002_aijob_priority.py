@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ai_agent', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='aijob',
+            name='priority',
+            field=models.CharField(choices=[('interactive', 'Interactive'), ('background', 'Background'), ('bulk', 'Bulk')], default='background', max_length=20),
+        ),
+    ]
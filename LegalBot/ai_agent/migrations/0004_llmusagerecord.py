@@ -0,0 +1,49 @@
+# Generated by Django 5.2.18 on 2026-10-17 01:05
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ai_agent', '0003_aijob_cancellation'),
+        ('chat_sessions', '0002_session_history_summary'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LLMUsageRecord',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(max_length=20)),
+                ('model', models.CharField(blank=True, default='', max_length=255)),
+                ('calls', models.JSONField(blank=True, default=list)),
+                ('llm_calls', models.PositiveIntegerField(default=0)),
+                ('prompt_tokens', models.PositiveIntegerField(default=0)),
+                ('completion_tokens', models.PositiveIntegerField(default=0)),
+                ('usage_estimated', models.BooleanField(default=False)),
+                ('tool_calls', models.PositiveIntegerField(default=0)),
+                ('time_to_first_token_ms', models.FloatField(blank=True, null=True)),
+                ('llm_ms', models.FloatField(default=0)),
+                ('tool_ms', models.FloatField(default=0)),
+                ('total_ms', models.FloatField(default=0)),
+                ('cached', models.BooleanField(default=False)),
+                ('streamed', models.BooleanField(default=False)),
+                ('status', models.CharField(choices=[('ok', 'OK'), ('error', 'Error'), ('cancelled', 'Cancelled')], default='ok', max_length=20)),
+                ('cost', models.DecimalField(blank=True, decimal_places=8, max_digits=14, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('job', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='usage', to='ai_agent.aijob')),
+                ('session', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='llm_usage', to='chat_sessions.session')),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='llm_usage', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'LLM usage record',
+                'verbose_name_plural': 'LLM usage records',
+                'ordering': ['-created_at'],
+                'indexes': [models.Index(fields=['user', 'created_at'], name='ai_agent_ll_user_id_e9842c_idx'), models.Index(fields=['session', 'created_at'], name='ai_agent_ll_session_13628b_idx')],
+            },
+        ),
+    ]
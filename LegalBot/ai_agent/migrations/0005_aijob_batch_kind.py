@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 01:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ai_agent', '0004_llmusagerecord'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='aijob',
+            name='kind',
+            field=models.CharField(choices=[('generate', 'Generate'), ('refine', 'Refine'), ('extract_details', 'Extract details'), ('batch', 'Batch')], max_length=20),
+        ),
+    ]
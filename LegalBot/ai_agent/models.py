@@ -1,3 +1,135 @@
+from django.conf import settings
 from django.db import models
+from django.utils import timezone
+import uuid
 
-# Create your models here.
+
+class AIJob(models.Model):
+    """
+    A queued AI request, run by `python manage.py run_ai_worker`.
+
+    Workers claim a job by leasing it until locked_until (the visibility
+    timeout); a job whose worker died becomes claimable again once the
+    lease expires. Failed attempts are retried after run_after until
+    max_attempts is reached. Workers choose between priority classes by
+    weight (see ai_agent/priority.py). Cancelling a running job sets
+    cancel_requested; its worker notices and stops the LLM call.
+    """
+
+    KIND_CHOICES = [
+        ('generate', 'Generate'),
+        ('refine', 'Refine'),
+        ('extract_details', 'Extract details'),
+        ('batch', 'Batch'),
+    ]
+
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+    CANCELLED = 'cancelled'
+    STATUS_CHOICES = [
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (SUCCEEDED, 'Succeeded'),
+        (FAILED, 'Failed'),
+        (CANCELLED, 'Cancelled'),
+    ]
+
+    PRIORITY_CHOICES = [
+        ('interactive', 'Interactive'),
+        ('background', 'Background'),
+        ('bulk', 'Bulk'),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    payload = models.JSONField(default=dict)
+    # Admission fairness key of the submitter (user:<id> or ip:<address>)
+    client = models.CharField(max_length=255, blank=True, default='')
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=QUEUED)
+    priority = models.CharField(max_length=20, choices=PRIORITY_CHOICES, default='background')
+    cancel_requested = models.BooleanField(default=False)
+    progress = models.JSONField(default=dict, blank=True)
+    result = models.JSONField(null=True, blank=True)
+    error = models.TextField(blank=True, default='')
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=3)
+    run_after = models.DateTimeField(default=timezone.now)
+    locked_by = models.CharField(max_length=255, blank=True, default='')
+    locked_until = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['created_at']
+        indexes = [models.Index(fields=['status', 'run_after'])]
+        verbose_name = 'AI Job'
+        verbose_name_plural = 'AI Jobs'
+
+    def __str__(self):
+        return f"{self.kind} {self.id} ({self.status})"
+
+    @property
+    def is_finished(self):
+        return self.status in (self.SUCCEEDED, self.FAILED, self.CANCELLED)
+
+
+class LLMUsageRecord(models.Model):
+    """
+    LLM usage of one AI request, background job attempt or batch item:
+    tokens, latency, tool invocations and cost, with the individual LLM
+    calls in `calls` (see ai_agent/accounting.py). `model` is the model
+    of the last call, the one that produced the answer.
+    """
+
+    OK = 'ok'
+    ERROR = 'error'
+    CANCELLED = 'cancelled'
+    STATUS_CHOICES = [
+        (OK, 'OK'),
+        (ERROR, 'Error'),
+        (CANCELLED, 'Cancelled'),
+    ]
+
+    kind = models.CharField(max_length=20)
+    session = models.ForeignKey(
+        'chat_sessions.Session', null=True, blank=True, on_delete=models.SET_NULL, related_name='llm_usage'
+    )
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL, null=True, blank=True, on_delete=models.SET_NULL, related_name='llm_usage'
+    )
+    job = models.ForeignKey(AIJob, null=True, blank=True, on_delete=models.SET_NULL, related_name='usage')
+    model = models.CharField(max_length=255, blank=True, default='')
+    calls = models.JSONField(default=list, blank=True)
+    llm_calls = models.PositiveIntegerField(default=0)
+    prompt_tokens = models.PositiveIntegerField(default=0)
+    completion_tokens = models.PositiveIntegerField(default=0)
+    # Set when the provider reported no usage for some call and it was counted locally
+    usage_estimated = models.BooleanField(default=False)
+    tool_calls = models.PositiveIntegerField(default=0)
+    time_to_first_token_ms = models.FloatField(null=True, blank=True)
+    llm_ms = models.FloatField(default=0)
+    tool_ms = models.FloatField(default=0)
+    total_ms = models.FloatField(default=0)
+    # Answered from the response cache, or by another request's identical call
+    cached = models.BooleanField(default=False)
+    streamed = models.BooleanField(default=False)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=OK)
+    # Null when no model used has a price in AI_MODEL_PRICES
+    cost = models.DecimalField(max_digits=14, decimal_places=8, null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['user', 'created_at']),
+            models.Index(fields=['session', 'created_at']),
+        ]
+        verbose_name = 'LLM usage record'
+        verbose_name_plural = 'LLM usage records'
+
+    def __str__(self):
+        return f"{self.kind} {self.model} ({self.prompt_tokens}+{self.completion_tokens} tokens)"
@@ -0,0 +1,75 @@
+"""
+Priority classes for AI work.
+
+Every AI request runs in one of three classes: `interactive` (chat turns
+waiting on screen), `background` (queued jobs) and `bulk` (batch
+drafting). When work of several classes is waiting, the admission
+controller and the job workers pick the next class by smooth weighted
+round robin over AI_PRIORITY_WEIGHTS, so interactive work is served most
+often without shutting the other classes out. As starvation protection,
+anything that has waited longer than AI_PRIORITY_STARVATION_AFTER seconds
+is served first, oldest first.
+"""
+
+import threading
+
+from django.conf import settings
+
+INTERACTIVE = 'interactive'
+BACKGROUND = 'background'
+BULK = 'bulk'
+PRIORITY_CLASSES = (INTERACTIVE, BACKGROUND, BULK)
+
+DEFAULT_WEIGHTS = {INTERACTIVE: 8, BACKGROUND: 3, BULK: 1}
+
+
+class InvalidPriority(ValueError):
+    pass
+
+
+def normalize_priority(value, default=INTERACTIVE):
+    """Return a valid priority class for a client-supplied value."""
+    if value in (None, ''):
+        return default
+    value = str(value).strip().lower()
+    if value not in PRIORITY_CLASSES:
+        raise InvalidPriority(f"priority must be one of: {', '.join(PRIORITY_CLASSES)}.")
+    return value
+
+
+def priority_weights():
+    weights = getattr(settings, 'AI_PRIORITY_WEIGHTS', None) or {}
+    return {cls: max(int(weights.get(cls, DEFAULT_WEIGHTS[cls])), 1) for cls in PRIORITY_CLASSES}
+
+
+class WeightedPicker:
+    """
+    Smooth weighted round robin: with weights 8/3/1 and all classes busy,
+    every 12 picks serve 8 interactive, 3 background and 1 bulk item,
+    interleaved rather than in runs.
+    """
+
+    def __init__(self, weights=None):
+        self._weights = weights
+        self._current = dict.fromkeys(PRIORITY_CLASSES, 0)
+        self._lock = threading.Lock()
+
+    @property
+    def weights(self):
+        # Without explicit weights, follow the current settings
+        return self._weights or priority_weights()
+
+    def pick(self, candidates):
+        """Choose one class out of the non-empty candidate classes."""
+        candidates = [cls for cls in PRIORITY_CLASSES if cls in candidates]
+        if len(candidates) == 1:
+            return candidates[0]
+        weights = self.weights
+        with self._lock:
+            total = sum(weights[cls] for cls in candidates)
+            for cls in candidates:
+                self._current[cls] += weights[cls]
+            # Ties go to the higher class, hence the stable max over PRIORITY_CLASSES order
+            chosen = max(candidates, key=lambda cls: self._current[cls])
+            self._current[chosen] -= total
+            return chosen
@@ -0,0 +1,190 @@
+"""
+Refinement strategies for /api/ai/refine/.
+
+"full" sends the whole draft through the agent and gets the whole document
+back. "sections" numbers the draft's sections, asks the model for only the
+sections that change (a structured patch) and splices them back in, so a
+one-line edit no longer costs a full document of output tokens. Both are
+executor-like (invoke/ainvoke returning {"output": ...}) so the blocking,
+streaming and async paths can use either.
+
+Before either runs, mechanical requests ("replace X with Y", "set the rent
+to $2,000") are applied locally by modules/edits.py without an LLM call.
+"""
+
+import threading
+
+from django.conf import settings
+
+from modules.agent import get_refinement_prompt, get_section_refinement_prompt
+from modules.edits import apply_simple_edit
+from modules.sections import (
+    apply_section_patch,
+    parse_section_patch,
+    render_numbered_sections,
+    split_sections,
+)
+from modules.tokens import count_tokens
+
+from .reporting import report
+
+REFINE_MODES = ('full', 'sections')
+# Refinements answered by the local edit interpreter are tracked as their own mode
+LOCAL_MODE = 'local'
+
+
+class RefinementStats:
+    """Token usage per refinement mode versus the full-rewrite estimate."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._modes = {
+            mode: {
+                'calls': 0,
+                'input_tokens': 0,
+                'output_tokens': 0,
+                'full_rewrite_input_tokens': 0,
+                'full_rewrite_output_tokens': 0,
+            }
+            for mode in REFINE_MODES + (LOCAL_MODE,)
+        }
+        self.fallbacks = 0
+
+    def record(self, mode, input_tokens, output_tokens, full_input_tokens, full_output_tokens):
+        with self._lock:
+            totals = self._modes[mode]
+            totals['calls'] += 1
+            totals['input_tokens'] += input_tokens
+            totals['output_tokens'] += output_tokens
+            totals['full_rewrite_input_tokens'] += full_input_tokens
+            totals['full_rewrite_output_tokens'] += full_output_tokens
+        report(
+            refine_mode=mode,
+            refine_input_tokens=input_tokens,
+            refine_output_tokens=output_tokens,
+            refine_full_rewrite_tokens=full_input_tokens + full_output_tokens,
+        )
+
+    def record_fallback(self):
+        with self._lock:
+            self.fallbacks += 1
+
+    def stats(self):
+        with self._lock:
+            calls = sum(totals['calls'] for totals in self._modes.values())
+            local_served = self._modes[LOCAL_MODE]['calls']
+            stats = {
+                'fallbacks': self.fallbacks,
+                'local_served': local_served,
+                'local_rate': local_served / calls if calls else 0.0,
+            }
+            for mode, totals in self._modes.items():
+                spent = totals['input_tokens'] + totals['output_tokens']
+                full = totals['full_rewrite_input_tokens'] + totals['full_rewrite_output_tokens']
+                stats[mode] = {**totals, 'tokens_saved': full - spent}
+            return stats
+
+
+refinement_stats = RefinementStats()
+
+
+def _full_rewrite_estimate(current_draft, user_request):
+    """Tokens a full rewrite would cost: the prompt in, the whole document out."""
+    return (
+        count_tokens(get_refinement_prompt(current_draft, user_request)),
+        count_tokens(current_draft),
+    )
+
+
+def refine_locally(current_draft, user_request):
+    """
+    Apply a mechanical edit without the LLM.
+
+    Returns:
+        str: The edited document, or None if the request needs the model
+    """
+    if not getattr(settings, 'AI_REFINE_LOCAL_EDITS', True):
+        return None
+    document = apply_simple_edit(current_draft, user_request)
+    if document is not None:
+        full_input, full_output = _full_rewrite_estimate(current_draft, user_request)
+        refinement_stats.record(LOCAL_MODE, 0, 0, full_input, full_output)
+    return document
+
+
+def _usage(message, prompt):
+    """Prefer provider-reported usage, else count the text ourselves."""
+    usage = getattr(message, 'usage_metadata', None)
+    if usage:
+        return usage.get('input_tokens', 0), usage.get('output_tokens', 0)
+    return count_tokens(prompt), count_tokens(message.content)
+
+
+class FullRefiner:
+    """Refines by having the agent return the entire updated document."""
+
+    def __init__(self, agent_executor):
+        self.agent_executor = agent_executor
+
+    def _record(self, inputs, output):
+        # A full rewrite is its own baseline
+        input_tokens, output_tokens = count_tokens(inputs['input']), count_tokens(output)
+        refinement_stats.record('full', input_tokens, output_tokens, input_tokens, output_tokens)
+
+    def invoke(self, inputs, config=None):
+        response = self.agent_executor.invoke(inputs, config=config)
+        self._record(inputs, response['output'])
+        return response
+
+    async def ainvoke(self, inputs, config=None):
+        response = await self.agent_executor.ainvoke(inputs, config=config)
+        self._record(inputs, response['output'])
+        return response
+
+
+class SectionRefiner:
+    """
+    Refines by asking the model to rewrite only the affected sections.
+
+    Falls back to FullRefiner when the draft has a single section or the
+    model's reply is not a valid patch.
+    """
+
+    def __init__(self, llm, agent_executor, current_draft, user_request):
+        self.llm = llm
+        self.fallback = FullRefiner(agent_executor)
+        self.current_draft = current_draft
+        self.user_request = user_request
+        self.sections = split_sections(current_draft)
+        self.prompt = get_section_refinement_prompt(
+            render_numbered_sections(self.sections), user_request
+        )
+
+    def _splice(self, message):
+        patch = parse_section_patch(message.content)
+        if patch is None:
+            return None
+        try:
+            document = apply_section_patch(self.sections, *patch)
+        except ValueError:
+            return None
+        input_tokens, output_tokens = _usage(message, self.prompt)
+        full_input, full_output = _full_rewrite_estimate(self.current_draft, self.user_request)
+        refinement_stats.record('sections', input_tokens, output_tokens, full_input, full_output)
+        return document
+
+    def invoke(self, inputs, config=None):
+        if len(self.sections) > 1:
+            document = self._splice(self.llm.invoke(self.prompt, config=config))
+            if document is not None:
+                return {'output': document}
+            refinement_stats.record_fallback()
+        return self.fallback.invoke(inputs, config=config)
+
+    async def ainvoke(self, inputs, config=None):
+        if len(self.sections) > 1:
+            document = self._splice(await self.llm.ainvoke(self.prompt, config=config))
+            if document is not None:
+                return {'output': document}
+            refinement_stats.record_fallback()
+        return await self.fallback.ainvoke(inputs, config=config)
@@ -0,0 +1,35 @@
+"""
+Per-request reporting for AI calls.
+
+Services record facts about the call they are serving (tokens saved,
+cache hits, ...) into a context-local report, which the views expose as
+`X-AI-*` response headers. Context variables keep reports separate across
+threads and asyncio tasks.
+"""
+
+import contextvars
+
+_current_report = contextvars.ContextVar('ai_call_report', default=None)
+
+
+def start_report():
+    """Begin a fresh report for the current request and return it."""
+    call_report = {}
+    _current_report.set(call_report)
+    return call_report
+
+
+def report(**fields):
+    """Record fields on the current request's report, if one is active."""
+    call_report = _current_report.get()
+    if call_report is not None:
+        call_report.update(fields)
+
+
+def report_headers(call_report):
+    """Render a report as headers, e.g. history_tokens_saved -> X-AI-History-Tokens-Saved."""
+    headers = {}
+    for key, value in (call_report or {}).items():
+        name = 'X-AI-' + '-'.join(part.capitalize() for part in key.split('_'))
+        headers[name] = str(value)
+    return headers
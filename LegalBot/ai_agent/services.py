@@ -3,8 +3,12 @@ AI Agent service for LegalBot (Django backend).
 Directly imports and uses logic from modules/agent.py.
 """
 
+import asyncio
+import hashlib
+import json
 import sys
 import os
+import threading
 from pathlib import Path
 from django.conf import settings
 from langchain_core.messages import AIMessage, HumanMessage
@@ -15,11 +19,628 @@ if str(BASE_DIR) not in sys.path:
     sys.path.insert(0, str(BASE_DIR))
 
 # Import the modules directly
-from modules.agent import get_agent_executor, get_refinement_prompt
+from modules.agent import (
+    CORPUS_PROMPT_VERSION,
+    DEFAULT_BASE_URL,
+    DEFAULT_MODEL,
+    DEFAULT_TEMPERATURE,
+    PROMPT_VERSION,
+    agent_registry,
+    get_agent_executor,
+    get_chat_model,
+    get_refinement_prompt,
+    get_summary_prompt,
+)
+from modules.cache import ResponseCache, make_cache_key, normalize_text
+from modules.cassette import CASSETTE_MODES, REPLAY, CassettePolicy, cassette_stats
+from modules.fake_llm import FakeLLMConfig
+from modules.hedging import HedgePolicy, hedge_stats
+from modules.legal_index import CorpusPolicy, IndexNotFound, corpus_stats, open_index
+from modules.resilience import LLMUnavailable, ResiliencePolicy, model_health
+from modules.routing import RoutingPolicy, routing_stats
+from modules.scratchpad import ScratchpadPolicy, scratchpad_stats
+from modules.search import SEARCH_BACKENDS, SearchPolicy, reset_searches, search_cache_stats, search_stats
+from modules.semantic_cache import SemanticCache
+from modules.singleflight import FlightTimeout, SingleFlight
 from modules.ui import clean_legal_document, extract_document_details
 
+from .accounting import accounting_callbacks, current_account, mark_cached
+from .cancellation import cancellation_callbacks, current_cancel_token
+from .history import (
+    aapply_history_window,
+    aload_session_history,
+    apply_history_window,
+    history_window_stats,
+    load_session_history,
+    session_history,
+)
+from .refinement import REFINE_MODES, FullRefiner, SectionRefiner, refine_locally, refinement_stats
+from .reporting import report
+from .streaming import (
+    acached_event_stream,
+    aresult_event_stream,
+    astream_agent_events,
+    cached_event_stream,
+    result_event_stream,
+    stream_agent_events,
+)
 
-def generate_legal_document(prompt, conversation_history=None):
+LLM_BACKENDS = ('openai', 'fake')
+
+_response_cache = None
+_semantic_cache = None
+_response_cache_lock = threading.Lock()
+# Concurrent identical generate/refine requests share one upstream call
+_inflight = SingleFlight()
+
+
+def _get_agent_executor(routed=True):
+    """
+    Return the shared agent executor for the configured API key.
+
+    Executors come from the process-wide registry in modules/agent.py, so
+    the LLM client and its connection pool are reused across requests.
+    With routed=False every turn uses AI_MODEL, even if AI_FAST_MODEL is set.
+    """
+    return get_agent_executor(
+        _api_key(), **_llm_options(), routing=_routing_policy() if routed else None,
+        scratchpad=_scratchpad_policy(), search=_search_policy(), corpus=_corpus_policy(),
+    )
+
+
+def _get_chat_model(fast=False):
+    """
+    Return the shared chat model for tool-free calls: AI_MODEL, or with
+    fast=True AI_FAST_MODEL when one is configured (used for summaries).
+    """
+    options = _llm_options()
+    if fast and getattr(settings, 'AI_FAST_MODEL', ''):
+        options['model'] = settings.AI_FAST_MODEL
+    return get_chat_model(_api_key(), **options)
+
+
+def _api_key():
+    """The provider API key; the fake backend and cassette replays need none."""
+    api_key = getattr(settings, 'LLM_API_KEY', '')
+    if api_key:
+        return api_key
+    cassette = _cassette_policy()
+    if _fake_llm_config() is not None or (cassette is not None and cassette.mode == REPLAY):
+        return 'fake'
+    raise ValueError("LLM_API_KEY not configured in Django settings")
+
+
+def _llm_options():
+    """Model, temperature, endpoint, fallback model, retry/breaker, hedging policy, backend and cassette from settings."""
+    return {
+        'model': getattr(settings, 'AI_MODEL', '') or DEFAULT_MODEL,
+        'temperature': getattr(settings, 'AI_TEMPERATURE', DEFAULT_TEMPERATURE),
+        'base_url': getattr(settings, 'LLM_BASE_URL', DEFAULT_BASE_URL),
+        'fallback_model': getattr(settings, 'AI_FALLBACK_MODEL', '') or None,
+        'policy': ResiliencePolicy(
+            timeout=getattr(settings, 'AI_LLM_TIMEOUT', 60),
+            max_attempts=getattr(settings, 'AI_LLM_MAX_ATTEMPTS', 3),
+            base_delay=getattr(settings, 'AI_LLM_BACKOFF_BASE', 0.5),
+            max_delay=getattr(settings, 'AI_LLM_BACKOFF_MAX', 8),
+            failure_threshold=getattr(settings, 'AI_CIRCUIT_FAILURE_THRESHOLD', 5),
+            reset_timeout=getattr(settings, 'AI_CIRCUIT_RESET_TIMEOUT', 30),
+        ),
+        'hedge': _hedge_policy(),
+        'fake': _fake_llm_config(),
+        'cassette': _cassette_policy(),
+    }
+
+
+def _cassette_policy():
+    """Recording or replay of upstream calls from settings, or None when AI_LLM_CASSETTE_MODE is 'off'."""
+    mode = getattr(settings, 'AI_LLM_CASSETTE_MODE', 'off') or 'off'
+    if mode == 'off':
+        return None
+    if mode not in CASSETTE_MODES:
+        raise ValueError(f"AI_LLM_CASSETTE_MODE must be one of: off, {', '.join(CASSETTE_MODES)}")
+    return CassettePolicy(
+        mode=mode,
+        path=str(getattr(settings, 'AI_LLM_CASSETTE_PATH', 'llm_cassette.jsonl.gz')),
+        realtime=getattr(settings, 'AI_LLM_CASSETTE_REALTIME', True),
+    )
+
+
+def _fake_llm_config():
+    """The fake backend's settings when AI_LLM_BACKEND is 'fake', else None."""
+    backend = getattr(settings, 'AI_LLM_BACKEND', 'openai') or 'openai'
+    if backend not in LLM_BACKENDS:
+        raise ValueError(f"AI_LLM_BACKEND must be one of: {', '.join(LLM_BACKENDS)}")
+    if backend != 'fake':
+        return None
+    return FakeLLMConfig(
+        script=getattr(settings, 'AI_FAKE_LLM_SCRIPT', ''),
+        latency=getattr(settings, 'AI_FAKE_LLM_LATENCY', 0.0),
+        tokens_per_second=getattr(settings, 'AI_FAKE_LLM_TOKEN_RATE', 0.0),
+        questions=getattr(settings, 'AI_FAKE_LLM_QUESTIONS', 2),
+        tool_calls=getattr(settings, 'AI_FAKE_LLM_TOOL_CALLS', 0),
+        draft_words=getattr(settings, 'AI_FAKE_LLM_DRAFT_WORDS', 400),
+    )
+
+
+def get_llm_backend():
+    """Name of the configured LLM backend ('openai' or 'fake')."""
+    return 'fake' if _fake_llm_config() is not None else 'openai'
+
+
+def _hedge_policy():
+    """Hedging to the secondary endpoint from settings, or None when AI_HEDGE_AFTER is 0."""
+    after = getattr(settings, 'AI_HEDGE_AFTER', 0)
+    if not after:
+        return None
+    return HedgePolicy(
+        after=after,
+        base_url=getattr(settings, 'AI_HEDGE_BASE_URL', '') or getattr(settings, 'LLM_BASE_URL', DEFAULT_BASE_URL),
+        model=getattr(settings, 'AI_HEDGE_MODEL', '') or None,
+        budget=getattr(settings, 'AI_HEDGE_BUDGET', 0.1),
+        api_key=getattr(settings, 'AI_HEDGE_API_KEY', ''),
+    )
+
+
+def _routing_policy():
+    """Fast-model routing from settings, or None when AI_FAST_MODEL is unset."""
+    fast_model = getattr(settings, 'AI_FAST_MODEL', '')
+    if not fast_model:
+        return None
+    return RoutingPolicy(
+        fast_model=fast_model,
+        long_input_tokens=getattr(settings, 'AI_ROUTER_LONG_INPUT_TOKENS', 400),
+        escalate=getattr(settings, 'AI_ROUTER_ESCALATE', True),
+    )
+
+
+def _scratchpad_policy():
+    """Agent iteration limit and tool output compaction budgets from settings."""
+    return ScratchpadPolicy(
+        max_iterations=getattr(settings, 'AI_AGENT_MAX_ITERATIONS', 6),
+        tool_output_tokens=getattr(settings, 'AI_TOOL_OUTPUT_TOKENS', 600),
+        scratchpad_tokens=getattr(settings, 'AI_SCRATCHPAD_TOKENS', 2000),
+    )
+
+
+def get_scratchpad_stats():
+    """Return tool output compaction counts and the prompt tokens it trimmed."""
+    return {**scratchpad_stats.stats(), 'policy': vars(_scratchpad_policy())}
+
+
+def _search_policy():
+    """Legal_Web_Search backend, result cache and rate limit from settings."""
+    backend = getattr(settings, 'AI_SEARCH_BACKEND', 'duckduckgo') or 'duckduckgo'
+    if backend not in SEARCH_BACKENDS:
+        raise ValueError(f"AI_SEARCH_BACKEND must be one of: {', '.join(SEARCH_BACKENDS)}")
+    return SearchPolicy(
+        backend=backend,
+        cache_path=str(getattr(settings, 'AI_SEARCH_CACHE_PATH', '') or ''),
+        cache_ttl=getattr(settings, 'AI_SEARCH_CACHE_TTL', 86400),
+        cache_max_entries=getattr(settings, 'AI_SEARCH_CACHE_MAX_ENTRIES', 5000),
+        rate=getattr(settings, 'AI_SEARCH_RATE', 1.0),
+        burst=getattr(settings, 'AI_SEARCH_BURST', 3),
+        max_wait=getattr(settings, 'AI_SEARCH_MAX_WAIT', 10),
+        stub_latency=getattr(settings, 'AI_SEARCH_STUB_LATENCY', 0.0),
+    )
+
+
+def get_search_stats():
+    """Return how searches were answered (cache, shared, upstream) and rate limiter waits."""
+    policy = _search_policy()
+    return {
+        'backend': policy.backend,
+        **search_stats.stats(),
+        'caches': search_cache_stats(),
+    }
+
+
+def _corpus_policy():
+    """Local legal index search from settings, or None when AI_LEGAL_INDEX_PATH is unset."""
+    index_path = str(getattr(settings, 'AI_LEGAL_INDEX_PATH', '') or '')
+    if not index_path:
+        return None
+    return CorpusPolicy(
+        index_path=index_path,
+        top_k=getattr(settings, 'AI_LEGAL_INDEX_TOP_K', 5),
+        min_coverage=getattr(settings, 'AI_LEGAL_INDEX_MIN_COVERAGE', 0.5),
+    )
+
+
+def get_legal_index_stats():
+    """Return local corpus searches, how many fell back to the web, and the index size."""
+    policy = _corpus_policy()
+    if policy is None:
+        return {'enabled': False}
+    try:
+        index = open_index(policy.index_path).stats()
+    except IndexNotFound as error:
+        index = {'error': str(error)}
+    return {'enabled': True, **corpus_stats.stats(), 'index': index}
+
+
+def get_llm_health_stats():
+    """Return per-model latency percentiles, token usage, retries and circuit breaker state."""
+    return model_health.stats()
+
+
+def get_hedging_stats():
+    """Return how many calls were hedged and which endpoint won them."""
+    return {'enabled': _hedge_policy() is not None, **hedge_stats.stats()}
+
+
+def get_cassette_stats():
+    """Return the cassette mode and how many calls were recorded, replayed or missing."""
+    policy = _cassette_policy()
+    current = next(
+        (stats for stats in cassette_stats() if policy and (stats['path'], stats['mode']) == (policy.path, policy.mode)),
+        None,
+    )
+    return {'mode': policy.mode if policy else 'off', **(current or {})}
+
+
+def get_routing_stats():
+    """Return how many turns each model served and how many were escalated."""
+    routing = _routing_policy()
+    return {
+        'enabled': routing is not None,
+        'fast_model': routing.fast_model if routing else None,
+        'strong_model': _llm_options()['model'],
+        **routing_stats.stats(),
+    }
+
+
+def get_executor_registry_stats():
+    """Return hit/miss counters for the shared agent executor registry."""
+    return agent_registry.stats()
+
+
+def warm_agent_executor():
+    """
+    Build the shared agent executor now, ahead of the first request.
+
+    Raises:
+        ValueError: If no OpenAI API key is configured
+    """
+    _get_agent_executor()
+
+
+def invalidate_agent_executors():
+    """Drop cached agent executors so they are rebuilt from current settings."""
+    agent_registry.invalidate()
+    reset_searches()
+
+
+def _get_response_cache():
+    """Return the process-wide response cache, or None if it is disabled."""
+    global _response_cache
+    if not getattr(settings, 'AI_RESPONSE_CACHE_ENABLED', True):
+        return None
+    with _response_cache_lock:
+        if _response_cache is None:
+            _response_cache = ResponseCache(
+                max_entries=getattr(settings, 'AI_RESPONSE_CACHE_MAX_ENTRIES', 512),
+                ttl=getattr(settings, 'AI_RESPONSE_CACHE_TTL', 3600),
+                path=getattr(settings, 'AI_RESPONSE_CACHE_PATH', '') or None,
+            )
+        return _response_cache
+
+
+def reset_response_cache():
+    """Forget the response caches so they are rebuilt from current settings."""
+    global _response_cache, _semantic_cache
+    with _response_cache_lock:
+        _response_cache = None
+        _semantic_cache = None
+
+
+def get_response_cache_stats():
+    """Return hit rate and size of the response cache."""
+    cache = _get_response_cache()
+    return cache.stats() if cache is not None else {'enabled': False}
+
+
+def _generation_model():
+    """The model(s) and prompt version that answer generation requests."""
+    options = _llm_options()
+    routing = _routing_policy()
+    model = f"{routing.fast_model}|{options['model']}" if routing else options['model']
+    if options['fake'] is not None:
+        # Keep fake replies apart from real ones in a persistent cache
+        model = f"{options['fake']!r}|{model}"
+    return model, CORPUS_PROMPT_VERSION if _corpus_policy() else PROMPT_VERSION
+
+
+def _generation_cache_key(inputs):
+    model, prompt_version = _generation_model()
+    return make_cache_key(
+        model=model,
+        temperature=_llm_options()['temperature'],
+        prompt_version=prompt_version,
+        history=inputs["history"],
+        prompt=inputs["input"],
+    )
+
+
+def _semantic_namespace():
+    """Semantic cache entries only match requests answered by the same model and prompt."""
+    model, prompt_version = _generation_model()
+    return f"{model}|{prompt_version}"
+
+
+def _get_semantic_cache():
+    """Return the process-wide semantic cache, or None if it is off."""
+    global _semantic_cache
+    if getattr(settings, 'AI_SEMANTIC_CACHE_MODE', 'shadow') not in ('shadow', 'on'):
+        return None
+    with _response_cache_lock:
+        if _semantic_cache is None:
+            _semantic_cache = SemanticCache(
+                threshold=getattr(settings, 'AI_SEMANTIC_CACHE_THRESHOLD', 0.9),
+                max_entries=getattr(settings, 'AI_SEMANTIC_CACHE_MAX_ENTRIES', 1024),
+            )
+        return _semantic_cache
+
+
+def get_semantic_cache_stats():
+    """Return hit rate and similarity score distribution of the semantic cache."""
+    cache = _get_semantic_cache()
+    if cache is None:
+        return {'mode': 'off'}
+    return {'mode': getattr(settings, 'AI_SEMANTIC_CACHE_MODE', 'shadow'), **cache.stats()}
+
+
+def _semantic_cache_applies(inputs):
+    """Only early turns (few assistant replies so far) are paraphrase-cacheable."""
+    assistant_turns = sum(1 for msg in inputs["history"] if isinstance(msg, AIMessage))
+    return assistant_turns <= getattr(settings, 'AI_SEMANTIC_CACHE_MAX_TURNS', 0)
+
+
+def _lookup_generation(inputs, use_cache):
+    """
+    Look a generation request up in the exact-match and semantic caches.
+    
+    Returns:
+        tuple: (cache_key, cached result or None, cache info dict or None)
+    """
+    if not use_cache:
+        return None, None, None
+    
+    cache_key = _generation_cache_key(inputs)
+    cache = _get_response_cache()
+    if cache is not None:
+        result = cache.get(cache_key)
+        if result is not None:
+            mark_cached()
+            return cache_key, result, {'type': 'exact'}
+    
+    # In shadow mode the lookup only records similarity scores for tuning
+    semantic_cache = _get_semantic_cache()
+    if semantic_cache is not None and _semantic_cache_applies(inputs):
+        result, similarity = semantic_cache.lookup(
+            inputs["history"], inputs["input"], namespace=_semantic_namespace(),
+            shadow=settings.AI_SEMANTIC_CACHE_MODE != 'on',
+        )
+        if result is not None:
+            mark_cached()
+            return cache_key, result, {'type': 'semantic', 'similarity': round(similarity, 4)}
+    
+    return cache_key, None, None
+
+
+def _store_generation(cache_key, inputs, result):
+    if cache_key is None:
+        return
+    
+    cache = _get_response_cache()
+    if cache is not None:
+        cache.set(cache_key, result)
+    
+    # Drafts carry user-specific details and must never be served to a paraphrase
+    semantic_cache = _get_semantic_cache()
+    if (semantic_cache is not None and _semantic_cache_applies(inputs)
+            and "DRAFT_COMPLETE:" not in result):
+        semantic_cache.store(inputs["history"], inputs["input"], result, namespace=_semantic_namespace())
+
+
+async def _alookup_generation(inputs, use_cache):
+    """
+    Async variant of _lookup_generation. The SQLite tier and the semantic
+    similarity search run in a worker thread, off the event loop.
+    """
+    if not use_cache:
+        return None, None, None
+    return await asyncio.to_thread(_lookup_generation, inputs, use_cache)
+
+
+async def _astore_generation(cache_key, inputs, result):
+    """Async variant of _store_generation, run in a worker thread."""
+    if cache_key is None:
+        return
+    await asyncio.to_thread(_store_generation, cache_key, inputs, result)
+
+
+def _to_langchain_history(conversation_history):
+    """Convert [{"role": ..., "content": ...}] dicts to LangChain messages."""
+    history = []
+    if conversation_history:
+        for msg in conversation_history:
+            if msg.get('role') == 'user':
+                history.append(HumanMessage(content=msg.get('content', '')))
+            elif msg.get('role') == 'assistant':
+                history.append(AIMessage(content=msg.get('content', '')))
+    return history
+
+
+def _resolve_history(conversation_history, session_id=None):
+    """
+    Return the conversation as LangChain messages, read from the session's
+    stored messages when a session id is given.
+    """
+    if session_id:
+        return load_session_history(session_id)
+    return _to_langchain_history(conversation_history)
+
+
+async def _aresolve_history(conversation_history, session_id=None):
+    """Async variant of _resolve_history."""
+    if session_id:
+        return await aload_session_history(session_id)
+    return _to_langchain_history(conversation_history)
+
+
+def get_session_history_stats():
+    """Return hit/miss counters for the server-side session history cache."""
+    return session_history.stats()
+
+
+def get_history_window_stats():
+    """Return token savings of the history window."""
+    return history_window_stats.stats()
+
+
+def _summarize_history(existing_summary, turns):
+    response = _get_chat_model(fast=True).invoke(get_summary_prompt(existing_summary, turns), config=_run_config())
+    return response.content.strip()
+
+
+async def _asummarize_history(existing_summary, turns):
+    response = await _get_chat_model(fast=True).ainvoke(
+        get_summary_prompt(existing_summary, turns), config=_run_config()
+    )
+    return response.content.strip()
+
+
+def _prepare_history(conversation_history, session_id=None):
+    """Resolve the history and fit it into the token budget."""
+    history = _resolve_history(conversation_history, session_id)
+    history, _ = apply_history_window(history, session_id, _summarize_history)
+    return history
+
+
+async def _aprepare_history(conversation_history, session_id=None):
+    """Async variant of _prepare_history."""
+    history = await _aresolve_history(conversation_history, session_id)
+    history, _ = await aapply_history_window(history, session_id, _asummarize_history)
+    return history
+
+
+def _build_generation_inputs(prompt, history):
+    history = list(history)
+    
+    # Add current user message to history
+    history.append(HumanMessage(content=prompt))
+    
+    return {
+        "input": prompt,
+        "history": history
+    }
+
+
+def _finalize_generation(response_content):
+    """Clean the draft if the agent signalled DRAFT_COMPLETE."""
+    if "DRAFT_COMPLETE:" in response_content:
+        draft = response_content.replace("DRAFT_COMPLETE:", "").strip()
+        # Clean the document using existing utility
+        cleaned_draft = clean_legal_document(draft)
+        return f"DRAFT_COMPLETE: {cleaned_draft}"
+    
+    return response_content
+
+
+def _build_refinement_inputs(current_draft, user_request):
+    return {
+        "input": get_refinement_prompt(current_draft, user_request),
+        "history": []  # Empty history for refinement
+    }
+
+
+def _run_config(callbacks=None):
+    """
+    Runnable config carrying the given callbacks plus the handlers of the
+    current cancel token and usage account.
+    """
+    handlers = [*(callbacks or []), *cancellation_callbacks(), *accounting_callbacks()]
+    return {'callbacks': handlers} if handlers else None
+
+
+def _flight_options():
+    """
+    How long a request sharing another's call waits for it (its deadline),
+    and the check that stops the wait once the request itself is cancelled.
+    """
+    token = current_cancel_token()
+    return {
+        'timeout': getattr(settings, 'AI_COALESCE_WAIT_TIMEOUT', 180),
+        'check': token.check if token is not None else None,
+    }
+
+
+def _shared_call_timed_out(error):
+    unavailable = LLMUnavailable("Timed out waiting for an identical request's LLM call")
+    unavailable.__cause__ = error
+    return unavailable
+
+
+def _coalesce(key, fn):
+    """Share one upstream call between concurrent identical requests."""
+    try:
+        result, shared = _inflight.do(key, fn, **_flight_options())
+    except FlightTimeout as error:
+        raise _shared_call_timed_out(error)
+    if shared:
+        report(coalesced=True)
+        mark_cached()
+    return result
+
+
+async def _acoalesce(key, coroutine_fn):
+    try:
+        result, shared = await _inflight.ado(key, coroutine_fn, **_flight_options())
+    except FlightTimeout as error:
+        raise _shared_call_timed_out(error)
+    if shared:
+        report(coalesced=True)
+        mark_cached()
+    return result
+
+
+def get_coalescing_stats():
+    """Return how many requests shared another request's upstream call."""
+    return _inflight.stats()
+
+
+def _generation_flight_key(cache_key, inputs):
+    # Built from the inputs, so requests that bypass the cache coalesce too
+    return f"generate:{cache_key or _generation_cache_key(inputs)}"
+
+
+def _refinement_flight_key(current_draft, user_request, mode):
+    mode = mode or getattr(settings, 'AI_REFINE_MODE', 'full')
+    payload = json.dumps([mode, PROMPT_VERSION, current_draft, normalize_text(user_request)])
+    return f"refine:{hashlib.sha256(payload.encode('utf-8')).hexdigest()}"
+
+
+def _get_refiner(current_draft, user_request, mode=None):
+    """
+    Return the executor-like refiner for mode ("full" or "sections"),
+    defaulting to the AI_REFINE_MODE setting.
+    """
+    mode = mode or getattr(settings, 'AI_REFINE_MODE', 'full')
+    if mode not in REFINE_MODES:
+        raise ValueError(f"Unknown refine mode: {mode}")
+    # Refinements rewrite the document, so they always use the drafting model
+    agent_executor = _get_agent_executor(routed=False)
+    if mode == 'sections':
+        return SectionRefiner(_get_chat_model(), agent_executor, current_draft, user_request)
+    return FullRefiner(agent_executor)
+
+
+def get_refinement_stats():
+    """Return token usage per refine mode against full-rewrite estimates."""
+    return refinement_stats.stats()
+
+
+def generate_legal_document(prompt, conversation_history=None, use_cache=True, session_id=None, callbacks=None):
     """
     Generate legal document using the existing Streamlit modules.
     
@@ -27,114 +648,265 @@ def generate_legal_document(prompt, conversation_history=None):
         prompt (str): User input prompt
         conversation_history (list): List of conversation messages in format:
                                    [{"role": "user", "content": "..."}, {"role": "assistant", "content": "..."}]
+        use_cache (bool): Serve and store identical requests from the response cache
+        session_id (str): Load the history from this chat session instead of
+                          conversation_history
+        callbacks (list): LangChain callback handlers for the agent run,
+                          e.g. to report progress of a background job
     
     Returns:
         str: AI response or document content
+    
+    Raises:
+        SessionNotFound: if session_id does not match a chat session
     """
+    history = _prepare_history(conversation_history, session_id)
     try:
-        # Get API key from Django settings
-        api_key = getattr(settings, 'LLM_API_KEY', '')
-        if not api_key:
-            raise ValueError("LLM_API_KEY not configured in Django settings")
-        
-        # Initialize agent executor
-        agent_executor = get_agent_executor(api_key)
-        
-        # Convert conversation history to LangChain message format
-        history = []
-        if conversation_history:
-            for msg in conversation_history:
-                if msg.get('role') == 'user':
-                    history.append(HumanMessage(content=msg.get('content', '')))
-                elif msg.get('role') == 'assistant':
-                    history.append(AIMessage(content=msg.get('content', '')))
+        inputs = _build_generation_inputs(prompt, history)
+        cache_key, cached, _ = _lookup_generation(inputs, use_cache)
+        if cached is not None:
+            return cached
         
-        # Add current user message to history
-        history.append(HumanMessage(content=prompt))
+        def generate():
+            # Reuse the shared agent executor
+            agent_executor = _get_agent_executor()
+            
+            # Generate response using agent
+            response = agent_executor.invoke(inputs, config=_run_config(callbacks))
+            
+            result = _finalize_generation(response["output"])
+            _store_generation(cache_key, inputs, result)
+            return result
         
-        # Generate response using agent
-        response = agent_executor.invoke({
-            "input": prompt,
-            "history": history
-        })
-        
-        response_content = response["output"]
-        
-        # Check if this is a draft completion
-        if "DRAFT_COMPLETE:" in response_content:
-            draft = response_content.replace("DRAFT_COMPLETE:", "").strip()
-            # Clean the document using existing utility
-            cleaned_draft = clean_legal_document(draft)
-            return f"DRAFT_COMPLETE: {cleaned_draft}"
-        
-        return response_content
+        return _coalesce(_generation_flight_key(cache_key, inputs), generate)
         
+    except LLMUnavailable:
+        raise
     except Exception as e:
         raise Exception(f"Error generating legal document: {str(e)}")
 
 
-def refine_legal_document(current_draft, user_request):
+def _caching_finalizer(cache_key, inputs):
+    def finalize(response_content):
+        result = _finalize_generation(response_content)
+        _store_generation(cache_key, inputs, result)
+        return result
+    return finalize
+
+
+def _acaching_finalizer(cache_key, inputs):
+    async def finalize(response_content):
+        result = _finalize_generation(response_content)
+        await _astore_generation(cache_key, inputs, result)
+        return result
+    return finalize
+
+
+def stream_generate_legal_document(prompt, conversation_history=None, use_cache=True, session_id=None):
+    """
+    Streaming variant of generate_legal_document.
+    
+    Returns:
+        iterator: Server-Sent Events frames (see ai_agent/streaming.py)
+    """
+    history = _prepare_history(conversation_history, session_id)
+    inputs = _build_generation_inputs(prompt, history)
+    cache_key, cached, cache_info = _lookup_generation(inputs, use_cache)
+    if cached is not None:
+        return cached_event_stream(cached, cache_info)
+    
+    agent_executor = _get_agent_executor()
+    return stream_agent_events(
+        agent_executor, inputs, _caching_finalizer(cache_key, inputs), current_cancel_token(),
+        account=current_account(),
+    )
+
+
+def refine_legal_document(current_draft, user_request, mode=None, callbacks=None):
     """
     Refine an existing legal document based on user feedback.
     
     Args:
         current_draft (str): Current document content
         user_request (str): User's refinement request
+        mode (str): "full" rewrites the whole document, "sections" only the
+                    sections that change (defaults to AI_REFINE_MODE)
+        callbacks (list): LangChain callback handlers for the refinement run
     
     Returns:
         str: Updated document content
     """
     try:
-        # Get API key from Django settings
-        api_key = getattr(settings, 'OPENROUTER_API_KEY', '')
-        if not api_key:
-            raise ValueError("OPENROUTER_API_KEY not configured in Django settings")
+        # Mechanical edits ("replace X with Y") are applied without the LLM
+        local_result = refine_locally(current_draft, user_request)
+        if local_result is not None:
+            return local_result
         
-        # Initialize agent executor
-        agent_executor = get_agent_executor(api_key)
+        def refine():
+            refiner = _get_refiner(current_draft, user_request, mode)
+            
+            # Generate refined document
+            response = refiner.invoke(
+                _build_refinement_inputs(current_draft, user_request), config=_run_config(callbacks)
+            )
+            
+            # Clean the document
+            return clean_legal_document(response["output"])
         
-        # Get refinement prompt
-        refinement_input = get_refinement_prompt(current_draft, user_request)
+        return _coalesce(_refinement_flight_key(current_draft, user_request, mode), refine)
         
-        # Generate refined document
-        response = agent_executor.invoke({
-            "input": refinement_input,
-            "history": []  # Empty history for refinement
-        })
+    except LLMUnavailable:
+        raise
+    except Exception as e:
+        raise Exception(f"Error refining legal document: {str(e)}")
+
+
+def stream_refine_legal_document(current_draft, user_request, mode=None):
+    """
+    Streaming variant of refine_legal_document.
+    
+    Returns:
+        iterator: Server-Sent Events frames (see ai_agent/streaming.py)
+    """
+    local_result = refine_locally(current_draft, user_request)
+    if local_result is not None:
+        return result_event_stream(local_result, local=True)
+    
+    refiner = _get_refiner(current_draft, user_request, mode)
+    return stream_agent_events(
+        refiner,
+        _build_refinement_inputs(current_draft, user_request),
+        clean_legal_document,
+        current_cancel_token(),
+        account=current_account(),
+    )
+
+
+async def agenerate_legal_document(prompt, conversation_history=None, use_cache=True, session_id=None):
+    """
+    Async variant of generate_legal_document using `ainvoke`, so an ASGI
+    worker can hold many in-flight LLM calls on one event loop.
+    """
+    history = await _aprepare_history(conversation_history, session_id)
+    try:
+        inputs = _build_generation_inputs(prompt, history)
+        cache_key, cached, _ = await _alookup_generation(inputs, use_cache)
+        if cached is not None:
+            return cached
         
-        updated_draft = response["output"]
-        # Clean the document
-        cleaned_draft = clean_legal_document(updated_draft)
+        async def generate():
+            agent_executor = _get_agent_executor()
+            
+            response = await agent_executor.ainvoke(inputs, config=_run_config())
+            
+            result = _finalize_generation(response["output"])
+            await _astore_generation(cache_key, inputs, result)
+            return result
         
-        return cleaned_draft
+        return await _acoalesce(_generation_flight_key(cache_key, inputs), generate)
         
+    except LLMUnavailable:
+        raise
+    except Exception as e:
+        raise Exception(f"Error generating legal document: {str(e)}")
+
+
+async def astream_generate_legal_document(prompt, conversation_history=None, use_cache=True, session_id=None):
+    """
+    Async streaming variant of generate_legal_document.
+    
+    Returns:
+        async iterator: Server-Sent Events frames
+    """
+    history = await _aprepare_history(conversation_history, session_id)
+    inputs = _build_generation_inputs(prompt, history)
+    cache_key, cached, cache_info = await _alookup_generation(inputs, use_cache)
+    if cached is not None:
+        return acached_event_stream(cached, cache_info)
+    
+    agent_executor = _get_agent_executor()
+    return astream_agent_events(
+        agent_executor, inputs, _acaching_finalizer(cache_key, inputs), current_cancel_token(),
+        account=current_account(),
+    )
+
+
+async def arefine_legal_document(current_draft, user_request, mode=None):
+    """Async variant of refine_legal_document using `ainvoke`."""
+    try:
+        local_result = refine_locally(current_draft, user_request)
+        if local_result is not None:
+            return local_result
+        
+        async def refine():
+            refiner = _get_refiner(current_draft, user_request, mode)
+            
+            response = await refiner.ainvoke(
+                _build_refinement_inputs(current_draft, user_request), config=_run_config()
+            )
+            
+            return clean_legal_document(response["output"])
+        
+        return await _acoalesce(_refinement_flight_key(current_draft, user_request, mode), refine)
+        
+    except LLMUnavailable:
+        raise
     except Exception as e:
         raise Exception(f"Error refining legal document: {str(e)}")
 
 
-def extract_document_details_from_history(conversation_history):
+def astream_refine_legal_document(current_draft, user_request, mode=None):
+    """
+    Async streaming variant of refine_legal_document.
+    
+    Returns:
+        async iterator: Server-Sent Events frames
+    """
+    local_result = refine_locally(current_draft, user_request)
+    if local_result is not None:
+        return aresult_event_stream(local_result, local=True)
+    
+    refiner = _get_refiner(current_draft, user_request, mode)
+    return astream_agent_events(
+        refiner,
+        _build_refinement_inputs(current_draft, user_request),
+        clean_legal_document,
+        current_cancel_token(),
+        account=current_account(),
+    )
+
+
+def extract_document_details_from_history(conversation_history, session_id=None):
     """
     Extract document details from conversation history.
     
     Args:
         conversation_history (list): List of conversation messages
+        session_id (str): Read the history from this chat session instead
     
     Returns:
         dict: Extracted document details
     """
+    # Convert to LangChain message format
+    history = _resolve_history(conversation_history, session_id)
     try:
-        # Convert to LangChain message format
-        history = []
-        if conversation_history:
-            for msg in conversation_history:
-                if msg.get('role') == 'user':
-                    history.append(HumanMessage(content=msg.get('content', '')))
-                elif msg.get('role') == 'assistant':
-                    history.append(AIMessage(content=msg.get('content', '')))
-        
         # Extract details using existing utility
         details = extract_document_details(history)
         return details
         
     except Exception as e:
         raise Exception(f"Error extracting document details: {str(e)}")
+
+
+async def aextract_document_details_from_history(conversation_history, session_id=None):
+    """
+    Async variant of extract_document_details_from_history.
+    
+    The session history is read through the async ORM; extraction itself is
+    pure in-process text processing, so it runs directly on the event loop.
+    """
+    history = await _aresolve_history(conversation_history, session_id)
+    try:
+        return extract_document_details(history)
+    except Exception as e:
+        raise Exception(f"Error extracting document details: {str(e)}")
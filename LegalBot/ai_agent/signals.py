@@ -0,0 +1,122 @@
+from django.core.signals import setting_changed
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from chat.models import Message
+from chat_sessions.models import Session
+
+from .history import session_history
+
+# Settings that change how agent executors are built
+AI_SETTINGS = {
+    'LLM_API_KEY',
+    'LLM_BASE_URL',
+    'AI_MODEL',
+    'AI_TEMPERATURE',
+    'AI_LLM_BACKEND',
+    'AI_FAKE_LLM_SCRIPT',
+    'AI_FAKE_LLM_LATENCY',
+    'AI_FAKE_LLM_TOKEN_RATE',
+    'AI_FAKE_LLM_QUESTIONS',
+    'AI_FAKE_LLM_TOOL_CALLS',
+    'AI_FAKE_LLM_DRAFT_WORDS',
+    'AI_LLM_CASSETTE_MODE',
+    'AI_LLM_CASSETTE_PATH',
+    'AI_LLM_CASSETTE_REALTIME',
+    'AI_FAST_MODEL',
+    'AI_ROUTER_LONG_INPUT_TOKENS',
+    'AI_ROUTER_ESCALATE',
+    'AI_LLM_TIMEOUT',
+    'AI_LLM_MAX_ATTEMPTS',
+    'AI_LLM_BACKOFF_BASE',
+    'AI_LLM_BACKOFF_MAX',
+    'AI_CIRCUIT_FAILURE_THRESHOLD',
+    'AI_CIRCUIT_RESET_TIMEOUT',
+    'AI_FALLBACK_MODEL',
+    'AI_HEDGE_AFTER',
+    'AI_HEDGE_BASE_URL',
+    'AI_HEDGE_API_KEY',
+    'AI_HEDGE_MODEL',
+    'AI_HEDGE_BUDGET',
+    'AI_AGENT_MAX_ITERATIONS',
+    'AI_TOOL_OUTPUT_TOKENS',
+    'AI_SCRATCHPAD_TOKENS',
+    'AI_SEARCH_BACKEND',
+    'AI_SEARCH_CACHE_PATH',
+    'AI_SEARCH_CACHE_TTL',
+    'AI_SEARCH_CACHE_MAX_ENTRIES',
+    'AI_SEARCH_RATE',
+    'AI_SEARCH_BURST',
+    'AI_SEARCH_MAX_WAIT',
+    'AI_SEARCH_STUB_LATENCY',
+    'AI_LEGAL_INDEX_PATH',
+    'AI_LEGAL_INDEX_TOP_K',
+    'AI_LEGAL_INDEX_MIN_COVERAGE',
+}
+
+RESPONSE_CACHE_SETTINGS = {
+    'AI_RESPONSE_CACHE_ENABLED',
+    'AI_RESPONSE_CACHE_MAX_ENTRIES',
+    'AI_RESPONSE_CACHE_TTL',
+    'AI_RESPONSE_CACHE_PATH',
+    'AI_SEMANTIC_CACHE_MODE',
+    'AI_SEMANTIC_CACHE_THRESHOLD',
+    'AI_SEMANTIC_CACHE_MAX_ENTRIES',
+    'AI_SEMANTIC_CACHE_MAX_TURNS',
+}
+
+ADMISSION_SETTINGS = {
+    'AI_MAX_CONCURRENT_CALLS',
+    'AI_MAX_QUEUED_CALLS',
+    'AI_MAX_QUEUED_PER_CLIENT',
+    'AI_QUEUE_TIMEOUT',
+    'AI_PRIORITY_WEIGHTS',
+    'AI_PRIORITY_STARVATION_AFTER',
+    'AI_INTERACTIVE_RESERVED_SLOTS',
+}
+
+
+@receiver(setting_changed)
+def invalidate_agent_executors_on_setting_change(sender, setting, **kwargs):
+    """Rebuild cached agent executors when an AI setting is overridden."""
+    if setting in AI_SETTINGS:
+        from .services import invalidate_agent_executors
+        invalidate_agent_executors()
+
+
+@receiver(setting_changed)
+def reset_response_cache_on_setting_change(sender, setting, **kwargs):
+    """Rebuild the response cache when its configuration changes."""
+    if setting in RESPONSE_CACHE_SETTINGS:
+        from .services import reset_response_cache
+        reset_response_cache()
+
+
+@receiver(setting_changed)
+def reset_admission_controller_on_setting_change(sender, setting, **kwargs):
+    """Rebuild the admission controller when its limits change."""
+    if setting in ADMISSION_SETTINGS:
+        from .concurrency import reset_admission_controller
+        reset_admission_controller()
+
+
+def _reset_history_summary(session_id):
+    # The stored summary indexes into the message list, so it is rebuilt
+    # from scratch whenever earlier messages change
+    Session.objects.filter(pk=session_id).update(history_summary='', summary_message_count=0)
+
+
+@receiver(post_save, sender=Message)
+def update_session_history_on_message_save(sender, instance, created, **kwargs):
+    """Append new messages to the cached history; edits force a reload."""
+    if created:
+        session_history.append(instance.session_id, instance.role, instance.content)
+    else:
+        session_history.invalidate(instance.session_id)
+        _reset_history_summary(instance.session_id)
+
+
+@receiver(post_delete, sender=Message)
+def invalidate_session_history_on_message_delete(sender, instance, **kwargs):
+    session_history.invalidate(instance.session_id)
+    _reset_history_summary(instance.session_id)
@@ -0,0 +1,270 @@
+"""
+Server-Sent Events streaming for the AI agent.
+
+The agent runs in a worker thread (or an asyncio task under ASGI) while a
+callback handler forwards LLM tokens and Legal_Web_Search tool activity
+onto a queue, which the response generator drains and encodes as SSE
+frames.
+"""
+
+import asyncio
+import inspect
+import json
+import queue
+import threading
+import time
+
+from langchain_core.callbacks import AsyncCallbackHandler, BaseCallbackHandler
+from rest_framework.renderers import BaseRenderer
+
+from .accounting import accounting_callbacks
+from .cancellation import CLIENT_DISCONNECTED, GenerationCancelled, cancellation_callbacks
+
+SSE_CONTENT_TYPE = 'text/event-stream'
+
+# Tool output is echoed back to the client for progress display only
+TOOL_OUTPUT_PREVIEW_CHARS = 500
+
+_DONE = object()
+
+
+def format_sse(event, data):
+    """Encode a single Server-Sent Events frame."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def wants_event_stream(request, data=None):
+    """
+    Return True if the client asked for a streamed response.
+
+    Works for both DRF requests and plain Django requests; pass the parsed
+    JSON body as `data` for the latter.
+    """
+    if data is None:
+        data = getattr(request, 'data', {})
+    stream = data.get('stream') if hasattr(data, 'get') else None
+    if stream is None:
+        stream = request.GET.get('stream')
+    if isinstance(stream, str):
+        stream = stream.lower() in ('1', 'true', 'yes')
+    if stream:
+        return True
+    return SSE_CONTENT_TYPE in request.headers.get('Accept', '')
+
+
+class EventStreamRenderer(BaseRenderer):
+    """
+    Lets DRF content negotiation accept `Accept: text/event-stream`.
+
+    Successful streams bypass rendering entirely (they are returned as a
+    StreamingHttpResponse); this only renders error payloads as an SSE
+    `error` event.
+    """
+    media_type = SSE_CONTENT_TYPE
+    format = 'sse'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return format_sse('error', data).encode(self.charset)
+
+
+class QueueCallbackHandler(BaseCallbackHandler):
+    """Forwards agent callbacks onto a queue as (event, data) tuples."""
+
+    def __init__(self, events):
+        self.events = events
+
+    def on_llm_new_token(self, token, **kwargs):
+        # Tool-call chunks arrive with an empty token
+        if token:
+            self.events.put(('token', {'text': token}))
+
+    def on_tool_start(self, serialized, input_str, **kwargs):
+        self.events.put(('tool_start', {
+            'tool': (serialized or {}).get('name') or kwargs.get('name'),
+            'input': input_str,
+        }))
+
+    def on_tool_end(self, output, **kwargs):
+        self.events.put(('tool_end', {
+            'tool': kwargs.get('name'),
+            'output': str(output)[:TOOL_OUTPUT_PREVIEW_CHARS],
+        }))
+
+    def on_tool_error(self, error, **kwargs):
+        self.events.put(('tool_error', {
+            'tool': kwargs.get('name'),
+            'error': str(error),
+        }))
+
+
+class AsyncQueueCallbackHandler(AsyncCallbackHandler):
+    """Async counterpart of QueueCallbackHandler for an asyncio.Queue."""
+
+    def __init__(self, events):
+        self.events = events
+
+    async def on_llm_new_token(self, token, **kwargs):
+        if token:
+            self.events.put_nowait(('token', {'text': token}))
+
+    async def on_tool_start(self, serialized, input_str, **kwargs):
+        self.events.put_nowait(('tool_start', {
+            'tool': (serialized or {}).get('name') or kwargs.get('name'),
+            'input': input_str,
+        }))
+
+    async def on_tool_end(self, output, **kwargs):
+        self.events.put_nowait(('tool_end', {
+            'tool': kwargs.get('name'),
+            'output': str(output)[:TOOL_OUTPUT_PREVIEW_CHARS],
+        }))
+
+    async def on_tool_error(self, error, **kwargs):
+        self.events.put_nowait(('tool_error', {
+            'tool': kwargs.get('name'),
+            'error': str(error),
+        }))
+
+
+class StreamTimer:
+    """Adds elapsed time to every frame and timing metrics to `final`."""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.first_token_at = None
+        self.token_count = 0
+
+    def annotate(self, event, data):
+        now = time.monotonic()
+        if event == 'token':
+            self.token_count += 1
+            if self.first_token_at is None:
+                self.first_token_at = now
+        elif event == 'final':
+            data['metrics'] = {
+                'time_to_first_token_ms': (
+                    round((self.first_token_at - self.started) * 1000, 1)
+                    if self.first_token_at is not None else None
+                ),
+                'total_ms': round((now - self.started) * 1000, 1),
+                'tokens_streamed': self.token_count,
+            }
+        data['elapsed_ms'] = round((now - self.started) * 1000, 1)
+        return data
+
+
+def result_event_stream(result, **fields):
+    """SSE frames for a result produced without streaming: `start` then `final`."""
+    timer = StreamTimer()
+    yield format_sse('start', timer.annotate('start', {}))
+    data = timer.annotate('final', {'result': result, **fields})
+    data['metrics']['time_to_first_token_ms'] = data['metrics']['total_ms']
+    yield format_sse('final', data)
+
+
+async def aresult_event_stream(result, **fields):
+    """Async iterator over result_event_stream, for ASGI responses."""
+    for frame in result_event_stream(result, **fields):
+        yield frame
+
+
+def cached_event_stream(result, cache_info=None):
+    """SSE frames for a response served from cache."""
+    return result_event_stream(result, cached=cache_info or True)
+
+
+def acached_event_stream(result, cache_info=None):
+    """Async variant of cached_event_stream."""
+    return aresult_event_stream(result, cached=cache_info or True)
+
+
+def stream_agent_events(agent_executor, inputs, finalize, cancel_token=None, account=None):
+    """
+    Run the agent and yield SSE frames as it progresses.
+
+    Emits `start`, then `token`/`tool_start`/`tool_end` events as they occur,
+    and finishes with a `final` event carrying `finalize(output)` plus
+    timing metrics (or an `error` event if the agent fails, `cancelled` if
+    cancel_token was cancelled). Closing the generator early cancels
+    cancel_token, which stops the agent thread at its next LLM token. LLM
+    usage is recorded into the usage `account`, if given.
+    """
+    events = queue.Queue()
+    callbacks = [
+        QueueCallbackHandler(events), *cancellation_callbacks(cancel_token), *accounting_callbacks(account),
+    ]
+
+    def run():
+        try:
+            response = agent_executor.invoke(inputs, config={'callbacks': callbacks})
+            events.put(('final', {'result': finalize(response['output'])}))
+        except GenerationCancelled as e:
+            events.put(('cancelled', {'reason': e.reason}))
+        except Exception as e:
+            events.put(('error', {'error': str(e)}))
+        finally:
+            events.put(_DONE)
+
+    timer = StreamTimer()
+    threading.Thread(target=run, daemon=True).start()
+    finished = False
+    try:
+        yield format_sse('start', timer.annotate('start', {}))
+
+        while True:
+            item = events.get()
+            if item is _DONE:
+                finished = True
+                break
+            event, data = item
+            yield format_sse(event, timer.annotate(event, data))
+    finally:
+        if not finished and cancel_token is not None:
+            cancel_token.cancel(CLIENT_DISCONNECTED)
+
+
+async def astream_agent_events(agent_executor, inputs, finalize, cancel_token=None, account=None):
+    """
+    Async variant of stream_agent_events built on `ainvoke`.
+
+    The agent runs as an asyncio task on the event loop; if the client goes
+    away and the response is closed, the task is cancelled with it.
+    finalize may be a coroutine function.
+    """
+    events = asyncio.Queue()
+    callbacks = [
+        AsyncQueueCallbackHandler(events), *cancellation_callbacks(cancel_token), *accounting_callbacks(account),
+    ]
+
+    async def run():
+        try:
+            response = await agent_executor.ainvoke(inputs, config={'callbacks': callbacks})
+            result = finalize(response['output'])
+            if inspect.isawaitable(result):
+                result = await result
+            events.put_nowait(('final', {'result': result}))
+        except GenerationCancelled as e:
+            events.put_nowait(('cancelled', {'reason': e.reason}))
+        except Exception as e:
+            events.put_nowait(('error', {'error': str(e)}))
+        finally:
+            events.put_nowait(_DONE)
+
+    timer = StreamTimer()
+    task = asyncio.ensure_future(run())
+    try:
+        yield format_sse('start', timer.annotate('start', {}))
+        while True:
+            item = await events.get()
+            if item is _DONE:
+                break
+            event, data = item
+            yield format_sse(event, timer.annotate(event, data))
+    finally:
+        if not task.done():
+            if cancel_token is not None:
+                cancel_token.cancel(CLIENT_DISCONNECTED)
+            task.cancel()
@@ -1,3 +1,1607 @@
-from django.test import TestCase
+import asyncio
+import json
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from datetime import timedelta
+from pathlib import Path
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.core.management import call_command
+from django.http import HttpResponse
+from django.test import AsyncClient, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.client import RequestFactory
+from django.utils import timezone
+from langchain_core.agents import AgentAction
+from langchain_core.messages import AIMessage, HumanMessage
+
+from backend.middleware import IdempotencyMiddleware
+from chat.models import Message
+from chat_sessions.models import Session
+from modules.agent import agent_registry, build_llm
+from modules.cache import ResponseCache, make_cache_key
+from modules.cassette import (
+    RECORD, REPLAY, CassetteChatModel, CassetteMiss, CassettePolicy, cassette_tool, reset_cassettes,
+)
+from modules.edits import apply_simple_edit
+from modules.fake_llm import CLARIFYING_QUESTIONS, DRAFT_MARKER, FakeChatModel, FakeLLMConfig, FakeResponder
+from modules.fake_llm_server import FakeLLMServer
+from modules.hedging import HedgeBudget, HedgedChatModel, HedgePolicy, hedge_stats
+from modules.legal_index import open_index, reset_indexes, update_index
+from modules.resilience import CircuitOpenError, LLMUnavailable, ResiliencePolicy, ResilientChatModel, model_health
+from modules.routing import FAST, STRONG, RoutedChatModel, RoutingPolicy, classify_turn
+from modules.scratchpad import (
+    ELIDED_OBSERVATION, SEARCH_LIMIT_NOTE, ScratchpadPolicy, compact_steps, compact_tool_output, split_snippets,
+)
+from modules.search import LegalSearch, SearchPolicy, SearchThrottled, normalize_query
+from modules.semantic_cache import SemanticCache
+from modules.singleflight import FlightTimeout, SingleFlight
+from modules.tokens import count_message_tokens
+
+from . import jobs, services
+from .cancellation import CancelToken, GenerationCancelled, cancellation_stats, cancellations
+from .concurrency import AdmissionController, AdmissionRejected, client_key, get_admission_controller
+from .history import apply_history_window, load_session_history, session_history
+from .models import AIJob, LLMUsageRecord
+from .priority import BACKGROUND, BULK, INTERACTIVE, PRIORITY_CLASSES, WeightedPicker
+
+# Offline agent: the fake LLM backend and canned search results
+fake_ai = override_settings(
+    ALLOWED_HOSTS=['*'],
+    AI_LLM_BACKEND='fake',
+    AI_SEARCH_BACKEND='stub',
+    AI_SEARCH_CACHE_PATH='',
+    AI_LLM_CASSETTE_MODE='off',
+    AI_LEGAL_INDEX_PATH='',
+    AI_FAKE_LLM_QUESTIONS=0,
+    AI_FAKE_LLM_TOOL_CALLS=0,
+    AI_FAKE_LLM_LATENCY=0.0,
+    AI_FAKE_LLM_TOKEN_RATE=0.0,
+    AI_FAKE_LLM_DRAFT_WORDS=80,
+    AI_RESPONSE_CACHE_ENABLED=False,
+    AI_RESPONSE_CACHE_PATH='',
+    AI_SEMANTIC_CACHE_MODE='off',
+)
+
+DRAFT = (
+    "SERVICE AGREEMENT\n\n"
+    "This agreement is made on October 1, 2024 between John Smith and Acme Ltd.\n\n"
+    "1. TERM\n"
+    "The Term of this agreement is one year.\n\n"
+    "2. PAYMENT\n"
+    "John Smith shall pay $1,500 per month.\n\n"
+    "3. GOVERNING LAW\n"
+    "This agreement is governed by the laws of Ontario.\n"
+)
+
+
+def parse_sse(content):
+    """[(event, data), ...] from a Server-Sent Events body."""
+    events = []
+    for frame in content.decode('utf-8').split('\n\n'):
+        fields = dict(line.split(': ', 1) for line in frame.splitlines() if ': ' in line)
+        if 'event' in fields:
+            events.append((fields['event'], json.loads(fields['data'])))
+    return events
+
+
+def post_json(client, path, body, **extra):
+    return client.post(path, json.dumps(body), content_type='application/json', **extra)
+
+
+class FakeBackendTests(SimpleTestCase):
+    def _respond(self, messages, tools=(), **config):
+        return FakeResponder(FakeLLMConfig(**config)).respond(messages, tools)
+
+    def test_asks_questions_then_drafts(self):
+        conversation = [HumanMessage('I need a residential lease')]
+        for turn in range(2):
+            reply = self._respond(conversation, questions=2)
+            self.assertEqual(reply.content, CLARIFYING_QUESTIONS[turn])
+            conversation += [AIMessage(reply.content), HumanMessage('Toronto, Ontario, starting May 1')]
+
+        reply = self._respond(conversation, questions=2)
+
+        self.assertTrue(reply.content.startswith(DRAFT_MARKER))
+        self.assertIn('RESIDENTIAL LEASE', reply.content)
+
+    def test_asking_for_the_draft_skips_the_questions(self):
+        reply = self._respond([HumanMessage('Please draft an NDA now')], questions=2)
+
+        self.assertTrue(reply.content.startswith(DRAFT_MARKER))
+        self.assertIn('NON-DISCLOSURE AGREEMENT', reply.content)
+
+    def test_searches_before_drafting_when_tools_are_bound(self):
+        conversation = [HumanMessage('Please draft a lease now')]
+        reply = self._respond(conversation, tools=('Legal_Web_Search',), tool_calls=1)
+        (name, args, call_id), = reply.tool_calls
+        self.assertEqual((name, args['query']), ('Legal_Web_Search', 'lease requirements Canada'))
+
+        conversation += [AIMessage('', tool_calls=[{'name': name, 'args': args, 'id': call_id}])]
+        self.assertTrue(self._respond(conversation, tools=('Legal_Web_Search',), tool_calls=1)
+                        .content.startswith(DRAFT_MARKER))
+        # Without tools bound the draft comes at once
+        self.assertEqual(self._respond([HumanMessage('Please draft a lease now')], tool_calls=1).tool_calls, ())
+
+    def test_script_rules_take_precedence(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as script:
+            json.dump([
+                {'kind': 'drafting', 'match': r'(?i)\blease\b', 'reply': 'Which province? ({turn})'},
+                {'kind': 'refine', 'reply': '{document}\nAMENDED: {request}'},
+            ], script)
+
+        self.assertEqual(self._respond([HumanMessage('A lease please')], script=script.name).content,
+                         'Which province? (0)')
+        self.assertIn('NON-DISCLOSURE', self._respond([HumanMessage('Please draft an NDA now')],
+                                                      script=script.name).content)
+
+    def test_stream_joins_to_the_invoked_reply(self):
+        model = FakeChatModel(config=FakeLLMConfig(draft_words=60))
+        messages = [HumanMessage('Please draft a will now')]
+
+        streamed = ''.join(chunk.content for chunk in model.stream(messages))
+        invoked = model.invoke(messages)
+
+        self.assertEqual(streamed, invoked.content)
+        self.assertGreater(invoked.usage_metadata['output_tokens'], 0)
+
+    def test_server_speaks_the_openai_protocol(self):
+        with FakeLLMServer(fail_first=1) as server:
+            model = ResilientChatModel(
+                primary=build_llm('fake', model='test/server', base_url=server.base_url, max_retries=0),
+                policy=ResiliencePolicy(base_delay=0.0, max_delay=0.0),
+            )
+            invoked = model.invoke('Please draft a will now')
+            streamed = ''.join(chunk.content for chunk in model.stream('Please draft a will now'))
+
+        self.assertTrue(invoked.content.startswith(DRAFT_MARKER))
+        self.assertEqual(streamed, invoked.content)
+        # The injected 503 was retried
+        self.assertEqual(server.faults.requests, 3)
+
+
+@override_settings(AI_FAKE_LLM_QUESTIONS=1, AI_USAGE_ACCOUNTING=False)
+@fake_ai
+class FakeAgentTests(TestCase):
+    def test_generate_runs_the_agent_offline(self):
+        question = post_json(self.client, '/api/ai/generate/', {'prompt': 'I need an employment contract'})
+        draft = post_json(self.client, '/api/ai/generate/', {
+            'prompt': 'Jane Doe, Ottawa', 'conversation_history': [
+                {'role': 'user', 'content': 'I need an employment contract'},
+                {'role': 'assistant', 'content': question.json()['result']},
+            ],
+        })
+
+        self.assertEqual(question.json()['result'], CLARIFYING_QUESTIONS[0])
+        self.assertTrue(draft.json()['result'].startswith(DRAFT_MARKER))
+        self.assertIn('EMPLOYMENT CONTRACT', draft.json()['result'])
+
+
+@fake_ai
+class ExecutorRegistryTests(TestCase):
+    def setUp(self):
+        agent_registry.invalidate()
+
+    def test_requests_share_one_executor(self):
+        post_json(self.client, '/api/ai/generate/', {'prompt': 'Please draft a lease now'})
+        before = agent_registry.stats()
+
+        post_json(self.client, '/api/ai/generate/', {'prompt': 'Please draft a will now'})
+        after = agent_registry.stats()
+
+        self.assertEqual(after['misses'], before['misses'])
+        self.assertGreater(after['hits'], before['hits'])
+        self.assertEqual(after['http_clients'], before['http_clients'])
+
+    def test_setting_change_rebuilds_executors(self):
+        post_json(self.client, '/api/ai/generate/', {'prompt': 'Please draft a lease now'})
+        self.assertGreater(agent_registry.stats()['executors'], 0)
+
+        with override_settings(AI_TEMPERATURE=0.5):
+            self.assertEqual(agent_registry.stats()['executors'], 0)
+
+    def test_only_staff_can_drop_executors(self):
+        post_json(self.client, '/api/ai/generate/', {'prompt': 'Please draft a lease now'})
+        user = get_user_model().objects.create_user(email='user@example.com', username='user', password='x')
+
+        self.client.force_login(user)
+        self.assertEqual(self.client.delete('/api/ai/metrics/').status_code, 403)
+        self.assertGreater(agent_registry.stats()['executors'], 0)
+
+        user.is_staff = True
+        user.save()
+        self.assertEqual(self.client.delete('/api/ai/metrics/').status_code, 204)
+        self.assertEqual(agent_registry.stats()['executors'], 0)
+
+
+@fake_ai
+class EventStreamTests(TestCase):
+    def test_generate_stream(self):
+        response = post_json(self.client, '/api/ai/generate/', {
+            'prompt': 'Please draft a residential lease for Ontario now', 'stream': True,
+        })
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        events = parse_sse(b''.join(response.streaming_content))
+        names = [name for name, _ in events]
+        self.assertEqual(names[0], 'start')
+        self.assertIn('token', names)
+        self.assertEqual(names[-1], 'final')
+        self.assertTrue(events[-1][1]['result'].startswith('DRAFT_COMPLETE:'))
+
+    def test_refine_stream(self):
+        response = post_json(self.client, '/api/ai/refine/', {
+            'current_draft': DRAFT, 'user_request': 'Add a confidentiality clause', 'stream': True,
+        })
+
+        events = parse_sse(b''.join(response.streaming_content))
+        self.assertEqual(events[0][0], 'start')
+        self.assertEqual(events[-1][0], 'final')
+        self.assertIn('GOVERNING LAW', events[-1][1]['result'])
+
+
+def _on_event_loop():
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+
+@fake_ai
+class AsyncViewTests(TestCase):
+    async def _post(self, path, body):
+        return await AsyncClient().post(path, body, content_type='application/json')
+
+    async def test_async_generate(self):
+        response = await self._post('/api/ai/async/generate/', {'prompt': 'Please draft a will now'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.json()['result'].startswith('DRAFT_COMPLETE:'))
+
+    async def test_async_refine(self):
+        response = await self._post('/api/ai/async/refine/', {
+            'current_draft': DRAFT, 'user_request': 'Add a confidentiality clause',
+        })
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('confidentiality', response.json()['result'])
+
+    async def test_cache_tiers_run_off_the_event_loop(self):
+        calls = []
+
+        def recording(function):
+            def wrapper(*args):
+                calls.append((function.__name__, _on_event_loop()))
+                return function(*args)
+            return wrapper
+
+        with mock.patch('ai_agent.services._lookup_generation', recording(services._lookup_generation)), \
+                mock.patch('ai_agent.services._store_generation', recording(services._store_generation)):
+            await self._post('/api/ai/async/generate/', {'prompt': 'Please draft a will now'})
+            response = await self._post('/api/ai/async/generate/', {'prompt': 'Please draft a lease now',
+                                                                     'stream': True})
+            b''.join([chunk async for chunk in response.streaming_content])
+
+        self.assertEqual(calls, [('_lookup_generation', False), ('_store_generation', False)] * 2)
+
+
+class ResponseCacheTests(SimpleTestCase):
+    def _key(self, prompt, history=()):
+        return make_cache_key('model', 0.2, 'v1', list(history), prompt)
+
+    def test_key_ignores_whitespace_but_not_case(self):
+        self.assertEqual(self._key('Draft  a lease\nin CA'), self._key(' Draft a lease in CA '))
+        self.assertNotEqual(self._key('Draft a lease in CA'), self._key('draft a lease in ca'))
+        self.assertNotEqual(self._key('Yes', [{'role': 'user', 'content': 'John Smith'}]),
+                            self._key('Yes', [{'role': 'user', 'content': 'john smith'}]))
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = ResponseCache(max_entries=2)
+        cache.set('a', 'A')
+        cache.set('b', 'B')
+        cache.get('a')
+        cache.set('c', 'C')
+
+        self.assertEqual((cache.get('a'), cache.get('b'), cache.get('c')), ('A', None, 'C'))
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_entries_expire(self):
+        cache = ResponseCache(ttl=0)
+        cache.set('a', 'A')
+
+        self.assertIsNone(cache.get('a'))
+
+    def test_sqlite_tier_survives_a_restart(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory) / 'responses.sqlite3'
+            ResponseCache(path=path).set('a', 'A')
+
+            cache = ResponseCache(path=path)
+            self.assertEqual(cache.get('a'), 'A')
+            self.assertEqual(cache.stats()['disk_hits'], 1)
+
+
+@override_settings(AI_RESPONSE_CACHE_ENABLED=True, AI_USAGE_ACCOUNTING=False)
+@fake_ai
+class GenerateCacheTests(TestCase):
+    def setUp(self):
+        services.reset_response_cache()
+
+    def _generate(self, prompt, **body):
+        return post_json(self.client, '/api/ai/generate/', {'prompt': prompt, **body})
+
+    def test_repeated_request_is_answered_from_the_cache(self):
+        first = self._generate('Please draft a lease for Jane Doe now')
+        with mock.patch('ai_agent.services._get_agent_executor') as executor:
+            second = self._generate('Please draft a lease  for Jane Doe now')
+
+        executor.assert_not_called()
+        self.assertEqual(second.json(), first.json())
+        self.assertEqual(services.get_response_cache_stats()['hits'], 1)
+
+    def test_case_and_opt_out_miss_the_cache(self):
+        self._generate('Please draft a lease for Jane Doe now')
+        self._generate('Please draft a lease for JANE DOE now')
+        self._generate('Please draft a lease for Jane Doe now', cache=False)
+
+        self.assertEqual(services.get_response_cache_stats()['hits'], 0)
+
+
+class SemanticCacheTests(SimpleTestCase):
+    PROMPT = 'I need a residential lease agreement for my apartment in Toronto'
+    PARAPHRASE = 'I need a residential lease agreement for my Toronto apartment'
+
+    def setUp(self):
+        self.cache = SemanticCache(threshold=0.7, max_entries=8)
+        self.cache.store([], self.PROMPT, 'Which province?', namespace='model-a')
+
+    def test_paraphrase_is_served(self):
+        answer, similarity = self.cache.lookup([], self.PARAPHRASE, namespace='model-a')
+
+        self.assertEqual(answer, 'Which province?')
+        self.assertGreaterEqual(similarity, 0.7)
+
+    def test_unrelated_prompt_misses(self):
+        self.assertIsNone(self.cache.lookup([], 'Write a will leaving my house to my son', namespace='model-a')[0])
+
+    def test_other_namespace_misses(self):
+        self.assertIsNone(self.cache.lookup([], self.PARAPHRASE, namespace='model-b')[0])
+
+    def test_shadow_lookup_only_counts_the_match(self):
+        self.assertIsNone(self.cache.lookup([], self.PARAPHRASE, namespace='model-a', shadow=True)[0])
+        self.assertEqual((self.cache.stats()['shadow_matches'], self.cache.stats()['hits']), (1, 0))
+
+
+@override_settings(AI_SEMANTIC_CACHE_MODE='on', AI_SEMANTIC_CACHE_THRESHOLD=0.7, AI_FAKE_LLM_QUESTIONS=1,
+                   AI_USAGE_ACCOUNTING=False)
+@fake_ai
+class GenerateSemanticCacheTests(TestCase):
+    def setUp(self):
+        services.reset_response_cache()
+
+    def _generate(self, prompt):
+        return post_json(self.client, '/api/ai/generate/', {'prompt': prompt})
+
+    def test_paraphrased_first_turn_is_served(self):
+        first = self._generate(SemanticCacheTests.PROMPT)
+        with mock.patch('ai_agent.services._get_agent_executor') as executor:
+            second = self._generate(SemanticCacheTests.PARAPHRASE)
+
+        executor.assert_not_called()
+        self.assertEqual(second.json(), first.json())
+        self.assertEqual(services.get_semantic_cache_stats()['hits'], 1)
+
+    def test_drafts_are_never_stored(self):
+        self._generate('Please draft a lease for my Toronto apartment now')
+
+        self.assertEqual(services.get_semantic_cache_stats()['stores'], 0)
+
+    def test_other_model_does_not_match(self):
+        self._generate(SemanticCacheTests.PROMPT)
+        with override_settings(AI_MODEL='another/model'):
+            self._generate(SemanticCacheTests.PARAPHRASE)
+
+        self.assertEqual(services.get_semantic_cache_stats()['hits'], 0)
+
+
+@override_settings(AI_FAKE_LLM_QUESTIONS=2, AI_USAGE_ACCOUNTING=False)
+@fake_ai
+class SessionHistoryTests(TestCase):
+    def setUp(self):
+        user = get_user_model().objects.create_user(email='owner@example.com', username='owner', password='x')
+        self.session = Session.objects.create(user=user, title='Employment contract')
+        self._say('user', 'I need an employment contract')
+        self._say('assistant', CLARIFYING_QUESTIONS[0])
+
+    def _say(self, role, content):
+        return Message.objects.create(session=self.session, role=role, content=content)
+
+    def _generate(self, prompt):
+        return post_json(self.client, '/api/ai/generate/', {'prompt': prompt, 'session': str(self.session.id)})
+
+    def test_history_is_read_from_the_session(self):
+        self.assertEqual(self._generate('Jane Doe and Acme Ltd.').json()['result'], CLARIFYING_QUESTIONS[1])
+
+        self._say('user', 'Jane Doe and Acme Ltd.')
+        self._say('assistant', CLARIFYING_QUESTIONS[1])
+        draft = self._generate('Ontario, starting May 1').json()['result']
+
+        self.assertTrue(draft.startswith(DRAFT_MARKER))
+        self.assertIn('EMPLOYMENT CONTRACT', draft)
+
+    def test_saved_messages_extend_the_cached_history(self):
+        self.assertEqual(len(load_session_history(self.session.id)), 2)
+        self._say('user', 'Jane Doe and Acme Ltd.')
+        before = session_history.stats()
+
+        history = load_session_history(self.session.id)
+
+        self.assertEqual(history[-1].content, 'Jane Doe and Acme Ltd.')
+        self.assertEqual(session_history.stats()['hits'], before['hits'] + 1)
+
+    def test_edited_message_is_reloaded(self):
+        message = self._say('user', 'Jane Doe')
+        load_session_history(self.session.id)
+        message.content = 'John Roe'
+        message.save()
+
+        self.assertEqual(load_session_history(self.session.id)[-1].content, 'John Roe')
+
+    def test_unknown_session_is_not_found(self):
+        response = post_json(self.client, '/api/ai/generate/', {'prompt': 'Hello', 'session': str(uuid.uuid4())})
+
+        self.assertEqual(response.status_code, 404)
+
+
+@override_settings(AI_HISTORY_TOKEN_BUDGET=120, AI_USAGE_ACCOUNTING=False)
+@fake_ai
+class HistoryWindowTests(TestCase):
+    def setUp(self):
+        user = get_user_model().objects.create_user(email='owner@example.com', username='owner', password='x')
+        self.session = Session.objects.create(user=user, title='Lease')
+        for turn in range(6):
+            Message.objects.create(session=self.session, role='user', content=f'Detail {turn}: ' + 'rent terms ' * 20)
+            Message.objects.create(session=self.session, role='assistant', content=CLARIFYING_QUESTIONS[turn % 4])
+
+    def test_history_without_a_session_is_truncated(self):
+        history = load_session_history(self.session.id)
+
+        messages, window = apply_history_window(history)
+
+        self.assertLess(len(messages), len(history))
+        self.assertEqual(messages[-1], history[-1])
+        self.assertGreater(window['tokens_saved'], 0)
+        self.assertLessEqual(count_message_tokens(messages), 120)
+
+    def test_older_turns_are_folded_into_the_session_summary(self):
+        response = post_json(self.client, '/api/ai/generate/', {
+            'prompt': 'Please draft the lease now', 'session': str(self.session.id),
+        })
+
+        self.assertEqual(response.status_code, 200)
+        self.assertGreater(int(response['X-AI-History-Tokens-Saved']), 0)
+        self.session.refresh_from_db()
+        self.assertIn('- Detail 0:', self.session.history_summary)
+        self.assertGreater(self.session.summary_message_count, 0)
+
+    def test_failed_summary_falls_back_to_truncation(self):
+        history = load_session_history(self.session.id)
+
+        messages, window = apply_history_window(history, self.session.id, mock.Mock(side_effect=RuntimeError))
+
+        self.assertGreater(window['tokens_saved'], 0)
+        self.assertFalse(window['summary_updated'])
+        self.session.refresh_from_db()
+        self.assertEqual(self.session.history_summary, '')
+
+    @override_settings(AI_HISTORY_TOKEN_BUDGET=0)
+    def test_zero_budget_keeps_the_whole_history(self):
+        history = load_session_history(self.session.id)
+
+        self.assertEqual(apply_history_window(history), (history, None))
+
+
+@override_settings(AI_USAGE_ACCOUNTING=False)
+@fake_ai
+class SectionRefinementTests(TestCase):
+    def _refine(self, user_request, **body):
+        return post_json(self.client, '/api/ai/refine/', {
+            'current_draft': DRAFT, 'user_request': user_request, **body,
+        })
+
+    def test_only_the_matching_section_is_rewritten(self):
+        response = self._refine('Add a late fee to the payment terms', mode='sections')
+
+        result = response.json()['result']
+        self.assertLess(result.index('2. PAYMENT'), result.index('As requested: Add a late fee'))
+        self.assertLess(result.index('As requested: Add a late fee'), result.index('3. GOVERNING LAW'))
+        self.assertIn('governed by the laws of Ontario.', result)
+        self.assertEqual(response['X-AI-Refine-Mode'], 'sections')
+        self.assertLess(int(response['X-AI-Refine-Output-Tokens']), int(response['X-AI-Refine-Full-Rewrite-Tokens']))
+
+    def test_invalid_patch_falls_back_to_a_full_rewrite(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as script:
+            json.dump([{'kind': 'sections', 'reply': 'Sure, here is the change.'}], script)
+        fallbacks = services.get_refinement_stats()['fallbacks']
+
+        with override_settings(AI_FAKE_LLM_SCRIPT=script.name):
+            response = self._refine('Add a late fee to the payment terms', mode='sections')
+
+        self.assertIn('AMENDMENT', response.json()['result'])
+        self.assertEqual(response['X-AI-Refine-Mode'], 'full')
+        self.assertEqual(services.get_refinement_stats()['fallbacks'], fallbacks + 1)
+
+    def test_unknown_mode_is_rejected(self):
+        self.assertEqual(self._refine('Add a late fee', mode='diff').status_code, 400)
+
+    def test_refine_stream_reports_local_edit(self):
+        response = self._refine('Replace John Smith with Jane Doe', stream=True)
+
+        self.assertEqual(response['X-AI-Refine-Mode'], 'local')
+        name, data = parse_sse(b''.join(response.streaming_content))[-1]
+        self.assertEqual(name, 'final')
+        self.assertTrue(data['local'])
+        self.assertNotIn('John Smith', data['result'])
+
+    async def test_async_refine_stream_reports_local_edit(self):
+        response = await AsyncClient().post(
+            '/api/ai/async/refine/',
+            {'current_draft': DRAFT, 'user_request': 'Replace John Smith with Jane Doe', 'stream': True},
+            content_type='application/json',
+        )
+
+        self.assertEqual(response['X-AI-Refine-Mode'], 'local')
+        content = b''.join([chunk async for chunk in response.streaming_content])
+        self.assertEqual(parse_sse(content)[-1][0], 'final')
+
+
+LEASE = (
+    "RESIDENTIAL LEASE\n\n"
+    "The Effective Date of this Lease is October 1, 2024.\n\n"
+    "1. RENT\n"
+    "The Tenant shall pay Rent of $1,500, payable on the first day of each month.\n"
+    "The monthly Rent is $1,500.\n\n"
+    "2. DEPOSIT\n"
+    "The Tenant shall pay a security deposit of $1,500.\n"
+)
+
+
+class LocalEditTests(SimpleTestCase):
+    def test_name_is_replaced_everywhere(self):
+        edited = apply_simple_edit(DRAFT, 'Replace John Smith with Jane Doe')
+
+        self.assertEqual(edited.count('Jane Doe'), 2)
+        self.assertNotIn('John Smith', edited)
+
+    def test_quoted_text_is_replaced(self):
+        edited = apply_simple_edit(DRAFT, 'replace "one year" with "two years"')
+
+        self.assertIn('The Term of this agreement is two years.', edited)
+
+    def test_amount_and_date_are_replaced(self):
+        self.assertIn('$2,000 per month', apply_simple_edit(DRAFT, 'change $1,500 to $2,000'))
+        self.assertIn('made on October 15, 2024', apply_simple_edit(DRAFT, 'change the date to October 15, 2024'))
+
+    def test_capitalized_field_sets_its_value(self):
+        edited = apply_simple_edit(LEASE, 'Set Rent to $2,000')
+
+        self.assertIn('The Tenant shall pay Rent of $2,000, payable', edited)
+        self.assertIn('The monthly Rent is $2,000.', edited)
+        self.assertIn('security deposit of $1,500.', edited)
+
+    def test_capitalized_date_field_sets_its_value(self):
+        edited = apply_simple_edit(LEASE, 'Change Effective Date to October 15, 2024')
+
+        self.assertIn('The Effective Date of this Lease is October 15, 2024.', edited)
+
+    def test_field_description_sets_its_value(self):
+        self.assertEqual(apply_simple_edit(LEASE, 'Set the rent to $2,000'),
+                         apply_simple_edit(LEASE, 'Set Rent to $2,000'))
+
+    def test_amount_stops_before_trailing_punctuation(self):
+        edited = apply_simple_edit(LEASE, 'Change $1,500 to $1,750')
+
+        self.assertIn('Rent of $1,750, payable', edited)
+        self.assertIn('deposit of $1,750.', edited)
+
+    def test_descriptions_go_to_the_model(self):
+        self.assertIsNone(apply_simple_edit(DRAFT, 'change payment terms to net 30 days'))
+        self.assertIsNone(apply_simple_edit(DRAFT, 'set governing law to British Columbia'))
+
+    def test_replacement_is_case_sensitive(self):
+        self.assertIsNone(apply_simple_edit(DRAFT, 'replace "john smith" with "Jane Doe"'))
+
+    def test_headings_are_never_rewritten(self):
+        edited = apply_simple_edit(DRAFT, 'replace "Term" with "Duration"')
+
+        self.assertIn('1. TERM\n', edited)
+        self.assertIn('The Duration of this agreement', edited)
+
+    def test_text_found_only_in_headings_goes_to_the_model(self):
+        self.assertIsNone(apply_simple_edit(DRAFT, 'replace "GOVERNING LAW" with "APPLICABLE LAW"'))
+        self.assertIsNone(apply_simple_edit(DRAFT, 'replace "PAYMENT" with "FEES"'))
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+def queue_in_background(controller, client, admitted, priority=INTERACTIVE):
+    """Acquire a slot from another thread and wait until that request is queued."""
+    depth = controller.stats()['queue_depth']
+
+    def run():
+        slot = controller.acquire(client, priority)
+        admitted.append(client)
+        slot.release()
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    wait_for(lambda: controller.stats()['queue_depth'] > depth)
+    return thread
+
+
+class AdmissionTests(SimpleTestCase):
+    def test_full_queue_is_rejected_with_retry_after(self):
+        controller = AdmissionController(max_concurrent=1, max_queue=1, queue_timeout=5)
+        slot, admitted = controller.acquire('a'), []
+        thread = queue_in_background(controller, 'b', admitted)
+
+        with self.assertRaises(AdmissionRejected) as rejected:
+            controller.acquire('c')
+        slot.release()
+        thread.join()
+
+        self.assertGreaterEqual(rejected.exception.retry_after, 1)
+        self.assertEqual(admitted, ['b'])
+        self.assertEqual(controller.stats()['rejected_queue_full'], 1)
+
+    def test_waiting_clients_are_served_round_robin(self):
+        controller = AdmissionController(max_concurrent=1, max_queue=8, queue_timeout=5)
+        slot, admitted = controller.acquire('holder'), []
+        threads = [queue_in_background(controller, client, admitted) for client in ('a', 'a', 'b')]
+
+        slot.release()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(admitted, ['a', 'b', 'a'])
+
+    def test_client_share_of_the_queue_is_bounded(self):
+        controller = AdmissionController(max_concurrent=1, max_queue=8, max_queued_per_client=1, queue_timeout=5)
+        slot, admitted = controller.acquire('holder'), []
+        thread = queue_in_background(controller, 'a', admitted)
+
+        self.assertRaises(AdmissionRejected, controller.acquire, 'a')
+        slot.release()
+        thread.join()
+
+    def test_wait_times_out(self):
+        controller = AdmissionController(max_concurrent=1, queue_timeout=0.05)
+        controller.acquire('holder')
+
+        with self.assertRaisesMessage(AdmissionRejected, 'Timed out'):
+            controller.acquire('a')
+
+    def test_forwarded_for_is_ignored_without_trusted_proxies(self):
+        request = RequestFactory().post('/', REMOTE_ADDR='10.0.0.5', HTTP_X_FORWARDED_FOR='198.51.100.7')
+
+        self.assertEqual(client_key(request), 'ip:10.0.0.5')
+
+    def test_trusted_proxies_pick_their_forwarded_entry(self):
+        request = RequestFactory().post(
+            '/', REMOTE_ADDR='10.0.0.5', HTTP_X_FORWARDED_FOR='198.51.100.7, 203.0.113.9, 10.0.0.2',
+        )
+
+        with override_settings(AI_TRUSTED_PROXY_COUNT=1):
+            self.assertEqual(client_key(request), 'ip:10.0.0.2')
+        with override_settings(AI_TRUSTED_PROXY_COUNT=2):
+            self.assertEqual(client_key(request), 'ip:203.0.113.9')
+        with override_settings(AI_TRUSTED_PROXY_COUNT=4):
+            self.assertEqual(client_key(request), 'ip:10.0.0.5')
+
+
+@override_settings(AI_MAX_CONCURRENT_CALLS=1, AI_MAX_QUEUED_CALLS=0, AI_USAGE_ACCOUNTING=False)
+@fake_ai
+class AdmissionViewTests(TestCase):
+    def test_busy_server_answers_429(self):
+        slot = get_admission_controller().acquire('ip:10.0.0.9')
+        self.addCleanup(slot.release)
+
+        response = post_json(self.client, '/api/ai/generate/', {'prompt': 'Please draft a will now'})
+
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], str(response.json()['retry_after']))
+
+    def test_slot_is_released_after_the_request(self):
+        for _ in range(2):
+            response = post_json(self.client, '/api/ai/generate/', {'prompt': 'Please draft a will now'})
+            self.assertEqual(response.status_code, 200)
+        self.assertEqual(get_admission_controller().stats()['in_flight'], 0)
+
+
+class UnreachableChatModel(FakeChatModel):
+    """Fake model whose upstream always times out."""
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        raise TimeoutError('upstream timed out')
+
+
+class ResilienceTests(SimpleTestCase):
+    def _resilient(self, primary, fallback=None, **policy):
+        return ResilientChatModel(
+            primary=primary, fallback=fallback,
+            policy=ResiliencePolicy(**{'base_delay': 0.0, 'max_delay': 0.0, **policy}),
+        )
+
+    def _health(self, name):
+        return model_health.stats()['models'][name]
+
+    def test_transient_failure_is_retried(self):
+        primary = FakeChatModel(model_name='test/retried')
+        result = primary._generate([HumanMessage('Please draft a will now')])
+
+        with mock.patch.object(FakeChatModel, '_generate', side_effect=[TimeoutError(), result]):
+            reply = self._resilient(primary).invoke('Please draft a will now')
+
+        self.assertTrue(reply.content.startswith(DRAFT_MARKER))
+        self.assertEqual(self._health('test/retried')['retries'], 1)
+
+    def test_other_errors_are_not_retried(self):
+        primary = FakeChatModel(model_name='test/bad-request')
+
+        with mock.patch.object(FakeChatModel, '_generate', side_effect=ValueError('bad request')) as generate:
+            self.assertRaises(ValueError, self._resilient(primary).invoke, 'Hello')
+
+        self.assertEqual(generate.call_count, 1)
+        self.assertEqual(self._health('test/bad-request')['breaker']['consecutive_failures'], 0)
+
+    def test_open_circuit_fails_fast(self):
+        model = self._resilient(UnreachableChatModel(model_name='test/down'), max_attempts=2, failure_threshold=2)
+
+        self.assertRaises(LLMUnavailable, model.invoke, 'Hello')
+        with self.assertRaises(CircuitOpenError) as raised:
+            model.invoke('Hello')
+
+        health = self._health('test/down')
+        self.assertEqual((health['calls'], health['breaker']['state']), (2, 'open'))
+        self.assertGreater(raised.exception.retry_after, 0)
+
+    def test_fallback_model_answers_when_the_primary_is_down(self):
+        fallbacks = model_health.stats()['fallbacks']
+        model = self._resilient(UnreachableChatModel(model_name='test/primary-down'),
+                                FakeChatModel(model_name='test/fallback'), max_attempts=1)
+
+        self.assertTrue(model.invoke('Please draft a will now').content.startswith(DRAFT_MARKER))
+        self.assertEqual(model_health.stats()['fallbacks'], fallbacks + 1)
+
+
+@override_settings(AI_MODEL='test/unreachable', AI_LLM_MAX_ATTEMPTS=1, AI_CIRCUIT_FAILURE_THRESHOLD=1,
+                   AI_USAGE_ACCOUNTING=False)
+@fake_ai
+class LLMOutageTests(TestCase):
+    def test_outage_answers_503_with_retry_after(self):
+        with mock.patch.object(FakeChatModel, '_generate', side_effect=TimeoutError('upstream timed out')), \
+                mock.patch.object(FakeChatModel, '_stream', side_effect=TimeoutError('upstream timed out')):
+            first = post_json(self.client, '/api/ai/generate/', {'prompt': 'Please draft a will now'})
+            second = post_json(self.client, '/api/ai/generate/', {'prompt': 'Please draft a lease now'})
+
+        self.assertEqual((first.status_code, second.status_code), (503, 503))
+        self.assertIn('circuit breaker is open', second.json()['error'])
+        self.assertGreater(int(second['Retry-After']), 0)
+
+
+class SingleFlightTests(SimpleTestCase):
+    def setUp(self):
+        self.flight = SingleFlight()
+        self.release = threading.Event()
+        self.leader = []
+
+    def _lead_in_background(self, result='draft'):
+        def run():
+            self.leader.append(self.flight.do('key', lambda: self.release.wait(5) and result))
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        wait_for(lambda: self.flight.stats()['in_flight'])
+        self.addCleanup(thread.join)
+        self.addCleanup(self.release.set)
+        return thread
+
+    def test_follower_shares_the_leaders_result(self):
+        thread = self._lead_in_background()
+        follower = []
+        follower_thread = threading.Thread(target=lambda: follower.append(self.flight.do('key', mock.Mock())))
+        follower_thread.start()
+        wait_for(lambda: self.flight.stats()['coalesced'])
+
+        self.release.set()
+        thread.join()
+        follower_thread.join()
+
+        self.assertEqual((self.leader, follower), ([('draft', False)], [('draft', True)]))
+
+    def test_follower_gives_up_on_a_hung_leader(self):
+        self._lead_in_background()
+
+        with self.assertRaises(FlightTimeout):
+            self.flight.do('key', mock.Mock(), timeout=0.2)
+
+    def test_cancelled_follower_stops_waiting(self):
+        thread = self._lead_in_background()
+        token = CancelToken()
+        threading.Timer(0.1, token.cancel).start()
+
+        with self.assertRaises(GenerationCancelled):
+            self.flight.do('key', mock.Mock(), timeout=5, check=token.check)
+        self.release.set()
+        thread.join()
+
+        self.assertEqual(self.leader, [('draft', False)])
+
+    def test_async_follower_gives_up_and_leaves_the_flight(self):
+        thread = self._lead_in_background()
+
+        async def follow():
+            await self.flight.ado('key', mock.AsyncMock(), timeout=0.2)
+
+        with self.assertRaises(FlightTimeout):
+            asyncio.run(follow())
+        # Finishing after the follower's loop has closed must not fail
+        self.release.set()
+        thread.join()
+
+        self.assertEqual(self.leader, [('draft', False)])
+
+
+class ConcurrentRequestTestCase(TransactionTestCase):
+    """Requests that overlap a slow fake LLM call made from another thread."""
+
+    def setUp(self):
+        user = get_user_model().objects.create_user(email='owner@example.com', username='owner', password='x')
+        self.session = Session.objects.create(user=user, title='Lease')
+
+    def _post_in_background(self, body, started):
+        """POST body from another thread and wait until started() says its call is running."""
+        responses = []
+        thread = threading.Thread(
+            target=lambda: responses.append(post_json(self.client_class(), '/api/ai/generate/', body))
+        )
+        thread.start()
+        wait_for(started)
+        return thread, responses
+
+
+@override_settings(AI_FAKE_LLM_LATENCY=0.5, AI_USAGE_ACCOUNTING=False)
+@fake_ai
+class CoalescingTests(ConcurrentRequestTestCase):
+    def _in_flight(self):
+        return services.get_coalescing_stats()['in_flight']
+
+    def test_identical_requests_share_one_call(self):
+        before = services.get_coalescing_stats()['coalesced']
+        body = {'prompt': 'Please draft a mutual NDA now'}
+
+        thread, first = self._post_in_background(body, self._in_flight)
+        second = post_json(self.client, '/api/ai/generate/', body)
+        thread.join()
+
+        self.assertEqual((first[0].status_code, second.status_code), (200, 200))
+        self.assertEqual(first[0].json(), second.json())
+        self.assertEqual(second['X-AI-Coalesced'], 'True')
+        self.assertEqual(services.get_coalescing_stats()['coalesced'], before + 1)
+
+    def test_uncached_identical_requests_share_one_call(self):
+        body = {'prompt': 'Please draft a mutual NDA now', 'cache': False}
+
+        thread, first = self._post_in_background(body, self._in_flight)
+        second = post_json(self.client, '/api/ai/generate/', body)
+        thread.join()
+
+        self.assertEqual(second['X-AI-Coalesced'], 'True')
+        self.assertEqual(first[0].json(), second.json())
+
+    @override_settings(AI_COALESCE_WAIT_TIMEOUT=0.1)
+    def test_follower_gives_up_after_its_deadline(self):
+        body = {'prompt': 'Please draft a mutual NDA now'}
+
+        thread, first = self._post_in_background(body, self._in_flight)
+        second = post_json(self.client, '/api/ai/generate/', body)
+        thread.join()
+
+        self.assertEqual((first[0].status_code, second.status_code), (200, 503))
+
+
+@fake_ai
+class IdempotencyTests(TestCase):
+    def setUp(self):
+        caches['idempotency'].clear()
+
+    def _post(self, body, key):
+        return post_json(self.client, '/api/ai/generate/', body, HTTP_IDEMPOTENCY_KEY=key)
+
+    def test_retry_is_replayed(self):
+        key = uuid.uuid4().hex
+        first = self._post({'prompt': 'Please draft a will now'}, key)
+        with mock.patch('ai_agent.views.generate_legal_document') as generate:
+            retry = self._post({'prompt': 'Please draft a will now'}, key)
+
+        generate.assert_not_called()
+        self.assertEqual(retry.status_code, 200)
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertEqual(retry.content, first.content)
+
+    def test_key_reused_for_another_request(self):
+        key = uuid.uuid4().hex
+        self._post({'prompt': 'Please draft a will now'}, key)
+
+        self.assertEqual(self._post({'prompt': 'Please draft a lease now'}, key).status_code, 422)
+
+    def test_incomplete_responses_are_not_stored(self):
+        for status_code in (499, 429, 503):
+            calls = []
+
+            def view(request):
+                calls.append(request)
+                return HttpResponse(status=status_code)
+
+            middleware = IdempotencyMiddleware(view)
+            for _ in range(2):
+                request = RequestFactory().post(
+                    '/api/ai/generate/', '{}', content_type='application/json',
+                    HTTP_IDEMPOTENCY_KEY=f"retry-{status_code}",
+                )
+                self.assertEqual(middleware(request).status_code, status_code)
+            self.assertEqual(len(calls), 2)
+
+
+@override_settings(AI_MAX_CONCURRENT_CALLS=2, AI_MAX_QUEUED_CALLS=8, AI_USAGE_ACCOUNTING=False)
+@fake_ai
+class BatchTests(TestCase):
+    def test_small_batch_is_answered_in_the_request(self):
+        response = post_json(self.client, '/api/ai/batch-generate/', {
+            'prompt': 'Please draft a lease now',
+            'items': [{'id': 'a', 'details': {'tenant': 'Jane Doe'}}, {'id': 'b'}, 'Please draft a will now'],
+        })
+
+        self.assertEqual(response.status_code, 200)
+        body = response.json()
+        self.assertEqual([result['id'] for result in body['results']], ['a', 'b', 2])
+        self.assertEqual(body['summary']['succeeded'], 3)
+        self.assertIn('WILL', body['results'][2]['result'])
+        self.assertEqual(get_admission_controller().stats()['in_flight'], 0)
+
+    @override_settings(AI_MAX_CONCURRENT_CALLS=1, AI_MAX_QUEUED_CALLS=0, AI_QUEUE_TIMEOUT=0.05)
+    def test_item_without_a_slot_fails_with_429(self):
+        slot = get_admission_controller().acquire('ip:10.0.0.9')
+        self.addCleanup(slot.release)
+
+        response = post_json(self.client, '/api/ai/batch-generate/', {'items': ['Please draft a will now']})
+
+        self.assertEqual(response.status_code, 200)
+        result, = response.json()['results']
+        self.assertEqual((result['status'], result['status_code']), ('error', 429))
+        self.assertEqual(response.json()['summary']['failed'], 1)
+
+    def test_malformed_batch_is_rejected(self):
+        response = post_json(self.client, '/api/ai/batch-generate/', {'items': [{'id': 'a'}]})
+
+        self.assertEqual(response.status_code, 400)
+
+
+@override_settings(AI_JOB_MAX_ATTEMPTS=2, AI_JOB_RETRY_BACKOFF=5, AI_USAGE_ACCOUNTING=False)
+@fake_ai
+class JobTests(TestCase):
+    def _run_next(self):
+        return jobs.run_job(jobs.claim_next('worker-1'), 'worker-1')
+
+    def test_job_is_claimed_once_and_succeeds(self):
+        job = jobs.enqueue('generate', {'prompt': 'Please draft a lease now'})
+
+        claimed = jobs.claim_next('worker-1')
+        self.assertEqual(claimed.pk, job.pk)
+        self.assertIsNone(jobs.claim_next('worker-2'))
+        self.assertTrue(jobs.run_job(claimed, 'worker-1'))
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, AIJob.SUCCEEDED)
+        self.assertTrue(job.result['result'].startswith(DRAFT_MARKER))
+        self.assertEqual(job.progress['stage'], 'done')
+
+    def test_outage_is_retried_with_backoff_then_fails(self):
+        job = jobs.enqueue('generate', {'prompt': 'Please draft a lease now'})
+        failing = mock.Mock(side_effect=LLMUnavailable('LLM unavailable: upstream timed out'))
+
+        with mock.patch.dict(jobs.JOB_HANDLERS, {'generate': failing}):
+            self.assertFalse(self._run_next())
+            job.refresh_from_db()
+            self.assertEqual((job.status, job.attempts), (AIJob.QUEUED, 1))
+            self.assertGreater(job.run_after, timezone.now())
+            self.assertIsNone(jobs.claim_next('worker-1'))
+
+            AIJob.objects.filter(pk=job.pk).update(run_after=timezone.now())
+            self.assertFalse(self._run_next())
+
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (AIJob.FAILED, 2))
+        self.assertEqual(job.error, 'LLM unavailable: upstream timed out')
+
+    def test_other_errors_fail_at_once(self):
+        job = jobs.enqueue('generate', {'prompt': 'Please draft a lease now'})
+        failing = mock.Mock(side_effect=Exception('Error generating legal document: bad request'))
+
+        with mock.patch.dict(jobs.JOB_HANDLERS, {'generate': failing}):
+            self.assertFalse(self._run_next())
+
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (AIJob.FAILED, 1))
+
+    def test_expired_lease_is_claimed_by_another_worker(self):
+        job = jobs.enqueue('generate', {'prompt': 'Please draft a lease now'})
+        jobs.claim_next('worker-1')
+        AIJob.objects.filter(pk=job.pk).update(locked_until=timezone.now() - timedelta(seconds=1))
+
+        claimed = jobs.claim_next('worker-2')
+
+        self.assertEqual(claimed.pk, job.pk)
+        self.assertEqual((claimed.locked_by, claimed.attempts), ('worker-2', 2))
+        self.assertTrue(jobs.run_job(claimed, 'worker-2'))
+
+    def test_refine_job_reports_progress(self):
+        job = jobs.enqueue('refine', {'current_draft': DRAFT, 'user_request': 'Add a confidentiality clause'})
+
+        self.assertTrue(self._run_next())
+
+        job.refresh_from_db()
+        self.assertIn('confidentiality', job.result['result'])
+        self.assertGreaterEqual(job.progress['llm_calls'], 1)
+
+    def test_large_batch_runs_as_job(self):
+        response = post_json(self.client, '/api/ai/batch-generate/', {
+            'prompt': 'Please draft an NDA now', 'items': [{'details': {'party': n}} for n in range(3)], 'async': True,
+        })
+
+        self.assertEqual(response.status_code, 202)
+        job = jobs.claim_next('worker-1')
+        self.assertEqual((job.kind, job.priority), ('batch', 'bulk'))
+        jobs.run_job(job, 'worker-1')
+
+        data = self.client.get(response.json()['status_url']).json()
+        self.assertEqual(data['status'], AIJob.SUCCEEDED)
+        self.assertEqual(data['progress']['completed'], 3)
+        self.assertEqual(data['result']['summary']['succeeded'], 3)
+
+    async def _stream(self, job):
+        response = await AsyncClient().get(f'/api/ai/jobs/{job.pk}/?stream=true')
+        return parse_sse(b''.join([chunk async for chunk in response.streaming_content]))
+
+    async def test_stream_ends_with_the_result(self):
+        job = await AIJob.objects.acreate(kind='generate', payload={}, status=AIJob.SUCCEEDED, result={'result': 'x'})
+
+        (name, data), = await self._stream(job)
+
+        self.assertEqual((name, data['result']), ('final', {'result': 'x'}))
+
+    @override_settings(AI_JOB_STREAM_MAX_SECONDS=0)
+    async def test_stream_of_a_stuck_job_is_closed(self):
+        job = await AIJob.objects.acreate(kind='generate', payload={}, status=AIJob.RUNNING)
+
+        events = await self._stream(job)
+
+        self.assertEqual([name for name, _ in events], ['status', 'timeout'])
+        self.assertEqual(events[-1][1]['status'], AIJob.RUNNING)
+
+
+class PriorityTests(SimpleTestCase):
+    def test_weighted_picks_interleave_the_classes(self):
+        picker = WeightedPicker({INTERACTIVE: 8, BACKGROUND: 3, BULK: 1})
+
+        picks = [picker.pick(PRIORITY_CLASSES) for _ in range(12)]
+
+        self.assertEqual([picks.count(cls) for cls in PRIORITY_CLASSES], [8, 3, 1])
+        self.assertEqual(picks[:3], [INTERACTIVE, BACKGROUND, INTERACTIVE])
+        self.assertEqual(picker.pick([BULK]), BULK)
+
+    def test_reserved_slot_is_kept_for_interactive_requests(self):
+        controller = AdmissionController(max_concurrent=2, queue_timeout=0.05, reserved_interactive=1)
+        controller.acquire('batch:a', BULK)
+
+        self.assertRaises(AdmissionRejected, controller.acquire, 'batch:b', BULK)
+        controller.acquire('ip:10.0.0.1', INTERACTIVE)
+        self.assertEqual(controller.stats()['in_flight'], 2)
+
+    def test_waiting_interactive_request_goes_first(self):
+        controller = AdmissionController(max_concurrent=1, max_queue=8, queue_timeout=5)
+        slot, admitted = controller.acquire('holder'), []
+        threads = [
+            queue_in_background(controller, 'batch:a', admitted, BULK),
+            queue_in_background(controller, 'ip:10.0.0.1', admitted, INTERACTIVE),
+        ]
+
+        slot.release()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(admitted, ['ip:10.0.0.1', 'batch:a'])
+
+    def test_starving_request_is_served_first(self):
+        controller = AdmissionController(max_concurrent=1, max_queue=8, queue_timeout=5, starvation_after=0.05)
+        slot, admitted = controller.acquire('holder'), []
+        threads = [queue_in_background(controller, 'batch:a', admitted, BULK)]
+        time.sleep(0.1)
+        threads.append(queue_in_background(controller, 'ip:10.0.0.1', admitted, INTERACTIVE))
+
+        slot.release()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(admitted, ['batch:a', 'ip:10.0.0.1'])
+        self.assertEqual(controller.stats()['starvation_promotions'], 1)
+
+
+@override_settings(AI_FAKE_LLM_LATENCY=0.5, AI_USAGE_ACCOUNTING=False)
+@fake_ai
+class CancellationTests(ConcurrentRequestTestCase):
+    def _cancelled(self, reason):
+        return cancellation_stats.stats()['by_reason'][reason]
+
+    def test_cancelled_token_stops_the_run(self):
+        token = CancelToken()
+        token.check()
+
+        self.assertTrue(token.cancel())
+        self.assertFalse(token.cancel())
+        with self.assertRaises(GenerationCancelled) as raised:
+            token.check()
+        self.assertEqual(raised.exception.reason, 'cancelled')
+
+    def test_identical_session_request_joins_running_call(self):
+        body = {'prompt': 'Please draft a lease now', 'session': str(self.session.id), 'cache': False}
+
+        thread, first = self._post_in_background(body, cancellations.in_flight)
+        second = post_json(self.client, '/api/ai/generate/', body)
+        thread.join()
+
+        self.assertEqual((first[0].status_code, second.status_code), (200, 200))
+
+    def test_new_session_request_supersedes_running_call(self):
+        thread, first = self._post_in_background(
+            {'prompt': 'Please draft a lease now', 'session': str(self.session.id)}, cancellations.in_flight
+        )
+        second = post_json(self.client, '/api/ai/generate/', {
+            'prompt': 'Please draft an NDA now', 'session': str(self.session.id),
+        })
+        thread.join()
+
+        self.assertEqual(first[0].status_code, 499)
+        self.assertEqual(first[0].json()['reason'], 'superseded')
+        self.assertEqual(second.status_code, 200)
+
+    def test_session_cancel_endpoint_stops_running_call(self):
+        thread, first = self._post_in_background(
+            {'prompt': 'Please draft a lease now', 'session': str(self.session.id)}, cancellations.in_flight
+        )
+        response = self.client.post(f'/api/ai/sessions/{self.session.id}/cancel/')
+        thread.join()
+
+        self.assertEqual(response.json(), {'cancelled': 1})
+        self.assertEqual((first[0].status_code, first[0].json()['reason']), (499, 'cancelled'))
+        self.assertEqual(cancellations.in_flight(), 0)
+
+    def test_closing_a_stream_cancels_its_call(self):
+        before = self._cancelled('client_disconnected')
+        response = post_json(self.client, '/api/ai/generate/', {'prompt': 'Please draft a lease now', 'stream': True})
+
+        next(iter(response.streaming_content))
+        response.close()
+
+        self.assertEqual(self._cancelled('client_disconnected'), before + 1)
+        self.assertEqual(cancellations.in_flight(), 0)
+
+
+class RoutingTests(SimpleTestCase):
+    policy = RoutingPolicy(fast_model='test/fast', long_input_tokens=50)
+
+    def _routed(self, fast_config=FakeLLMConfig(questions=1)):
+        return RoutedChatModel(
+            fast=FakeChatModel(model_name='test/fast', config=fast_config),
+            strong=FakeChatModel(model_name='test/strong'),
+            policy=self.policy,
+        )
+
+    def _route(self, *messages):
+        return classify_turn(list(messages), self.policy)
+
+    def test_turns_are_classified(self):
+        self.assertEqual(self._route(HumanMessage('I need a lease')), (FAST, 'clarifying'))
+        self.assertEqual(self._route(HumanMessage('Please draft the lease now')), (STRONG, 'draft_requested'))
+        self.assertEqual(self._route(HumanMessage('clause ' * 60)), (STRONG, 'long_input'))
+        self.assertEqual(
+            self._route(HumanMessage('I need a will'), AIMessage(f"{DRAFT_MARKER} LAST WILL"), HumanMessage('Thanks')),
+            (STRONG, 'draft_revision'),
+        )
+
+    def test_clarifying_turn_uses_the_fast_model(self):
+        reply = self._routed().invoke([HumanMessage('I need a lease')])
+
+        self.assertEqual(reply.response_metadata['model_name'], 'test/fast')
+        self.assertEqual(reply.content, CLARIFYING_QUESTIONS[0])
+
+    def test_draft_uses_the_strong_model(self):
+        reply = self._routed().invoke([HumanMessage('Please draft the lease now')])
+
+        self.assertEqual(reply.response_metadata['model_name'], 'test/strong')
+        self.assertTrue(reply.content.startswith(DRAFT_MARKER))
+
+    def test_fast_draft_is_escalated(self):
+        before = services.get_routing_stats()['escalations']
+        routed = self._routed(FakeLLMConfig(questions=0))
+
+        invoked = routed.invoke([HumanMessage('I need a lease')])
+        streamed = list(routed.stream([HumanMessage('I need a lease')]))
+
+        self.assertEqual(invoked.response_metadata['model_name'], 'test/strong')
+        self.assertEqual(''.join(chunk.content for chunk in streamed), invoked.content)
+        self.assertEqual({chunk.response_metadata.get('model_name') for chunk in streamed} - {None}, {'test/strong'})
+        self.assertEqual(services.get_routing_stats()['escalations'], before + 2)
+
+    @fake_ai
+    @override_settings(AI_FAST_MODEL='test/fast', AI_FAKE_LLM_QUESTIONS=1, AI_USAGE_ACCOUNTING=False)
+    def test_agent_routes_each_turn(self):
+        before = services.get_routing_stats()['routes']
+
+        question = post_json(self.client, '/api/ai/generate/', {'prompt': 'I need an employment contract'})
+        draft = post_json(self.client, '/api/ai/generate/', {
+            'prompt': 'Please draft it now',
+            'conversation_history': [
+                {'role': 'user', 'content': 'I need an employment contract'},
+                {'role': 'assistant', 'content': question.json()['result']},
+            ],
+        })
+
+        routes = services.get_routing_stats()['routes']
+        self.assertFalse(question.json()['result'].startswith(DRAFT_MARKER))
+        self.assertTrue(draft.json()['result'].startswith(DRAFT_MARKER))
+        self.assertEqual((routes[FAST] - before[FAST], routes[STRONG] - before[STRONG]), (1, 1))
+
+
+@mock.patch('modules.hedging.hedge_budget', HedgeBudget())
+class HedgingTests(SimpleTestCase):
+    def _hedged(self, primary_latency):
+        return HedgedChatModel(
+            primary=FakeChatModel(model_name='test/primary', config=FakeLLMConfig(latency=primary_latency)),
+            secondary=FakeChatModel(model_name='test/secondary'),
+            policy=HedgePolicy(after=0.05, base_url='http://hedge.invalid/v1'),
+        )
+
+    def _counts(self):
+        stats = hedge_stats.stats()
+        return stats['hedged'], stats['secondary_wins']
+
+    def test_fast_primary_is_not_hedged(self):
+        before = self._counts()
+
+        reply = self._hedged(0.0).invoke('Please draft a will now')
+
+        self.assertEqual(reply.response_metadata['model_name'], 'test/primary')
+        self.assertEqual(self._counts(), before)
+
+    def test_slow_primary_loses_to_the_hedge(self):
+        hedged, wins = self._counts()
+
+        reply = self._hedged(1.0).invoke('Please draft a will now')
+        chunks = list(self._hedged(1.0).stream('Please draft a will now'))
+
+        self.assertEqual(reply.response_metadata['model_name'], 'test/secondary')
+        self.assertEqual(''.join(chunk.content for chunk in chunks), reply.content)
+        self.assertEqual(self._counts(), (hedged + 2, wins + 2))
+
+    async def test_async_hedge_cancels_the_primary(self):
+        before = hedge_stats.stats()['losers_cancelled']
+
+        reply = await self._hedged(1.0).ainvoke('Please draft a will now')
+
+        self.assertEqual(reply.response_metadata['model_name'], 'test/secondary')
+        self.assertEqual(hedge_stats.stats()['losers_cancelled'], before + 1)
+
+    def test_budget_limits_hedges(self):
+        budget = HedgeBudget(burst=1)
+
+        self.assertTrue(budget.try_spend())
+        self.assertFalse(budget.try_spend())
+        budget.earn(0.5)
+        self.assertFalse(budget.try_spend())
+        budget.earn(0.5)
+        self.assertTrue(budget.try_spend())
+
+
+class CassetteTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.addCleanup(reset_cassettes)
+        self.path = str(Path(directory.name) / 'calls.jsonl.gz')
+
+    def _model(self, mode, inner=None):
+        return CassetteChatModel(
+            inner=inner or FakeChatModel(model_name='test/recorded'),
+            policy=CassettePolicy(mode=mode, path=self.path, realtime=False),
+        )
+
+    def test_replay_answers_without_calling_upstream(self):
+        recorded = self._model(RECORD).invoke('Please draft a will now')
+        streamed = ''.join(chunk.content for chunk in self._model(RECORD).stream('Please draft a lease now'))
+        reset_cassettes()
+
+        replay = self._model(REPLAY, UnreachableChatModel(model_name='test/recorded'))
+
+        self.assertEqual(replay.invoke('Please draft a will now').content, recorded.content)
+        self.assertEqual(''.join(chunk.content for chunk in replay.stream('Please draft a lease now')), streamed)
+        self.assertRaises(CassetteMiss, replay.invoke, 'Please draft an NDA now')
+
+    def test_tool_outputs_are_replayed(self):
+        policy = CassettePolicy(mode=RECORD, path=self.path, realtime=False)
+        cassette_tool(policy, 'Legal_Web_Search', 'lease law Ontario', lambda: 'Residential Tenancies Act')
+        reset_cassettes()
+
+        search = mock.Mock()
+        output = cassette_tool(CassettePolicy(mode=REPLAY, path=self.path, realtime=False),
+                               'Legal_Web_Search', 'lease law Ontario', search)
+
+        self.assertEqual(output, 'Residential Tenancies Act')
+        search.assert_not_called()
+
+    @fake_ai
+    @override_settings(AI_FAKE_LLM_TOOL_CALLS=1, AI_USAGE_ACCOUNTING=False)
+    def test_searching_conversation_is_replayed(self):
+        body = {'prompt': 'Please draft a lease now'}
+        with override_settings(AI_LLM_CASSETTE_MODE='record', AI_LLM_CASSETTE_PATH=self.path):
+            recorded = post_json(self.client, '/api/ai/generate/', body).json()['result']
+        reset_cassettes()
+
+        with override_settings(AI_LLM_CASSETTE_MODE='replay', AI_LLM_CASSETTE_PATH=self.path,
+                               AI_LLM_CASSETTE_REALTIME=False, AI_LLM_BACKEND='openai', LLM_API_KEY=''), \
+                mock.patch('modules.search.StubSearchBackend.search', side_effect=AssertionError('searched')):
+            replayed = post_json(self.client, '/api/ai/generate/', body).json()['result']
+            stats = services.get_cassette_stats()
+
+        self.assertEqual(replayed, recorded)
+        self.assertEqual((stats['mode'], stats['misses']), ('replay', 0))
+        # Two LLM calls around one search
+        self.assertEqual(stats['replayed'], 3)
+
+
+@override_settings(AI_MODEL='test/priced', AI_MODEL_PRICES={'test/priced': [1.0, 2.0]})
+@fake_ai
+class AccountingTests(TestCase):
+    def setUp(self):
+        services.reset_response_cache()
+        self.addCleanup(services.reset_response_cache)
+        self.user = get_user_model().objects.create_user(email='owner@example.com', username='owner', password='x')
+        self.session = Session.objects.create(user=self.user, title='Will')
+
+    def _generate(self, prompt='Please draft a will now'):
+        return post_json(self.client, '/api/ai/generate/', {'prompt': prompt, 'session': str(self.session.id)})
+
+    def test_request_usage_is_recorded(self):
+        self._generate()
+
+        record = LLMUsageRecord.objects.get()
+        self.assertEqual((record.kind, record.status, record.model), ('generate', 'ok', 'test/priced'))
+        self.assertEqual((record.session, record.user), (self.session, self.user))
+        self.assertEqual(record.llm_calls, 1)
+        self.assertGreater(record.prompt_tokens, 0)
+        self.assertGreater(record.completion_tokens, 0)
+        expected = (record.prompt_tokens * 1 + record.completion_tokens * 2) / 1_000_000
+        self.assertAlmostEqual(float(record.cost), expected)
+
+    @override_settings(AI_RESPONSE_CACHE_ENABLED=True)
+    def test_cached_answer_is_recorded_as_cached(self):
+        self._generate()
+        self._generate()
+
+        first, second = LLMUsageRecord.objects.order_by('created_at', 'id')
+        self.assertFalse(first.cached)
+        self.assertTrue(second.cached)
+        self.assertEqual((second.llm_calls, second.prompt_tokens), (0, 0))
+
+    def test_local_edit_is_not_recorded(self):
+        post_json(self.client, '/api/ai/refine/', {
+            'current_draft': DRAFT, 'user_request': 'Replace John Smith with Jane Doe',
+        })
+
+        self.assertFalse(LLMUsageRecord.objects.exists())
+
+    def test_usage_endpoint_aggregates_own_records(self):
+        self._generate()
+        self.assertEqual(self.client.get('/api/ai/usage/').status_code, 401)
+
+        self.client.force_login(self.user)
+        totals = self.client.get('/api/ai/usage/').json()['totals']
+        self.assertEqual((totals['requests'], totals['llm_calls']), (1, 1))
+
+        other = get_user_model().objects.create_user(email='other@example.com', username='other', password='x')
+        self.client.force_login(other)
+        self.assertEqual(self.client.get('/api/ai/usage/').json()['totals']['requests'], 0)
+
+
+class ScratchpadTests(SimpleTestCase):
+    RESULT = (
+        "Under the Residential Tenancies Act, 2006, S.O. 2006, c. 17, s. 134 a landlord may not collect "
+        "a security deposit. Tenants should know their rights. "
+        "Under the Residential Tenancies Act, 2006, S.O. 2006, c. 17, s. 134 a landlord may not collect "
+        "a security deposit. Visit our store for great deals on furniture and home decor items today."
+    )
+
+    def _step(self, query, observation):
+        return AgentAction('Legal_Web_Search', {'query': query}, ''), observation
+
+    def test_snippets_split_on_sentences_not_citations(self):
+        self.assertEqual(
+            split_snippets('See R.S.O. 1990, s. 5 of the Act. The tenant pays rent.'),
+            ['See R.S.O. 1990, s. 5 of the Act.', 'The tenant pays rent.'],
+        )
+
+    def test_result_is_deduplicated_and_ranked_to_the_budget(self):
+        compacted = compact_tool_output(self.RESULT, 'security deposit landlord Ontario', budget=40)
+
+        self.assertEqual(compacted.count('security deposit'), 1)
+        self.assertTrue(compacted.startswith('Under the Residential Tenancies Act'))
+        self.assertNotIn('furniture', compacted)
+
+    def test_older_results_are_elided_beyond_the_budget(self):
+        steps = [self._step(f'lease question {n}', f'Finding {n}. ' + 'word ' * 50) for n in range(3)]
+
+        compacted = compact_steps(steps, ScratchpadPolicy(max_iterations=0, tool_output_tokens=0,
+                                                          scratchpad_tokens=80))
+
+        observations = [observation for _, observation in compacted]
+        self.assertEqual(observations[0], ELIDED_OBSERVATION)
+        self.assertEqual(observations[2], steps[2][1])
+        self.assertEqual([action for action, _ in compacted], [action for action, _ in steps])
+
+    def test_last_allowed_search_tells_the_agent_to_answer(self):
+        steps = [self._step('lease deposit', 'A deposit is limited.')]
+
+        self.assertNotIn(SEARCH_LIMIT_NOTE, compact_steps(steps, ScratchpadPolicy(max_iterations=3))[-1][1])
+        self.assertTrue(compact_steps(steps * 2, ScratchpadPolicy(max_iterations=3))[-1][1]
+                        .endswith(SEARCH_LIMIT_NOTE))
+
+
+class SearchTests(SimpleTestCase):
+    def _search(self, **policy):
+        search = LegalSearch(SearchPolicy(**{'backend': 'stub', 'rate': 0, **policy}))
+        upstream = mock.Mock(wraps=search.backend.search)
+        search.backend.search = upstream
+        return search, upstream
+
+    def test_query_is_normalized(self):
+        self.assertEqual(normalize_query('  Lease Law, ONTARIO?  site:canlii.org OR'), 'lease law ontario')
+
+    def test_equivalent_queries_hit_the_cache(self):
+        search, upstream = self._search()
+
+        first = search.search('Lease law Ontario')
+        second = search.search('lease law, ontario site:justice.gc.ca')
+
+        self.assertEqual(first, second)
+        upstream.assert_called_once_with('lease law ontario')
+        self.assertEqual(search.cache.stats()['hits'], 1)
+
+    def test_cache_persists_across_processes(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = str(Path(directory.name) / 'search.sqlite3')
+        self._search(cache_path=path)[0].search('Lease law Ontario')
+
+        search, upstream = self._search(cache_path=path)
+        search.search('Lease law Ontario')
+
+        upstream.assert_not_called()
+
+    def test_concurrent_identical_searches_share_one_call(self):
+        search, upstream = self._search(cache_ttl=0, stub_latency=0.2)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(search.search('notice period'))) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(set(results)), 1)
+        upstream.assert_called_once()
+
+    def test_rate_limit_throttles_instead_of_waiting_long(self):
+        search, upstream = self._search(cache_ttl=0, rate=0.01, burst=1, max_wait=0.1)
+
+        search.search('notice period')
+
+        self.assertRaises(SearchThrottled, search.search, 'limitation period')
+        self.assertEqual(upstream.call_count, 1)
+
+    def test_upstream_rate_limit_pauses_searches(self):
+        class RatelimitException(Exception):
+            pass
+
+        search, upstream = self._search(cache_ttl=0, rate=10, max_wait=1)
+        upstream.side_effect = RatelimitException('202 Ratelimit')
+
+        self.assertRaises(RatelimitException, search.search, 'notice period')
+        self.assertRaises(SearchThrottled, search.search, 'notice period')
+        self.assertEqual(upstream.call_count, 1)
+
+
+class LegalIndexTests(SimpleTestCase):
+    def setUp(self):
+        self.root = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.root)
+        self.addCleanup(reset_indexes)
+        self.corpus = self.root / 'corpus'
+        self.corpus.mkdir()
+        self.index = self.root / 'index'
+        self._write('rta.txt', 'Residential Tenancies Act. A landlord shall not collect a security deposit '
+                               'other than a rent deposit for the last month of the tenancy.')
+        self._write('esa.txt', 'Employment Standards Act. An employer shall give written notice of '
+                               'termination to an employee employed for three months or more.')
+
+    def _write(self, name, text):
+        (self.corpus / name).write_text(text, encoding='utf-8')
+
+    def _top_source(self, query):
+        hits = open_index(self.index).search(query, top_k=1)
+        return hits[0].source if hits else None
+
+    def test_build_and_search(self):
+        summary = update_index(self.corpus, self.index)
+
+        self.assertEqual((summary['added'], summary['rebuilt']), (2, True))
+        self.assertEqual(self._top_source('landlord security deposit'), 'rta.txt')
+        self.assertEqual(self._top_source('termination notice employee'), 'esa.txt')
+        self.assertEqual(open_index(self.index).search('gardening tips'), [])
+
+    def test_update_reindexes_only_changed_files(self):
+        update_index(self.corpus, self.index)
+        self._write('esa.txt', 'Employment Standards Act. Overtime pay is owed after 44 hours of work in a week.')
+        self._write('wills.txt', 'Succession Law Reform Act. A will must be signed by the testator '
+                                 'before two witnesses.')
+
+        summary = update_index(self.corpus, self.index)
+
+        self.assertEqual(
+            (summary['added'], summary['changed'], summary['unchanged'], summary['rebuilt']), (1, 1, 1, False)
+        )
+        self.assertEqual(self._top_source('overtime hours'), 'esa.txt')
+        self.assertIsNone(self._top_source('termination notice'))
+        self.assertEqual(self._top_source('testator witnesses'), 'wills.txt')
+
+    def test_removed_file_leaves_the_index(self):
+        update_index(self.corpus, self.index)
+        (self.corpus / 'rta.txt').unlink()
+
+        self.assertEqual(update_index(self.corpus, self.index)['removed'], 1)
+        self.assertIsNone(self._top_source('landlord security deposit'))
+        self.assertEqual(open_index(self.index).stats()['files'], 1)
+
+    def test_build_legal_index_command(self):
+        call_command('build_legal_index', str(self.corpus), index=str(self.index), stdout=mock.Mock())
+
+        self.assertEqual(open_index(self.index).stats()['files'], 2)
+
+    @fake_ai
+    @override_settings(AI_FAKE_LLM_TOOL_CALLS=1, AI_USAGE_ACCOUNTING=False)
+    def test_agent_searches_the_index(self):
+        update_index(self.corpus, self.index)
+        with override_settings(AI_LEGAL_INDEX_PATH=str(self.index)):
+            before = services.get_legal_index_stats()['queries']
+            response = post_json(self.client, '/api/ai/generate/', {'prompt': 'Please draft an Ontario lease now'})
+
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(services.get_legal_index_stats()['queries'], before + 1)
@@ -3,12 +3,32 @@ from .views import (
     GenerateLegalDocumentView,
     RefineLegalDocumentView,
     ExtractDocumentDetailsView,
-    HealthCheckView
+    BatchGenerateView,
+    AIJobListView,
+    AIJobDetailView,
+    AIJobCancelView,
+    SessionCancelView,
+    AsyncGenerateLegalDocumentView,
+    AsyncRefineLegalDocumentView,
+    AsyncExtractDocumentDetailsView,
+    HealthCheckView,
+    AIMetricsView,
+    AIUsageView,
 )
 
 urlpatterns = [
     path('generate/', GenerateLegalDocumentView.as_view(), name='generate_legal_document'),
     path('refine/', RefineLegalDocumentView.as_view(), name='refine_legal_document'),
     path('extract-details/', ExtractDocumentDetailsView.as_view(), name='extract_document_details'),
+    path('batch-generate/', BatchGenerateView.as_view(), name='batch_generate'),
+    path('jobs/', AIJobListView.as_view(), name='ai_job_list'),
+    path('jobs/<uuid:job_id>/', AIJobDetailView.as_view(), name='ai_job_detail'),
+    path('jobs/<uuid:job_id>/cancel/', AIJobCancelView.as_view(), name='ai_job_cancel'),
+    path('sessions/<uuid:session_id>/cancel/', SessionCancelView.as_view(), name='ai_session_cancel'),
+    path('async/generate/', AsyncGenerateLegalDocumentView.as_view(), name='async_generate_legal_document'),
+    path('async/refine/', AsyncRefineLegalDocumentView.as_view(), name='async_refine_legal_document'),
+    path('async/extract-details/', AsyncExtractDocumentDetailsView.as_view(), name='async_extract_document_details'),
     path('health/', HealthCheckView.as_view(), name='ai_health_check'),
+    path('metrics/', AIMetricsView.as_view(), name='ai_metrics'),
+    path('usage/', AIUsageView.as_view(), name='ai_usage'),
 ]
@@ -1,12 +1,113 @@
+import json
+import math
+from datetime import datetime, time
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.http import JsonResponse, StreamingHttpResponse
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from django.utils.decorators import method_decorator
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
-from rest_framework.permissions import AllowAny
+from rest_framework.permissions import AllowAny, IsAdminUser, IsAuthenticated
+from rest_framework.renderers import JSONRenderer
+from backend.middleware import idempotency_stats
+from modules.resilience import LLMUnavailable
+
 from .services import (
     generate_legal_document, 
+    stream_generate_legal_document,
+    agenerate_legal_document,
+    astream_generate_legal_document,
     refine_legal_document, 
-    extract_document_details_from_history
+    stream_refine_legal_document,
+    arefine_legal_document,
+    astream_refine_legal_document,
+    extract_document_details_from_history,
+    aextract_document_details_from_history,
+    get_executor_registry_stats,
+    get_response_cache_stats,
+    get_semantic_cache_stats,
+    get_session_history_stats,
+    get_history_window_stats,
+    get_refinement_stats,
+    get_coalescing_stats,
+    get_llm_health_stats,
+    get_routing_stats,
+    get_hedging_stats,
+    get_llm_backend,
+    get_cassette_stats,
+    get_scratchpad_stats,
+    get_search_stats,
+    get_legal_index_stats,
+    invalidate_agent_executors,
 )
+from .accounting import accounted, accounting_stats, usage_summary
+from .cancellation import cancellable, cancellation_stats, cancellations
+from .batch import BatchValidationError, build_batch_items, run_batch
+from .concurrency import admission_controlled, client_key, get_admission_stats
+from .jobs import JobValidationError, cancel_job, enqueue, get_job_stats, job_event_stream, serialize_job
+from .models import AIJob, LLMUsageRecord
+from .priority import BACKGROUND, BULK
+from .history import SessionNotFound
+from .refinement import REFINE_MODES
+from .reporting import report_headers, start_report
+from .streaming import SSE_CONTENT_TYPE, EventStreamRenderer, wants_event_stream
+
+
+def event_stream_response(frames):
+    """Wrap SSE frames in a response that proxies will not buffer."""
+    response = StreamingHttpResponse(frames, content_type=SSE_CONTENT_TYPE)
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def with_report_headers(response, call_report):
+    """Expose the per-request AI report as X-AI-* response headers."""
+    for name, value in report_headers(call_report).items():
+        response[name] = value
+    return response
+
+
+def llm_unavailable_response(error):
+    """503 for an upstream outage, with Retry-After when the circuit is open."""
+    response = JsonResponse({'error': str(error)}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+    if error.retry_after:
+        response['Retry-After'] = str(math.ceil(error.retry_after))
+    return response
+
+
+def parse_usage_since(value):
+    """An ISO date (midnight) or datetime, made timezone-aware."""
+    try:
+        moment = parse_datetime(value)
+        if moment is None:
+            day = parse_date(value)
+            moment = datetime.combine(day, time.min) if day is not None else None
+    except ValueError:
+        moment = None
+    if moment is None:
+        raise ValueError('since must be an ISO date or datetime.')
+    return timezone.make_aware(moment) if timezone.is_naive(moment) else moment
+
+
+def cache_allowed(request, data=None):
+    """
+    Per-request response cache opt-out: "cache": false in the body or a
+    `Cache-Control: no-cache` header bypasses the cache entirely.
+    """
+    if data is None:
+        data = request.data
+    if data.get('cache', True) in (False, 'false', '0', 0):
+        return False
+    return 'no-cache' not in request.headers.get('Cache-Control', '')
+
 
 class GenerateLegalDocumentView(APIView):
     """
@@ -19,26 +120,68 @@ class GenerateLegalDocumentView(APIView):
         "conversation_history": [
             {"role": "user", "content": "..."},
             {"role": "assistant", "content": "..."}
-        ]
+        ],
+        "cache": true
     }
     
     Response:
     {
         "result": "AI response or DRAFT_COMPLETE: [document content]"
     }
+
+    Instead of conversation_history, clients may send "session": "<id>" and
+    the history is read from that session's stored messages. Histories over
+    AI_HISTORY_TOKEN_BUDGET keep their latest turns verbatim and the rest
+    as a summary; X-AI-History-Tokens-Saved reports the saving.
+
+    Identical requests are answered from the response cache unless
+    "cache" is false or the request sends `Cache-Control: no-cache`.
+
+    Requests are admitted as interactive work; send "priority":
+    "background" or "bulk" (or an `X-AI-Priority` header) for work nobody
+    is waiting on, so it yields to chat turns.
+
+    Send "stream": true (or `Accept: text/event-stream`) to receive
+    Server-Sent Events instead: `token` events as the LLM writes,
+    `tool_start`/`tool_end` around Legal_Web_Search, and a `final` event
+    with the cleaned result and time-to-first-token metrics.
+
+    A different request for the same "session" cancels one still running
+    for it, which then ends with status 499 (or a `cancelled` event when
+    streamed). An identical request (a retry) shares the running call instead.
+    Closing a streamed response also stops the LLM call.
     """
     permission_classes = [AllowAny]  # Allow access without authentication
+    renderer_classes = [JSONRenderer, EventStreamRenderer]
 
+    @cancellable(supersede=True)
+    @admission_controlled
+    @accounted('generate')
     def post(self, request):
         prompt = request.data.get('prompt')
         conversation_history = request.data.get('conversation_history', None)
+        session_id = request.data.get('session')
         
         if not prompt:
             return Response({'error': 'Prompt is required.'}, status=status.HTTP_400_BAD_REQUEST)
         
+        use_cache = cache_allowed(request)
+        call_report = start_report()
         try:
-            result = generate_legal_document(prompt, conversation_history)
-            return Response({'result': result})
+            if wants_event_stream(request):
+                return with_report_headers(event_stream_response(
+                    stream_generate_legal_document(
+                        prompt, conversation_history, use_cache=use_cache, session_id=session_id
+                    )
+                ), call_report)
+            result = generate_legal_document(
+                prompt, conversation_history, use_cache=use_cache, session_id=session_id
+            )
+            return with_report_headers(Response({'result': result}), call_report)
+        except SessionNotFound as e:
+            return Response({'error': str(e)}, status=status.HTTP_404_NOT_FOUND)
+        except LLMUnavailable as e:
+            return llm_unavailable_response(e)
         except Exception as e:
             return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
@@ -51,28 +194,49 @@ class RefineLegalDocumentView(APIView):
     Request Body:
     {
         "current_draft": "Current document content...",
-        "user_request": "Please change the date to October 15, 2024"
+        "user_request": "Please change the date to October 15, 2024",
+        "mode": "sections"  // optional, "full" or "sections" (default AI_REFINE_MODE)
     }
     
     Response:
     {
         "result": "Updated document content"
     }
+
+    "sections" asks the model for the changed sections only and splices
+    them into the draft, falling back to "full" if the reply is not a
+    valid patch. Supports the same "stream": true mode as /api/ai/generate/.
     """
     permission_classes = [AllowAny]
+    renderer_classes = [JSONRenderer, EventStreamRenderer]
 
+    @cancellable
+    @admission_controlled
+    @accounted('refine')
     def post(self, request):
         current_draft = request.data.get('current_draft')
         user_request = request.data.get('user_request')
+        mode = request.data.get('mode')
         
         if not current_draft or not user_request:
             return Response({
                 'error': 'Both current_draft and user_request are required.'
             }, status=status.HTTP_400_BAD_REQUEST)
+        if mode and mode not in REFINE_MODES:
+            return Response({
+                'error': f"mode must be one of: {', '.join(REFINE_MODES)}."
+            }, status=status.HTTP_400_BAD_REQUEST)
         
+        call_report = start_report()
         try:
-            result = refine_legal_document(current_draft, user_request)
-            return Response({'result': result})
+            if wants_event_stream(request):
+                return with_report_headers(event_stream_response(
+                    stream_refine_legal_document(current_draft, user_request, mode)
+                ), call_report)
+            result = refine_legal_document(current_draft, user_request, mode)
+            return with_report_headers(Response({'result': result}), call_report)
+        except LLMUnavailable as e:
+            return llm_unavailable_response(e)
         except Exception as e:
             return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
@@ -89,6 +253,7 @@ class ExtractDocumentDetailsView(APIView):
             {"role": "assistant", "content": "..."}
         ]
     }
+    or {"session": "<id>"} to use the session's stored messages.
     
     Response:
     {
@@ -102,16 +267,338 @@ class ExtractDocumentDetailsView(APIView):
     """
     permission_classes = [AllowAny]
 
+    @admission_controlled
     def post(self, request):
         conversation_history = request.data.get('conversation_history', [])
+        session_id = request.data.get('session')
         
         try:
-            details = extract_document_details_from_history(conversation_history)
+            details = extract_document_details_from_history(conversation_history, session_id=session_id)
             return Response({'details': details})
+        except SessionNotFound as e:
+            return Response({'error': str(e)}, status=status.HTTP_404_NOT_FOUND)
+        except Exception as e:
+            return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+class BatchGenerateView(APIView):
+    """
+    Generate many documents in one call.
+
+    POST /api/ai/batch-generate/
+    Request Body:
+    {
+        "prompt": "Draft a mutual NDA",  // optional, shared by items without their own prompt
+        "items": [
+            {"id": "c-1", "details": {"contractor": "Jane Doe", "start_date": "2025-03-01"}},
+            {"id": "c-2", "prompt": "Draft a one-way NDA for Acme Ltd"},
+            "Draft an NDA for a freelance designer"
+        ],
+        "max_parallel": 4,  // optional, capped at AI_BATCH_MAX_PARALLEL
+        "async": false,     // optional, force a job even for small batches
+        "cache": true
+    }
+
+    Response (200), for batches of up to AI_BATCH_SYNC_LIMIT items:
+    {
+        "results": [
+            {"index": 0, "id": "c-1", "status": "ok", "result": "...", "elapsed_ms": 8123.4, "report": {...}},
+            {"index": 1, "id": "c-2", "status": "error", "error": "...", "elapsed_ms": 301.0, "report": {}},
+            ...
+        ],
+        "summary": {"items": 3, "succeeded": 2, "failed": 1, "parallelism": 3, "elapsed_ms": 9120.7, ...}
+    }
+
+    Response (202), for larger batches, queued as a "batch" job:
+    {"job_id": "<id>", "status": "queued", "status_url": "/api/ai/jobs/<id>/"}
+
+    Items run in parallel and each one takes an admission slot, so failed
+    items never fail the whole batch.
+    """
+    permission_classes = [AllowAny]
+
+    def post(self, request):
+        try:
+            items = build_batch_items(request.data.get('items'), request.data.get('prompt'))
+            max_parallel = int(request.data.get('max_parallel') or 0) or None
+        except (BatchValidationError, TypeError, ValueError) as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        use_cache = cache_allowed(request)
+        client = client_key(request)
+        run_as_job = request.data.get('async') in (True, 'true', '1', 1)
+        if run_as_job or len(items) > getattr(settings, 'AI_BATCH_SYNC_LIMIT', 5):
+            payload = {
+                'items': request.data.get('items'),
+                'prompt': request.data.get('prompt'),
+                'max_parallel': max_parallel,
+                'cache': use_cache,
+            }
+            job = enqueue('batch', payload, client=client, priority=BULK)
+            return Response({
+                'job_id': str(job.id),
+                'status': job.status,
+                'status_url': reverse('ai_job_detail', args=[job.id]),
+            }, status=status.HTTP_202_ACCEPTED)
+
+        try:
+            return Response(run_batch(items, client, use_cache=use_cache, max_parallel=max_parallel))
+        except LLMUnavailable as e:
+            return llm_unavailable_response(e)
         except Exception as e:
             return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
+class AIJobListView(APIView):
+    """
+    Queue an AI request to run in the background.
+
+    POST /api/ai/jobs/
+    Request Body: "kind" plus the body of the matching endpoint, e.g.
+    {
+        "kind": "generate",  // generate | refine | extract_details | batch
+        "priority": "background",  // optional: interactive | background | bulk
+        "prompt": "I need a property transfer agreement",
+        "session": "<id>"
+    }
+
+    Response (202):
+    {"job_id": "<id>", "status": "queued", "status_url": "/api/ai/jobs/<id>/"}
+
+    Jobs are run by `python manage.py run_ai_worker`.
+    """
+    permission_classes = [AllowAny]
+
+    def post(self, request):
+        payload = {
+            key: value for key, value in request.data.items() if key not in ('kind', 'stream', 'priority')
+        }
+        try:
+            job = enqueue(
+                request.data.get('kind'), payload, client=client_key(request),
+                priority=request.data.get('priority') or BACKGROUND,
+            )
+        except JobValidationError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({
+            'job_id': str(job.id),
+            'status': job.status,
+            'status_url': reverse('ai_job_detail', args=[job.id]),
+        }, status=status.HTTP_202_ACCEPTED)
+
+
+class AIJobDetailView(APIView):
+    """
+    Status, progress and result of a background AI job.
+
+    GET /api/ai/jobs/<id>/
+    Response:
+    {
+        "job_id": "<id>",
+        "kind": "generate",
+        "status": "running",  // queued | running | succeeded | failed | cancelled
+        "progress": {"stage": "searching", "llm_calls": 2, "searches": 1, "tokens": 0},
+        "result": null,       // once succeeded: {"result": "..."}, {"details": {...}} or {"results": [...], "summary": {...}}
+        "error": null,
+        "attempts": 1,
+        ...
+    }
+
+    With `?stream=true` (or `Accept: text/event-stream`) the job is
+    followed as Server-Sent Events: `status` on every change, then
+    `final` with the job on success, `error` on failure or `cancelled`.
+    The stream closes with `timeout` after AI_JOB_STREAM_MAX_SECONDS.
+    """
+    permission_classes = [AllowAny]
+    renderer_classes = [JSONRenderer, EventStreamRenderer]
+
+    def get(self, request, job_id):
+        job = AIJob.objects.filter(pk=job_id).first()
+        if job is None:
+            return Response({'error': 'Job not found.'}, status=status.HTTP_404_NOT_FOUND)
+        if wants_event_stream(request):
+            return event_stream_response(job_event_stream(job.pk))
+        return Response(serialize_job(job))
+
+
+class AIJobCancelView(APIView):
+    """
+    Cancel a background AI job.
+
+    POST /api/ai/jobs/<id>/cancel/
+    Response (200): the job, as from GET /api/ai/jobs/<id>/
+
+    A queued job is cancelled at once. A running job is marked and its
+    worker stops the LLM call within AI_JOB_POLL_INTERVAL seconds, so the
+    response may still show "running". Finished jobs give 409.
+    """
+    permission_classes = [AllowAny]
+
+    def post(self, request, job_id):
+        job = AIJob.objects.filter(pk=job_id).first()
+        if job is None:
+            return Response({'error': 'Job not found.'}, status=status.HTTP_404_NOT_FOUND)
+        job = cancel_job(job)
+        if job.status in (AIJob.SUCCEEDED, AIJob.FAILED):
+            return Response({
+                'error': f"Job already {job.status}.", **serialize_job(job)
+            }, status=status.HTTP_409_CONFLICT)
+        return Response(serialize_job(job))
+
+
+class SessionCancelView(APIView):
+    """
+    Stop the AI calls running for a chat session.
+
+    POST /api/ai/sessions/<id>/cancel/
+    Response:
+    {"cancelled": 1}
+
+    The cancelled requests end with status 499, or a `cancelled` event
+    when streamed. Only calls served by this server process are reached.
+    """
+    permission_classes = [AllowAny]
+
+    def post(self, request, session_id):
+        return Response({'cancelled': cancellations.cancel_session(session_id)})
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncAIView(View):
+    """
+    Base class for native async AI views.
+
+    These are plain Django async views rather than DRF APIViews, so under
+    ASGI they run directly on the event loop and one worker can hold many
+    in-flight LLM calls. Request and response bodies match the sync views.
+    """
+    http_method_names = ['post', 'options']
+
+    @staticmethod
+    def parse_json(request):
+        try:
+            data = json.loads(request.body or b'{}')
+        except (ValueError, UnicodeDecodeError):
+            return None
+        return data if isinstance(data, dict) else None
+
+
+class AsyncGenerateLegalDocumentView(AsyncAIView):
+    """
+    Async version of GenerateLegalDocumentView.
+
+    POST /api/ai/async/generate/
+    Same request/response format as /api/ai/generate/, including "stream".
+    Under ASGI a client disconnect cancels the LLM call even when not streaming.
+    """
+
+    @cancellable(supersede=True)
+    @admission_controlled
+    @accounted('generate')
+    async def post(self, request):
+        data = self.parse_json(request)
+        if data is None:
+            return JsonResponse({'error': 'Invalid JSON body.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        prompt = data.get('prompt')
+        conversation_history = data.get('conversation_history', None)
+        session_id = data.get('session')
+
+        if not prompt:
+            return JsonResponse({'error': 'Prompt is required.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        use_cache = cache_allowed(request, data)
+        call_report = start_report()
+        try:
+            if wants_event_stream(request, data):
+                return with_report_headers(event_stream_response(
+                    await astream_generate_legal_document(
+                        prompt, conversation_history, use_cache=use_cache, session_id=session_id
+                    )
+                ), call_report)
+            result = await agenerate_legal_document(
+                prompt, conversation_history, use_cache=use_cache, session_id=session_id
+            )
+            return with_report_headers(JsonResponse({'result': result}), call_report)
+        except SessionNotFound as e:
+            return JsonResponse({'error': str(e)}, status=status.HTTP_404_NOT_FOUND)
+        except LLMUnavailable as e:
+            return llm_unavailable_response(e)
+        except Exception as e:
+            return JsonResponse({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+class AsyncRefineLegalDocumentView(AsyncAIView):
+    """
+    Async version of RefineLegalDocumentView.
+
+    POST /api/ai/async/refine/
+    Same request/response format as /api/ai/refine/, including "stream".
+    """
+
+    @cancellable
+    @admission_controlled
+    @accounted('refine')
+    async def post(self, request):
+        data = self.parse_json(request)
+        if data is None:
+            return JsonResponse({'error': 'Invalid JSON body.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        current_draft = data.get('current_draft')
+        user_request = data.get('user_request')
+        mode = data.get('mode')
+
+        if not current_draft or not user_request:
+            return JsonResponse({
+                'error': 'Both current_draft and user_request are required.'
+            }, status=status.HTTP_400_BAD_REQUEST)
+        if mode and mode not in REFINE_MODES:
+            return JsonResponse({
+                'error': f"mode must be one of: {', '.join(REFINE_MODES)}."
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        call_report = start_report()
+        try:
+            if wants_event_stream(request, data):
+                return with_report_headers(event_stream_response(
+                    astream_refine_legal_document(current_draft, user_request, mode)
+                ), call_report)
+            result = await arefine_legal_document(current_draft, user_request, mode)
+            return with_report_headers(JsonResponse({'result': result}), call_report)
+        except LLMUnavailable as e:
+            return llm_unavailable_response(e)
+        except Exception as e:
+            return JsonResponse({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+class AsyncExtractDocumentDetailsView(AsyncAIView):
+    """
+    Async version of ExtractDocumentDetailsView.
+
+    POST /api/ai/async/extract-details/
+    Same request/response format as /api/ai/extract-details/.
+    """
+
+    @admission_controlled
+    async def post(self, request):
+        data = self.parse_json(request)
+        if data is None:
+            return JsonResponse({'error': 'Invalid JSON body.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        conversation_history = data.get('conversation_history', [])
+        session_id = data.get('session')
+
+        try:
+            details = await aextract_document_details_from_history(
+                conversation_history, session_id=session_id
+            )
+            return JsonResponse({'details': details})
+        except SessionNotFound as e:
+            return JsonResponse({'error': str(e)}, status=status.HTTP_404_NOT_FOUND)
+        except Exception as e:
+            return JsonResponse({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
 class HealthCheckView(APIView):
     """
     Health check endpoint to verify AI agent is working.
@@ -121,6 +608,7 @@ class HealthCheckView(APIView):
     {
         "status": "healthy",
         "ai_configured": true,
+        "llm_backend": "openai",
         "modules_loaded": true
     }
     """
@@ -130,8 +618,9 @@ class HealthCheckView(APIView):
         try:
             from django.conf import settings
             
-            # Check if API key is configured
-            api_key_configured = bool(getattr(settings, 'OPENROUTER_API_KEY', ''))
+            # Check if API key is configured (the offline fake backend needs none)
+            llm_backend = get_llm_backend()
+            api_key_configured = bool(getattr(settings, 'LLM_API_KEY', '')) or llm_backend == 'fake'
             
             # Try to import modules
             modules_loaded = True
@@ -144,6 +633,7 @@ class HealthCheckView(APIView):
             return Response({
                 'status': 'healthy',
                 'ai_configured': api_key_configured,
+                'llm_backend': llm_backend,
                 'modules_loaded': modules_loaded,
                 'debug_mode': settings.DEBUG
             })
@@ -152,3 +642,116 @@ class HealthCheckView(APIView):
                 'status': 'error',
                 'error': str(e)
             }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+class AIMetricsView(APIView):
+    """
+    Runtime metrics for the AI agent.
+
+    GET /api/ai/metrics/
+    Response:
+    {
+        "executor_registry": {"hits": 41, "misses": 1, "hit_rate": 0.976, ...},
+        "response_cache": {"hits": 12, "misses": 30, "bytes_stored": 48213, ...},
+        "semantic_cache": {"mode": "shadow", "score_histogram": {...}, ...},
+        "session_history": {"hits": 88, "misses": 9, "appends": 170, ...},
+        "history_window": {"budget": 6000, "tokens_saved": 91234, ...},
+        "refinement": {"sections": {"calls": 7, "tokens_saved": 20311, ...}, "fallbacks": 1, ...},
+        "admission": {"in_flight": 4, "queue_depth": 2, "wait_p95_ms": 8410.2, ...},
+        "llm": {"fallbacks": 0, "models": {"<model>": {"latency_p99_ms": 9120.4, "output_tokens": 80412, "breaker": {...}, ...}}},
+        "routing": {"enabled": true, "routes": {"fast": 61, "strong": 14}, "escalations": 3, ...},
+        "hedging": {"enabled": true, "calls": 75, "hedged": 6, "secondary_wins": 4, ...},
+        "scratchpad": {"results_compacted": 9, "prompts": 14, "tokens_trimmed": 30211, "trim_ratio": 0.81, ...},
+        "search": {"backend": "duckduckgo", "searches": 40, "cache_hits": 31, "coalesced": 2, "upstream_calls": 7, ...},
+        "legal_index": {"enabled": true, "queries": 52, "answered_locally": 47, "web_fallbacks": 5, "avg_query_ms": 1.8, ...},
+        "coalescing": {"leaders": 310, "coalesced": 12, "in_flight": 1, ...},
+        "idempotency": {"stored": 95, "replayed": 7, "conflicts": 1, "mismatches": 0},
+        "jobs": {"queued": 2, "running": 1, "succeeded": 40, "failed": 1, "oldest_queued_age_s": 3.2},
+        "cancellation": {"cancelled": 5, "by_reason": {...}, "estimated_tokens_saved": 4120, "in_flight": 2},
+        "usage_accounting": {"enabled": true, "recorded": 212, "save_failures": 0}
+    }
+
+    Per-user and per-session LLM usage is served by GET /api/ai/usage/.
+
+    DELETE /api/ai/metrics/
+    Drops cached agent executors so they are rebuilt from current settings.
+    Staff users only.
+    """
+    permission_classes = [AllowAny]
+
+    def get_permissions(self):
+        if self.request.method == 'DELETE':
+            return [IsAdminUser()]
+        return super().get_permissions()
+
+    def get(self, request):
+        return Response({
+            'executor_registry': get_executor_registry_stats(),
+            'response_cache': get_response_cache_stats(),
+            'semantic_cache': get_semantic_cache_stats(),
+            'session_history': get_session_history_stats(),
+            'history_window': get_history_window_stats(),
+            'refinement': get_refinement_stats(),
+            'admission': get_admission_stats(),
+            'llm': get_llm_health_stats(),
+            'routing': get_routing_stats(),
+            'hedging': get_hedging_stats(),
+            'cassette': get_cassette_stats(),
+            'scratchpad': get_scratchpad_stats(),
+            'search': get_search_stats(),
+            'legal_index': get_legal_index_stats(),
+            'coalescing': get_coalescing_stats(),
+            'idempotency': idempotency_stats.stats(),
+            'jobs': get_job_stats(),
+            'cancellation': {**cancellation_stats.stats(), 'in_flight': cancellations.in_flight()},
+            'usage_accounting': accounting_stats.stats(),
+        })
+
+    def delete(self, request):
+        invalidate_agent_executors()
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+class AIUsageView(APIView):
+    """
+    LLM token usage, latency and cost of AI calls, from usage records.
+
+    GET /api/ai/usage/?session=<id>&kind=generate&since=2026-10-01
+    Response:
+    {
+        "totals": {"requests": 42, "llm_calls": 97, "prompt_tokens": 181230, "completion_tokens": 20411,
+                   "tool_calls": 12, "cost": "0.26519", "cached": 5, "errors": 1, "cancelled": 2,
+                   "avg_total_ms": 6120.4, "max_total_ms": 30412.0, "avg_time_to_first_token_ms": 812.3, ...},
+        "by_model": [{"model": "<model>", "requests": 30, "prompt_tokens": 150022, "cost": "0.2011", ...}],
+        "by_kind": [{"kind": "generate", "requests": 35, ...}],
+        "recent": [{"kind": "generate", "model": "<model>", "llm_calls": 3, "calls": [...], ...}]
+    }
+
+    Users see their own usage (including anonymous calls in their
+    sessions); staff see everyone's and may filter with `user=<id>`.
+    `since` takes an ISO date or datetime. Costs are null for models
+    without a price in AI_MODEL_PRICES.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        params = request.query_params
+        try:
+            since = parse_usage_since(params['since']) if params.get('since') else None
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        records = LLMUsageRecord.objects.all()
+        try:
+            if not request.user.is_staff:
+                records = records.filter(user=request.user)
+            elif params.get('user'):
+                records = records.filter(user_id=params['user'])
+            if params.get('session'):
+                records = records.filter(session_id=params['session'])
+        except (ValueError, ValidationError):
+            return Response({'error': 'Invalid user or session id.'}, status=status.HTTP_400_BAD_REQUEST)
+        if params.get('kind'):
+            records = records.filter(kind=params['kind'])
+        if since is not None:
+            records = records.filter(created_at__gte=since)
+        return Response(usage_summary(records))
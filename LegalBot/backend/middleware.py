@@ -0,0 +1,178 @@
+"""
+Idempotency-Key support for retried POSTs.
+
+Clients on flaky networks may resend a POST they never saw the answer to.
+When such a request carries an `Idempotency-Key` header, the first
+response is stored in the Django cache (IDEMPOTENCY_CACHE_ALIAS) for
+IDEMPOTENCY_TTL seconds and replayed for every retry with the same key, so
+a retried generation or message creation costs one cache lookup.
+
+- Keys are scoped per caller (Authorization header, else client address),
+  method and path.
+- A retry whose body differs from the original gets 422.
+- A retry that arrives while the original is still running gets 409.
+- Responses meaning the request did not complete (5xx, 408, 429, and 499
+  for a cancelled AI call) and streaming responses are not stored, so
+  those may be retried.
+"""
+
+import hashlib
+import threading
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpResponse, JsonResponse
+
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+REPLAYED_HEADER = 'Idempotent-Replayed'
+IDEMPOTENT_METHODS = {'POST', 'PUT', 'PATCH'}
+# Headers added by outer middleware again on replay
+_SKIPPED_HEADERS = {'content-length', 'vary', 'access-control-allow-origin', 'access-control-allow-credentials'}
+# Timed out, rate limited, or cancelled / client closed request (ai_agent.cancellation)
+_INCOMPLETE_STATUSES = {408, 429, 499}
+
+
+class IdempotencyStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stored = 0
+        self.replayed = 0
+        self.conflicts = 0
+        self.mismatches = 0
+
+    def incr(self, field):
+        with self._lock:
+            setattr(self, field, getattr(self, field) + 1)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'stored': self.stored,
+                'replayed': self.replayed,
+                'conflicts': self.conflicts,
+                'mismatches': self.mismatches,
+            }
+
+
+idempotency_stats = IdempotencyStats()
+
+
+def _cache():
+    return caches[getattr(settings, 'IDEMPOTENCY_CACHE_ALIAS', 'default')]
+
+
+def _applies(request):
+    if request.method not in IDEMPOTENT_METHODS or not request.headers.get(IDEMPOTENCY_HEADER):
+        return False
+    prefixes = getattr(settings, 'IDEMPOTENCY_PATH_PREFIXES', ())
+    return any(request.path.startswith(prefix) for prefix in prefixes)
+
+
+def _cache_keys(request):
+    caller = request.headers.get('Authorization') or request.META.get('REMOTE_ADDR', '')
+    scope = '\n'.join([caller, request.method, request.path, request.headers[IDEMPOTENCY_HEADER]])
+    digest = hashlib.sha256(scope.encode('utf-8')).hexdigest()
+    return f"idempotency:{digest}", f"idempotency-lock:{digest}"
+
+
+def _fingerprint(request):
+    return hashlib.sha256(request.body).hexdigest()
+
+
+def _storable(response):
+    return (
+        not response.streaming
+        and response.status_code < 500
+        and response.status_code not in _INCOMPLETE_STATUSES
+    )
+
+
+def _serialize(response, fingerprint):
+    return {
+        'fingerprint': fingerprint,
+        'status': response.status_code,
+        'headers': [(name, value) for name, value in response.items() if name.lower() not in _SKIPPED_HEADERS],
+        'content': response.content,
+    }
+
+
+def _replay(stored):
+    response = HttpResponse(stored['content'], status=stored['status'])
+    for name, value in stored['headers']:
+        response[name] = value
+    response[REPLAYED_HEADER] = 'true'
+    idempotency_stats.incr('replayed')
+    return response
+
+
+def _mismatch():
+    idempotency_stats.incr('mismatches')
+    return JsonResponse(
+        {'error': f'{IDEMPOTENCY_HEADER} was already used for a different request.'},
+        status=422,
+    )
+
+
+def _conflict():
+    idempotency_stats.incr('conflicts')
+    response = JsonResponse(
+        {'error': f'A request with this {IDEMPOTENCY_HEADER} is still being processed.'},
+        status=409,
+    )
+    response['Retry-After'] = '1'
+    return response
+
+
+class IdempotencyMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not _applies(request):
+            return self.get_response(request)
+
+        cache = _cache()
+        key, lock_key = _cache_keys(request)
+        fingerprint = _fingerprint(request)
+        stored = cache.get(key)
+        if stored is not None:
+            return _replay(stored) if stored['fingerprint'] == fingerprint else _mismatch()
+        if not cache.add(lock_key, fingerprint, getattr(settings, 'IDEMPOTENCY_LOCK_TIMEOUT', 300)):
+            return _conflict()
+        try:
+            response = self.get_response(request)
+            if _storable(response):
+                cache.set(key, _serialize(response, fingerprint), getattr(settings, 'IDEMPOTENCY_TTL', 86400))
+                idempotency_stats.incr('stored')
+        finally:
+            cache.delete(lock_key)
+        return response
+
+    async def __acall__(self, request):
+        if not _applies(request):
+            return await self.get_response(request)
+
+        cache = _cache()
+        key, lock_key = _cache_keys(request)
+        fingerprint = _fingerprint(request)
+        stored = await cache.aget(key)
+        if stored is not None:
+            return _replay(stored) if stored['fingerprint'] == fingerprint else _mismatch()
+        if not await cache.aadd(lock_key, fingerprint, getattr(settings, 'IDEMPOTENCY_LOCK_TIMEOUT', 300)):
+            return _conflict()
+        try:
+            response = await self.get_response(request)
+            if _storable(response):
+                await cache.aset(key, _serialize(response, fingerprint), getattr(settings, 'IDEMPOTENCY_TTL', 86400))
+                idempotency_stats.incr('stored')
+        finally:
+            await cache.adelete(lock_key)
+        return response
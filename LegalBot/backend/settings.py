@@ -2,6 +2,7 @@
 Django settings for LegalBot backend project.
 """
 
+import json
 from pathlib import Path
 from decouple import config
 
@@ -50,6 +51,7 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     # 'django.middleware.csrf.CsrfViewMiddleware',  # Disabled for development
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'backend.middleware.IdempotencyMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -162,6 +164,19 @@ CORS_ALLOW_HEADERS = [
     'user-agent',
     'x-csrftoken',
     'x-requested-with',
+    'idempotency-key',
+    'x-ai-priority',
+]
+# Per-request AI reporting headers (see ai_agent/reporting.py)
+CORS_EXPOSE_HEADERS = [
+    'x-ai-history-tokens-saved',
+    'x-ai-refine-mode',
+    'x-ai-refine-input-tokens',
+    'x-ai-refine-output-tokens',
+    'x-ai-refine-full-rewrite-tokens',
+    'retry-after',
+    'x-ai-coalesced',
+    'idempotent-replayed',
 ]
 
 # Channels (WebSocket)
@@ -180,6 +195,189 @@ LLM_BASE_URL = config('OPENROUTER_BASE_URL', default='https://openrouter.ai/api/
 AI_MODEL = config('AI_MODEL', default='deepseek/deepseek-chat-v3-0324:free')
 AI_TEMPERATURE = config('AI_TEMPERATURE', default=0.3, cast=float)
 
+# LLM backend: 'openai' (any OpenAI-compatible endpoint) or 'fake', an
+# offline deterministic backend for tests and benchmarks that needs no API
+# key. The fake waits AI_FAKE_LLM_LATENCY seconds, then streams at
+# AI_FAKE_LLM_TOKEN_RATE tokens/s (0 = unthrottled); it asks
+# AI_FAKE_LLM_QUESTIONS clarifying questions and makes
+# AI_FAKE_LLM_TOOL_CALLS searches before drafting, and AI_FAKE_LLM_SCRIPT
+# may point at a JSON file of scripted replies (see modules/fake_llm.py).
+AI_LLM_BACKEND = config('AI_LLM_BACKEND', default='openai')
+AI_FAKE_LLM_SCRIPT = config('AI_FAKE_LLM_SCRIPT', default='')
+AI_FAKE_LLM_LATENCY = config('AI_FAKE_LLM_LATENCY', default=0.0, cast=float)
+AI_FAKE_LLM_TOKEN_RATE = config('AI_FAKE_LLM_TOKEN_RATE', default=0.0, cast=float)
+AI_FAKE_LLM_QUESTIONS = config('AI_FAKE_LLM_QUESTIONS', default=2, cast=int)
+AI_FAKE_LLM_TOOL_CALLS = config('AI_FAKE_LLM_TOOL_CALLS', default=0, cast=int)
+AI_FAKE_LLM_DRAFT_WORDS = config('AI_FAKE_LLM_DRAFT_WORDS', default=400, cast=int)
+
+# LLM cassettes: 'record' appends every upstream call (with its timings) to
+# AI_LLM_CASSETTE_PATH (gzip when it ends in .gz); 'replay' answers calls
+# from it without going upstream, with the recorded timings or, with
+# AI_LLM_CASSETTE_REALTIME off, at full speed. 'off' disables both.
+AI_LLM_CASSETTE_MODE = config('AI_LLM_CASSETTE_MODE', default='off')
+AI_LLM_CASSETTE_PATH = config('AI_LLM_CASSETTE_PATH', default=str(BASE_DIR / 'llm_cassette.jsonl.gz'))
+AI_LLM_CASSETTE_REALTIME = config('AI_LLM_CASSETTE_REALTIME', default=True, cast=bool)
+
+# Model routing: with AI_FAST_MODEL set, clarifying turns and history
+# summaries use it and drafts use AI_MODEL. Inputs of at least
+# AI_ROUTER_LONG_INPUT_TOKENS go to AI_MODEL, and fast turns that start a
+# draft are escalated to it unless AI_ROUTER_ESCALATE is off.
+AI_FAST_MODEL = config('AI_FAST_MODEL', default='')
+AI_ROUTER_LONG_INPUT_TOKENS = config('AI_ROUTER_LONG_INPUT_TOKENS', default=400, cast=int)
+AI_ROUTER_ESCALATE = config('AI_ROUTER_ESCALATE', default=True, cast=bool)
+
+# Upstream resilience: per-attempt timeout (seconds), retries with jittered
+# exponential backoff, circuit breaker and an optional fallback model
+AI_LLM_TIMEOUT = config('AI_LLM_TIMEOUT', default=60, cast=float)
+AI_LLM_MAX_ATTEMPTS = config('AI_LLM_MAX_ATTEMPTS', default=3, cast=int)
+AI_LLM_BACKOFF_BASE = config('AI_LLM_BACKOFF_BASE', default=0.5, cast=float)
+AI_LLM_BACKOFF_MAX = config('AI_LLM_BACKOFF_MAX', default=8, cast=float)
+AI_CIRCUIT_FAILURE_THRESHOLD = config('AI_CIRCUIT_FAILURE_THRESHOLD', default=5, cast=int)
+AI_CIRCUIT_RESET_TIMEOUT = config('AI_CIRCUIT_RESET_TIMEOUT', default=30, cast=float)
+AI_FALLBACK_MODEL = config('AI_FALLBACK_MODEL', default='')
+
+# Deadline (seconds) of a request sharing an identical request's running
+# call: past it the request gives up with 503 instead of waiting on a hung call
+AI_COALESCE_WAIT_TIMEOUT = config('AI_COALESCE_WAIT_TIMEOUT', default=180, cast=float)
+
+# Hedged requests: after AI_HEDGE_AFTER seconds without a first token
+# (0 disables), race a duplicate call on AI_HEDGE_BASE_URL (default: the
+# primary endpoint) with AI_HEDGE_MODEL (default: the same model). At most
+# AI_HEDGE_BUDGET of calls are hedged in the long run.
+AI_HEDGE_AFTER = config('AI_HEDGE_AFTER', default=0, cast=float)
+AI_HEDGE_BASE_URL = config('AI_HEDGE_BASE_URL', default='')
+AI_HEDGE_API_KEY = config('AI_HEDGE_API_KEY', default='')
+AI_HEDGE_MODEL = config('AI_HEDGE_MODEL', default='')
+AI_HEDGE_BUDGET = config('AI_HEDGE_BUDGET', default=0.1, cast=float)
+
+# LLM usage accounting: tokens, latency, tool calls and cost of every AI
+# request are saved per session and user (GET /api/ai/usage/).
+# AI_MODEL_PRICES is JSON mapping model ids to [input, output] prices per
+# million tokens, e.g. {"openai/gpt-4o-mini": [0.15, 0.6]}
+AI_USAGE_ACCOUNTING = config('AI_USAGE_ACCOUNTING', default=True, cast=bool)
+AI_MODEL_PRICES = config('AI_MODEL_PRICES', default='{}', cast=json.loads)
+
+# Drafting agent: stop after AI_AGENT_MAX_ITERATIONS steps (LLM call plus
+# tool call). Before search results re-enter the prompt they are
+# deduplicated and ranked down to AI_TOOL_OUTPUT_TOKENS each, and older
+# results are trimmed to keep all of them within AI_SCRATCHPAD_TOKENS
+# (0 disables either limit; see modules/scratchpad.py)
+AI_AGENT_MAX_ITERATIONS = config('AI_AGENT_MAX_ITERATIONS', default=6, cast=int)
+AI_TOOL_OUTPUT_TOKENS = config('AI_TOOL_OUTPUT_TOKENS', default=600, cast=int)
+AI_SCRATCHPAD_TOKENS = config('AI_SCRATCHPAD_TOKENS', default=2000, cast=int)
+
+# Legal_Web_Search: 'duckduckgo' or 'stub' (offline, made-up results).
+# Results are cached in SQLite at AI_SEARCH_CACHE_PATH (empty keeps them in
+# memory) for AI_SEARCH_CACHE_TTL seconds (0 disables the cache), and live
+# searches are limited to AI_SEARCH_RATE per second with bursts of
+# AI_SEARCH_BURST; a search that would wait longer than AI_SEARCH_MAX_WAIT
+# seconds fails instead (see modules/search.py)
+AI_SEARCH_BACKEND = config('AI_SEARCH_BACKEND', default='duckduckgo')
+AI_SEARCH_CACHE_PATH = config('AI_SEARCH_CACHE_PATH', default=str(BASE_DIR / 'search_cache.sqlite3'))
+AI_SEARCH_CACHE_TTL = config('AI_SEARCH_CACHE_TTL', default=86400, cast=int)
+AI_SEARCH_CACHE_MAX_ENTRIES = config('AI_SEARCH_CACHE_MAX_ENTRIES', default=5000, cast=int)
+AI_SEARCH_RATE = config('AI_SEARCH_RATE', default=1.0, cast=float)
+AI_SEARCH_BURST = config('AI_SEARCH_BURST', default=3, cast=int)
+AI_SEARCH_MAX_WAIT = config('AI_SEARCH_MAX_WAIT', default=10, cast=float)
+AI_SEARCH_STUB_LATENCY = config('AI_SEARCH_STUB_LATENCY', default=0.0, cast=float)
+
+# Local legal corpus: `python manage.py build_legal_index` indexes the
+# .txt/.md statutes and regulations under AI_LEGAL_CORPUS_DIR into a BM25
+# index at AI_LEGAL_INDEX_PATH. When the path is set the agent searches it
+# first (Legal_Corpus_Search) and falls back to the web when the best
+# passage matches less than AI_LEGAL_INDEX_MIN_COVERAGE of the query terms
+# (see modules/legal_index.py)
+AI_LEGAL_CORPUS_DIR = config('AI_LEGAL_CORPUS_DIR', default=str(BASE_DIR / 'legal_corpus'))
+AI_LEGAL_INDEX_PATH = config('AI_LEGAL_INDEX_PATH', default='')
+AI_LEGAL_INDEX_TOP_K = config('AI_LEGAL_INDEX_TOP_K', default=5, cast=int)
+AI_LEGAL_INDEX_MIN_COVERAGE = config('AI_LEGAL_INDEX_MIN_COVERAGE', default=0.5, cast=float)
+
+# Exact-match LLM response cache (set AI_RESPONSE_CACHE_PATH to persist to SQLite)
+AI_RESPONSE_CACHE_ENABLED = config('AI_RESPONSE_CACHE_ENABLED', default=True, cast=bool)
+AI_RESPONSE_CACHE_MAX_ENTRIES = config('AI_RESPONSE_CACHE_MAX_ENTRIES', default=512, cast=int)
+AI_RESPONSE_CACHE_TTL = config('AI_RESPONSE_CACHE_TTL', default=3600, cast=int)
+AI_RESPONSE_CACHE_PATH = config('AI_RESPONSE_CACHE_PATH', default='')
+
+# Semantic (paraphrase) cache: 'off', 'shadow' (score only, never serve) or 'on'
+AI_SEMANTIC_CACHE_MODE = config('AI_SEMANTIC_CACHE_MODE', default='shadow')
+AI_SEMANTIC_CACHE_THRESHOLD = config('AI_SEMANTIC_CACHE_THRESHOLD', default=0.9, cast=float)
+AI_SEMANTIC_CACHE_MAX_ENTRIES = config('AI_SEMANTIC_CACHE_MAX_ENTRIES', default=1024, cast=int)
+# Highest number of prior assistant replies for which a request is cacheable
+AI_SEMANTIC_CACHE_MAX_TURNS = config('AI_SEMANTIC_CACHE_MAX_TURNS', default=0, cast=int)
+
+# Token budget for conversation history sent to the model (0 disables the window)
+AI_HISTORY_TOKEN_BUDGET = config('AI_HISTORY_TOKEN_BUDGET', default=6000, cast=int)
+
+# Default refine strategy: 'full' rewrites the document, 'sections' patches changed sections
+AI_REFINE_MODE = config('AI_REFINE_MODE', default='full')
+# Apply mechanical refine requests ("replace X with Y", "set the rent to $2,000") without the LLM
+AI_REFINE_LOCAL_EDITS = config('AI_REFINE_LOCAL_EDITS', default=True, cast=bool)
+
+# Admission control for AI endpoints (0 disables). With threaded workers keep
+# AI_MAX_CONCURRENT_CALLS + AI_MAX_QUEUED_CALLS below the worker thread count
+# so CRUD requests always find a free thread.
+AI_MAX_CONCURRENT_CALLS = config('AI_MAX_CONCURRENT_CALLS', default=4, cast=int)
+AI_MAX_QUEUED_CALLS = config('AI_MAX_QUEUED_CALLS', default=16, cast=int)
+AI_MAX_QUEUED_PER_CLIENT = config('AI_MAX_QUEUED_PER_CLIENT', default=4, cast=int)
+AI_QUEUE_TIMEOUT = config('AI_QUEUE_TIMEOUT', default=30, cast=float)
+
+# Anonymous AI requests are queued fairly per client address. The address is
+# REMOTE_ADDR unless the server runs behind this many reverse proxies, each
+# appending to X-Forwarded-For; 0 ignores the header, which clients can forge
+AI_TRUSTED_PROXY_COUNT = config('AI_TRUSTED_PROXY_COUNT', default=0, cast=int)
+
+# Priority classes for AI work (see ai_agent/priority.py): waiting classes
+# are served by weight, anything waiting longer than
+# AI_PRIORITY_STARVATION_AFTER seconds goes first, and
+# AI_INTERACTIVE_RESERVED_SLOTS slots (and job worker threads) are kept for
+# interactive requests
+AI_PRIORITY_WEIGHTS = {
+    'interactive': config('AI_PRIORITY_WEIGHT_INTERACTIVE', default=8, cast=int),
+    'background': config('AI_PRIORITY_WEIGHT_BACKGROUND', default=3, cast=int),
+    'bulk': config('AI_PRIORITY_WEIGHT_BULK', default=1, cast=int),
+}
+AI_PRIORITY_STARVATION_AFTER = config('AI_PRIORITY_STARVATION_AFTER', default=10, cast=float)
+AI_INTERACTIVE_RESERVED_SLOTS = config('AI_INTERACTIVE_RESERVED_SLOTS', default=1, cast=int)
+
+# Batch generation (/api/ai/batch-generate/): larger batches than
+# AI_BATCH_SYNC_LIMIT are queued as "batch" AI jobs for run_ai_worker
+AI_BATCH_MAX_ITEMS = config('AI_BATCH_MAX_ITEMS', default=50, cast=int)
+AI_BATCH_SYNC_LIMIT = config('AI_BATCH_SYNC_LIMIT', default=5, cast=int)
+AI_BATCH_MAX_PARALLEL = config('AI_BATCH_MAX_PARALLEL', default=4, cast=int)
+
+# Background AI jobs (/api/ai/jobs/), run by `python manage.py run_ai_worker`.
+# A running job's lease is renewed every third of AI_JOB_VISIBILITY_TIMEOUT;
+# if its worker dies the job is retried once the lease lapses.
+AI_JOB_WORKER_CONCURRENCY = config('AI_JOB_WORKER_CONCURRENCY', default=2, cast=int)
+AI_JOB_POLL_INTERVAL = config('AI_JOB_POLL_INTERVAL', default=1.0, cast=float)
+AI_JOB_VISIBILITY_TIMEOUT = config('AI_JOB_VISIBILITY_TIMEOUT', default=300, cast=int)
+AI_JOB_MAX_ATTEMPTS = config('AI_JOB_MAX_ATTEMPTS', default=3, cast=int)
+AI_JOB_RETRY_BACKOFF = config('AI_JOB_RETRY_BACKOFF', default=5, cast=float)
+# A job's SSE stream (?stream=true) is closed with a `timeout` event after
+# this many seconds; clients re-subscribe to keep following the job
+AI_JOB_STREAM_MAX_SECONDS = config('AI_JOB_STREAM_MAX_SECONDS', default=600, cast=float)
+
+# Idempotency-Key replay for retried POSTs (see backend/middleware.py). The
+# default in-process cache only deduplicates within one worker; set
+# IDEMPOTENCY_CACHE_BACKEND=django.core.cache.backends.db.DatabaseCache and run
+# `python manage.py createcachetable` to share stored responses across workers.
+IDEMPOTENCY_TTL = config('IDEMPOTENCY_TTL', default=24 * 60 * 60, cast=int)
+IDEMPOTENCY_LOCK_TIMEOUT = config('IDEMPOTENCY_LOCK_TIMEOUT', default=300, cast=int)
+IDEMPOTENCY_CACHE_ALIAS = 'idempotency'
+IDEMPOTENCY_PATH_PREFIXES = ['/api/ai/', '/api/messages/', '/api/documents/', '/api/document-details/', '/api/sessions/']
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'idempotency': {
+        'BACKEND': config('IDEMPOTENCY_CACHE_BACKEND', default='django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': 'idempotency_keys',
+        'TIMEOUT': IDEMPOTENCY_TTL,
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    },
+}
+
 # File Upload Settings
 FILE_UPLOAD_MAX_MEMORY_SIZE = 10 * 1024 * 1024  # 10MB
 DATA_UPLOAD_MAX_MEMORY_SIZE = 10 * 1024 * 1024  # 10MB
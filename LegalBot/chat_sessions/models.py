@@ -24,6 +24,10 @@ class Session(models.Model):
         choices=STATUS_CHOICES,
         default='drafting'
     )
+    # Rolling summary of the oldest messages, maintained by the AI history
+    # window once the conversation outgrows its token budget
+    history_summary = models.TextField(blank=True, default='')
+    summary_message_count = models.PositiveIntegerField(default=0)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
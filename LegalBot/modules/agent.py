@@ -1,10 +1,35 @@
+import hashlib
+import threading
+from urllib.parse import urlsplit
+
+import httpx
 from langchain_openai import ChatOpenAI
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain.agents import create_tool_calling_agent, AgentExecutor
-from .tools import LegalWebSearchTool
+from .cassette import CassetteChatModel, CassettePolicy
+from .fake_llm import FakeChatModel, FakeLLMConfig
+from .hedging import HedgedChatModel, HedgePolicy
+from .legal_index import CorpusPolicy
+from .resilience import ResiliencePolicy, ResilientChatModel
+from .routing import RoutedChatModel, RoutingPolicy
+from .scratchpad import ScratchpadPolicy, compacting_formatter
+from .search import SearchPolicy
+from .tools import LegalCorpusSearchTool, LegalWebSearchTool
+
+DEFAULT_MODEL = "deepseek/deepseek-chat-v3-0324:free"
+DEFAULT_TEMPERATURE = 0.3
+DEFAULT_BASE_URL = "https://openrouter.ai/api/v1"
+DEFAULT_HEADERS = {
+    "HTTP-Referer": "http://localhost:8501",
+    "X-Title": "Agentic Legal AI",
+}
+
+# Connection pool limits for the shared keep-alive HTTP clients
+HTTP_MAX_CONNECTIONS = 100
+HTTP_MAX_KEEPALIVE_CONNECTIONS = 20
+HTTP_KEEPALIVE_EXPIRY = 60.0
 
-def get_drafting_prompt():
-    system_prompt = """
+DRAFTING_SYSTEM_PROMPT = """
     You are an expert AI legal assistant operating in Canada. Your persona is that of a professional, meticulous, and formal Canadian lawyer.
 
     **Your Mandate:**
@@ -19,6 +44,21 @@ def get_drafting_prompt():
     -   If legal context is needed, state "I will now search for relevant legal information..." and then use the Legal_Web_Search tool.
     -   When ready to draft, output the `DRAFT_COMPLETE:` command followed by the document.
     """
+
+# Appended to the drafting prompt when a local legal corpus is indexed
+CORPUS_SEARCH_PROMPT = """
+    **Local Legal Library:** For statutes and regulations, use the `Legal_Corpus_Search` tool before `Legal_Web_Search`. It is much faster and searches the web by itself when the library has nothing relevant, so only use `Legal_Web_Search` for case law or when its results do not answer your question.
+    """
+
+# Changes whenever the drafting prompt text changes, so cached responses
+# produced by an older prompt are never served
+PROMPT_VERSION = hashlib.sha256(DRAFTING_SYSTEM_PROMPT.encode("utf-8")).hexdigest()[:12]
+CORPUS_PROMPT_VERSION = hashlib.sha256(
+    (DRAFTING_SYSTEM_PROMPT + CORPUS_SEARCH_PROMPT).encode("utf-8")
+).hexdigest()[:12]
+
+def get_drafting_prompt(corpus: bool = False):
+    system_prompt = DRAFTING_SYSTEM_PROMPT + CORPUS_SEARCH_PROMPT if corpus else DRAFTING_SYSTEM_PROMPT
     return ChatPromptTemplate.from_messages([
         ("system", system_prompt),
         MessagesPlaceholder(variable_name="history"),
@@ -46,22 +86,385 @@ def get_refinement_prompt(document: str, user_request: str) -> str:
     3.  Return the **ENTIRE, FULLY UPDATED** document as your response. Do not provide conversational text or summaries of changes.
     """
 
-def get_agent_executor(llm_api_key: str):
-    llm = ChatOpenAI(
-        model="deepseek/deepseek-chat-v3-0324:free",
-        temperature=0.3,
+def get_section_refinement_prompt(numbered_document: str, user_request: str) -> str:
+    return f"""
+    You are an expert AI legal assistant acting as a reviewing lawyer in Canada. Your task is to refine an existing legal document based on a user's specific request, changing only the sections that need it.
+
+    **Current Document Draft (sections are marked [[SECTION n]]):**
+    ---
+    {numbered_document}
+    ---
+
+    **User's Refinement Request:**
+    ---
+    "{user_request}"
+    ---
+
+    **Your Instructions:**
+    1.  Identify the sections affected by the request, including any other sections that must change for the document to stay consistent.
+    2.  For each affected section, output its complete new text between `<<<SECTION n>>>` and `<<<END>>>` (without the [[SECTION n]] marker). An empty body deletes the section.
+    3.  To add a new section after section n, output it between `<<<INSERT AFTER n>>>` and `<<<END>>>` (use 0 to insert at the start).
+    4.  Output nothing except these blocks. If no change is needed, output `NO_CHANGES`.
+    5.  Maintain a professional and formal legal tone.
+    """
+
+def get_summary_prompt(existing_summary: str, conversation: str) -> str:
+    return f"""
+    You are maintaining a running summary of a conversation between a user and an AI legal assistant drafting a Canadian legal document.
+
+    **Current Summary:**
+    ---
+    {existing_summary or "(none yet)"}
+    ---
+
+    **New Conversation Turns:**
+    ---
+    {conversation}
+    ---
+
+    **Your Instructions:**
+    1.  Update the summary so it also covers the new turns.
+    2.  Preserve every concrete detail the user provided (document type, party names, addresses, dates, amounts, jurisdiction, special clauses) and any research findings.
+    3.  Respond with the updated summary only, as concise bullet points. Do not add commentary.
+    """
+
+def build_llm(
+    llm_api_key: str,
+    model: str = DEFAULT_MODEL,
+    temperature: float = DEFAULT_TEMPERATURE,
+    base_url: str = DEFAULT_BASE_URL,
+    http_client: httpx.Client = None,
+    timeout: float = None,
+    max_retries: int = 2,
+):
+    return ChatOpenAI(
+        model=model,
+        temperature=temperature,
         api_key=llm_api_key,
-        base_url="https://openrouter.ai/api/v1",
-        default_headers={
-            "HTTP-Referer": "http://localhost:8501",
-            "X-Title": "Agentic Legal AI",
-        }
+        base_url=base_url,
+        default_headers=DEFAULT_HEADERS,
+        http_client=http_client,
+        timeout=timeout,
+        max_retries=max_retries,
+        # Ask for token usage in the final chunk of streamed responses too
+        stream_usage=True,
+    )
+
+
+def build_resilient_llm(
+    llm_api_key: str,
+    model: str = DEFAULT_MODEL,
+    temperature: float = DEFAULT_TEMPERATURE,
+    base_url: str = DEFAULT_BASE_URL,
+    http_client: httpx.Client = None,
+    fallback_model: str = None,
+    policy: ResiliencePolicy = None,
+    endpoint: str = None,
+    fake: FakeLLMConfig = None,
+    cassette: CassettePolicy = None,
+):
+    """
+    Build the primary (and optional fallback) client with client-side
+    retries disabled, wrapped in ResilientChatModel which owns the retry,
+    timeout and circuit-breaker policy. endpoint labels the health stats
+    of clients for a secondary endpoint. With fake set the clients are
+    offline FakeChatModels instead of ChatOpenAI, and with cassette set
+    each client's calls are recorded or replayed.
+    """
+    policy = policy or ResiliencePolicy()
+
+    def client(model_name):
+        if fake is not None:
+            llm = FakeChatModel(model_name=model_name, config=fake)
+        else:
+            llm = build_llm(
+                llm_api_key,
+                model=model_name,
+                temperature=temperature,
+                base_url=base_url,
+                http_client=http_client,
+                timeout=policy.timeout,
+                max_retries=0,
+            )
+        if cassette is not None:
+            return CassetteChatModel(inner=llm, policy=cassette)
+        return llm
+
+    return ResilientChatModel(
+        primary=client(model),
+        fallback=client(fallback_model) if fallback_model else None,
+        policy=policy,
+        endpoint=endpoint,
     )
 
-    tools = [LegalWebSearchTool()]
+def build_routed_llm(
+    llm_api_key: str,
+    model: str = DEFAULT_MODEL,
+    temperature: float = DEFAULT_TEMPERATURE,
+    base_url: str = DEFAULT_BASE_URL,
+    http_client: httpx.Client = None,
+    fallback_model: str = None,
+    policy: ResiliencePolicy = None,
+    routing: RoutingPolicy = None,
+    hedge: HedgePolicy = None,
+    hedge_http_client: httpx.Client = None,
+    fake: FakeLLMConfig = None,
+    cassette: CassettePolicy = None,
+):
+    """
+    Build the drafting model: `model` alone, or with routing set, a
+    RoutedChatModel serving clarifying turns from routing.fast_model and
+    drafts from `model`. Each side has its own retries and breaker, and
+    with hedge set is raced against a duplicate on hedge.base_url.
+    fake swaps every underlying client for the offline fake backend, and
+    cassette records or replays their calls.
+    """
+    def resilient(model_name):
+        primary = build_resilient_llm(
+            llm_api_key,
+            model=model_name,
+            temperature=temperature,
+            base_url=base_url,
+            http_client=http_client,
+            fallback_model=fallback_model,
+            policy=policy,
+            fake=fake,
+            cassette=cassette,
+        )
+        if hedge is None:
+            return primary
+        secondary = build_resilient_llm(
+            hedge.api_key or llm_api_key,
+            model=hedge.model or model_name,
+            temperature=temperature,
+            base_url=hedge.base_url,
+            http_client=hedge_http_client,
+            policy=policy,
+            endpoint=urlsplit(hedge.base_url).netloc,
+            fake=fake,
+            cassette=cassette,
+        )
+        return HedgedChatModel(primary=primary, secondary=secondary, policy=hedge)
+
+    if routing is None or routing.fast_model == model:
+        return resilient(model)
+    return RoutedChatModel(fast=resilient(routing.fast_model), strong=resilient(model), policy=routing)
+
+def build_agent_executor(
+    llm, scratchpad: ScratchpadPolicy = None, search: SearchPolicy = None, corpus: CorpusPolicy = None,
+    cassette: CassettePolicy = None,
+):
+    """
+    Build the drafting agent. Tool output is compacted before it re-enters
+    the prompt and the agent stops after scratchpad.max_iterations steps
+    (see modules/scratchpad.py); searches are cached and rate limited as
+    set by `search` (see modules/search.py). With a `corpus` the agent is
+    told to search the local legal index first (see modules/legal_index.py).
+    With a `cassette` tool outputs are recorded or replayed along with the
+    LLM calls (see modules/cassette.py).
+    """
+    scratchpad = scratchpad or ScratchpadPolicy()
+    search = search or SearchPolicy()
+    tools = [LegalWebSearchTool(policy=search, cassette=cassette)]
+    if corpus is not None:
+        tools.insert(0, LegalCorpusSearchTool(policy=corpus, search_policy=search, cassette=cassette))
+
+    prompt = get_drafting_prompt(corpus=corpus is not None)
+    agent = create_tool_calling_agent(llm, tools, prompt, message_formatter=compacting_formatter(scratchpad))
+    agent_executor = AgentExecutor(
+        agent=agent, tools=tools, verbose=True, max_iterations=scratchpad.max_iterations,
+    )
 
-    prompt = get_drafting_prompt()
-    agent = create_tool_calling_agent(llm, tools, prompt)
-    agent_executor = AgentExecutor(agent=agent, tools=tools, verbose=True)
-    
     return agent_executor
+
+
+class AgentExecutorRegistry:
+    """
+    Process-wide, thread-safe cache of agent executors.
+
+    Chat models are keyed by (API key, model, temperature, base URL, fallback
+    model, resilience policy, routing policy, hedge policy, fake backend
+    config, cassette policy), executors by that key plus their scratchpad,
+    search and corpus policies, and every
+    LLM client talking to the same base URL shares one keep-alive HTTP
+    connection pool, so repeated requests skip both object construction and
+    TLS handshakes.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._executors = {}
+        self._llms = {}
+        self._http_clients = {}
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def make_key(
+        llm_api_key, model, temperature, base_url, fallback_model=None, policy=None, routing=None, hedge=None,
+        fake=None, cassette=None,
+    ):
+        # Never keep the raw API key around as a dictionary key
+        key_digest = hashlib.sha256(llm_api_key.encode("utf-8")).hexdigest()
+        return (
+            key_digest, model, float(temperature), base_url.rstrip("/"),
+            fallback_model or None, policy or ResiliencePolicy(), routing or None, hedge or None,
+            fake or None, cassette or None,
+        )
+
+    def _get_http_client(self, base_url):
+        client = self._http_clients.get(base_url)
+        if client is None:
+            client = httpx.Client(
+                limits=httpx.Limits(
+                    max_connections=HTTP_MAX_CONNECTIONS,
+                    max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                    keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+                ),
+            )
+            self._http_clients[base_url] = client
+        return client
+
+    def _get_llm_locked(self, key, llm_api_key, model, temperature, base_url):
+        llm = self._llms.get(key)
+        if llm is None:
+            llm = build_routed_llm(
+                llm_api_key,
+                model=model,
+                temperature=temperature,
+                base_url=base_url,
+                http_client=self._get_http_client(key[3]),
+                fallback_model=key[4],
+                policy=key[5],
+                routing=key[6],
+                hedge=key[7],
+                hedge_http_client=self._get_http_client(key[7].base_url.rstrip("/")) if key[7] else None,
+                fake=key[8],
+                cassette=key[9],
+            )
+            self._llms[key] = llm
+        return llm
+
+    def get(
+        self,
+        llm_api_key: str,
+        model: str = DEFAULT_MODEL,
+        temperature: float = DEFAULT_TEMPERATURE,
+        base_url: str = DEFAULT_BASE_URL,
+        fallback_model: str = None,
+        policy: ResiliencePolicy = None,
+        routing: RoutingPolicy = None,
+        hedge: HedgePolicy = None,
+        fake: FakeLLMConfig = None,
+        cassette: CassettePolicy = None,
+        scratchpad: ScratchpadPolicy = None,
+        search: SearchPolicy = None,
+        corpus: CorpusPolicy = None,
+    ):
+        key = self.make_key(
+            llm_api_key, model, temperature, base_url, fallback_model, policy, routing, hedge, fake, cassette,
+        )
+        executor_key = (key, scratchpad or ScratchpadPolicy(), search or SearchPolicy(), corpus or None)
+        with self._lock:
+            executor = self._executors.get(executor_key)
+            if executor is not None:
+                self.hits += 1
+                return executor
+
+            self.misses += 1
+            llm = self._get_llm_locked(key, llm_api_key, model, temperature, base_url)
+            executor = build_agent_executor(llm, *executor_key[1:], cassette=key[9])
+            self._executors[executor_key] = executor
+            return executor
+
+    def get_llm(
+        self,
+        llm_api_key: str,
+        model: str = DEFAULT_MODEL,
+        temperature: float = DEFAULT_TEMPERATURE,
+        base_url: str = DEFAULT_BASE_URL,
+        fallback_model: str = None,
+        policy: ResiliencePolicy = None,
+        routing: RoutingPolicy = None,
+        hedge: HedgePolicy = None,
+        fake: FakeLLMConfig = None,
+        cassette: CassettePolicy = None,
+    ):
+        """Return the shared chat model itself, for calls that need no tools."""
+        key = self.make_key(
+            llm_api_key, model, temperature, base_url, fallback_model, policy, routing, hedge, fake, cassette,
+        )
+        with self._lock:
+            return self._get_llm_locked(key, llm_api_key, model, temperature, base_url)
+
+    def invalidate(self, close_clients: bool = False):
+        """
+        Drop every cached executor so the next request rebuilds it from the
+        current settings. Shared HTTP clients are kept unless close_clients
+        is set, since in-flight requests may still be using them.
+        """
+        with self._lock:
+            self._executors.clear()
+            self._llms.clear()
+            self.invalidations += 1
+            if close_clients:
+                for client in self._http_clients.values():
+                    client.close()
+                self._http_clients.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "invalidations": self.invalidations,
+                "executors": len(self._executors),
+                "http_clients": len(self._http_clients),
+            }
+
+
+agent_registry = AgentExecutorRegistry()
+
+
+def get_agent_executor(
+    llm_api_key: str,
+    model: str = DEFAULT_MODEL,
+    temperature: float = DEFAULT_TEMPERATURE,
+    base_url: str = DEFAULT_BASE_URL,
+    fallback_model: str = None,
+    policy: ResiliencePolicy = None,
+    routing: RoutingPolicy = None,
+    hedge: HedgePolicy = None,
+    fake: FakeLLMConfig = None,
+    cassette: CassettePolicy = None,
+    scratchpad: ScratchpadPolicy = None,
+    search: SearchPolicy = None,
+    corpus: CorpusPolicy = None,
+):
+    return agent_registry.get(
+        llm_api_key, model=model, temperature=temperature, base_url=base_url,
+        fallback_model=fallback_model, policy=policy, routing=routing, hedge=hedge, fake=fake,
+        cassette=cassette, scratchpad=scratchpad, search=search, corpus=corpus,
+    )
+
+
+def get_chat_model(
+    llm_api_key: str,
+    model: str = DEFAULT_MODEL,
+    temperature: float = DEFAULT_TEMPERATURE,
+    base_url: str = DEFAULT_BASE_URL,
+    fallback_model: str = None,
+    policy: ResiliencePolicy = None,
+    routing: RoutingPolicy = None,
+    hedge: HedgePolicy = None,
+    fake: FakeLLMConfig = None,
+    cassette: CassettePolicy = None,
+):
+    return agent_registry.get_llm(
+        llm_api_key, model=model, temperature=temperature, base_url=base_url,
+        fallback_model=fallback_model, policy=policy, routing=routing, hedge=hedge, fake=fake,
+        cassette=cassette,
+    )
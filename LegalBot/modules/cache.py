@@ -0,0 +1,168 @@
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+def normalize_text(text: str) -> str:
+    """
+    Collapse runs of whitespace so trivially different prompts share a key.
+    Case is kept: party names and codes such as "CA" are significant.
+    """
+    return re.sub(r"\s+", " ", str(text or "")).strip()
+
+
+def normalize_history(history) -> list:
+    """
+    Reduce a conversation history to [role, normalized content] pairs.
+
+    Accepts either LangChain messages or {"role": ..., "content": ...} dicts.
+    """
+    normalized = []
+    for message in history or []:
+        if isinstance(message, dict):
+            role, content = message.get("role", ""), message.get("content", "")
+        else:
+            role, content = message.type, message.content
+        normalized.append([role, normalize_text(content)])
+    return normalized
+
+
+def make_cache_key(model, temperature, prompt_version, history, prompt) -> str:
+    """Canonical SHA-256 of everything that determines an LLM response."""
+    payload = json.dumps(
+        {
+            "model": model,
+            "temperature": float(temperature),
+            "prompt_version": prompt_version,
+            "history": normalize_history(history),
+            "input": normalize_text(prompt),
+        },
+        sort_keys=True,
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    Exact-match cache for LLM responses.
+
+    Entries live in an in-memory LRU bounded by max_entries and expire after
+    ttl seconds. If a path is given, entries are also written to a SQLite
+    file so they survive restarts; memory misses fall through to disk.
+    """
+
+    def __init__(self, max_entries: int = 512, ttl: float = 3600, path: str = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = str(path) if path else None
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._memory_bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self._db = None
+        if self.path:
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS response_cache ("
+                " key TEXT PRIMARY KEY,"
+                " value TEXT NOT NULL,"
+                " expires_at REAL NOT NULL)"
+            )
+            self._db.execute("DELETE FROM response_cache WHERE expires_at <= ?", (time.time(),))
+            self._db.commit()
+
+    def get(self, key: str):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                self._drop(key)
+
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT value, expires_at FROM response_cache WHERE key = ? AND expires_at > ?",
+                    (key, now),
+                ).fetchone()
+                if row is not None:
+                    value, expires_at = row
+                    self._remember(key, value, expires_at)
+                    self.hits += 1
+                    self.disk_hits += 1
+                    return value
+
+            self.misses += 1
+            return None
+
+    def set(self, key: str, value: str):
+        expires_at = time.time() + self.ttl
+        with self._lock:
+            self._remember(key, value, expires_at)
+            self.stores += 1
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO response_cache (key, value, expires_at) VALUES (?, ?, ?)",
+                    (key, value, expires_at),
+                )
+                self._db.execute(
+                    "DELETE FROM response_cache WHERE key NOT IN ("
+                    " SELECT key FROM response_cache ORDER BY expires_at DESC LIMIT ?)",
+                    (self.max_entries * 4,),
+                )
+                self._db.commit()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._memory_bytes = 0
+            if self._db is not None:
+                self._db.execute("DELETE FROM response_cache")
+                self._db.commit()
+
+    def _remember(self, key, value, expires_at):
+        if key in self._entries:
+            self._drop(key)
+        self._entries[key] = (expires_at, value)
+        self._memory_bytes += len(value.encode("utf-8"))
+        while len(self._entries) > self.max_entries:
+            oldest = next(iter(self._entries))
+            self._drop(oldest)
+            self.evictions += 1
+
+    def _drop(self, key):
+        _, value = self._entries.pop(key)
+        self._memory_bytes -= len(value.encode("utf-8"))
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            stats = {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "stores": self.stores,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes_stored": self._memory_bytes,
+            }
+            if self._db is not None:
+                count, size = self._db.execute(
+                    "SELECT COUNT(*), COALESCE(SUM(LENGTH(CAST(value AS BLOB))), 0) FROM response_cache"
+                ).fetchone()
+                stats["disk_entries"] = count
+                stats["disk_bytes_stored"] = size
+            return stats
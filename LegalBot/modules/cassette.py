@@ -0,0 +1,377 @@
+"""
+Record/replay cassettes of upstream LLM calls.
+
+Comparing latency and token usage across releases needs the same
+conversations answered by the same model outputs. With a CassettePolicy
+every provider client built by modules/agent.py is wrapped in
+CassetteChatModel:
+
+- "record" passes calls through and appends each completed one (text,
+  tool calls, usage and per-chunk timings) to the cassette file,
+- "replay" never calls upstream: each call is answered from the recorded
+  call with the same model, messages, tools and stop words, with its
+  original timings (realtime) or at full speed. A call that was recorded
+  several times is answered by each recording in turn; one that was never
+  recorded raises CassetteMiss.
+
+The wrapper sits below the resilience, routing and hedging layers, so
+retries, fallbacks and hedges are recorded and replayed as the individual
+upstream calls they are. Streams closed before they finish are not
+recorded.
+
+Tool results are part of the next call's messages, and so of its key. A
+live web search rarely returns the same text twice, so the agent's tools
+go through cassette_tool() too: recording stores each tool output next to
+the LLM calls, and replay serves it (after its recorded duration when
+realtime) without searching. Cassettes recorded before tool outputs were
+stored replay conversations without tool calls only; any searching
+conversation misses and has to be recorded again.
+
+A cassette is a JSON Lines file, gzip-compressed when its path ends in
+".gz", with one call per line:
+
+    {"key": "<request digest>", "model": "...", "timing": [[ms, "text"], ...],
+     "end": ms, "tool_calls": [...], "usage": {...}}
+
+where each timing entry is a text chunk and the milliseconds since the
+previous one, and "end" is the time from the last chunk to the end of
+the call. Tool outputs are stored as
+
+    {"key": "<tool digest>", "tool": "Legal_Web_Search", "ms": 412, "output": "..."}
+"""
+
+import asyncio
+import gzip
+import hashlib
+import json
+import threading
+import time
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Any, Optional
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from pydantic import ConfigDict
+
+RECORD = "record"
+REPLAY = "replay"
+CASSETTE_MODES = (RECORD, REPLAY)
+
+
+class CassetteMiss(LookupError):
+    """A replayed call has no recording in the cassette."""
+
+
+@dataclass(frozen=True)
+class CassettePolicy:
+    """Cassette settings; hashable so it can key caches."""
+
+    mode: str
+    path: str
+    realtime: bool = True
+
+
+def _message_record(message) -> dict:
+    message_type = "ai" if message.type == "AIMessageChunk" else message.type
+    return {
+        "type": message_type,
+        "content": message.content,
+        "tool_calls": [
+            {"name": call["name"], "args": call["args"], "id": call.get("id")}
+            for call in getattr(message, "tool_calls", None) or ()
+        ],
+        "tool_call_id": getattr(message, "tool_call_id", None),
+    }
+
+
+def request_key(model_name, messages, stop=None, **kwargs) -> str:
+    """Digest of everything that determines an upstream call's output."""
+    payload = {
+        "model": model_name,
+        "messages": [_message_record(message) for message in messages],
+        "tools": kwargs.get("tools") or [],
+        "tool_choice": kwargs.get("tool_choice"),
+        "stop": stop,
+    }
+    encoded = json.dumps(payload, sort_keys=True, default=str).encode("utf-8")
+    return hashlib.sha256(encoded).hexdigest()[:32]
+
+
+def tool_key(tool_name, tool_input) -> str:
+    """Digest of a tool invocation, for recording its output."""
+    encoded = json.dumps({"tool": tool_name, "input": tool_input}, sort_keys=True, default=str).encode("utf-8")
+    return hashlib.sha256(encoded).hexdigest()[:32]
+
+
+class Cassette:
+    """One cassette file: appended to when recording, loaded into memory for replay."""
+
+    def __init__(self, path, mode):
+        self.path = path
+        self.mode = mode
+        self._lock = threading.Lock()
+        self._entries = defaultdict(list)
+        self._served = defaultdict(int)
+        self.recorded = 0
+        self.replayed = 0
+        self.misses = 0
+        if mode == REPLAY:
+            self._load()
+
+    def _open(self, mode):
+        if self.path.endswith(".gz"):
+            return gzip.open(self.path, mode + "t", encoding="utf-8")
+        return open(self.path, mode, encoding="utf-8")
+
+    def _load(self):
+        with self._open("r") as handle:
+            for line in handle:
+                if line.strip():
+                    entry = json.loads(line)
+                    self._entries[entry["key"]].append(entry)
+
+    def lookup(self, key) -> dict:
+        with self._lock:
+            entries = self._entries.get(key)
+            if not entries:
+                self.misses += 1
+                raise CassetteMiss(f"No recorded call in {self.path} matches this request ({key})")
+            entry = entries[self._served[key] % len(entries)]
+            self._served[key] += 1
+            self.replayed += 1
+            return entry
+
+    def record(self, entry):
+        line = json.dumps(entry, separators=(",", ":")) + "\n"
+        with self._lock:
+            with self._open("a") as handle:
+                handle.write(line)
+            self.recorded += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "mode": self.mode,
+                "path": self.path,
+                "calls_loaded": sum(len(entries) for entries in self._entries.values()),
+                "recorded": self.recorded,
+                "replayed": self.replayed,
+                "misses": self.misses,
+            }
+
+
+_cassettes = {}
+_cassettes_lock = threading.Lock()
+
+
+def open_cassette(policy: CassettePolicy) -> Cassette:
+    """The process-wide Cassette for policy's path and mode."""
+    key = (policy.path, policy.mode)
+    with _cassettes_lock:
+        cassette = _cassettes.get(key)
+        if cassette is None:
+            cassette = _cassettes[key] = Cassette(policy.path, policy.mode)
+        return cassette
+
+
+def cassette_tool(policy: CassettePolicy, tool_name, tool_input, run):
+    """
+    Output of a tool call: run() and record it, or serve the recording.
+
+    Raises:
+        CassetteMiss: when replaying a tool call that was never recorded
+    """
+    cassette = open_cassette(policy)
+    key = tool_key(tool_name, tool_input)
+    if policy.mode == REPLAY:
+        entry = cassette.lookup(key)
+        if policy.realtime:
+            time.sleep(entry["ms"] / 1000)
+        return entry["output"]
+    started = time.monotonic()
+    output = run()
+    ms = round((time.monotonic() - started) * 1000)
+    cassette.record({"key": key, "tool": tool_name, "ms": ms, "output": output})
+    return output
+
+
+def cassette_stats() -> list:
+    with _cassettes_lock:
+        cassettes = list(_cassettes.values())
+    return [cassette.stats() for cassette in cassettes]
+
+
+def reset_cassettes():
+    """Forget loaded cassettes, so replays re-read their files."""
+    with _cassettes_lock:
+        _cassettes.clear()
+
+
+class _StreamRecorder:
+    """Collects a streamed call's chunks and their timings."""
+
+    def __init__(self):
+        self.last = time.monotonic()
+        self.timing = []
+        self.message = None
+
+    def add(self, chunk):
+        now = time.monotonic()
+        if chunk.text:
+            self.timing.append([round((now - self.last) * 1000), chunk.text])
+            self.last = now
+        self.message = chunk.message if self.message is None else self.message + chunk.message
+
+    def entry(self, key, model_name) -> dict:
+        end = round((time.monotonic() - self.last) * 1000)
+        return _entry(key, model_name, self.timing, end, self.message)
+
+
+def _entry(key, model_name, timing, end, message) -> dict:
+    return {
+        "key": key,
+        "model": model_name,
+        "timing": timing,
+        "end": end,
+        "tool_calls": [
+            {"name": call["name"], "args": call["args"], "id": call.get("id")}
+            for call in getattr(message, "tool_calls", None) or ()
+        ],
+        "usage": getattr(message, "usage_metadata", None) or None,
+    }
+
+
+def _entry_text(entry) -> str:
+    return "".join(text for _, text in entry["timing"])
+
+
+class CassetteChatModel(BaseChatModel):
+    """Chat model that records or replays the calls of `inner` (see module docstring)."""
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    inner: Any
+    policy: CassettePolicy
+    model_name: Optional[str] = None
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        if self.model_name is None:
+            self.model_name = getattr(self.inner, "model_name", None)
+
+    @property
+    def _llm_type(self) -> str:
+        return "cassette-chat"
+
+    @property
+    def _identifying_params(self) -> dict:
+        return {"inner": self.inner._identifying_params, "cassette": self.policy.path}
+
+    @property
+    def cassette(self) -> Cassette:
+        return open_cassette(self.policy)
+
+    def bind_tools(self, tools, **kwargs):
+        binding = self.inner.bind_tools(tools, **kwargs)
+        return self.bind(**binding.kwargs)
+
+    def _key(self, messages, stop, kwargs):
+        return request_key(self.model_name, messages, stop, **kwargs)
+
+    def _pause(self, ms) -> float:
+        return ms / 1000 if self.policy.realtime else 0.0
+
+    @staticmethod
+    def _result(entry) -> ChatResult:
+        message = AIMessage(
+            content=_entry_text(entry),
+            tool_calls=entry["tool_calls"],
+            usage_metadata=entry["usage"],
+            response_metadata={"model_name": entry["model"]},
+        )
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _replay_chunks(self, entry):
+        """(seconds to wait, chunk) pairs that re-create a recorded call."""
+        for ms, text in entry["timing"]:
+            yield self._pause(ms), ChatGenerationChunk(message=AIMessageChunk(content=text))
+        tail = AIMessageChunk(
+            content="",
+            tool_call_chunks=[
+                {"name": call["name"], "args": json.dumps(call["args"]), "id": call["id"], "index": index}
+                for index, call in enumerate(entry["tool_calls"])
+            ],
+            usage_metadata=entry["usage"],
+            response_metadata={"model_name": entry["model"]},
+        )
+        yield self._pause(entry["end"]), ChatGenerationChunk(message=tail)
+
+    def _recorded(self, key, result, started):
+        message = result.generations[0].message if result.generations else None
+        text = result.generations[0].text if result.generations else ""
+        ms = round((time.monotonic() - started) * 1000)
+        timing = [[ms, text]] if text else []
+        self.cassette.record(_entry(key, self.model_name, timing, 0 if text else ms, message))
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        key = self._key(messages, stop, kwargs)
+        if self.policy.mode == REPLAY:
+            entry = self.cassette.lookup(key)
+            time.sleep(sum(pause for pause, _ in self._replay_chunks(entry)))
+            return self._result(entry)
+        started = time.monotonic()
+        result = self.inner._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+        self._recorded(key, result, started)
+        return result
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        key = self._key(messages, stop, kwargs)
+        if self.policy.mode == REPLAY:
+            entry = self.cassette.lookup(key)
+            await asyncio.sleep(sum(pause for pause, _ in self._replay_chunks(entry)))
+            return self._result(entry)
+        started = time.monotonic()
+        result = await self.inner._agenerate(messages, stop=stop, run_manager=run_manager, **kwargs)
+        self._recorded(key, result, started)
+        return result
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        key = self._key(messages, stop, kwargs)
+        if self.policy.mode == REPLAY:
+            # Sleep to each chunk's recorded offset, so per-chunk overhead does not add up
+            due = time.monotonic()
+            for pause, chunk in self._replay_chunks(self.cassette.lookup(key)):
+                due += pause
+                time.sleep(max(due - time.monotonic(), 0))
+                yield chunk
+            return
+        recorder = _StreamRecorder()
+        chunks = self.inner._stream(messages, stop=stop, run_manager=run_manager, **kwargs)
+        try:
+            for chunk in chunks:
+                recorder.add(chunk)
+                yield chunk
+        finally:
+            chunks.close()
+        self.cassette.record(recorder.entry(key, self.model_name))
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        key = self._key(messages, stop, kwargs)
+        if self.policy.mode == REPLAY:
+            due = time.monotonic()
+            for pause, chunk in self._replay_chunks(self.cassette.lookup(key)):
+                due += pause
+                await asyncio.sleep(max(due - time.monotonic(), 0))
+                yield chunk
+            return
+        recorder = _StreamRecorder()
+        chunks = self.inner._astream(messages, stop=stop, run_manager=run_manager, **kwargs)
+        try:
+            async for chunk in chunks:
+                recorder.add(chunk)
+                yield chunk
+        finally:
+            await chunks.aclose()
+        self.cassette.record(recorder.entry(key, self.model_name))
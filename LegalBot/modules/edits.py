@@ -0,0 +1,186 @@
+"""
+Rule-based interpreter for mechanical refinement requests.
+
+Requests such as "replace John Smith with Jane Doe", "change the date to
+October 15, 2024" or "set the rent to $2,000" are applied locally instead
+of asking the model to rewrite the document. The interpreter is
+deliberately conservative: whenever the request or the document is
+ambiguous it returns None and the caller falls back to the LLM.
+"""
+
+import re
+
+from .sections import is_heading, split_sections
+
+_MONTHS = (
+    r"(?:jan(?:uary)?|feb(?:ruary)?|mar(?:ch)?|apr(?:il)?|may|june?|july?|aug(?:ust)?"
+    r"|sep(?:t(?:ember)?)?|oct(?:ober)?|nov(?:ember)?|dec(?:ember)?)\.?"
+)
+_DAY = r"\d{1,2}(?:st|nd|rd|th)?"
+DATE_RE = re.compile(
+    rf"\b{_MONTHS}\s+{_DAY},?\s+\d{{4}}\b"                 # October 15, 2024
+    rf"|\b{_DAY}(?:\s+day\s+of)?\s+{_MONTHS},?\s+\d{{4}}\b"  # 15 October 2024 / 15th day of October, 2024
+    r"|\b\d{1,2}[/.-]\d{1,2}[/.-]\d{4}\b"                   # 10/15/2024
+    r"|\b\d{4}-\d{2}-\d{2}\b",                              # 2024-10-15
+    re.I,
+)
+MONEY_RE = re.compile(
+    r"(?:[$£€₹]|\b(?:Rs\.?|INR|USD)\s?)\s?(?:\d{1,3}(?:,\d{3})+|\d+)(?:\.\d+)?(?:\s?/-)?",
+    re.I,
+)
+
+_REPLACE_RE = re.compile(
+    r"^(?:replace|substitute|swap)\s+(?:all\s+(?:occurrences|instances)\s+of\s+)?(?P<old>.+?)"
+    r"\s+(?:with|by|for)\s+(?P<new>.+)$",
+    re.I | re.S,
+)
+_UPDATE_RE = re.compile(
+    r"^(?:change|update|set|modify|make|rename|correct)\s+(?P<old>.+?)\s+(?:to|as|into)\s+(?P<new>.+)$",
+    re.I | re.S,
+)
+_POLITE_PREFIX_RE = re.compile(r"^(?:(?:please|kindly|can you|could you|would you)[\s,]+)+", re.I)
+_POLITE_SUFFIX_RE = re.compile(r"[\s,]*(?:please|thanks|thank you)?[\s.!]*$", re.I)
+_SCOPE_SUFFIX_RE = re.compile(
+    r"\s+(?:throughout(?:\s+the\s+\w+)?|everywhere|in\s+all\s+places"
+    r"|in\s+the\s+(?:document|agreement|contract|draft|deed))$",
+    re.I,
+)
+_QUOTED_RE = re.compile(r"^[\"'“‘](.+)[\"'”’]$", re.S)
+# Words that suggest the request does more than one thing
+_COMPOUND_RE = re.compile(r"\b(?:and|also|then|but|plus|except)\b|[;\n]", re.I)
+# A proper name ("John Smith", "Acme Holdings Ltd."): every word capitalized
+_NAME_RE = re.compile(r"^[A-Z][\w.&'’-]*(?:\s+[A-Z][\w.&'’-]*)*$")
+_FIELD_FILLER = {"the", "a", "an", "this", "that", "date", "amount", "value", "of", "in", "on"}
+# "$1,500 (One Thousand Five Hundred Dollars)": editing the figure alone
+# would leave the words inconsistent
+_AMOUNT_IN_WORDS_RE = re.compile(r"\([A-Za-z ,\-]*(?:dollars|rupees|pounds|euros)[^)]*\)", re.I)
+
+
+def _unquote(text):
+    match = _QUOTED_RE.match(text.strip())
+    return (match.group(1), True) if match else (text.strip(), False)
+
+
+def _literal_pattern(text):
+    return re.compile(rf"(?<!\w){re.escape(text)}(?!\w)")
+
+
+def _fullmatch(pattern, text):
+    match = pattern.search(text)
+    return match is not None and match.group(0).strip() == text.strip()
+
+
+def _value_pattern(value):
+    if _fullmatch(DATE_RE, value):
+        return DATE_RE
+    if _fullmatch(MONEY_RE, value):
+        return MONEY_RE
+    return None
+
+
+def _kind(value):
+    """The kind of a literal value: "date", "amount", "name" or None."""
+    pattern = _value_pattern(value)
+    if pattern is DATE_RE:
+        return "date"
+    if pattern is MONEY_RE:
+        return "amount"
+    if _NAME_RE.match(value):
+        return "name"
+    return None
+
+
+def _replace_literal(document, old, new):
+    """
+    Replace whole-word, case-sensitive occurrences of old outside heading
+    lines, so "Payment" in "2. PAYMENT TERMS" is never renamed.
+    """
+    pattern = _literal_pattern(old)
+    lines, count = document.splitlines(keepends=True), 0
+    for index, line in enumerate(lines):
+        if is_heading(line):
+            continue
+        lines[index], replaced = pattern.subn(lambda _: new, line)
+        count += replaced
+    return "".join(lines) if count else None
+
+
+def _replace_field(document, field, new, pattern):
+    """
+    Set a date or amount identified by a field description ("the rent",
+    "the effective date") to new.
+
+    Lines mentioning every keyword of the field, and sections headed by
+    it, are searched for values of the same kind; the edit only happens if
+    they hold exactly one distinct value.
+    """
+    keywords = [word for word in re.findall(r"[a-z]+", field.lower()) if word not in _FIELD_FILLER]
+
+    def mentions_field(line):
+        return all(re.search(rf"\b{word}", line, re.I) for word in keywords)
+
+    lines, targets = [], []
+    for section in split_sections(document):
+        section_lines = section.splitlines(keepends=True)
+        # A section headed by the field ("2. Rent") is searched as a whole
+        headed = bool(keywords) and mentions_field(section_lines[0])
+        for line in section_lines:
+            if (headed or mentions_field(line)) and pattern.search(line):
+                targets.append(len(lines))
+            lines.append(line)
+    values = {match.group(0).strip() for index in targets for match in pattern.finditer(lines[index])}
+    if len(values) != 1:
+        return None
+    if pattern is MONEY_RE and any(_AMOUNT_IN_WORDS_RE.search(lines[index]) for index in targets):
+        return None
+    for index in targets:
+        lines[index] = pattern.sub(lambda _: new, lines[index])
+    return "".join(lines)
+
+
+def parse_edit_request(request: str):
+    """
+    Parse a refinement request into (old, new, old_quoted), or None if it
+    is not a single find/replace or field update.
+    """
+    text = _POLITE_PREFIX_RE.sub("", (request or "").strip())
+    text = _POLITE_SUFFIX_RE.sub("", text)
+    match = _REPLACE_RE.match(text) or _UPDATE_RE.match(text)
+    if match is None:
+        return None
+    old, old_quoted = _unquote(match.group("old"))
+    new, new_quoted = _unquote(_SCOPE_SUFFIX_RE.sub("", match.group("new").strip()))
+    if not old or not new or len(new) > 120:
+        return None
+    if not new_quoted and (_COMPOUND_RE.search(new) or _COMPOUND_RE.search(old)):
+        return None
+    return old, new, old_quoted
+
+
+def apply_simple_edit(document: str, request: str):
+    """
+    Apply a mechanical edit request to the document locally.
+
+    Returns:
+        str: The edited document, or None if the request should go to the LLM
+    """
+    parsed = parse_edit_request(request)
+    if parsed is None:
+        return None
+    old, new, old_quoted = parsed
+
+    pattern = _value_pattern(new)
+    old_kind = _kind(old)
+    if old_quoted or (old_kind is not None and old_kind == _kind(new)):
+        # Quoted text, or a name, date or amount replaced by one of the same
+        # kind. "Set Rent to $2,000" names a field, not the text to replace.
+        edited = _replace_literal(document, old, new)
+    elif pattern is not None:
+        edited = _replace_field(document, old, new, pattern)
+    else:
+        # A description ("payment terms", "governing law") needs the model
+        edited = None
+
+    if edited is None or edited == document:
+        return None
+    return edited
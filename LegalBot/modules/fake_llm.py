@@ -0,0 +1,395 @@
+"""
+Deterministic fake LLM backend for tests and benchmarks.
+
+With AI_LLM_BACKEND=fake the agent registry builds FakeChatModel instead
+of ChatOpenAI clients, so the Django views, the agent loop (including tool
+calls), the resilience/routing/hedging wrappers and the cleaning pipeline
+all run offline, with no API key and no provider cost. The same replies
+are served over HTTP by modules/fake_llm_server.py, for benchmarking the
+real OpenAI client path against a local stub.
+
+Replies depend only on the conversation, never on randomness:
+
+- drafting turns ask FakeLLMConfig.questions clarifying questions, then
+  call Legal_Corpus_Search (Legal_Web_Search when no corpus is indexed)
+  tool_calls times (when tools are bound), then answer `DRAFT_COMPLETE:`
+  with a templated document of about draft_words words; a user who asks
+  for the document gets it at once,
+- refinement prompts get the document back with the request appended as
+  a new clause, section refinements a patch of the best matching section,
+- summary prompts get a bullet list of the new user turns.
+
+A JSON script (FakeLLMConfig.script) can override any of these. It is a
+list of rules; the first rule whose optional "kind" (drafting, refine,
+sections or summary) and "match" regex (searched in the latest user
+message) fit the call answers it with "reply" (a template), "replies" (one
+per assistant turn so far, the last repeating) or "tool_call" ({"name",
+"args"}). Templates may use {input}, {turn}, {document}, {request} and
+{draft}. Calls no rule matches fall back to the built-in replies:
+
+    [
+        {"kind": "drafting", "match": "(?i)lease", "reply": "Which province is the property in?"},
+        {"kind": "refine", "reply": "{document}\\n\\nAMENDMENT\\n{request}"}
+    ]
+
+Latency and throughput are simulated: `latency` seconds before the first
+token, then `tokens_per_second` (0 streams as fast as possible).
+"""
+
+import asyncio
+import functools
+import json
+import re
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.utils.function_calling import convert_to_openai_tool
+
+from .routing import DRAFT_MARKER, DRAFT_REQUEST
+from .tokens import MESSAGE_OVERHEAD_TOKENS, count_tokens
+
+DRAFTING = "drafting"
+REFINE = "refine"
+SECTIONS = "sections"
+SUMMARY = "summary"
+CALL_KINDS = (DRAFTING, REFINE, SECTIONS, SUMMARY)
+
+SEARCH_TOOL = "Legal_Web_Search"
+CORPUS_SEARCH_TOOL = "Legal_Corpus_Search"
+
+CLARIFYING_QUESTIONS = (
+    "Thank you. Could you please provide the full legal names and addresses of all parties involved?",
+    "Understood. In which province or territory will this document be governed, and what is its effective date?",
+    "Are there any specific terms, amounts or special clauses you would like the document to include?",
+    "Is there anything else I should know before I prepare the draft?",
+)
+
+DOCUMENT_TYPES = re.compile(
+    r"\b(residential lease|lease agreement|employment (?:agreement|contract)|non-disclosure agreement|"
+    r"service agreement|partnership agreement|power of attorney|last will|lease|will|nda|contract|agreement)\b",
+    re.IGNORECASE,
+)
+
+SECTION_HEADINGS = (
+    "PARTIES", "DEFINITIONS", "TERM", "PAYMENT", "OBLIGATIONS OF THE PARTIES", "CONFIDENTIALITY",
+    "LIABILITY", "TERMINATION", "NOTICES", "GOVERNING LAW", "ENTIRE AGREEMENT",
+)
+
+CLAUSES = (
+    "The parties agree to perform their obligations under this document in good faith.",
+    "Each party shall act reasonably and promptly in exercising its rights hereunder.",
+    "Any amendment to this document must be made in writing and signed by both parties.",
+    "Time is of the essence in the performance of every obligation set out herein.",
+    "No waiver of any provision shall be effective unless given expressly and in writing.",
+    "Where any provision is found to be unenforceable, the remaining provisions continue in full force.",
+    "Headings are for convenience only and do not affect the interpretation of this document.",
+)
+
+_SECTION_BLOCK = re.compile(r"\[\[SECTION (\d+)\]\]\n(.*?)(?=\n\[\[SECTION \d+\]\]|\Z)", re.S)
+# Pattern template for the ---delimited blocks after a **heading** in the prompts
+_QUOTED_BLOCK = r"\*\*{}\*\*\s*\n\s*---\s*\n(.*?)\n\s*---"
+
+
+@dataclass(frozen=True)
+class FakeLLMConfig:
+    """Fake backend settings; hashable so it can key caches."""
+
+    script: str = ""
+    latency: float = 0.0
+    tokens_per_second: float = 0.0
+    questions: int = 2
+    tool_calls: int = 0
+    draft_words: int = 400
+
+
+@dataclass(frozen=True)
+class FakeReply:
+    content: str
+    tool_calls: tuple = ()
+
+
+class _Template(dict):
+    """format_map mapping that leaves unknown {placeholders} untouched."""
+
+    def __missing__(self, key):
+        return "{" + key + "}"
+
+
+def _content_text(content) -> str:
+    if isinstance(content, list):
+        return " ".join(part.get("text", "") if isinstance(part, dict) else str(part) for part in content)
+    return str(content or "")
+
+
+def _normalize(messages):
+    """(role, text, has_tool_calls) for LangChain messages or OpenAI-style dicts."""
+    roles = {"human": "user", "ai": "assistant", "AIMessageChunk": "assistant"}
+    normalized = []
+    for message in messages:
+        if isinstance(message, dict):
+            role, content, tool_calls = message.get("role"), message.get("content"), message.get("tool_calls")
+        else:
+            role = roles.get(message.type, message.type)
+            content, tool_calls = message.content, getattr(message, "tool_calls", None)
+        normalized.append((role, _content_text(content), bool(tool_calls)))
+    return normalized
+
+
+def _quoted(text, heading):
+    """The ---delimited block after a **heading** of the refinement/summary prompts."""
+    match = re.search(_QUOTED_BLOCK.format(re.escape(heading)), text, re.S)
+    return match.group(1).strip() if match else ""
+
+
+def _words(text):
+    return set(re.findall(r"[a-z]{4,}", text.lower()))
+
+
+@functools.lru_cache(maxsize=8)
+def load_script(path):
+    with open(path, encoding="utf-8") as handle:
+        rules = json.load(handle)
+    if not isinstance(rules, list):
+        raise ValueError(f"Fake LLM script {path} must contain a JSON list of rules")
+    return tuple(rules)
+
+
+def split_tokens(text):
+    """Split text into word-sized stream pieces that join back to it exactly."""
+    return re.findall(r"\s*\S+|\s+", text)
+
+
+class FakeResponder:
+    """Computes the deterministic reply to one chat call (see module docstring)."""
+
+    def __init__(self, config: FakeLLMConfig = None):
+        self.config = config or FakeLLMConfig()
+
+    def respond(self, messages, tools=()) -> FakeReply:
+        """Reply to messages; tools are the names of the tools bound to the call."""
+        conversation = _normalize(messages)
+        user_text = next((text for role, text, _ in reversed(conversation) if role == "user"), "")
+        kind = self.kind(user_text)
+        values = self._values(conversation, kind, user_text)
+        reply = self._scripted(kind, user_text, values) if self.config.script else None
+        if reply is None:
+            reply = getattr(self, f"_{kind}")(conversation, values, tools)
+        return reply
+
+    @staticmethod
+    def kind(user_text) -> str:
+        if "maintaining a running summary" in user_text:
+            return SUMMARY
+        if "[[SECTION " in user_text and "<<<SECTION n>>>" in user_text:
+            return SECTIONS
+        if "**Current Document Draft" in user_text:
+            return REFINE
+        return DRAFTING
+
+    def _values(self, conversation, kind, user_text):
+        turn = sum(1 for role, _, tool_calls in conversation if role == "assistant" and not tool_calls)
+        values = {"input": user_text, "turn": turn, "document": "", "request": ""}
+        if kind in (REFINE, SECTIONS):
+            heading = "Current Document Draft:" if kind == REFINE else \
+                "Current Document Draft (sections are marked [[SECTION n]]):"
+            values["document"] = _quoted(user_text, heading)
+            values["request"] = _quoted(user_text, "User's Refinement Request:").strip('"')
+        if kind == DRAFTING:
+            values["draft"] = self.draft_document(conversation)
+        return _Template(values)
+
+    def _scripted(self, kind, user_text, values) -> Optional[FakeReply]:
+        for rule in load_script(self.config.script):
+            if rule.get("kind", kind) != kind:
+                continue
+            if rule.get("match") and not re.search(rule["match"], user_text):
+                continue
+            if "tool_call" in rule:
+                call = rule["tool_call"]
+                return FakeReply("", ((call.get("name", SEARCH_TOOL), call.get("args", {}), _call_id(values)),))
+            if "replies" in rule:
+                replies = rule["replies"]
+                return FakeReply(replies[min(values["turn"], len(replies) - 1)].format_map(values))
+            return FakeReply(rule.get("reply", "").format_map(values))
+        return None
+
+    def _drafting(self, conversation, values, tools):
+        users = [text for role, text, _ in conversation if role == "user"]
+        has_draft = any(role == "assistant" and text.lstrip().startswith(DRAFT_MARKER)
+                        for role, text, _ in conversation)
+        summarized = any(role == "system" and "Summary of the earlier conversation" in text
+                         for role, text, _ in conversation)
+        asked_for_draft = bool(users) and DRAFT_REQUEST.search(users[-1])
+        if not (has_draft or asked_for_draft or summarized) and values["turn"] < self.config.questions:
+            return FakeReply(CLARIFYING_QUESTIONS[values["turn"] % len(CLARIFYING_QUESTIONS)])
+        # Searches made since the latest user message
+        searches = 0
+        for role, _, tool_calls in reversed(conversation):
+            if role == "user":
+                break
+            searches += role == "assistant" and tool_calls
+        tool = CORPUS_SEARCH_TOOL if CORPUS_SEARCH_TOOL in tools else SEARCH_TOOL
+        if tool in tools and searches < self.config.tool_calls:
+            query = f"{_document_type(users).lower()} requirements Canada"
+            return FakeReply("", ((tool, {"query": query}, _call_id(values, searches)),))
+        return FakeReply(f"{DRAFT_MARKER}\n\n{values['draft']}")
+
+    def _refine(self, conversation, values, tools):
+        document = values["document"].rstrip()
+        return FakeReply(f"{document}\n\nAMENDMENT\n\nAs requested: {values['request']}")
+
+    def _sections(self, conversation, values, tools):
+        sections = [(int(number), body.rstrip()) for number, body in _SECTION_BLOCK.findall(values["document"])]
+        if not sections:
+            return FakeReply("NO_CHANGES")
+        request = _words(values["request"])
+        # The section sharing most words with the request; ties go to the later one
+        number, body = max(sections, key=lambda section: (len(request & _words(section[1])), section[0]))
+        return FakeReply(f"<<<SECTION {number}>>>\n{body}\nAs requested: {values['request']}\n<<<END>>>")
+
+    def _summary(self, conversation, values, tools):
+        text = values["input"]
+        existing = _quoted(text, "Current Summary:")
+        lines = [] if existing in ("", "(none yet)") else existing.splitlines()
+        for line in _quoted(text, "New Conversation Turns:").splitlines():
+            if line.startswith("User: "):
+                lines.append(f"- {line[len('User: '):][:200]}")
+        return FakeReply("\n".join(lines) or "- No details provided yet.")
+
+    def draft_document(self, conversation) -> str:
+        """A numbered legal document of about config.draft_words words."""
+        users = [text for role, text, _ in conversation if role == "user"]
+        title = _document_type(users).upper()
+        # The current prompt is both the last history message and the input
+        details = list(dict.fromkeys(" ".join(text.split())[:300] for text in users if text.strip()))
+        lines = [title, "", f"This {title.title()} is entered into under the laws of Canada.", ""]
+        words = sum(len(line.split()) for line in lines)
+        index = 0
+        while index < len(SECTION_HEADINGS) and (words < self.config.draft_words or index < 3):
+            body = [details[index]] if index < len(details) else []
+            clause = index
+            while sum(len(part.split()) for part in body) < 40:
+                body.append(CLAUSES[clause % len(CLAUSES)])
+                clause += 1
+            section = [f"{index + 1}. {SECTION_HEADINGS[index]}", "", " ".join(body), ""]
+            lines += section
+            words += sum(len(line.split()) for line in section)
+            index += 1
+        lines += ["IN WITNESS WHEREOF the parties have signed this document.", "", "_______________", "Signature"]
+        return "\n".join(lines)
+
+    # Pacing
+
+    def delays(self):
+        """Seconds to wait before the first token and between tokens."""
+        rate = self.config.tokens_per_second
+        return self.config.latency, (1.0 / rate if rate > 0 else 0.0)
+
+    def usage(self, messages, reply: FakeReply) -> dict:
+        input_tokens = sum(count_tokens(text) + MESSAGE_OVERHEAD_TOKENS for _, text, _ in _normalize(messages))
+        output_tokens = count_tokens(reply.content) + sum(
+            count_tokens(name) + count_tokens(json.dumps(args)) for name, args, _ in reply.tool_calls
+        )
+        return {"input_tokens": input_tokens, "output_tokens": output_tokens,
+                "total_tokens": input_tokens + output_tokens}
+
+
+def _document_type(users) -> str:
+    for text in users:
+        match = DOCUMENT_TYPES.search(text)
+        if match:
+            name = match.group(1)
+            return "Non-Disclosure Agreement" if name.lower() == "nda" else name.title()
+    return "Legal Agreement"
+
+
+def _call_id(values, index=0):
+    return f"call_fake_{values['turn']}_{index}"
+
+
+def _tool_names(kwargs):
+    return tuple(tool.get("function", {}).get("name") for tool in kwargs.get("tools") or ())
+
+
+class FakeChatModel(BaseChatModel):
+    """Chat model answering from FakeResponder with simulated latency (see module docstring)."""
+
+    model_name: str = "fake-model"
+    config: FakeLLMConfig = FakeLLMConfig()
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat"
+
+    @property
+    def _identifying_params(self) -> dict:
+        return {"model_name": self.model_name, "config": self.config}
+
+    def bind_tools(self, tools, **kwargs):
+        return self.bind(tools=[convert_to_openai_tool(tool) for tool in tools], **kwargs)
+
+    def _reply(self, messages, kwargs):
+        responder = FakeResponder(self.config)
+        reply = responder.respond(messages, _tool_names(kwargs))
+        return responder, reply
+
+    def _result(self, responder, messages, reply):
+        message = AIMessage(
+            content=reply.content,
+            tool_calls=[{"name": name, "args": args, "id": call_id} for name, args, call_id in reply.tool_calls],
+            usage_metadata=responder.usage(messages, reply),
+            response_metadata={"model_name": self.model_name},
+        )
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _chunks(self, responder, messages, reply):
+        for piece in split_tokens(reply.content):
+            yield ChatGenerationChunk(message=AIMessageChunk(content=piece))
+        for index, (name, args, call_id) in enumerate(reply.tool_calls):
+            yield ChatGenerationChunk(message=AIMessageChunk(
+                content="",
+                tool_call_chunks=[{"name": name, "args": json.dumps(args), "id": call_id, "index": index}],
+            ))
+        yield ChatGenerationChunk(message=AIMessageChunk(
+            content="",
+            usage_metadata=responder.usage(messages, reply),
+            response_metadata={"model_name": self.model_name},
+        ))
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        responder, reply = self._reply(messages, kwargs)
+        first, between = responder.delays()
+        time.sleep(first + between * len(split_tokens(reply.content)))
+        return self._result(responder, messages, reply)
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        responder, reply = self._reply(messages, kwargs)
+        first, between = responder.delays()
+        await asyncio.sleep(first + between * len(split_tokens(reply.content)))
+        return self._result(responder, messages, reply)
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        responder, reply = self._reply(messages, kwargs)
+        first, between = responder.delays()
+        time.sleep(first)
+        for chunk in self._chunks(responder, messages, reply):
+            if chunk.text and between:
+                time.sleep(between)
+            if run_manager and chunk.text:
+                run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        responder, reply = self._reply(messages, kwargs)
+        first, between = responder.delays()
+        await asyncio.sleep(first)
+        for chunk in self._chunks(responder, messages, reply):
+            if chunk.text and between:
+                await asyncio.sleep(between)
+            if run_manager and chunk.text:
+                await run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
@@ -0,0 +1,242 @@
+"""
+Minimal OpenAI-compatible chat completions server for local testing.
+
+Serves POST .../chat/completions (plain and "stream": true) with the
+deterministic replies of modules/fake_llm.py (clarifying questions, tool
+calls, templated drafts, or a JSON script), or a fixed --reply. It can
+pace streamed tokens and inject upstream faults, so the OpenAI client
+path, the retry, timeout, circuit breaker and fallback behaviour in
+modules/resilience.py and the server overhead can all be exercised
+without a real provider:
+
+    python -m modules.fake_llm_server --port 8765 --fail-first 2 --latency 0.5 --token-rate 50
+
+then point OPENROUTER_BASE_URL at http://127.0.0.1:8765/v1.
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .fake_llm import FakeLLMConfig, FakeReply, FakeResponder, split_tokens
+
+
+class FaultConfig:
+    """Mutable fault settings shared by all request handlers."""
+
+    def __init__(self, reply=None, latency=0.0, fail_first=0, fail_rate=0.0, fail_status=503, hang=0.0,
+                 token_rate=0.0, responder=None):
+        # A fixed reply, or None to answer from the responder
+        self.reply = reply
+        self.responder = responder or FakeResponder()
+        self.latency = latency
+        self.token_rate = token_rate
+        self.fail_first = fail_first
+        self.fail_rate = fail_rate
+        self.fail_status = fail_status
+        self.hang = hang
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def next_request(self):
+        """Count a request and return the status code it should fail with, if any."""
+        with self._lock:
+            self.requests += 1
+            number = self.requests
+        if number <= self.fail_first or random.random() < self.fail_rate:
+            return self.fail_status
+        return None
+
+    def answer(self, request):
+        """The FakeReply and its usage for a chat completions request body."""
+        messages = request.get("messages") or []
+        if self.reply is not None:
+            reply = FakeReply(self.reply)
+        else:
+            tools = tuple(tool.get("function", {}).get("name") for tool in request.get("tools") or ())
+            reply = self.responder.respond(messages, tools)
+        usage = self.responder.usage(messages, reply)
+        return reply, {
+            "prompt_tokens": usage["input_tokens"],
+            "completion_tokens": usage["output_tokens"],
+            "total_tokens": usage["total_tokens"],
+        }
+
+
+def _tool_calls(reply, streamed=False):
+    calls = [
+        {"id": call_id, "type": "function", "function": {"name": name, "arguments": json.dumps(args)}}
+        for name, args, call_id in reply.tool_calls
+    ]
+    if streamed:
+        for index, call in enumerate(calls):
+            call["index"] = index
+    return calls
+
+
+def _finish_reason(reply):
+    return "tool_calls" if reply.tool_calls else "stop"
+
+
+def _completion(model, reply, usage):
+    message = {"role": "assistant", "content": reply.content}
+    if reply.tool_calls:
+        message["tool_calls"] = _tool_calls(reply)
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex[:12]}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "message": message, "finish_reason": _finish_reason(reply)}],
+        "usage": usage,
+    }
+
+
+def _chunk(completion_id, model, delta, finish_reason=None):
+    return {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+
+
+def _usage_chunk(completion_id, model, usage):
+    return {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [],
+        "usage": usage,
+    }
+
+
+class FakeLLMHandler(BaseHTTPRequestHandler):
+    faults = FaultConfig()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        request = json.loads(self.rfile.read(length) or b"{}")
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": "Not found"}})
+            return
+
+        faults = self.faults
+        fail_status = faults.next_request()
+        if faults.hang:
+            time.sleep(faults.hang)
+        if fail_status is not None:
+            self._send_json(fail_status, {"error": {"message": "Injected failure", "code": fail_status}})
+            return
+        time.sleep(faults.latency)
+
+        model = request.get("model", "fake-model")
+        reply, usage = faults.answer(request)
+        pieces = split_tokens(reply.content)
+        pause = 1.0 / faults.token_rate if faults.token_rate > 0 else 0.0
+        if not request.get("stream"):
+            time.sleep(pause * len(pieces))
+            self._send_json(200, _completion(model, reply, usage))
+            return
+
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        self._send_event(_chunk(completion_id, model, {"role": "assistant", "content": ""}))
+        for piece in pieces:
+            time.sleep(pause)
+            self._send_event(_chunk(completion_id, model, {"content": piece}))
+        if reply.tool_calls:
+            self._send_event(_chunk(completion_id, model, {"tool_calls": _tool_calls(reply, streamed=True)}))
+        self._send_event(_chunk(completion_id, model, {}, _finish_reason(reply)))
+        if (request.get("stream_options") or {}).get("include_usage"):
+            self._send_event(_usage_chunk(completion_id, model, usage))
+        self.wfile.write(b"data: [DONE]\n\n")
+
+    def _send_event(self, payload):
+        self.wfile.write(f"data: {json.dumps(payload)}\n\n".encode("utf-8"))
+        self.wfile.flush()
+
+
+class FakeLLMServer:
+    """Runs the fake server on a background thread; usable as a context manager."""
+
+    def __init__(self, host="127.0.0.1", port=0, **faults):
+        handler = type("Handler", (FakeLLMHandler,), {"faults": FaultConfig(**faults)})
+        self.httpd = ThreadingHTTPServer((host, port), handler)
+        self.httpd.daemon_threads = True
+        self.faults = handler.faults
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--reply", default=None, help="always answer with this text instead of the fake replies")
+    parser.add_argument("--script", default="", help="JSON file of scripted replies (see modules/fake_llm.py)")
+    parser.add_argument("--questions", type=int, default=2, help="clarifying questions before drafting")
+    parser.add_argument("--tool-calls", type=int, default=0, help="Legal_Web_Search calls before drafting")
+    parser.add_argument("--draft-words", type=int, default=400, help="approximate length of drafts")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds before answering")
+    parser.add_argument("--token-rate", type=float, default=0.0, help="streamed tokens per second (0 = unthrottled)")
+    parser.add_argument("--fail-first", type=int, default=0, help="fail this many initial requests")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="probability of failing a request")
+    parser.add_argument("--fail-status", type=int, default=503)
+    parser.add_argument("--hang", type=float, default=0.0, help="stall every request this long (timeouts)")
+    args = parser.parse_args()
+
+    server = FakeLLMServer(
+        args.host, args.port, reply=args.reply, latency=args.latency, fail_first=args.fail_first,
+        fail_rate=args.fail_rate, fail_status=args.fail_status, hang=args.hang, token_rate=args.token_rate,
+        responder=FakeResponder(FakeLLMConfig(
+            script=args.script, questions=args.questions, tool_calls=args.tool_calls, draft_words=args.draft_words,
+        )),
+    )
+    print(f"Fake LLM server listening on {server.base_url}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,347 @@
+"""
+Hedged requests across two OpenAI-compatible endpoints.
+
+A slow upstream route dominates tail latency, so HedgedChatModel sends
+each call to the primary model and, if no first token has arrived after
+HedgePolicy.after seconds, fires a duplicate at a secondary endpoint
+(optionally with another model). Whichever produces a token (or a
+complete answer) first wins; the other is cancelled and its output
+discarded, so clients only ever see one reply.
+
+Hedges are limited by a token bucket: every call earns `budget` of a
+hedge (0.1 = at most one hedge per ten calls in the long run) and each
+hedge spends one, so an upstream that is slow for everyone cannot double
+the load on both endpoints.
+
+Sync calls run each side on a thread; a losing stream is closed, which
+drops its HTTP connection, as soon as it yields its next chunk. Async
+calls cancel the losing task at once. A non-streamed sync call cannot be
+interrupted and is left to finish in the background.
+"""
+
+import asyncio
+import contextvars
+import queue
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any, Optional
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from pydantic import ConfigDict
+
+PRIMARY = "primary"
+SECONDARY = "secondary"
+
+# Hedges that may be spent in a burst after a quiet period
+HEDGE_BURST = 5
+
+
+@dataclass(frozen=True)
+class HedgePolicy:
+    """Hedging settings; hashable so it can key caches."""
+
+    after: float
+    base_url: str
+    model: Optional[str] = None
+    budget: float = 0.1
+    api_key: str = field(default="", repr=False, compare=False)
+
+
+class HedgeBudget:
+    """Token bucket limiting hedges to a fraction of calls."""
+
+    def __init__(self, burst=HEDGE_BURST):
+        self.burst = burst
+        self._tokens = float(burst)
+        self._lock = threading.Lock()
+
+    def earn(self, ratio):
+        with self._lock:
+            self._tokens = min(self._tokens + ratio, self.burst)
+
+    def try_spend(self):
+        with self._lock:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+class HedgeStats:
+    """Calls, hedges fired and which side won them."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.hedged = 0
+        self.secondary_wins = 0
+        self.primary_wins = 0
+        self.budget_exhausted = 0
+        self.losers_cancelled = 0
+
+    def record(self, **counts):
+        with self._lock:
+            for name, count in counts.items():
+                setattr(self, name, getattr(self, name) + count)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "hedged": self.hedged,
+                "hedge_rate": round(self.hedged / self.calls, 3) if self.calls else 0.0,
+                "secondary_wins": self.secondary_wins,
+                "primary_wins_after_hedge": self.primary_wins,
+                "budget_exhausted": self.budget_exhausted,
+                "losers_cancelled": self.losers_cancelled,
+            }
+
+
+hedge_budget = HedgeBudget()
+hedge_stats = HedgeStats()
+
+
+def _is_first_token(item) -> bool:
+    """Whether a stream item carries output, as opposed to an empty role/metadata chunk."""
+    message = getattr(item, "message", None)
+    if message is None:
+        return True  # a complete (non-streamed) result
+    return bool(item.text or getattr(message, "tool_call_chunks", None))
+
+
+class _Lane:
+    def __init__(self, name):
+        self.name = name
+        self.cancelled = threading.Event()
+        self.task = None
+
+
+class _Race:
+    """One side per thread, all feeding one event queue."""
+
+    def __init__(self):
+        self.events = queue.Queue()
+        self.lanes = []
+
+    def start(self, name, produce):
+        lane = _Lane(name)
+        self.lanes.append(lane)
+        context = contextvars.copy_context()
+        threading.Thread(
+            target=context.run, args=(self._run, lane, produce), name=f"hedge-{name}", daemon=True,
+        ).start()
+        return lane
+
+    def _run(self, lane, produce):
+        items = produce()
+        try:
+            for item in items:
+                if lane.cancelled.is_set():
+                    return
+                self.events.put((lane, "item", item))
+            self.events.put((lane, "done", None))
+        except Exception as error:
+            self.events.put((lane, "error", error))
+        finally:
+            # Closing the stream releases its upstream connection
+            items.close()
+
+
+class HedgedChatModel(BaseChatModel):
+    """Chat model racing a primary and a hedge model (see module docstring)."""
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    primary: Any
+    secondary: Any
+    policy: HedgePolicy
+
+    @property
+    def _llm_type(self) -> str:
+        return "hedged-chat"
+
+    @property
+    def _identifying_params(self) -> dict:
+        return {"primary": self.primary._identifying_params, "secondary": self.secondary._identifying_params}
+
+    def bind_tools(self, tools, **kwargs):
+        binding = self.primary.bind_tools(tools, **kwargs)
+        return self.bind(**binding.kwargs)
+
+    def _model(self, name):
+        return self.primary if name == PRIMARY else self.secondary
+
+    def _begin(self):
+        hedge_stats.record(calls=1)
+        hedge_budget.earn(self.policy.budget)
+
+    def _may_hedge(self):
+        if hedge_budget.try_spend():
+            hedge_stats.record(hedged=1)
+            return True
+        hedge_stats.record(budget_exhausted=1)
+        return False
+
+    def _decide(self, lanes, winner):
+        """Record the winner and cancel every other lane; returns how many were cancelled."""
+        losers = [lane for lane in lanes if lane is not winner and not lane.cancelled.is_set()]
+        for lane in losers:
+            lane.cancelled.set()
+            if lane.task is not None:
+                lane.task.cancel()
+        if len(lanes) > 1:
+            hedge_stats.record(
+                secondary_wins=winner.name == SECONDARY,
+                primary_wins=winner.name == PRIMARY,
+                losers_cancelled=len(losers),
+            )
+
+    def _race(self, produce):
+        """
+        Run produce(model) on the primary, hedging to the secondary after
+        policy.after seconds without output. Yields the winner's items.
+        """
+        self._begin()
+        race = _Race()
+        race.start(PRIMARY, lambda: produce(self.primary))
+        deadline = time.monotonic() + self.policy.after
+        hedge_pending = True
+        winner, errors = None, {}
+        buffered = []
+        try:
+            while winner is None:
+                timeout = max(deadline - time.monotonic(), 0) if hedge_pending else None
+                try:
+                    lane, kind, item = race.events.get(timeout=timeout)
+                except queue.Empty:
+                    hedge_pending = False
+                    if self._may_hedge():
+                        race.start(SECONDARY, lambda: produce(self.secondary))
+                    continue
+                if lane.cancelled.is_set():
+                    continue
+                if kind == "error":
+                    # Each side already retried and fell back; wait for the other if it runs
+                    errors[lane.name] = item
+                    lane.cancelled.set()
+                    hedge_pending = False
+                    if len(errors) == len(race.lanes):
+                        raise errors.get(PRIMARY, item)
+                    continue
+                if kind == "item":
+                    buffered.append((lane, item))
+                if kind == "done" or _is_first_token(item):
+                    winner = lane
+                    self._decide(race.lanes, winner)
+            yield from (item for lane, item in buffered if lane is winner)
+            while True:
+                lane, kind, item = race.events.get()
+                if lane is not winner:
+                    continue
+                if kind == "error":
+                    raise item
+                if kind == "done":
+                    return
+                yield item
+        finally:
+            for lane in race.lanes:
+                lane.cancelled.set()
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        def produce(model):
+            yield model._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+        results = self._race(produce)
+        try:
+            return next(results)
+        finally:
+            results.close()
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        def produce(model):
+            chunks = model._stream(messages, stop=stop, run_manager=run_manager, **kwargs)
+            try:
+                yield from chunks
+            finally:
+                chunks.close()
+        yield from self._race(produce)
+
+    async def _arace(self, produce):
+        """Async _race: each side is an asyncio task, and the loser is cancelled at once."""
+        self._begin()
+        events = asyncio.Queue()
+        lanes = []
+
+        async def run(lane, items):
+            try:
+                async for item in items:
+                    events.put_nowait((lane, "item", item))
+                events.put_nowait((lane, "done", None))
+            except Exception as error:
+                events.put_nowait((lane, "error", error))
+
+        def start(name):
+            lane = _Lane(name)
+            lane.task = asyncio.ensure_future(run(lane, produce(self._model(name))))
+            lanes.append(lane)
+
+        start(PRIMARY)
+        deadline = time.monotonic() + self.policy.after
+        hedge_pending = True
+        winner, errors = None, {}
+        buffered = []
+        try:
+            while winner is None:
+                timeout = max(deadline - time.monotonic(), 0) if hedge_pending else None
+                try:
+                    lane, kind, item = await asyncio.wait_for(events.get(), timeout)
+                except asyncio.TimeoutError:
+                    hedge_pending = False
+                    if self._may_hedge():
+                        start(SECONDARY)
+                    continue
+                if lane.cancelled.is_set():
+                    continue
+                if kind == "error":
+                    errors[lane.name] = item
+                    lane.cancelled.set()
+                    hedge_pending = False
+                    if len(errors) == len(lanes):
+                        raise errors.get(PRIMARY, item)
+                    continue
+                if kind == "item":
+                    buffered.append((lane, item))
+                if kind == "done" or _is_first_token(item):
+                    winner = lane
+                    self._decide(lanes, winner)
+            for lane, item in buffered:
+                if lane is winner:
+                    yield item
+            while True:
+                lane, kind, item = await events.get()
+                if lane is not winner:
+                    continue
+                if kind == "error":
+                    raise item
+                if kind == "done":
+                    return
+                yield item
+        finally:
+            for lane in lanes:
+                lane.cancelled.set()
+                lane.task.cancel()
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        async def produce(model):
+            yield await model._agenerate(messages, stop=stop, run_manager=run_manager, **kwargs)
+        results = self._arace(produce)
+        try:
+            return await results.__anext__()
+        finally:
+            await results.aclose()
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        def produce(model):
+            return model._astream(messages, stop=stop, run_manager=run_manager, **kwargs)
+        async for chunk in self._arace(produce):
+            yield chunk
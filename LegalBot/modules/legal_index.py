@@ -0,0 +1,505 @@
+"""
+Offline BM25 index over a local corpus of Canadian statutes and regulations.
+
+Live web search is the slowest and least predictable step of drafting.
+When AI_LEGAL_INDEX_PATH is set, the agent also gets Legal_Corpus_Search,
+which answers from an index of a directory of .txt/.md files built by
+`python manage.py build_legal_index`, and searches the web itself only
+when the index finds too little (see CorpusPolicy.min_coverage).
+
+Each file is split into passages of about PASSAGE_WORDS words, and each
+passage (prefixed with its file's first line, usually the statute's
+title) is one BM25 document. The index is a directory of segments plus a
+manifest:
+
+    manifest.json        files (size, mtime, sha256, segment, passage range),
+                         segments and their deleted passages
+    seg-000001/
+        lexicon.json     term -> [first posting, document frequency]
+        postings.bin     (passage, term frequency) uint32 pairs, by term
+        docs.json        [source, title, text offset, text length, terms] per passage
+        text.bin         passage text, UTF-8
+
+postings.bin and text.bin are memory-mapped, so a query touches only the
+postings of its own terms, and scores them with numpy. Re-indexing is incremental: unchanged files
+are skipped, the passages of changed and removed files are marked deleted
+in their old segment, and changed and new files go into a new segment.
+Once there are more than MAX_SEGMENTS segments, or most passages are
+deleted, the whole index is rebuilt. The manifest is replaced atomically,
+so searches running during a re-index see either the old or the new
+index; running processes pick up the new one on their next search.
+"""
+
+import hashlib
+import heapq
+import json
+import math
+import mmap
+import os
+import re
+import shutil
+import sys
+import threading
+import time
+from array import array
+from collections import Counter, defaultdict
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+
+INDEX_VERSION = 1
+MANIFEST = "manifest.json"
+CORPUS_SUFFIXES = (".txt", ".md")
+
+# Words per passage; longer paragraphs are split
+PASSAGE_WORDS = 150
+
+# Beyond this many segments the next update rebuilds the index
+MAX_SEGMENTS = 8
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+_WORD = re.compile(r"[a-z0-9]+")
+_STOPWORDS = frozenset(
+    "a an and any are as at be been by can do does for from has have how i if in into is it its may my "
+    "of on or shall should such than that the their there these this those to under upon was what when "
+    "where which who will with would site canlii org justice gc ca www http https".split()
+)
+
+
+class IndexNotFound(FileNotFoundError):
+    """There is no index at the configured path."""
+
+
+@dataclass(frozen=True)
+class CorpusPolicy:
+    """
+    Local corpus search settings; hashable so it can key caches. Searches
+    whose best passage contains fewer than min_coverage of the query's
+    terms fall back to the web (with 0, only searches matching nothing do).
+    """
+
+    index_path: str
+    top_k: int = 5
+    min_coverage: float = 0.5
+
+
+@dataclass(frozen=True)
+class Hit:
+    source: str
+    title: str
+    text: str
+    score: float
+    coverage: float
+
+
+def _stem(word):
+    if len(word) > 4 and word.endswith("ies"):
+        return word[:-3] + "y"
+    if len(word) > 3 and word.endswith("s") and not word.endswith(("ss", "us", "is")):
+        return word[:-1]
+    return word
+
+
+def analyze(text) -> list:
+    """Index terms of text: lowercased words, stopwords dropped, plurals folded."""
+    return [_stem(word) for word in _WORD.findall(str(text or "").lower()) if word not in _STOPWORDS]
+
+
+def split_passages(text, words=PASSAGE_WORDS) -> list:
+    """Group a document's paragraphs into passages of about `words` words."""
+    passages, current, count = [], [], 0
+
+    def flush():
+        nonlocal current, count
+        if current:
+            passages.append(" ".join(current))
+        current, count = [], 0
+
+    for paragraph in re.split(r"\n\s*\n", text):
+        tokens = paragraph.split()
+        while len(tokens) > 2 * words:
+            flush()
+            passages.append(" ".join(tokens[:words]))
+            tokens = tokens[words:]
+        if not tokens:
+            continue
+        if count and count + len(tokens) > words:
+            flush()
+        current.append(" ".join(tokens))
+        count += len(tokens)
+    flush()
+    return passages
+
+
+def _title(text, source):
+    for line in text.splitlines():
+        line = line.strip().lstrip("#").strip()
+        if line:
+            return line[:120]
+    return source
+
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as handle:
+        for block in iter(lambda: handle.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _write_json(path, data):
+    temporary = f"{path}.tmp"
+    with open(temporary, "w", encoding="utf-8") as handle:
+        json.dump(data, handle, separators=(",", ":"))
+    os.replace(temporary, path)
+
+
+class Segment:
+    """One read-only, memory-mapped segment."""
+
+    def __init__(self, directory: Path, deleted=()):
+        self.name = directory.name
+        with open(directory / "lexicon.json", encoding="utf-8") as handle:
+            self.lexicon = json.load(handle)
+        with open(directory / "docs.json", encoding="utf-8") as handle:
+            self.docs = json.load(handle)
+        self.deleted = frozenset(deleted)
+        self.live = np.ones(len(self.docs), dtype=bool)
+        self.live[sorted(self.deleted)] = False
+        self.lengths = np.array([doc[4] for doc in self.docs], dtype=np.float32)
+        self._postings = self._map(directory / "postings.bin")
+        self._text = self._map(directory / "text.bin")
+        # Zero-copy view of the mapped file as (passage, term frequency) rows
+        self.postings = (
+            np.frombuffer(self._postings, dtype=np.uint32).reshape(-1, 2)
+            if self._postings is not None else np.zeros((0, 2), dtype=np.uint32)
+        )
+
+    @staticmethod
+    def _map(path):
+        with open(path, "rb") as handle:
+            if os.fstat(handle.fileno()).st_size == 0:
+                return None
+            return mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def document_frequency(self, term) -> int:
+        entry = self.lexicon.get(term)
+        return entry[1] if entry else 0
+
+    def postings_of(self, term) -> np.ndarray:
+        """(passage, term frequency) rows of term."""
+        entry = self.lexicon.get(term)
+        if not entry:
+            return self.postings[:0]
+        start, count = entry
+        return self.postings[start:start + count]
+
+    def text(self, doc) -> str:
+        _, _, offset, length, _ = self.docs[doc]
+        return self._text[offset:offset + length].decode("utf-8")
+
+
+class LegalIndex:
+    """A searchable snapshot of the index at `path` (see module docstring)."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        manifest_path = self.path / MANIFEST
+        if not manifest_path.is_file():
+            raise IndexNotFound(f"No legal index at {self.path}; run `python manage.py build_legal_index`")
+        with open(manifest_path, encoding="utf-8") as handle:
+            self.manifest = json.load(handle)
+        if self.manifest.get("version") != INDEX_VERSION or self.manifest.get("byteorder") != sys.byteorder:
+            raise IndexNotFound(f"The legal index at {self.path} is from another version; rebuild it")
+        self.segments = [
+            Segment(self.path / name, info["deleted"]) for name, info in self.manifest["segments"].items()
+        ]
+        self.documents = sum(int(segment.live.sum()) for segment in self.segments)
+        total_length = sum(float(segment.lengths[segment.live].sum()) for segment in self.segments)
+        self.average_length = total_length / self.documents if self.documents else 0.0
+        # BM25 length normalization of every passage, fixed for this snapshot
+        self._norms = [
+            K1 * (1 - B + B * segment.lengths / max(self.average_length, 1.0)) for segment in self.segments
+        ]
+
+    def search(self, query: str, top_k: int = 5) -> list:
+        """The top_k passages for query by BM25, best first."""
+        terms = set(analyze(query))
+        if not terms or not self.documents:
+            return []
+        idfs = {}
+        for term in terms:
+            frequency = sum(segment.document_frequency(term) for segment in self.segments)
+            if frequency:
+                idfs[term] = math.log(1 + (self.documents - frequency + 0.5) / (frequency + 0.5))
+
+        candidates = []
+        for number, (segment, norm) in enumerate(zip(self.segments, self._norms)):
+            scores = np.zeros(len(segment.docs), dtype=np.float32)
+            matched = np.zeros(len(segment.docs), dtype=np.int32)
+            for term, idf in idfs.items():
+                rows = segment.postings_of(term)
+                if not len(rows):
+                    continue
+                docs, frequencies = rows[:, 0], rows[:, 1].astype(np.float32)
+                # A term occurs once per passage in its postings, so += is safe
+                scores[docs] += idf * frequencies * (K1 + 1) / (frequencies + norm[docs])
+                matched[docs] += 1
+            scores[~segment.live] = 0
+            found = np.flatnonzero(scores)
+            if len(found) > top_k:
+                found = found[np.argpartition(-scores[found], top_k - 1)[:top_k]]
+            candidates.extend((float(scores[doc]), number, int(doc), int(matched[doc])) for doc in found)
+
+        hits = []
+        for score, number, doc, matched_terms in heapq.nlargest(top_k, candidates):
+            segment = self.segments[number]
+            source, title = segment.docs[doc][:2]
+            hits.append(Hit(source, title, segment.text(doc), round(score, 3), matched_terms / len(terms)))
+        return hits
+
+    def stats(self) -> dict:
+        return {
+            "path": str(self.path),
+            "files": len(self.manifest["files"]),
+            "passages": self.documents,
+            "deleted_passages": sum(len(segment.deleted) for segment in self.segments),
+            "segments": len(self.segments),
+            "lexicon_entries": sum(len(segment.lexicon) for segment in self.segments),
+            "updated_at": self.manifest.get("updated_at"),
+        }
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def open_index(path) -> LegalIndex:
+    """The process-wide LegalIndex at path, reopened whenever it is re-indexed."""
+    path = str(path)
+    try:
+        version = os.stat(os.path.join(path, MANIFEST)).st_mtime_ns
+    except FileNotFoundError:
+        raise IndexNotFound(f"No legal index at {path}; run `python manage.py build_legal_index`") from None
+    with _indexes_lock:
+        cached = _indexes.get(path)
+        if cached is None or cached[0] != version:
+            cached = _indexes[path] = (version, LegalIndex(path))
+        return cached[1]
+
+
+def reset_indexes():
+    with _indexes_lock:
+        _indexes.clear()
+
+
+# --- Indexing ---------------------------------------------------------------
+
+def _scan(corpus_dir: Path) -> dict:
+    files = {}
+    for path in sorted(corpus_dir.rglob("*")):
+        if path.suffix.lower() in CORPUS_SUFFIXES and path.is_file():
+            status = path.stat()
+            files[path.relative_to(corpus_dir).as_posix()] = (path, status.st_size, status.st_mtime_ns)
+    return files
+
+
+def _write_segment(directory: Path, files) -> dict:
+    """Index files ([(source, path)]) into a new segment; returns each source's passage range."""
+    directory.mkdir(parents=True)
+    postings = defaultdict(list)
+    docs, text, ranges = [], bytearray(), {}
+    for source, path in files:
+        content = path.read_text(encoding="utf-8", errors="replace")
+        title = _title(content, source)
+        first = len(docs)
+        for passage in split_passages(content):
+            counts = Counter(analyze(f"{title} {passage}"))
+            encoded = passage.encode("utf-8")
+            for term, frequency in counts.items():
+                postings[term].extend((len(docs), frequency))
+            docs.append([source, title, len(text), len(encoded), sum(counts.values())])
+            text += encoded
+        ranges[source] = [first, len(docs)]
+
+    lexicon, packed = {}, array("I")
+    for term in sorted(postings):
+        pairs = postings[term]
+        lexicon[term] = [len(packed) // 2, len(pairs) // 2]
+        packed.extend(pairs)
+    with open(directory / "postings.bin", "wb") as handle:
+        packed.tofile(handle)
+    with open(directory / "text.bin", "wb") as handle:
+        handle.write(text)
+    _write_json(directory / "lexicon.json", lexicon)
+    _write_json(directory / "docs.json", docs)
+    return {"docs": len(docs), "ranges": ranges}
+
+
+def _empty_manifest(corpus_dir, next_segment=1) -> dict:
+    return {
+        "version": INDEX_VERSION,
+        "byteorder": sys.byteorder,
+        "corpus": str(corpus_dir),
+        "next_segment": next_segment,
+        "segments": {},
+        "files": {},
+    }
+
+
+def update_index(corpus_dir, index_path, rebuild: bool = False) -> dict:
+    """
+    Bring the index at index_path up to date with corpus_dir, re-reading
+    only changed files unless rebuild is set. Only one update may run on
+    an index at a time.
+
+    Returns:
+        dict: counts of added, changed, removed and unchanged files,
+        passages indexed, and whether the index was rebuilt
+    """
+    corpus_dir, index_path = Path(corpus_dir).resolve(), Path(index_path)
+    if not corpus_dir.is_dir():
+        raise FileNotFoundError(f"Legal corpus directory {corpus_dir} does not exist")
+    index_path.mkdir(parents=True, exist_ok=True)
+
+    manifest, next_segment = None, 1
+    if (index_path / MANIFEST).is_file():
+        with open(index_path / MANIFEST, encoding="utf-8") as handle:
+            manifest = json.load(handle)
+        # New segments never reuse the name of one a reader may still have open
+        next_segment = manifest.get("next_segment", 1)
+        if rebuild or (manifest.get("version"), manifest.get("byteorder"), manifest.get("corpus")) != (
+            INDEX_VERSION, sys.byteorder, str(corpus_dir),
+        ):
+            manifest = None
+    rebuilt = manifest is None
+    manifest = manifest or _empty_manifest(corpus_dir, next_segment)
+
+    current = _scan(corpus_dir)
+    counts = {"added": 0, "changed": 0, "removed": 0, "unchanged": 0}
+    pending = []
+    for source, (path, size, mtime_ns) in current.items():
+        entry = manifest["files"].get(source)
+        if entry and (entry["size"], entry["mtime_ns"]) == (size, mtime_ns):
+            counts["unchanged"] += 1
+            continue
+        digest = _sha256(path)
+        if entry and entry["sha256"] == digest:
+            entry["mtime_ns"] = mtime_ns
+            counts["unchanged"] += 1
+            continue
+        counts["changed" if entry else "added"] += 1
+        pending.append((source, path, size, mtime_ns, digest))
+    stale = [source for source in manifest["files"] if source not in current]
+    counts["removed"] = len(stale)
+
+    # Retire the passages of changed and removed files
+    for source in stale + [source for source, *_ in pending if source in manifest["files"]]:
+        entry = manifest["files"].pop(source)
+        segment = manifest["segments"].get(entry["segment"])
+        if segment is not None:  # a file without text has no segment
+            segment["deleted"] = sorted(set(segment["deleted"]) | set(range(*entry["docs"])))
+
+    total = sum(info["docs"] for info in manifest["segments"].values())
+    deleted = sum(len(info["deleted"]) for info in manifest["segments"].values())
+    if not rebuilt and (len(manifest["segments"]) >= MAX_SEGMENTS or (total and deleted * 2 > total)):
+        summary = update_index(corpus_dir, index_path, rebuild=True)
+        return {**summary, **counts}
+
+    passages = 0
+    if pending:
+        name = f"seg-{manifest['next_segment']:06d}"
+        manifest["next_segment"] += 1
+        if (index_path / name).exists():
+            shutil.rmtree(index_path / name)
+        written = _write_segment(index_path / name, [(source, path) for source, path, *_ in pending])
+        manifest["segments"][name] = {"docs": written["docs"], "deleted": []}
+        passages = written["docs"]
+        for source, path, size, mtime_ns, digest in pending:
+            manifest["files"][source] = {
+                "size": size, "mtime_ns": mtime_ns, "sha256": digest,
+                "segment": name, "docs": written["ranges"][source],
+            }
+
+    # Segments whose passages are all deleted are dropped
+    manifest["segments"] = {
+        name: info for name, info in manifest["segments"].items() if len(info["deleted"]) < info["docs"]
+    }
+    manifest["updated_at"] = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+    _write_json(index_path / MANIFEST, manifest)
+
+    # Open readers keep their memory maps, so unreferenced segments can go
+    for directory in index_path.glob("seg-*"):
+        if directory.is_dir() and directory.name not in manifest["segments"]:
+            shutil.rmtree(directory, ignore_errors=True)
+    return {
+        **counts,
+        "passages_indexed": passages,
+        "segments": len(manifest["segments"]),
+        "rebuilt": rebuilt,
+    }
+
+
+# --- Lookup -----------------------------------------------------------------
+
+class CorpusStats:
+    """Corpus searches, how many needed the web, and their latency."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.queries = 0
+        self.answered = 0
+        self.low_recall = 0
+        self.errors = 0
+        self.query_ms = 0.0
+
+    def record(self, **counts):
+        with self._lock:
+            for name, count in counts.items():
+                setattr(self, name, getattr(self, name) + count)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "queries": self.queries,
+                "answered_locally": self.answered,
+                "web_fallbacks": self.low_recall,
+                "local_rate": round(self.answered / self.queries, 3) if self.queries else 0.0,
+                "errors": self.errors,
+                "avg_query_ms": round(self.query_ms / self.queries, 2) if self.queries else 0.0,
+            }
+
+
+corpus_stats = CorpusStats()
+
+
+def corpus_lookup(query: str, policy: CorpusPolicy):
+    """
+    Search the local index.
+
+    Returns:
+        tuple: (hits, enough) where enough is False when the web should be
+        searched instead: nothing matched well enough, or the index is
+        missing or unreadable
+    """
+    started = time.perf_counter()
+    try:
+        hits = open_index(policy.index_path).search(query, policy.top_k)
+    except (OSError, ValueError, KeyError):
+        corpus_stats.record(queries=1, errors=1, low_recall=1, query_ms=(time.perf_counter() - started) * 1000)
+        return [], False
+    enough = bool(hits) and hits[0].coverage >= policy.min_coverage
+    corpus_stats.record(
+        queries=1, answered=int(enough), low_recall=int(not enough),
+        query_ms=(time.perf_counter() - started) * 1000,
+    )
+    return hits, enough
+
+
+def format_hits(hits) -> str:
+    """Tool output for corpus hits: one passage per paragraph, with its source."""
+    return "\n\n".join(f"{hit.title} ({hit.source}): {hit.text}" for hit in hits)
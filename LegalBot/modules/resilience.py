@@ -0,0 +1,459 @@
+"""
+Resilience layer for upstream LLM calls.
+
+ResilientChatModel wraps a ChatOpenAI client (built with its own retries
+disabled and a per-attempt timeout) and adds:
+
+- capped exponential backoff with full jitter between attempts,
+- a per-model circuit breaker that fails fast after consecutive failures,
+- an optional fallback model used when the primary is exhausted or open,
+- latency percentiles and token usage per model.
+
+Only transient failures (timeouts, connection errors, 408/409/429/5xx) are
+retried or counted by the breaker; errors such as a bad API key surface
+immediately. A streamed response is only retried if it failed before its
+first chunk, so clients never see duplicated tokens.
+"""
+
+import asyncio
+import random
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Optional
+
+import httpx
+import openai
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages.ai import add_usage
+from pydantic import ConfigDict
+
+from .tokens import count_message_tokens, count_tokens
+
+# Number of recent call latencies kept per model for percentiles
+LATENCY_SAMPLES = 1000
+
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+
+class LLMUnavailable(Exception):
+    """The upstream model could not answer after retries and fallbacks."""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class CircuitOpenError(LLMUnavailable):
+    """Raised without calling upstream while a model's circuit is open."""
+
+
+def is_retryable(error) -> bool:
+    if isinstance(error, (openai.APITimeoutError, openai.APIConnectionError, httpx.TransportError)):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in RETRYABLE_STATUS_CODES
+    return isinstance(error, (TimeoutError, ConnectionError))
+
+
+@dataclass(frozen=True)
+class ResiliencePolicy:
+    """Retry, timeout and breaker settings; hashable so it can key caches."""
+
+    timeout: float = 60.0
+    max_attempts: int = 3
+    base_delay: float = 0.5
+    max_delay: float = 8.0
+    failure_threshold: int = 5
+    reset_timeout: float = 30.0
+
+    def backoff(self, attempt: int) -> float:
+        """Full-jitter delay before retry number `attempt` (1-based)."""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+
+class CircuitBreaker:
+    """
+    Classic closed / open / half-open breaker.
+
+    After failure_threshold consecutive failures the circuit opens and calls
+    fail fast for reset_timeout seconds; then a single trial call is let
+    through, closing the circuit on success or re-opening it on failure.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self.times_opened = 0
+        self.rejected = 0
+
+    def _refresh(self):
+        if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+            self._state = self.HALF_OPEN
+            self._trial_in_flight = False
+
+    def retry_after(self) -> float:
+        with self._lock:
+            if self._state != self.OPEN:
+                return 0.0
+            return max(self.reset_timeout - (time.monotonic() - self._opened_at), 0.0)
+
+    def allow(self) -> bool:
+        with self._lock:
+            self._refresh()
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.HALF_OPEN and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            self.rejected += 1
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._state = self.CLOSED
+            self._failures = 0
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self._state != self.OPEN:
+                    self.times_opened += 1
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+                self._trial_in_flight = False
+
+    def release_trial(self):
+        """End a half-open trial that was neither a success nor a failure."""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def stats(self) -> dict:
+        with self._lock:
+            self._refresh()
+            return {
+                "state": self._state,
+                "consecutive_failures": self._failures,
+                "times_opened": self.times_opened,
+                "rejected": self.rejected,
+            }
+
+
+class ModelHealth:
+    """Breaker plus call, retry, latency and token counters for one upstream model."""
+
+    def __init__(self, policy: ResiliencePolicy):
+        self.breaker = CircuitBreaker(policy.failure_threshold, policy.reset_timeout)
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=LATENCY_SAMPLES)
+        self.calls = 0
+        self.successes = 0
+        self.failures = 0
+        self.retries = 0
+        self.timeouts = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.estimated_usage_calls = 0
+
+    def record_attempt(self, seconds=None, error=None):
+        with self._lock:
+            self.calls += 1
+            if error is None:
+                self.successes += 1
+                self._latencies.append(seconds)
+                return
+            self.failures += 1
+            if isinstance(error, (openai.APITimeoutError, httpx.TimeoutException, TimeoutError)):
+                self.timeouts += 1
+
+    def record_retry(self):
+        with self._lock:
+            self.retries += 1
+
+    def record_usage(self, input_tokens, output_tokens, estimated=False):
+        with self._lock:
+            self.input_tokens += input_tokens
+            self.output_tokens += output_tokens
+            self.estimated_usage_calls += estimated
+
+    def stats(self) -> dict:
+        with self._lock:
+            latencies = sorted(self._latencies)
+
+            def percentile(fraction):
+                if not latencies:
+                    return None
+                return round(latencies[min(int(fraction * len(latencies)), len(latencies) - 1)] * 1000, 1)
+
+            stats = {
+                "calls": self.calls,
+                "successes": self.successes,
+                "failures": self.failures,
+                "retries": self.retries,
+                "timeouts": self.timeouts,
+                "latency_p50_ms": percentile(0.5),
+                "latency_p95_ms": percentile(0.95),
+                "latency_p99_ms": percentile(0.99),
+                "input_tokens": self.input_tokens,
+                "output_tokens": self.output_tokens,
+                "estimated_usage_calls": self.estimated_usage_calls,
+            }
+        stats["breaker"] = self.breaker.stats()
+        return stats
+
+
+class ModelHealthRegistry:
+    """Process-wide ModelHealth per model, shared by every client using it."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._models = {}
+        self.fallbacks = 0
+
+    def get(self, name: str, policy: ResiliencePolicy) -> ModelHealth:
+        with self._lock:
+            health = self._models.get(name)
+            if health is None:
+                health = self._models[name] = ModelHealth(policy)
+            # The breaker outlives client rebuilds, so follow policy changes
+            health.breaker.failure_threshold = policy.failure_threshold
+            health.breaker.reset_timeout = policy.reset_timeout
+            return health
+
+    def record_fallback(self):
+        with self._lock:
+            self.fallbacks += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            models = dict(self._models)
+            fallbacks = self.fallbacks
+        return {"fallbacks": fallbacks, "models": {name: health.stats() for name, health in models.items()}}
+
+
+model_health = ModelHealthRegistry()
+
+
+class ResilientChatModel(BaseChatModel):
+    """
+    Chat model that retries, circuit-breaks and falls back around one or
+    two underlying chat models (see module docstring).
+    """
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    primary: Any
+    fallback: Optional[Any] = None
+    policy: ResiliencePolicy = ResiliencePolicy()
+    # Set for clients of a secondary endpoint, so their health is tracked apart
+    endpoint: Optional[str] = None
+
+    @property
+    def _llm_type(self) -> str:
+        return "resilient-chat"
+
+    @property
+    def _identifying_params(self) -> dict:
+        return {
+            "primary": getattr(self.primary, "model_name", None),
+            "fallback": getattr(self.fallback, "model_name", None),
+        }
+
+    def bind_tools(self, tools, **kwargs):
+        # Let the primary format the tools, then bind the same kwargs here
+        # so they reach whichever model ends up serving the call
+        binding = self.primary.bind_tools(tools, **kwargs)
+        return self.bind(**binding.kwargs)
+
+    def _health_name(self, model) -> str:
+        name = _model_name(model)
+        return f"{name}@{self.endpoint}" if self.endpoint else name
+
+    def _attempts(self):
+        """Yield (model, health, attempt) for every attempt the breakers allow, primary first."""
+        models = [self.primary] + ([self.fallback] if self.fallback is not None else [])
+        for index, model in enumerate(models):
+            health = model_health.get(self._health_name(model), self.policy)
+            if index:
+                model_health.record_fallback()
+            for attempt in range(1, self.policy.max_attempts + 1):
+                if not health.breaker.allow():
+                    break
+                yield model, health, attempt
+
+    def _after_failure(self, health, error, attempt):
+        """
+        Record a failed attempt and return the backoff before the next one.
+        Non-retryable errors are re-raised.
+        """
+        health.record_attempt(error=error)
+        if not is_retryable(error):
+            health.breaker.release_trial()
+            raise error
+        health.breaker.record_failure()
+        if attempt == self.policy.max_attempts:
+            return 0.0  # moving on to the fallback model
+        health.record_retry()
+        return self.policy.backoff(attempt)
+
+    def _unavailable(self, last_error):
+        models = [self.primary] + ([self.fallback] if self.fallback is not None else [])
+        retry_after = min(
+            model_health.get(self._health_name(model), self.policy).breaker.retry_after() for model in models
+        ) or None
+        if last_error is None:
+            return CircuitOpenError("LLM circuit breaker is open", retry_after)
+        error = LLMUnavailable(f"LLM unavailable: {last_error}", retry_after)
+        error.__cause__ = last_error
+        return error
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        last_error, delay = None, 0.0
+        for model, health, attempt in self._attempts():
+            time.sleep(delay)
+            started = time.monotonic()
+            try:
+                result = model._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+            except Exception as error:
+                last_error = error
+                delay = self._after_failure(health, error, attempt)
+                continue
+            except BaseException:
+                health.breaker.release_trial()
+                raise
+            self._succeeded(health, started)
+            _record_result_usage(health, messages, result)
+            return result
+        raise self._unavailable(last_error)
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        last_error, delay = None, 0.0
+        for model, health, attempt in self._attempts():
+            await asyncio.sleep(delay)
+            started = time.monotonic()
+            try:
+                result = await model._agenerate(messages, stop=stop, run_manager=run_manager, **kwargs)
+            except Exception as error:
+                last_error = error
+                delay = self._after_failure(health, error, attempt)
+                continue
+            except BaseException:
+                health.breaker.release_trial()
+                raise
+            self._succeeded(health, started)
+            _record_result_usage(health, messages, result)
+            return result
+        raise self._unavailable(last_error)
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        last_error, delay = None, 0.0
+        for model, health, attempt in self._attempts():
+            time.sleep(delay)
+            started = time.monotonic()
+            emitted = False
+            usage = _StreamUsage()
+            try:
+                for chunk in model._stream(messages, stop=stop, run_manager=run_manager, **kwargs):
+                    emitted = True
+                    usage.add(chunk)
+                    yield chunk
+            except Exception as error:
+                if emitted:
+                    # Retrying now would repeat tokens the client already has
+                    health.record_attempt(error=error)
+                    health.breaker.record_failure()
+                    raise
+                last_error = error
+                delay = self._after_failure(health, error, attempt)
+                continue
+            except BaseException:
+                health.breaker.release_trial()
+                usage.record(health, messages)
+                raise
+            self._succeeded(health, started)
+            usage.record(health, messages)
+            return
+        raise self._unavailable(last_error)
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        last_error, delay = None, 0.0
+        for model, health, attempt in self._attempts():
+            await asyncio.sleep(delay)
+            started = time.monotonic()
+            emitted = False
+            usage = _StreamUsage()
+            try:
+                async for chunk in model._astream(messages, stop=stop, run_manager=run_manager, **kwargs):
+                    emitted = True
+                    usage.add(chunk)
+                    yield chunk
+            except Exception as error:
+                if emitted:
+                    health.record_attempt(error=error)
+                    health.breaker.record_failure()
+                    raise
+                last_error = error
+                delay = self._after_failure(health, error, attempt)
+                continue
+            except BaseException:
+                health.breaker.release_trial()
+                usage.record(health, messages)
+                raise
+            self._succeeded(health, started)
+            usage.record(health, messages)
+            return
+        raise self._unavailable(last_error)
+
+    @staticmethod
+    def _succeeded(health, started):
+        health.record_attempt(time.monotonic() - started)
+        health.breaker.record_success()
+
+
+def _record_usage(health, messages, usage, output_text):
+    if usage:
+        health.record_usage(usage.get("input_tokens", 0), usage.get("output_tokens", 0))
+    else:
+        # The provider reported no usage, so estimate it from the text
+        health.record_usage(count_message_tokens(messages), count_tokens(output_text), estimated=True)
+
+
+def _record_result_usage(health, messages, result):
+    message = result.generations[0].message if result.generations else None
+    _record_usage(
+        health, messages, getattr(message, "usage_metadata", None), getattr(message, "content", ""),
+    )
+
+
+class _StreamUsage:
+    """Usage of a streamed call: reported in its chunks, or estimated from their text."""
+
+    def __init__(self):
+        self.usage = None
+        self.text = []
+
+    def add(self, chunk):
+        self.text.append(chunk.text)
+        usage = getattr(chunk.message, "usage_metadata", None)
+        if usage:
+            self.usage = add_usage(self.usage, usage)
+
+    def record(self, health, messages):
+        if self.text or self.usage:
+            _record_usage(health, messages, self.usage, "".join(self.text))
+
+
+def _model_name(model) -> str:
+    return getattr(model, "model_name", None) or type(model).__name__
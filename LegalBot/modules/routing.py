@@ -0,0 +1,239 @@
+"""
+Per-turn model routing for the drafting agent.
+
+Most drafting turns are short clarifying questions; only the turn that
+emits `DRAFT_COMPLETE:` (and revisions of a finished draft) needs the
+strong model. RoutedChatModel picks a model for every LLM call with a
+cheap local classifier over the conversation:
+
+- the strong model when a draft already exists in the conversation, the
+  user explicitly asks for the document, or the input is long enough
+  that a long output is expected (refinements carry the whole document),
+- the fast model otherwise.
+
+A fast turn that starts writing `DRAFT_COMPLETE:` anyway is escalated:
+its first few tokens are held back until the reply either diverges from
+the marker or matches it, in which case the fast stream is closed and the
+turn is re-run on the strong model. Clients never see the discarded
+tokens, and a misrouted draft costs only those few tokens.
+"""
+
+import re
+import threading
+from dataclasses import dataclass
+from typing import Any
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, HumanMessage
+from langchain_core.outputs import ChatResult
+from pydantic import ConfigDict
+
+from .tokens import count_tokens
+
+FAST = "fast"
+STRONG = "strong"
+
+DRAFT_MARKER = "DRAFT_COMPLETE:"
+
+# Requests to produce the document now, as opposed to answering a question
+DRAFT_REQUEST = re.compile(
+    r"\b(?:draft|generate|write|prepare|produce|create|finali[sz]e)\b.{0,40}"
+    r"\b(?:document|agreement|contract|draft|lease|will|letter|notice|it|now)\b"
+    r"|\b(?:go ahead|proceed|that'?s (?:all|everything)|nothing (?:else|more))\b",
+    re.IGNORECASE | re.DOTALL,
+)
+
+
+@dataclass(frozen=True)
+class RoutingPolicy:
+    """Fast-model routing settings; hashable so it can key caches."""
+
+    fast_model: str
+    long_input_tokens: int = 400
+    escalate: bool = True
+
+
+def _text(message) -> str:
+    content = message.content
+    if isinstance(content, list):
+        return " ".join(part.get("text", "") if isinstance(part, dict) else str(part) for part in content)
+    return str(content or "")
+
+
+def classify_turn(messages, policy: RoutingPolicy):
+    """Return (route, reason) for the next LLM call over messages."""
+    last_human = next((message for message in reversed(messages) if isinstance(message, HumanMessage)), None)
+    if any(isinstance(message, AIMessage) and _text(message).lstrip().startswith(DRAFT_MARKER) for message in messages):
+        return STRONG, "draft_revision"
+    if last_human is None:
+        return FAST, "clarifying"
+    text = _text(last_human)
+    if count_tokens(text) >= policy.long_input_tokens:
+        return STRONG, "long_input"
+    if DRAFT_REQUEST.search(text):
+        return STRONG, "draft_requested"
+    return FAST, "clarifying"
+
+
+class RoutingStats:
+    """Turns per route and reason, and fast turns escalated to the strong model."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.routes = {FAST: 0, STRONG: 0}
+        self.reasons = {}
+        self.escalations = 0
+        self.escalation_tokens_discarded = 0
+
+    def record_route(self, route, reason):
+        with self._lock:
+            self.routes[route] += 1
+            self.reasons[reason] = self.reasons.get(reason, 0) + 1
+
+    def record_escalation(self, discarded_text):
+        with self._lock:
+            self.escalations += 1
+            self.escalation_tokens_discarded += count_tokens(discarded_text)
+
+    def stats(self) -> dict:
+        with self._lock:
+            turns = sum(self.routes.values())
+            return {
+                "turns": turns,
+                "routes": dict(self.routes),
+                "reasons": dict(self.reasons),
+                "fast_share": round(self.routes[FAST] / turns, 3) if turns else 0.0,
+                "escalations": self.escalations,
+                "escalation_tokens_discarded": self.escalation_tokens_discarded,
+            }
+
+
+routing_stats = RoutingStats()
+
+
+class _MarkerGate:
+    """
+    Holds back the start of a fast reply until it is known whether the
+    reply is a draft (starts with DRAFT_MARKER) or not.
+    """
+
+    def __init__(self):
+        self.held = []
+        self.text = ""
+        self.open = False
+
+    def push(self, chunk):
+        """Return "draft", "release" (flush held chunks) or "hold"."""
+        self.held.append(chunk)
+        self.text += chunk.text
+        if getattr(chunk.message, "tool_call_chunks", None):
+            return "release"
+        head = self.text.lstrip()
+        if head.startswith(DRAFT_MARKER):
+            return "draft"
+        if not head or DRAFT_MARKER.startswith(head):
+            return "hold"
+        return "release"
+
+    def release(self):
+        held, self.held, self.open = self.held, [], True
+        return held
+
+
+class RoutedChatModel(BaseChatModel):
+    """Chat model that serves each call from the fast or strong model (see module docstring)."""
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    fast: Any
+    strong: Any
+    policy: RoutingPolicy
+
+    @property
+    def _llm_type(self) -> str:
+        return "routed-chat"
+
+    @property
+    def _identifying_params(self) -> dict:
+        return {"fast": self.fast._identifying_params, "strong": self.strong._identifying_params}
+
+    def bind_tools(self, tools, **kwargs):
+        # Both models speak the same tool-calling format; bind the kwargs
+        # here so they reach whichever model serves the call
+        binding = self.strong.bind_tools(tools, **kwargs)
+        return self.bind(**binding.kwargs)
+
+    def _route(self, messages):
+        route, reason = classify_turn(messages, self.policy)
+        routing_stats.record_route(route, reason)
+        return route
+
+    def _is_draft(self, result: ChatResult) -> bool:
+        return bool(result.generations) and result.generations[0].text.lstrip().startswith(DRAFT_MARKER)
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        if self._route(messages) == FAST:
+            result = self.fast._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+            if not (self.policy.escalate and self._is_draft(result)):
+                return result
+            routing_stats.record_escalation(result.generations[0].text)
+        return self.strong._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        if self._route(messages) == FAST:
+            result = await self.fast._agenerate(messages, stop=stop, run_manager=run_manager, **kwargs)
+            if not (self.policy.escalate and self._is_draft(result)):
+                return result
+            routing_stats.record_escalation(result.generations[0].text)
+        return await self.strong._agenerate(messages, stop=stop, run_manager=run_manager, **kwargs)
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        if self._route(messages) == FAST:
+            gate = _MarkerGate() if self.policy.escalate else None
+            chunks = self.fast._stream(messages, stop=stop, run_manager=run_manager, **kwargs)
+            try:
+                for chunk in chunks:
+                    if gate is None or gate.open:
+                        yield chunk
+                        continue
+                    decision = gate.push(chunk)
+                    if decision == "release":
+                        yield from gate.release()
+                    elif decision == "draft":
+                        break
+                else:
+                    # A reply shorter than the marker ends while still held
+                    if gate is not None:
+                        yield from gate.release()
+                    return
+            finally:
+                # Closing the fast stream drops its upstream connection
+                chunks.close()
+            routing_stats.record_escalation(gate.text)
+        yield from self.strong._stream(messages, stop=stop, run_manager=run_manager, **kwargs)
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        if self._route(messages) == FAST:
+            gate = _MarkerGate() if self.policy.escalate else None
+            chunks = self.fast._astream(messages, stop=stop, run_manager=run_manager, **kwargs)
+            try:
+                async for chunk in chunks:
+                    if gate is None or gate.open:
+                        yield chunk
+                        continue
+                    decision = gate.push(chunk)
+                    if decision == "release":
+                        for held in gate.release():
+                            yield held
+                    elif decision == "draft":
+                        break
+                else:
+                    if gate is not None:
+                        for held in gate.release():
+                            yield held
+                    return
+            finally:
+                await chunks.aclose()
+            routing_stats.record_escalation(gate.text)
+        async for chunk in self.strong._astream(messages, stop=stop, run_manager=run_manager, **kwargs):
+            yield chunk
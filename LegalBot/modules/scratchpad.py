@@ -0,0 +1,215 @@
+"""
+Compaction of tool output in the agent scratchpad.
+
+Legal_Web_Search returns DuckDuckGo's result snippets as one blob, and the
+agent re-sends every earlier tool result on each iteration, so a couple of
+searches can dominate the prompt of every later step. Before tool results
+re-enter the prompt they are compacted:
+
+- each result is split into snippets (sentences), duplicate snippets are
+  dropped and overlong ones truncated,
+- the snippets are ranked by how many terms of the search query they
+  contain (statute and case citations count extra) and the best are kept,
+  in their original order, up to ScratchpadPolicy.tool_output_tokens,
+- across the whole scratchpad, the newest results are kept and older ones
+  are truncated, then elided, beyond ScratchpadPolicy.scratchpad_tokens.
+
+The agent executor stops after ScratchpadPolicy.max_iterations steps. So
+that the model answers instead of being cut off, the result before the
+last allowed step carries a note telling it to stop searching.
+
+Only the prompt is compacted: the tool's own output (and the tool events
+streamed to clients) is unchanged.
+"""
+
+import functools
+import re
+import threading
+from dataclasses import dataclass
+
+from langchain.agents.format_scratchpad.tools import format_to_tool_messages
+
+from .tokens import count_tokens, truncate_tokens
+
+# Longest single snippet kept, so one runaway snippet cannot fill the budget
+SNIPPET_MAX_TOKENS = 120
+
+# Stand-in for an older result dropped to fit the scratchpad budget
+ELIDED_OBSERVATION = "[Earlier search results omitted to save space.]"
+
+SEARCH_LIMIT_NOTE = "[Search limit reached. Do not search again; reply to the user with what you have.]"
+
+# Sentence ends, but not after initials or legal abbreviations ("R.S.O. 1990", "s. 134")
+_SNIPPET_BOUNDARY = re.compile(
+    r"(?<=[.!?…])(?<!\b[A-Z]\.)(?<!\bs\.)(?<!\bss\.)(?<!\bNo\.)(?<!\bv\.)(?<!\bc\.)(?<!\bArt\.)"
+    r"\s+(?=[\"'(\[A-Z0-9])"
+)
+_WORD = re.compile(r"[a-z0-9]+")
+_CITATION = re.compile(
+    r"\b(?:s{1,2}\.\s?\d+|sections?\s+\d+|[A-Z]\.?[A-Z]\.?[A-Z]?\.?\s?\d{4}|\d{4}\s+[A-Z]{2,6}\s+\d+|[A-Z][a-z]+ Act)\b"
+)
+_STOPWORDS = frozenset(
+    "a an and are as at be by for from how in is it of on or site the this to what when where which who "
+    "with canlii org justice gc ca www http https".split()
+)
+
+
+@dataclass(frozen=True)
+class ScratchpadPolicy:
+    """
+    Agent iteration and scratchpad limits; hashable so it can key caches.
+    A token limit of 0 disables that stage of the compaction.
+    """
+
+    max_iterations: int = 6
+    tool_output_tokens: int = 600
+    scratchpad_tokens: int = 2000
+
+
+def _terms(text):
+    return {word for word in _WORD.findall(text.lower()) if len(word) > 2 and word not in _STOPWORDS}
+
+
+def _normalized(snippet):
+    return " ".join(_WORD.findall(snippet.lower()))
+
+
+def split_snippets(text):
+    """Split a search result blob into sentence-sized snippets."""
+    return [snippet.strip() for snippet in _SNIPPET_BOUNDARY.split(str(text or "")) if snippet.strip()]
+
+
+def _score(snippet, query_terms):
+    return len(_terms(snippet) & query_terms) + 0.5 * len(_CITATION.findall(snippet))
+
+
+class ScratchpadStats:
+    """Tool results compacted, and the prompt tokens the compaction saved."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.results_compacted = 0
+        self.duplicates_removed = 0
+        self.snippets_dropped = 0
+        self.prompts = 0
+        self.observations_elided = 0
+        self.tokens_before = 0
+        self.tokens_after = 0
+
+    def record(self, **counts):
+        with self._lock:
+            for name, count in counts.items():
+                setattr(self, name, getattr(self, name) + count)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "results_compacted": self.results_compacted,
+                "duplicates_removed": self.duplicates_removed,
+                "snippets_dropped": self.snippets_dropped,
+                "prompts": self.prompts,
+                "observations_elided": self.observations_elided,
+                "tokens_before": self.tokens_before,
+                "tokens_after": self.tokens_after,
+                "tokens_trimmed": self.tokens_before - self.tokens_after,
+                "trim_ratio": (
+                    round(1 - self.tokens_after / self.tokens_before, 3) if self.tokens_before else 0.0
+                ),
+            }
+
+
+scratchpad_stats = ScratchpadStats()
+
+# Every iteration re-counts the same observations
+_count_tokens = functools.lru_cache(maxsize=1024)(count_tokens)
+
+
+@functools.lru_cache(maxsize=256)
+def compact_tool_output(text: str, query: str = "", budget: int = 600) -> str:
+    """
+    Deduplicate, truncate and rank the snippets of one tool result to
+    `budget` tokens (see module docstring).
+    """
+    snippets, seen, duplicates = [], set(), 0
+    for snippet in split_snippets(text):
+        key = _normalized(snippet)
+        if not key:
+            continue
+        if key in seen:
+            duplicates += 1
+            continue
+        seen.add(key)
+        snippets.append(truncate_tokens(snippet, SNIPPET_MAX_TOKENS))
+
+    query_terms = _terms(query)
+    ranked = sorted(range(len(snippets)), key=lambda index: (-_score(snippets[index], query_terms), index))
+    kept, used = set(), 0
+    for index in ranked:
+        tokens = count_tokens(snippets[index]) + 1
+        if used + tokens > budget:
+            continue
+        kept.add(index)
+        used += tokens
+    if not kept and snippets:
+        # Even the best snippet is over budget: keep what fits of it
+        best = ranked[0]
+        snippets[best] = truncate_tokens(snippets[best], budget)
+        kept.add(best)
+
+    scratchpad_stats.record(
+        results_compacted=1, duplicates_removed=duplicates, snippets_dropped=len(snippets) - len(kept),
+    )
+    return "\n".join(snippets[index] for index in sorted(kept))
+
+
+def _action_query(action) -> str:
+    tool_input = getattr(action, "tool_input", "")
+    if isinstance(tool_input, dict):
+        return str(tool_input.get("query") or " ".join(str(value) for value in tool_input.values()))
+    return str(tool_input or "")
+
+
+def compact_steps(intermediate_steps, policy: ScratchpadPolicy):
+    """
+    Return (action, observation) steps with every observation compacted
+    and the oldest ones shortened or elided to fit policy.scratchpad_tokens.
+    """
+    compacted = [
+        (action, (
+            compact_tool_output(str(observation), _action_query(action), policy.tool_output_tokens)
+            if policy.tool_output_tokens > 0 else str(observation)
+        ))
+        for action, observation in intermediate_steps
+    ]
+    remaining = policy.scratchpad_tokens if policy.scratchpad_tokens > 0 else float("inf")
+    steps, elided = [], 0
+    for position, (action, observation) in enumerate(reversed(compacted)):
+        tokens = _count_tokens(observation)
+        # The newest result is always kept, or the agent would search again
+        if position and remaining <= 0:
+            observation, elided = ELIDED_OBSERVATION, elided + 1
+        elif position and tokens > remaining:
+            observation = truncate_tokens(observation, remaining)
+        remaining -= tokens
+        steps.append((action, observation))
+    steps.reverse()
+    # One step left: it must be the answer, not another search
+    if steps and policy.max_iterations and len(steps) >= policy.max_iterations - 1:
+        action, observation = steps[-1]
+        steps[-1] = (action, f"{observation}\n\n{SEARCH_LIMIT_NOTE}")
+
+    if intermediate_steps:
+        scratchpad_stats.record(
+            prompts=1,
+            observations_elided=elided,
+            tokens_before=sum(_count_tokens(str(observation)) for _, observation in intermediate_steps),
+            tokens_after=sum(_count_tokens(observation) for _, observation in steps),
+        )
+    return steps
+
+
+def compacting_formatter(policy: ScratchpadPolicy):
+    """Scratchpad message formatter for create_tool_calling_agent that compacts tool output."""
+    def format_steps(intermediate_steps):
+        return format_to_tool_messages(compact_steps(intermediate_steps, policy))
+    return format_steps
@@ -0,0 +1,396 @@
+"""
+Cached, deduplicated and rate-limited legal web search.
+
+Legal_Web_Search queries repeat constantly across users ("ontario
+residential tenancy act notice period"), and every live DuckDuckGo search
+costs seconds and counts against its rate limit. Each search therefore:
+
+- is normalized (case, punctuation, whitespace, any site: filters the
+  model added) so trivially different queries share one cache entry,
+- is answered from a SQLite cache while its entry is younger than
+  SearchPolicy.cache_ttl; the least recently used entries are evicted
+  beyond SearchPolicy.cache_max_entries. With a cache_path the file is
+  shared by every worker process and survives restarts,
+- on a miss, runs once for all concurrent identical queries (single-flight),
+- waits for the rate limiter, a token bucket of SearchPolicy.rate searches
+  per second with bursts of SearchPolicy.burst. A search that would wait
+  longer than SearchPolicy.max_wait fails with SearchThrottled instead,
+  and when DuckDuckGo reports a rate limit no search is sent for
+  RATE_LIMIT_COOLDOWN seconds.
+
+Failed searches are never cached. With backend "stub" results are made up
+locally from the query, so the agent's tool calls run offline.
+"""
+
+import hashlib
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from dataclasses import dataclass
+
+from .singleflight import SingleFlight
+
+DUCKDUCKGO = "duckduckgo"
+STUB = "stub"
+SEARCH_BACKENDS = (DUCKDUCKGO, STUB)
+
+# Search results are restricted to official legal sources
+SITE_FILTER = "site:canlii.org OR site:justice.gc.ca"
+
+# Seconds without searches after DuckDuckGo reports a rate limit
+RATE_LIMIT_COOLDOWN = 30
+
+_SITE_OPERATOR = re.compile(r"\bsite:\S+")
+_PUNCTUATION = re.compile(r"[^\w\s.§/-]")
+_DANGLING_OR = re.compile(r"^(?:or\s+)+|(?:\s+or)+$")
+
+
+class SearchThrottled(RuntimeError):
+    """A search would have waited longer than SearchPolicy.max_wait for the rate limiter."""
+
+
+@dataclass(frozen=True)
+class SearchPolicy:
+    """
+    Search backend, cache and rate limit settings; hashable so it can key
+    caches. A cache_ttl of 0 disables the cache, a rate of 0 the limiter,
+    and an empty cache_path keeps the cache in memory.
+    """
+
+    backend: str = DUCKDUCKGO
+    cache_path: str = ""
+    cache_ttl: float = 86400
+    cache_max_entries: int = 5000
+    rate: float = 1.0
+    burst: int = 3
+    max_wait: float = 10
+    stub_latency: float = 0.0
+
+
+def normalize_query(query: str) -> str:
+    """Collapse case, punctuation, whitespace and site: filters of a search query."""
+    text = unicodedata.normalize("NFKC", str(query or "")).lower()
+    text = _PUNCTUATION.sub(" ", _SITE_OPERATOR.sub(" ", text))
+    text = re.sub(r"\s+", " ", text).strip(" .-/")
+    return _DANGLING_OR.sub("", text)
+
+
+def search_key(backend: str, query: str) -> str:
+    """Cache key of a normalized query on a backend."""
+    return hashlib.sha256(f"{backend}\n{query}".encode("utf-8")).hexdigest()
+
+
+class SearchCache:
+    """
+    SQLite cache of search results with a TTL and LRU eviction.
+
+    Every lookup goes to SQLite, so all processes sharing the file see the
+    same entries. SQLite errors (e.g. a file locked by another process for
+    too long) are counted and treated as misses.
+    """
+
+    def __init__(self, path: str = None, ttl: float = 86400, max_entries: int = 5000):
+        self.path = str(path) if path else ":memory:"
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.errors = 0
+        self._db = sqlite3.connect(self.path, check_same_thread=False, timeout=5)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS search_cache ("
+            " key TEXT PRIMARY KEY,"
+            " query TEXT NOT NULL,"
+            " results TEXT NOT NULL,"
+            " expires_at REAL NOT NULL,"
+            " last_used REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS search_cache_last_used ON search_cache (last_used)")
+        self._db.execute("DELETE FROM search_cache WHERE expires_at <= ?", (time.time(),))
+        self._db.commit()
+
+    def get(self, key: str):
+        now = time.time()
+        with self._lock:
+            try:
+                row = self._db.execute(
+                    "SELECT results FROM search_cache WHERE key = ? AND expires_at > ?", (key, now),
+                ).fetchone()
+                if row is not None:
+                    self._db.execute("UPDATE search_cache SET last_used = ? WHERE key = ?", (now, key))
+                    self._db.commit()
+            except sqlite3.Error:
+                self.errors += 1
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return row[0]
+
+    def set(self, key: str, query: str, results: str):
+        now = time.time()
+        with self._lock:
+            try:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO search_cache (key, query, results, expires_at, last_used)"
+                    " VALUES (?, ?, ?, ?, ?)",
+                    (key, query, results, now + self.ttl, now),
+                )
+                evicted = self._db.execute(
+                    "DELETE FROM search_cache WHERE expires_at <= ? OR key IN ("
+                    " SELECT key FROM search_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                    (now, self.max_entries),
+                ).rowcount
+                self._db.commit()
+            except sqlite3.Error:
+                self.errors += 1
+                return
+            self.stores += 1
+            self.evictions += evicted
+
+    def clear(self):
+        with self._lock:
+            self._db.execute("DELETE FROM search_cache")
+            self._db.commit()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            stats = {
+                "path": self.path,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+                "stores": self.stores,
+                "evictions": self.evictions,
+                "errors": self.errors,
+            }
+            try:
+                stats["entries"] = self._db.execute("SELECT COUNT(*) FROM search_cache").fetchone()[0]
+            except sqlite3.Error:
+                stats["entries"] = None
+            return stats
+
+
+class RateLimiter:
+    """Token bucket of `rate` acquisitions per second with bursts of `burst`."""
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self, max_wait: float = None) -> float:
+        """
+        Take one token, sleeping until it is available.
+
+        Returns:
+            float: seconds waited
+
+        Raises:
+            SearchThrottled: if the wait would exceed max_wait
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self._tokens + (now - self._updated) * self.rate, self.burst)
+            self._updated = now
+            # A negative balance reserves tokens for callers already waiting
+            wait = max((1 - self._tokens) / self.rate, self._paused_until - now, 0.0)
+            if max_wait is not None and wait > max_wait:
+                raise SearchThrottled(f"Search rate limit reached; retry in {wait:.0f}s")
+            self._tokens -= 1
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def pause(self, seconds: float):
+        """Hand out no tokens for the next `seconds`."""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+class DuckDuckGoBackend:
+    """Live DuckDuckGo text search through one reused API wrapper."""
+
+    name = DUCKDUCKGO
+
+    def __init__(self):
+        self._wrapper = None
+        self._lock = threading.Lock()
+
+    def _client(self):
+        with self._lock:
+            if self._wrapper is None:
+                from langchain_community.utilities import DuckDuckGoSearchAPIWrapper
+                self._wrapper = DuckDuckGoSearchAPIWrapper()
+            return self._wrapper
+
+    def search(self, query: str) -> str:
+        return self._client().run(f"{query} {SITE_FILTER}")
+
+
+_STUB_SNIPPETS = (
+    "{Topic} - CanLII. The governing statute addresses {topic} directly; see s. {section} and the regulations made under it.",
+    "Justice Laws Website: provisions on {topic} apply unless the parties agree otherwise in writing, subject to s. {section}.",
+    "In a {year} decision the court held that the requirements for {topic} must be met strictly, citing {year} ONCA {case}.",
+    "Government guidance on {topic}: a notice must be in writing, signed and delivered within the prescribed period.",
+    "Commentary on {topic} notes that the tribunal may refuse relief where the statutory requirements were not followed.",
+    "{Topic}: the limitation period runs from the day the claim was discovered, as set out in s. {section} of the Act.",
+)
+
+
+class StubSearchBackend:
+    """Offline backend returning results made up deterministically from the query."""
+
+    name = STUB
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+
+    def search(self, query: str) -> str:
+        if self.latency:
+            time.sleep(self.latency)
+        digest = int(hashlib.sha256(query.encode("utf-8")).hexdigest(), 16)
+        topic = query or "the question"
+        values = {
+            "topic": topic,
+            "Topic": topic[:1].upper() + topic[1:],
+            "section": digest % 200 + 1,
+            "year": 2000 + digest % 24,
+            "case": digest % 900 + 100,
+        }
+        start = digest % len(_STUB_SNIPPETS)
+        picked = [_STUB_SNIPPETS[(start + offset) % len(_STUB_SNIPPETS)] for offset in range(4)]
+        return " ".join(snippet.format(**values) for snippet in picked)
+
+
+class SearchStats:
+    """Searches, how they were answered and time spent waiting for the rate limiter."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.searches = 0
+        self.cache_hits = 0
+        self.coalesced = 0
+        self.upstream_calls = 0
+        self.upstream_errors = 0
+        self.throttled = 0
+        self.rate_limited = 0
+        self.rate_limit_wait_ms = 0
+        self.upstream_ms = 0
+
+    def record(self, **counts):
+        with self._lock:
+            for name, count in counts.items():
+                setattr(self, name, getattr(self, name) + count)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "searches": self.searches,
+                "cache_hits": self.cache_hits,
+                "coalesced": self.coalesced,
+                "upstream_calls": self.upstream_calls,
+                "upstream_errors": self.upstream_errors,
+                "throttled": self.throttled,
+                "rate_limited": self.rate_limited,
+                "rate_limit_wait_ms": self.rate_limit_wait_ms,
+                "avg_upstream_ms": round(self.upstream_ms / self.upstream_calls) if self.upstream_calls else 0,
+            }
+
+
+search_stats = SearchStats()
+
+
+def _is_rate_limit(error) -> bool:
+    # duckduckgo_search raises RatelimitException; matched by name so the package stays optional
+    return "ratelimit" in type(error).__name__.lower() or "202 ratelimit" in str(error).lower()
+
+
+class LegalSearch:
+    """One backend with its cache, rate limiter and in-flight searches (see module docstring)."""
+
+    def __init__(self, policy: SearchPolicy):
+        if policy.backend not in SEARCH_BACKENDS:
+            raise ValueError(f"Search backend must be one of: {', '.join(SEARCH_BACKENDS)}")
+        self.policy = policy
+        self.backend = StubSearchBackend(policy.stub_latency) if policy.backend == STUB else DuckDuckGoBackend()
+        self.cache = (
+            SearchCache(policy.cache_path, policy.cache_ttl, policy.cache_max_entries)
+            if policy.cache_ttl > 0 else None
+        )
+        self.limiter = RateLimiter(policy.rate, policy.burst) if policy.rate > 0 else None
+        self._inflight = SingleFlight()
+
+    def search(self, query: str) -> str:
+        normalized = normalize_query(query)
+        key = search_key(self.backend.name, normalized)
+        search_stats.record(searches=1)
+        if self.cache is not None:
+            results = self.cache.get(key)
+            if results is not None:
+                search_stats.record(cache_hits=1)
+                return results
+        results, shared = self._inflight.do(key, lambda: self._fetch(key, normalized))
+        if shared:
+            search_stats.record(coalesced=1)
+        return results
+
+    def _fetch(self, key, query) -> str:
+        if self.limiter is not None:
+            try:
+                waited = self.limiter.acquire(self.policy.max_wait)
+            except SearchThrottled:
+                search_stats.record(throttled=1)
+                raise
+            search_stats.record(rate_limit_wait_ms=round(waited * 1000))
+        started = time.monotonic()
+        try:
+            results = self.backend.search(query)
+        except Exception as error:
+            search_stats.record(upstream_calls=1, upstream_errors=1)
+            if _is_rate_limit(error) and self.limiter is not None:
+                search_stats.record(rate_limited=1)
+                self.limiter.pause(RATE_LIMIT_COOLDOWN)
+            raise
+        finally:
+            search_stats.record(upstream_ms=round((time.monotonic() - started) * 1000))
+        search_stats.record(upstream_calls=1)
+        if self.cache is not None:
+            self.cache.set(key, query, results)
+        return results
+
+
+_searches = {}
+_searches_lock = threading.Lock()
+
+
+def get_search(policy: SearchPolicy) -> LegalSearch:
+    """The process-wide LegalSearch for policy."""
+    with _searches_lock:
+        search = _searches.get(policy)
+        if search is None:
+            search = _searches[policy] = LegalSearch(policy)
+        return search
+
+
+def search_cache_stats() -> list:
+    with _searches_lock:
+        searches = list(_searches.values())
+    return [search.cache.stats() for search in searches if search.cache is not None]
+
+
+def reset_searches():
+    """Forget cache connections and rate limiters, e.g. after a settings change."""
+    with _searches_lock:
+        _searches.clear()
@@ -0,0 +1,92 @@
+import re
+
+# Lines that start a new section of a legal document
+_HEADING_PATTERNS = [
+    re.compile(r"^\s{0,3}#{1,6}\s+\S"),                               # Markdown heading
+    re.compile(r"^\s*(\*\*)?(ARTICLE|SECTION|SCHEDULE|PART)\b", re.I),  # ARTICLE 1, Section 2 ...
+    re.compile(r"^\s*(\*\*)?\d+(\.\d+)*[.)]\s+\S"),                   # 1. / 1.2 / 3) numbered clause
+    re.compile(r"^\s*\*\*[^*]+\*\*:?\s*$"),                             # **Bold heading**
+]
+
+_PATCH_RE = re.compile(
+    r"<<<(SECTION|INSERT AFTER) (\d+)>>>\n?(.*?)\n?<<<END>>>",
+    re.S,
+)
+
+
+def is_heading(line: str) -> bool:
+    stripped = line.strip()
+    if not stripped:
+        return False
+    if any(pattern.match(line) for pattern in _HEADING_PATTERNS):
+        return True
+    # Short ALL CAPS lines such as "TERMINATION" or "GOVERNING LAW:"
+    letters = [c for c in stripped if c.isalpha()]
+    return 3 <= len(letters) and len(stripped) <= 80 and all(c.isupper() for c in letters)
+
+
+def split_sections(document: str) -> list:
+    """
+    Split a document into sections at heading lines.
+
+    Any text before the first heading becomes its own section, and
+    "".join(split_sections(doc)) == doc.
+    """
+    sections = []
+    current = []
+    for line in document.splitlines(keepends=True):
+        if is_heading(line) and current and any(part.strip() for part in current):
+            sections.append("".join(current))
+            current = []
+        current.append(line)
+    if current:
+        sections.append("".join(current))
+    return sections
+
+
+def render_numbered_sections(sections: list) -> str:
+    """Render sections with [[SECTION n]] markers for the model to reference."""
+    return "\n".join(
+        f"[[SECTION {index}]]\n{section.rstrip()}\n"
+        for index, section in enumerate(sections, start=1)
+    )
+
+
+def parse_section_patch(text: str):
+    """
+    Parse the model's patch into (replacements, insertions).
+
+    replacements maps a 1-based section number to its new text ("" deletes
+    it); insertions maps a section number to text inserted after it (0 for
+    the very start). Returns None if the reply is not a valid patch.
+    """
+    text = (text or "").strip()
+    if text == "NO_CHANGES":
+        return {}, {}
+    matches = list(_PATCH_RE.finditer(text))
+    if not matches:
+        return None
+    # Anything outside the markers means the model did not follow the format
+    leftover = _PATCH_RE.sub("", text).strip()
+    if leftover:
+        return None
+    replacements, insertions = {}, {}
+    for kind, number, body in (match.groups() for match in matches):
+        target = insertions if kind == "INSERT AFTER" else replacements
+        target[int(number)] = body.strip("\n")
+    return replacements, insertions
+
+
+def apply_section_patch(sections: list, replacements: dict, insertions: dict) -> str:
+    """Splice a parsed patch into the sections and return the new document."""
+    count = len(sections)
+    if any(not 1 <= n <= count for n in replacements) or any(not 0 <= n <= count for n in insertions):
+        raise ValueError("Patch references a section that does not exist")
+
+    parts = [insertions[0]] if 0 in insertions else []
+    for number, section in enumerate(sections, start=1):
+        parts.append(replacements.get(number, section))
+        if number in insertions:
+            parts.append(insertions[number])
+    # Sections are separated by a single blank line; deleted ones vanish
+    return "\n\n".join(part.strip("\n") for part in parts if part.strip()) + "\n"
@@ -0,0 +1,192 @@
+import hashlib
+import re
+import threading
+
+import numpy as np
+
+from .cache import normalize_history, normalize_text
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+# Similarity histogram buckets reported by stats(), used to tune the threshold
+SCORE_BUCKETS = (0.5, 0.6, 0.7, 0.8, 0.85, 0.9, 0.95, 1.0)
+
+
+class HashedTfidfEmbedder:
+    """
+    CPU-only, fully offline text embedder.
+
+    Word unigrams, word bigrams and character trigrams are hashed into a
+    fixed number of dimensions (the "hashing trick") with sublinear term
+    frequency. Inverse document frequencies are learned incrementally from
+    the texts added to the index, so no model download is needed.
+    """
+
+    def __init__(self, dimensions: int = 2048):
+        self.dimensions = dimensions
+        self.document_frequency = np.zeros(dimensions, dtype=np.float32)
+        self.documents = 0
+
+    def _features(self, text):
+        words = _TOKEN_RE.findall(normalize_text(text).lower())
+        features = list(words)
+        features.extend(f"{a} {b}" for a, b in zip(words, words[1:]))
+        for word in words:
+            padded = f"#{word}#"
+            features.extend(padded[i:i + 3] for i in range(len(padded) - 2))
+        return features
+
+    def _bucket(self, feature):
+        digest = hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest()
+        return int.from_bytes(digest, "little") % self.dimensions
+
+    def term_frequencies(self, text) -> np.ndarray:
+        vector = np.zeros(self.dimensions, dtype=np.float32)
+        for feature in self._features(text):
+            vector[self._bucket(feature)] += 1.0
+        np.log1p(vector, out=vector)
+        return vector
+
+    def observe(self, tf: np.ndarray):
+        """Update document frequencies with a newly indexed text."""
+        self.document_frequency += tf > 0
+        self.documents += 1
+
+    def forget(self, tf: np.ndarray):
+        """Undo observe() for a text that has been evicted from the index."""
+        self.document_frequency -= tf > 0
+        self.documents -= 1
+
+    def idf(self) -> np.ndarray:
+        return np.log((1.0 + self.documents) / (1.0 + self.document_frequency)) + 1.0
+
+
+class SemanticCache:
+    """
+    Near-duplicate prompt cache over a compact NumPy matrix.
+
+    Each entry stores the term-frequency vector of its (history, input) text
+    in a preallocated float32 matrix, under a namespace naming the model and
+    prompt version that produced it. Lookups weight the matrix and the query
+    by the current IDF and return the cached answer of the most similar
+    entry in the same namespace if its cosine similarity reaches the
+    threshold. When full, the oldest entry is overwritten.
+
+    In shadow lookups a match is only counted (shadow_matches), never
+    served, so hits are answers that actually replaced an upstream call.
+    """
+
+    def __init__(self, threshold: float = 0.9, max_entries: int = 1024, dimensions: int = 2048):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.embedder = HashedTfidfEmbedder(dimensions)
+        self._lock = threading.Lock()
+        self._vectors = np.zeros((max_entries, dimensions), dtype=np.float32)
+        self._answers = [None] * max_entries
+        self._namespace_ids = np.full(max_entries, -1, dtype=np.int32)
+        self._namespaces = {}
+        self._size = 0
+        self._next = 0
+        self.hits = 0
+        self.shadow_matches = 0
+        self.misses = 0
+        self.stores = 0
+        self.last_score = None
+        self._score_histogram = [0] * len(SCORE_BUCKETS)
+
+    @staticmethod
+    def make_text(history, prompt) -> str:
+        turns = [f"{role}: {content}" for role, content in normalize_history(history)]
+        turns.append(f"input: {normalize_text(prompt)}")
+        return "\n".join(turns)
+
+    def _record_score(self, score):
+        self.last_score = score
+        for index, upper in enumerate(SCORE_BUCKETS):
+            if score <= upper:
+                self._score_histogram[index] += 1
+                break
+
+    def _namespace_id(self, namespace) -> int:
+        """Small integer for namespace; called with the lock held."""
+        return self._namespaces.setdefault(namespace, len(self._namespaces))
+
+    def lookup(self, history, prompt, namespace="", shadow=False):
+        """
+        Return (answer, similarity) for the closest cached entry in
+        namespace, with answer set to None if the similarity is below the
+        threshold or the lookup is a shadow one.
+        """
+        query = self.embedder.term_frequencies(self.make_text(history, prompt))
+        with self._lock:
+            candidates = self._namespace_ids[:self._size] == self._namespace_id(namespace)
+            if not candidates.any() or not query.any():
+                self.misses += 1
+                return None, 0.0
+
+            idf = self.embedder.idf()
+            weighted_query = query * idf
+            weighted_query /= np.linalg.norm(weighted_query)
+            matrix = self._vectors[:self._size] * idf
+            norms = np.linalg.norm(matrix, axis=1)
+            norms[norms == 0] = 1.0
+            scores = (matrix @ weighted_query) / norms
+            scores[~candidates] = -np.inf
+
+            best = int(np.argmax(scores))
+            score = float(scores[best])
+            self._record_score(score)
+            if score >= self.threshold and shadow:
+                self.shadow_matches += 1
+                return None, score
+            if score >= self.threshold:
+                self.hits += 1
+                return self._answers[best], score
+            self.misses += 1
+            return None, score
+
+    def store(self, history, prompt, answer, namespace=""):
+        tf = self.embedder.term_frequencies(self.make_text(history, prompt))
+        if not tf.any():
+            return
+        with self._lock:
+            if self._size == self.max_entries:
+                self.embedder.forget(self._vectors[self._next])
+            self._vectors[self._next] = tf
+            self._answers[self._next] = answer
+            self._namespace_ids[self._next] = self._namespace_id(namespace)
+            self.embedder.observe(tf)
+            self._next = (self._next + 1) % self.max_entries
+            self._size = min(self._size + 1, self.max_entries)
+            self.stores += 1
+
+    def clear(self):
+        with self._lock:
+            self._vectors[:] = 0
+            self._answers = [None] * self.max_entries
+            self._namespace_ids[:] = -1
+            self.embedder.document_frequency[:] = 0
+            self.embedder.documents = 0
+            self._size = 0
+            self._next = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.shadow_matches + self.misses
+            lower = 0.0
+            histogram = {}
+            for upper, count in zip(SCORE_BUCKETS, self._score_histogram):
+                histogram[f"{lower:.2f}-{upper:.2f}"] = count
+                lower = upper
+            return {
+                "threshold": self.threshold,
+                "hits": self.hits,
+                "shadow_matches": self.shadow_matches,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "stores": self.stores,
+                "entries": self._size,
+                "matrix_bytes": int(self._vectors.nbytes),
+                "last_score": self.last_score,
+                "score_histogram": histogram,
+            }
@@ -0,0 +1,173 @@
+"""
+Request coalescing ("single-flight").
+
+Concurrent calls with the same key share one execution: the first caller
+(the leader) runs the function, later callers wait for it and receive the
+same result or exception. Sync and async callers can share a flight, e.g.
+a DRF request and an ASGI request for the same prompt.
+
+Followers wait at most `timeout` seconds, so a hung leader cannot hold
+them forever, and call `check()` every POLL_INTERVAL seconds while they
+wait, which lets a follower whose own request was cancelled stop early by
+raising from it. Either way only the follower leaves; the leader's call
+carries on.
+"""
+
+import asyncio
+import threading
+import time
+
+# Seconds between check() calls of a waiting follower
+POLL_INTERVAL = 0.1
+
+
+class FlightTimeout(TimeoutError):
+    """A follower gave up waiting for the leader's call."""
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.abandoned = False
+        self.async_waiters = []  # (loop, future) pairs of async followers
+
+
+class SingleFlight:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    def _join(self, key):
+        """Return (call, is_leader) for key."""
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                self.coalesced += 1
+                return call, False
+            call = self._calls[key] = _Call()
+            self.leaders += 1
+            return call, True
+
+    def _finish(self, key, call, result=None, error=None, abandoned=False):
+        with self._lock:
+            self._calls.pop(key, None)
+            call.result, call.error, call.abandoned = result, error, abandoned
+            call.done.set()
+            waiters, call.async_waiters = call.async_waiters, []
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(_resolve, future)
+
+    @staticmethod
+    def _wait_step(deadline, check):
+        """Run check() and return how long to wait next; raise once the deadline passed."""
+        if check is not None:
+            check()
+        if deadline is None:
+            return POLL_INTERVAL
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise FlightTimeout("Timed out waiting for a shared call")
+        return min(POLL_INTERVAL, remaining)
+
+    def _wait(self, call, timeout, check):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not call.done.is_set():
+            call.done.wait(self._wait_step(deadline, check))
+
+    async def _await(self, call, timeout, check):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self._lock:
+            if call.done.is_set():
+                return
+            call.async_waiters.append((loop, future))
+        deadline = None if timeout is None else time.monotonic() + timeout
+        try:
+            while not future.done():
+                step = self._wait_step(deadline, check)
+                try:
+                    await asyncio.wait_for(asyncio.shield(future), step)
+                except asyncio.TimeoutError:
+                    pass
+        except BaseException:
+            # Leaving early: the leader must not resolve a future on a loop that may be gone
+            with self._lock:
+                if (loop, future) in call.async_waiters:
+                    call.async_waiters.remove((loop, future))
+            raise
+
+    @staticmethod
+    def _outcome(call):
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def do(self, key, fn, timeout=None, check=None):
+        """
+        Run fn() once for all concurrent callers with this key.
+
+        Followers wait at most timeout seconds and call check() while they
+        wait (see module docstring).
+
+        Returns:
+            tuple: (result, shared) where shared is True for followers
+
+        Raises:
+            FlightTimeout: if a follower's wait times out
+        """
+        call, leader = self._join(key)
+        if not leader:
+            self._wait(call, timeout, check)
+            if call.abandoned:
+                return self.do(key, fn, timeout, check)
+            return self._outcome(call), True
+        try:
+            result = fn()
+        except Exception as error:
+            self._finish(key, call, error=error)
+            raise
+        except BaseException:
+            # The leader was interrupted; followers retry on their own
+            self._finish(key, call, abandoned=True)
+            raise
+        self._finish(key, call, result=result)
+        return result, False
+
+    async def ado(self, key, coroutine_fn, timeout=None, check=None):
+        """Async variant of do() taking a coroutine function."""
+        call, leader = self._join(key)
+        if not leader:
+            await self._await(call, timeout, check)
+            if call.abandoned:
+                return await self.ado(key, coroutine_fn, timeout, check)
+            return self._outcome(call), True
+        try:
+            result = await coroutine_fn()
+        except Exception as error:
+            self._finish(key, call, error=error)
+            raise
+        except BaseException:
+            # Cancelled (e.g. the client disconnected); followers retry
+            self._finish(key, call, abandoned=True)
+            raise
+        self._finish(key, call, result=result)
+        return result, False
+
+    def stats(self) -> dict:
+        with self._lock:
+            calls = self.leaders + self.coalesced
+            return {
+                "leaders": self.leaders,
+                "coalesced": self.coalesced,
+                "coalesced_rate": self.coalesced / calls if calls else 0.0,
+                "in_flight": len(self._calls),
+            }
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
@@ -0,0 +1,62 @@
+"""
+Token counting helpers.
+
+Uses tiktoken when it is installed and its encoding is available locally;
+otherwise falls back to a character-based estimate (about four characters
+per token), which is close enough for budgeting prompts.
+"""
+
+import functools
+
+try:
+    import tiktoken
+except ImportError:  # pragma: no cover - optional dependency
+    tiktoken = None
+
+CHARS_PER_TOKEN = 4
+# Per-message overhead of the chat format (role markers, separators)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+@functools.lru_cache(maxsize=1)
+def _get_encoding():
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception:
+        # The encoding file may need a download that is unavailable offline
+        return None
+
+
+def count_tokens(text: str) -> int:
+    text = str(text or "")
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def count_message_tokens(messages) -> int:
+    """Count tokens for a list of LangChain messages."""
+    return sum(count_tokens(message.content) + MESSAGE_OVERHEAD_TOKENS for message in messages)
+
+
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    """The longest prefix of text within max_tokens, cut at a word boundary."""
+    text = str(text or "")
+    if max_tokens <= 0:
+        return ""
+    encoding = _get_encoding()
+    if encoding is not None:
+        tokens = encoding.encode(text, disallowed_special=())
+        if len(tokens) <= max_tokens:
+            return text
+        prefix = encoding.decode(tokens[:max_tokens])
+    else:
+        if len(text) <= max_tokens * CHARS_PER_TOKEN:
+            return text
+        prefix = text[:max_tokens * CHARS_PER_TOKEN]
+    # Drop the partial word at the cut, unless that would drop everything
+    cut = prefix.rsplit(None, 1)[0] if " " in prefix.strip() else prefix
+    return cut.rstrip()
@@ -1,8 +1,13 @@
-from langchain_community.tools import DuckDuckGoSearchRun
+import asyncio
+
 from langchain.tools import BaseTool
-from typing import Type
+from typing import Optional, Type
 from pydantic import BaseModel, Field
 
+from .cassette import CassettePolicy, cassette_tool
+from .legal_index import CorpusPolicy, corpus_lookup, format_hits
+from .search import SearchPolicy, get_search
+
 class LegalSearchInput(BaseModel):
     query: str = Field(description="A detailed search query to find information on Canadian legal topics.")
 
@@ -10,20 +15,66 @@ class LegalWebSearchTool(BaseTool):
     name: str = "Legal_Web_Search"
     description: str = "Use this tool to search the web for Canadian legal information, including statutes and case law. It is focused on official government and legal institute sources."
     args_schema: Type[BaseModel] = LegalSearchInput
+    policy: SearchPolicy = SearchPolicy()
+    cassette: Optional[CassettePolicy] = None
 
     def _run(self, query: str):
-        """Executes the web search using DuckDuckGo."""
-        # Append the site filter to the user's query
-        scoped_query = f"{query} site:canlii.org OR site:justice.gc.ca"
-        
-        # Initialize the DuckDuckGo search tool
-        ddg_search = DuckDuckGoSearchRun()
-        
+        """
+        Executes the web search, scoped to CanLII and the Justice Laws site.
+
+        Results are cached and concurrent identical searches share one
+        request (see modules/search.py). With a cassette the output is
+        recorded, or replayed without searching (see modules/cassette.py).
+        """
+        if self.cassette is not None:
+            return cassette_tool(self.cassette, self.name, query, lambda: self._search(query))
+        return self._search(query)
+
+    def _search(self, query: str):
+        try:
+            return get_search(self.policy).search(query)
+        except Exception as e:
+            return f"An error occurred during the search: {e}"
+
+    async def _arun(self, query: str):
+        """
+        Executes the web search without blocking the event loop.
+
+        The DuckDuckGo client is synchronous, so the search runs in a worker
+        thread while the loop keeps serving other requests.
+        """
+        return await asyncio.to_thread(self._run, query)
+
+
+class LegalCorpusSearchTool(BaseTool):
+    name: str = "Legal_Corpus_Search"
+    description: str = "Use this tool first to look up Canadian statutes and regulations. It searches a local legal library in milliseconds and searches the web by itself when the library has nothing relevant."
+    args_schema: Type[BaseModel] = LegalSearchInput
+    policy: CorpusPolicy
+    search_policy: SearchPolicy = SearchPolicy()
+    cassette: Optional[CassettePolicy] = None
+
+    def _run(self, query: str):
+        """
+        Searches the local BM25 index (see modules/legal_index.py), falling
+        back to the web search when too few query terms are matched. With a
+        cassette the output is recorded or replayed like the web search's.
+        """
+        if self.cassette is not None:
+            return cassette_tool(self.cassette, self.name, query, lambda: self._search(query))
+        return self._search(query)
+
+    def _search(self, query: str):
+        hits, enough = corpus_lookup(query, self.policy)
+        if enough:
+            return format_hits(hits)
         try:
-            results = ddg_search.run(scoped_query)
-            return results
+            return get_search(self.search_policy).search(query)
         except Exception as e:
+            if hits:
+                return format_hits(hits)
             return f"An error occurred during the search: {e}"
 
-    def _arun(self, query: str):
-        raise NotImplementedError("LegalWebSearchTool does not support async")
+    async def _arun(self, query: str):
+        """Runs _run in a worker thread; the web fallback is synchronous."""
+        return await asyncio.to_thread(self._run, query)
@@ -7,6 +7,7 @@ Tests all the converted Streamlit functionality.
 import requests
 import json
 import sys
+import time
 from pathlib import Path
 
 # API base URL
@@ -228,6 +229,39 @@ Emily Jane Smith
         print(f"❌ Document operations error: {e}")
         return False
 
+BENCHMARK_CALLS = {
+    "generate": ("/api/ai/generate/", {
+        "prompt": "I need a residential lease for a property in Toronto. Please draft it now.",
+        "conversation_history": [],
+    }),
+    "refine": ("/api/ai/refine/", {
+        "current_draft": "LEASE AGREEMENT\n\n1. PARTIES\n\nJohn Smith and Jane Doe.\n\n2. RENT\n\nRent is $2,000 per month.",
+        "user_request": "Add a clause allowing one small pet",
+    }),
+}
+
+def benchmark_ai_endpoints(calls=20):
+    """
+    Time the AI endpoints end to end with the response cache bypassed.
+    Run the server with AI_LLM_BACKEND=fake (or against
+    modules/fake_llm_server.py) to measure the Django stack, the agent
+    loop and the cleaning pipeline without provider latency.
+    """
+    print(f"⏱️ Benchmarking AI endpoints ({calls} calls each)...")
+    health = requests.get(f"{BASE_URL}/api/ai/health/").json()
+    print(f"LLM backend: {health.get('llm_backend', 'unknown')}")
+    for name, (path, payload) in BENCHMARK_CALLS.items():
+        timings, failures = [], 0
+        for _ in range(calls):
+            started = time.perf_counter()
+            response = requests.post(f"{BASE_URL}{path}", json=payload, headers={"Cache-Control": "no-cache"})
+            timings.append((time.perf_counter() - started) * 1000)
+            failures += response.status_code != 200
+        timings.sort()
+        p50 = timings[len(timings) // 2]
+        p95 = timings[min(int(len(timings) * 0.95), len(timings) - 1)]
+        print(f"{name:>8}: p50 {p50:.1f} ms  p95 {p95:.1f} ms  max {timings[-1]:.1f} ms  failures {failures}")
+
 def main():
     """Run all API tests."""
     print("🚀 Starting LegalBot API Tests")
@@ -276,4 +310,7 @@ def main():
         print("5. Check Django logs for detailed error messages")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    if len(sys.argv) > 1 and sys.argv[1] == "--benchmark":
+        benchmark_ai_endpoints(int(sys.argv[2]) if len(sys.argv) > 2 else 20)
+    else:
+        main()
\ No newline at end of file
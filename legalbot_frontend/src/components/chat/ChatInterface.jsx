@@ -119,20 +119,11 @@ export default function ChatInterface() {
       // Save user message to backend (this will also add it to local state)
       await addMessage(userMessage);
 
-      // Prepare conversation history for AI
-      const conversationHistory = messages.map(msg => ({
-        role: msg.role,
-        content: msg.content
-      }));
-      conversationHistory.push({
-        role: 'user',
-        content: data.message.trim()
-      });
-
-      // Generate AI response
+      // Generate AI response; the backend reads the conversation history
+      // from the session's saved messages
       const aiResponse = await generateDocument({
         prompt: data.message.trim(),
-        conversation_history: conversationHistory
+        session: currentSession.id
       });
 
       const assistantMessage = {